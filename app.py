@@ -11,7 +11,11 @@ from routes_inventory import init_inventory_routes
 from routes_services import init_services_routes
 from routes_appointments import init_appointments_routes
 from routes_calendar import init_calendar_routes
-from utils.sms_service import SMSService, send_appointment_reminder, send_appointment_confirmation, send_verification_code
+from routes_sms import init_sms_routes
+from routes_campaigns import init_campaign_routes
+from utils.sms_service import sms_service, send_appointment_reminder, send_appointment_confirmation, send_verification_code
+from utils.template_store import DEFAULT_REMINDER_TEMPLATE, OLD_DEFAULT_REMINDER_TEMPLATE
+
 
 def create_app():
     app = Flask(__name__)
@@ -212,7 +216,8 @@ def create_app():
             return PGConn(DATABASE_URL)
 
     else:
-        DB_PATH = os.path.join(os.path.dirname(__file__), 'db', 'users.db')
+        # SQLITE_PATH points the app at another SQLite file (tests build a throwaway schema with it)
+        DB_PATH = os.environ.get('SQLITE_PATH') or os.path.join(os.path.dirname(__file__), 'db', 'users.db')
         os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
         def get_db():
@@ -289,6 +294,157 @@ def create_app():
             except Exception as e:
                 print(f"Error adding address column: {e}")
                 conn.rollback()
+
+        # Provider message id (e.g. Twilio SID) for each SMS log row
+        c.execute("PRAGMA table_info(sms_logs)")
+        sms_log_columns = [column[1] for column in c.fetchall()]
+        if sms_log_columns and 'provider_message_id' not in sms_log_columns:
+            try:
+                c.execute('ALTER TABLE sms_logs ADD COLUMN provider_message_id TEXT')
+                conn.commit()
+                print("Added provider_message_id column to sms_logs table")
+            except Exception as e:
+                print(f"Error adding provider_message_id column: {e}")
+                conn.rollback()
+
+        # The old default reminder rendered to ~200 characters (2 SMS); replace it unless edited
+        try:
+            c.execute('''UPDATE sms_templates SET template_content = ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE template_name = 'appointment_reminder' AND template_content = ?''',
+                      (DEFAULT_REMINDER_TEMPLATE, OLD_DEFAULT_REMINDER_TEMPLATE))
+            if c.rowcount:
+                print("Shortened the default appointment_reminder SMS template")
+            conn.commit()
+        except Exception as e:
+            print(f"Error updating appointment_reminder template: {e}")
+            conn.rollback()
+
+        # Encoding and billable segment count of each SMS (utils/sms_encoding.py)
+        # Compact log storage references a template plus values (utils/sms_log_store.py)
+        for column, ddl in (('segments', 'INTEGER'), ('encoding', 'TEXT'),
+                            ('template_id', 'INTEGER'), ('template_vars', 'TEXT')):
+            if sms_log_columns and column not in sms_log_columns:
+                try:
+                    c.execute(f'ALTER TABLE sms_logs ADD COLUMN {column} {ddl}')
+                    conn.commit()
+                    print(f"Added {column} column to sms_logs table")
+                except Exception as e:
+                    print(f"Error adding {column} column: {e}")
+                    conn.rollback()
+
+        # Delivery receipts (routes_sms.sms_status_callback) update sms_logs by provider SID
+        try:
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_sms_logs_provider_message_id
+                        ON sms_logs (provider_message_id)''')
+            conn.commit()
+        except Exception as e:
+            print(f"Error creating sms_logs provider_message_id index: {e}")
+            conn.rollback()
+
+        # Appointment indexes used by the calendar feed and the list views. The appointments
+        # table is not created by init_db, so skip quietly if it doesn't exist yet.
+        try:
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_appointments_date
+                        ON appointments (appointment_date, appointment_time)''')
+            # Keyset pages of the admin list filtered by status or service seek on
+            # (filter, date, time, id); the rowid completes each key.
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_appointments_status_date
+                        ON appointments (status, appointment_date, appointment_time)''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_appointments_service_date
+                        ON appointments (service, appointment_date, appointment_time)''')
+            conn.commit()
+        except Exception as e:
+            print(f"Error creating appointment indexes: {e}")
+            conn.rollback()
+
+        # Archive lists page on (archived_at, id); the tables are created on first archive.
+        for table in ('archived_appointments', 'archived_users'):
+            try:
+                c.execute(f'''CREATE INDEX IF NOT EXISTS idx_{table}_archived_at
+                            ON {table} (archived_at)''')
+                conn.commit()
+            except Exception as e:
+                print(f"Error creating {table} index: {e}")
+                conn.rollback()
+
+        # Change-feed triggers: every insert/update/delete on appointments (including status
+        # changes, archives and restores) gets a row in appointment_changes.
+        try:
+            c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_change_insert
+                        AFTER INSERT ON appointments
+                        BEGIN
+                            INSERT INTO appointment_changes (appointment_id, change_type) VALUES (NEW.id, 'insert');
+                        END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_change_update
+                        AFTER UPDATE ON appointments
+                        BEGIN
+                            INSERT INTO appointment_changes (appointment_id, change_type) VALUES (NEW.id, 'update');
+                        END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_change_delete
+                        AFTER DELETE ON appointments
+                        BEGIN
+                            INSERT INTO appointment_changes (appointment_id, change_type) VALUES (OLD.id, 'delete');
+                        END''')
+            conn.commit()
+        except Exception as e:
+            print(f"Error creating appointment change triggers: {e}")
+            conn.rollback()
+
+        # Every write to inventory_transactions bumps its table_versions row, which keys the
+        # cached transaction list total (routes_inventory.inventory_transactions)
+        try:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_inventory_transactions_version_{event.lower()}
+                            AFTER {event} ON inventory_transactions
+                            BEGIN
+                                INSERT INTO table_versions (table_name, version) VALUES ('inventory_transactions', 1)
+                                ON CONFLICT (table_name) DO UPDATE SET version = version + 1;
+                            END''')
+            conn.commit()
+        except Exception as e:
+            print(f"Error creating inventory transaction version triggers: {e}")
+            conn.rollback()
+
+        # Occupancy triggers keep calendar_occupancy (booked appointments per date/slot) in step
+        # with every booking write. Cancelled appointments don't occupy a slot. Times are stored
+        # as '7:00' by the booking form and '07:00' by the admin form, hence the ltrim.
+        try:
+            c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_occupancy_insert
+                        AFTER INSERT ON appointments
+                        WHEN NEW.status IS NULL OR NEW.status != 'cancelled'
+                        BEGIN
+                            INSERT INTO calendar_occupancy (slot_date, slot_time, booked)
+                            VALUES (NEW.appointment_date, ltrim(NEW.appointment_time, '0'), 1)
+                            ON CONFLICT (slot_date, slot_time) DO UPDATE SET booked = booked + 1;
+                        END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_occupancy_delete
+                        AFTER DELETE ON appointments
+                        WHEN OLD.status IS NULL OR OLD.status != 'cancelled'
+                        BEGIN
+                            UPDATE calendar_occupancy SET booked = MAX(booked - 1, 0)
+                            WHERE slot_date = OLD.appointment_date AND slot_time = ltrim(OLD.appointment_time, '0');
+                        END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS trg_appointments_occupancy_update
+                        AFTER UPDATE OF appointment_date, appointment_time, status ON appointments
+                        BEGIN
+                            UPDATE calendar_occupancy SET booked = MAX(booked - 1, 0)
+                            WHERE slot_date = OLD.appointment_date AND slot_time = ltrim(OLD.appointment_time, '0')
+                              AND (OLD.status IS NULL OR OLD.status != 'cancelled');
+                            INSERT INTO calendar_occupancy (slot_date, slot_time, booked)
+                            SELECT NEW.appointment_date, ltrim(NEW.appointment_time, '0'), 1
+                            WHERE NEW.status IS NULL OR NEW.status != 'cancelled'
+                            ON CONFLICT (slot_date, slot_time) DO UPDATE SET booked = booked + 1;
+                        END''')
+            conn.commit()
+
+            # Backfill once (or after the table was cleared) from the existing appointments
+            c.execute('SELECT COUNT(*) FROM calendar_occupancy')
+            if (c.fetchone()[0] or 0) == 0:
+                from utils.booking_slots import rebuild_occupancy
+                rebuild_occupancy(conn)
+        except Exception as e:
+            print(f"Error creating appointment occupancy triggers: {e}")
+            conn.rollback()
     def init_db():
         conn = get_db()
         c = conn.cursor()
@@ -329,6 +485,14 @@ def create_app():
         c.execute('''CREATE INDEX IF NOT EXISTS idx_user_activity_time 
                     ON user_activity (activity_time)''')
         
+        # Daily totals of pruned user_activity rows (utils/retention.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS user_activity_daily (
+            day TEXT NOT NULL,
+            activity_type TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, activity_type)
+        )''')
+
         # Vaccine Schedules table
         c.execute('''CREATE TABLE IF NOT EXISTS vaccine_schedules (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -415,6 +579,17 @@ def create_app():
                     ON inventory_transactions (item_id)''')
         c.execute('''CREATE INDEX IF NOT EXISTS idx_inventory_transactions_date 
                     ON inventory_transactions (created_at)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_inventory_transactions_item_date
+                    ON inventory_transactions (item_id, created_at)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_inventory_transactions_type_date
+                    ON inventory_transactions (transaction_type, created_at)''')
+
+        # Write counters for tables whose list totals are cached (utils/keyset_pager.cached_count);
+        # bumped by triggers (see update_db_schema), so checking for changes is a key lookup
+        c.execute('''CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )''')
         
         # FAQ table
         c.execute('''CREATE TABLE IF NOT EXISTS faq (
@@ -434,6 +609,24 @@ def create_app():
         c.execute('''CREATE INDEX IF NOT EXISTS idx_faq_order
                     ON faq (display_order)''')
 
+        # Appointment change feed (populated by triggers, see update_db_schema).
+        # AUTOINCREMENT keeps seq strictly increasing so it can be used as a sync cursor.
+        c.execute('''CREATE TABLE IF NOT EXISTS appointment_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            appointment_id INTEGER NOT NULL,
+            change_type TEXT NOT NULL, -- 'insert', 'update', 'delete'
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        # Per-day/per-slot occupancy for the calendar heatmap (maintained by triggers,
+        # see update_db_schema). The primary key doubles as the month range index.
+        c.execute('''CREATE TABLE IF NOT EXISTS calendar_occupancy (
+            slot_date TEXT NOT NULL,
+            slot_time TEXT NOT NULL,
+            booked INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (slot_date, slot_time)
+        )''')
+
         # SMS Settings table
         c.execute('''CREATE TABLE IF NOT EXISTS sms_settings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -456,13 +649,104 @@ def create_app():
             phone_number TEXT NOT NULL,
             message_type TEXT NOT NULL, -- 'appointment_reminder', 'appointment_confirmation', 'vaccine_reminder', 'verification', 'marketing'
             message_content TEXT NOT NULL,
-            status TEXT DEFAULT 'pending', -- 'pending', 'sent', 'failed', 'delivered'
+            status TEXT DEFAULT 'pending', -- 'pending', 'sent', 'failed', 'delivered', 'merged' (sent within a digest)
             provider_response TEXT,
+            provider_message_id TEXT,
+            segments INTEGER, -- billable SMS parts (utils/sms_encoding.py)
+            encoding TEXT, -- 'GSM-7' or 'UCS-2'
+            template_id INTEGER, -- compact rows: sms_log_templates.id, message_content left empty
+            template_vars TEXT, -- compact rows: JSON values to render the template with
             sent_at TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE SET NULL
         )''')
 
+        # Daily totals of pruned sms_logs rows (utils/retention.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS sms_log_daily (
+            day TEXT NOT NULL,
+            message_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            segments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, message_type, status)
+        )''')
+
+        # Template bodies referenced by compact sms_logs rows (utils/sms_log_store.py);
+        # rows are only ever added, so old logs keep rebuilding to the text that was sent
+        c.execute('''CREATE TABLE IF NOT EXISTS sms_log_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        # SMS outbox: messages waiting for the worker (see utils/sms_outbox.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS sms_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phone_number TEXT NOT NULL,
+            body TEXT NOT NULL,
+            message_type TEXT NOT NULL DEFAULT 'general',
+            channel TEXT NOT NULL DEFAULT 'sms', -- 'sms' or 'verify' (Twilio Verify OTP)
+            status TEXT NOT NULL DEFAULT 'queued', -- 'queued', 'sending', 'sent', 'dead'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            next_attempt_at TIMESTAMP NOT NULL,
+            locked_by TEXT,
+            locked_until TIMESTAMP,
+            last_error TEXT,
+            provider_message_id TEXT,
+            sms_log_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_sms_outbox_due
+                    ON sms_outbox (status, next_attempt_at)''')
+
+        # One row per appointment reminder claimed by the scheduler (utils/reminder_scheduler.py);
+        # the primary key keeps concurrent scheduler runs from reminding twice.
+        c.execute('''CREATE TABLE IF NOT EXISTS appointment_reminders_sent (
+            appointment_id INTEGER NOT NULL,
+            reminder_type TEXT NOT NULL DEFAULT 'appointment_reminder',
+            status TEXT NOT NULL DEFAULT 'claimed', -- 'claimed', 'queued', 'skipped'
+            outbox_id INTEGER,
+            claimed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (appointment_id, reminder_type)
+        )''')
+
+        # Bulk SMS campaigns (utils/sms_campaigns.py): one row per campaign plus its
+        # materialized audience. Recipient status moves pending -> queued (in the outbox) or
+        # skipped/cancelled; delivery progress is read from the linked outbox rows.
+        c.execute('''CREATE TABLE IF NOT EXISTS sms_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            template_name TEXT,
+            body TEXT NOT NULL,
+            segment TEXT NOT NULL DEFAULT 'marketing', -- opt-in column: 'marketing' or 'general'
+            service_filter TEXT,
+            status TEXT NOT NULL DEFAULT 'draft', -- 'draft', 'running', 'dispatched', 'cancelled'
+            total_recipients INTEGER NOT NULL DEFAULT 0,
+            rate_per_minute REAL,
+            locked_by TEXT,
+            locked_until TIMESTAMP,
+            created_by TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            dispatched_at TIMESTAMP
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS sms_campaign_recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            user_id INTEGER,
+            name TEXT,
+            phone_number TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'queued', 'skipped', 'cancelled'
+            outbox_id INTEGER,
+            UNIQUE (campaign_id, phone_number),
+            FOREIGN KEY (campaign_id) REFERENCES sms_campaigns (id) ON DELETE CASCADE
+        )''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_sms_campaign_recipients_status
+                    ON sms_campaign_recipients (campaign_id, status, id)''')
+
         # SMS Templates table
         c.execute('''CREATE TABLE IF NOT EXISTS sms_templates (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -507,7 +791,7 @@ def create_app():
         if c.fetchone()['count'] == 0:
             default_templates = [
                 ('appointment_reminder', 'appointment_reminder',
-                 'Hi {{name}}! Reminder: You have an appointment scheduled for {{service}} on {{date}} at {{time}}. Please arrive 15 minutes early. Contact us at 0953 7207 342 if you need to reschedule.', 1),
+                 DEFAULT_REMINDER_TEMPLATE, 1),
                 ('appointment_confirmation', 'appointment_confirmation',
                  'Hi {{name}}! Your appointment for {{service}} on {{date}} at {{time}} has been confirmed. See you soon! Contact: 0953 7207 342', 1),
                 ('vaccine_reminder', 'vaccine_reminder',
@@ -546,6 +830,10 @@ def create_app():
             ]
             c.executemany('INSERT INTO faq (question, answer, category, is_active, display_order) VALUES (?, ?, ?, ?, ?)', default_faqs)
 
+        # Persist the seed rows and release the write lock before update_db_schema runs
+        conn.commit()
+        conn.close()
+
     # Initialize database and routes.
     # If DATABASE_URL is set we assume a managed DB will be used and skip the automatic SQLite init.
     with app.app_context():
@@ -561,6 +849,8 @@ def create_app():
         init_services_routes(app, get_db)
         init_appointments_routes(app, get_db)
         init_calendar_routes(app, get_db)
+        init_sms_routes(app, get_db)
+        init_campaign_routes(app, get_db)
     
     # Add datetime filter to Jinja2 environment
     def datetimeformat(value, format='%Y-%m-%d %H:%M'):
@@ -578,8 +868,8 @@ def create_app():
 
     app.jinja_env.filters['datetimeformat'] = datetimeformat
 
-    # Initialize SMS service
-    sms_service = SMSService(app)
+    # Initialize the shared SMS service used by the send_* helpers
+    sms_service.init_app(app)
 
     return app
 
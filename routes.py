@@ -1,7 +1,7 @@
 from flask import render_template, request, redirect, url_for, session, flash, current_app, abort, send_file, make_response, jsonify, send_from_directory
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_mail import Message
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import sqlite3
 import os
 import re
@@ -9,6 +9,10 @@ from io import BytesIO
 from io import StringIO
 import csv
 from utils.pdf_generator import generate_vaccine_record_pdf
+from utils.activity_log import log_activity
+from utils.keyset_pager import keyset_page
+from utils.rate_limit import (AVAILABILITY_LIMITS, LOGIN_ID_LIMITS, LOGIN_IP_LIMITS, client_ip, form_field,
+                              rate_limit)
 from functools import wraps
 import json
 
@@ -236,6 +240,7 @@ def init_routes(app, get_db, mail, serializer):
 
         return render_template('admin_faq_form.html', faq=faq, categories=categories)
     @app.route('/check-username', methods=['POST'])
+    @rate_limit((client_ip('check'), AVAILABILITY_LIMITS))
     def check_username():
         try:
             data = request.get_json()
@@ -265,6 +270,7 @@ def init_routes(app, get_db, mail, serializer):
             return jsonify({'available': False, 'error': 'Server error'})
 
     @app.route('/check-email', methods=['POST'])
+    @rate_limit((client_ip('check'), AVAILABILITY_LIMITS))
     def check_email():
         try:
             data = request.get_json()
@@ -734,6 +740,7 @@ def init_routes(app, get_db, mail, serializer):
                 
                 # Get the appointment ID for the confirmation
                 appointment_id = c.lastrowid
+                log_activity(get_db, 'booking', session['user_id'], request)
                 
                 # Send SMS confirmation if enabled
                 try:
@@ -788,7 +795,14 @@ def init_routes(app, get_db, mail, serializer):
     def first_aid_donts():
         return render_template('first_aid_donts.html')
 
+    def login_limited(decision):
+        minutes = max(1, round(decision.retry_after / 60))
+        flash(f'Too many login attempts. Please try again in {minutes} minute(s).', 'danger')
+        return render_template('login.html'), 429
+
     @app.route('/login', methods=['GET', 'POST'])
+    @rate_limit((client_ip('login'), LOGIN_IP_LIMITS), (form_field('login', 'identifier'), LOGIN_ID_LIMITS),
+                on_limited=login_limited)
     def login():
         if request.method == 'POST':
             identifier = request.form['identifier']  # Can be username or email
@@ -841,6 +855,7 @@ def init_routes(app, get_db, mail, serializer):
                          (datetime.now().isoformat(), user['id']))
                 conn.commit()
                 conn.close()
+                log_activity(get_db, 'login', user['id'], request)
                 next_url = request.args.get('next')
                 if next_url:
                     return redirect(next_url)
@@ -1566,6 +1581,7 @@ def init_routes(app, get_db, mail, serializer):
             try:
                 c.execute(query, tuple(params))
                 conn.commit()
+                log_activity(get_db, 'profile_update', user_id, request)
                 flash('Profile updated successfully!', 'success')
                 # Update session with new name and email
                 if name:
@@ -1627,8 +1643,7 @@ def init_routes(app, get_db, mail, serializer):
 
         # Validate phone number if provided
         if phone_number:
-            from utils.sms_service import SMSService
-            sms_service = SMSService(current_app)
+            from utils.sms_service import sms_service
             if not sms_service.validate_phone_number(phone_number):
                 flash('Please enter a valid Philippine mobile number (09XXXXXXXXX).', 'danger')
                 return redirect(url_for('edit_profile'))
@@ -1671,6 +1686,7 @@ def init_routes(app, get_db, mail, serializer):
                      vaccine_reminders, general_notifications, marketing_messages))
 
             conn.commit()
+            log_activity(get_db, 'sms_settings_update', user_id, request)
             flash('SMS settings updated successfully!', 'success')
 
         except Exception as e:
@@ -1797,6 +1813,7 @@ def init_routes(app, get_db, mail, serializer):
             # Update status to cancelled
             c.execute('UPDATE appointments SET status = ?, updated_at = ? WHERE id = ?', ('cancelled', datetime.now().isoformat(), booking_id))
             conn.commit()
+            log_activity(get_db, 'cancel', user_id, request)
 
             # Optionally send SMS notification for cancellation if patient_phone exists
             try:
@@ -1805,7 +1822,7 @@ def init_routes(app, get_db, mail, serializer):
                     try:
                         from utils.sms import send_message
                         msg = f"Your appointment on {row['appointment_date'] if isinstance(row, dict) else row[4]} at {row['appointment_time'] if isinstance(row, dict) else row[5]} has been cancelled."
-                        send_message(patient_phone, msg)
+                        send_message(patient_phone, msg, message_type='appointment_cancellation')
                     except Exception:
                         # don't fail the cancellation if SMS sending fails
                         pass
@@ -1833,12 +1850,14 @@ def init_routes(app, get_db, mail, serializer):
         # Get active users today
         active_today = 0
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
+            # a range on activity_time (not date(activity_time)) so idx_user_activity_time is used;
+            # rows are stamped in UTC, so the server's local midnight is converted to UTC first
+            start = datetime.combine(datetime.now().date(), datetime.min.time()).astimezone(timezone.utc).replace(tzinfo=None)
             c.execute('''
                 SELECT COUNT(DISTINCT user_id)
                 FROM user_activity
-                WHERE date(activity_time) = ?
-            ''', (today,))
+                WHERE activity_time >= ? AND activity_time < ?
+            ''', (start.strftime('%Y-%m-%d %H:%M:%S'), (start + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')))
             result = c.fetchone()
             active_today = result[0] if result and result[0] is not None else 0
         except sqlite3.OperationalError:
@@ -2403,6 +2422,7 @@ def init_routes(app, get_db, mail, serializer):
                         data TEXT
                     )
                 ''')
+                c.execute('CREATE INDEX IF NOT EXISTS idx_archived_users_archived_at ON archived_users (archived_at)')
 
                 archived_at = datetime.now().isoformat()
                 c.execute('''
@@ -2452,25 +2472,31 @@ def init_routes(app, get_db, mail, serializer):
         c.execute("PRAGMA table_info(archived_users)")
         cols = c.fetchall()
         rows = []
+        page = None
         if cols:
             # Support optional search by name, email or original_user_id
             search = request.args.get('search', '').strip()
+            params = []
+            where_sql = ''
             if search:
                 # If search looks numeric, allow searching by original_user_id exact match
-                params = []
                 where_clauses = []
                 where_clauses.append('(name LIKE ? OR email LIKE ? OR data LIKE ?)')
                 params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
                 if search.isdigit():
                     where_clauses.append('original_user_id = ?')
                     params.append(int(search))
-                q = f"SELECT id, original_user_id, name, email, archived_at, data FROM archived_users WHERE {' OR '.join(where_clauses)} ORDER BY archived_at DESC"
-                c.execute(q, params)
-            else:
-                c.execute("SELECT id, original_user_id, name, email, archived_at, data FROM archived_users ORDER BY archived_at DESC")
-            rows = [dict(r) for r in c.fetchall()]
+                where_sql = ' OR '.join(where_clauses)
+            page = keyset_page(
+                c, "SELECT id, original_user_id, name, email, archived_at, data FROM archived_users",
+                where_sql, params,
+                order_keys=[('archived_at', 'archived_at'), ('id', 'id')],
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+            )
+            rows = page.items
         conn.close()
-        return render_template('admin_archived_users.html', archived=rows, search=request.args.get('search', ''))
+        return render_template('admin_archived_users.html', archived=rows, page=page, search=request.args.get('search', ''))
 
     @app.route('/admin/archived-users/<int:archived_id>/restore', methods=['POST'])
     @admin_required
@@ -2591,6 +2617,7 @@ def init_routes(app, get_db, mail, serializer):
                     data TEXT
                 )
             ''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_archived_appointments_archived_at ON archived_appointments (archived_at)')
 
             archived_at = datetime.now().isoformat()
             snapshot = json.dumps(appt_dict, default=str)
@@ -2631,18 +2658,24 @@ def init_routes(app, get_db, mail, serializer):
         c.execute("PRAGMA table_info(archived_appointments)")
         cols = c.fetchall()
         rows = []
+        page = None
         if cols:
             search = request.args.get('search', '').strip()
+            params = []
+            where_sql = ''
             if search:
-                params = [f'%{search}%']
-                q = "SELECT id, original_appointment_id, patient_name, appointment_date, appointment_time, status, archived_at, data FROM archived_appointments WHERE patient_name LIKE ? OR data LIKE ? ORDER BY archived_at DESC"
-                params.append(f'%{search}%')
-                c.execute(q, params)
-            else:
-                c.execute("SELECT id, original_appointment_id, patient_name, appointment_date, appointment_time, status, archived_at, data FROM archived_appointments ORDER BY archived_at DESC")
-            rows = [dict(r) for r in c.fetchall()]
+                where_sql = 'patient_name LIKE ? OR data LIKE ?'
+                params = [f'%{search}%', f'%{search}%']
+            page = keyset_page(
+                c, "SELECT id, original_appointment_id, patient_name, appointment_date, appointment_time, status, archived_at, data FROM archived_appointments",
+                where_sql, params,
+                order_keys=[('archived_at', 'archived_at'), ('id', 'id')],
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+            )
+            rows = page.items
         conn.close()
-        return render_template('admin_archived_appointments.html', archived=rows, search=request.args.get('search', ''))
+        return render_template('admin_archived_appointments.html', archived=rows, page=page, search=request.args.get('search', ''))
 
     @app.route('/admin/archived-appointments/<int:archived_id>/restore', methods=['POST'])
     @admin_required
@@ -2726,6 +2759,7 @@ def init_routes(app, get_db, mail, serializer):
 
     @app.route('/logout')
     def logout():
+        log_activity(get_db, 'logout', session.get('user_id'), request)
         # Clear session user info
         session.pop('user_id', None)
         session.pop('user_name', None)
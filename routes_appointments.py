@@ -1,7 +1,9 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app
 from datetime import datetime
 from functools import wraps
 
+from utils.keyset_pager import cached_count, keyset_page
+
 # Create blueprint
 appointments_bp = Blueprint('appointments', __name__)
 
@@ -27,7 +29,7 @@ def init_appointments_routes(app, get_db):
         c = conn.cursor()
 
         # Filtering logic
-        query = '''
+        select_sql = '''
             SELECT a.*, u.name as user_name
             FROM appointments a
             JOIN users u ON a.user_id = u.id
@@ -50,21 +52,35 @@ def init_appointments_routes(app, get_db):
         if request.args.get('end_date'):
             filters.append('a.appointment_date <= ?')
             params.append(request.args.get('end_date'))
-
-        if filters:
-            query += ' WHERE ' + ' AND '.join(filters)
-
-        query += ' ORDER BY a.appointment_date DESC, a.appointment_time DESC'
-
-        c.execute(query, params)
-        appointments = [dict(row) for row in c.fetchall()]
+        where_sql = ' AND '.join(filters)
+
+        # Keyset pagination on (date, time, id), served by the appointment indexes
+        page = keyset_page(
+            c, select_sql, where_sql, params,
+            order_keys=[('a.appointment_date', 'appointment_date'),
+                        ('a.appointment_time', 'appointment_time'),
+                        ('a.id', 'id')],
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+        )
+
+        # Total per filter combination, cached until the change feed moves
+        try:
+            c.execute('SELECT MAX(seq) FROM appointment_changes')
+            version = c.fetchone()[0]
+        except Exception:
+            version = None
+        count_sql = 'SELECT COUNT(*) FROM appointments a JOIN users u ON a.user_id = u.id'
+        if where_sql:
+            count_sql += ' WHERE ' + where_sql
+        page.total = cached_count(c, count_sql, params, 'appointments', version=version)
 
         # Fetch services for filter dropdown
         c.execute('SELECT name FROM services WHERE is_active = 1 ORDER BY name')
         services = [row['name'] for row in c.fetchall()]
 
         conn.close()
-        return render_template('appointments/list.html', appointments=appointments, services=services)
+        return render_template('appointments/list.html', appointments=page.items, page=page, services=services)
 
     # View Appointment Details
     @appointments_bp.route('/appointments/view/<int:appointment_id>')
@@ -84,8 +100,8 @@ def init_appointments_routes(app, get_db):
         appointment = dict(c.fetchone())
         # Load SMS templates for modal selector
         try:
-            from utils.sms_templates import get_templates
-            sms_templates = get_templates()
+            from utils.template_store import json_templates
+            sms_templates = json_templates()
         except Exception:
             sms_templates = {}
         # Load available categories from services table for category updates
@@ -94,13 +110,20 @@ def init_appointments_routes(app, get_db):
             categories = [row['category'] for row in c.fetchall()]
         except Exception:
             categories = []
+        # Vaccines with multi-dose schedules for the series booking modal
+        try:
+            from utils.vaccine_series import list_series_vaccines
+            series_vaccines = list_series_vaccines(c)
+        except Exception:
+            series_vaccines = []
         conn.close()
 
         if not appointment:
             flash('Appointment not found.', 'danger')
             return redirect(url_for('appointments.list_appointments'))
 
-        return render_template('appointments/view.html', appointment=appointment, sms_templates=sms_templates, categories=categories)
+        return render_template('appointments/view.html', appointment=appointment, sms_templates=sms_templates,
+                               categories=categories, series_vaccines=series_vaccines)
     @appointments_bp.route('/appointments/manage', methods=['GET', 'POST'])
     @appointments_bp.route('/appointments/manage/<int:appointment_id>', methods=['GET', 'POST'])
     @admin_required
@@ -242,6 +265,46 @@ def init_appointments_routes(app, get_db):
 
         return redirect(url_for('appointments.view_appointment', appointment_id=appointment_id))
 
+    @appointments_bp.route('/appointments/book_series/<int:appointment_id>', methods=['POST'])
+    @admin_required
+    def book_vaccine_series(appointment_id):
+        """Book every follow-up dose of a vaccination course from its day-0 appointment."""
+        from utils.vaccine_series import book_series, format_series_message, SeriesBookingError
+
+        vaccine_name = request.form.get('vaccine_name', '').strip()
+        if not vaccine_name:
+            flash('Please select a vaccine schedule.', 'danger')
+            return redirect(url_for('appointments.view_appointment', appointment_id=appointment_id))
+
+        conn = get_db_connection()
+        try:
+            day0, visits = book_series(conn, appointment_id, vaccine_name)
+        except SeriesBookingError as e:
+            conn.close()
+            flash(str(e), 'danger')
+            return redirect(url_for('appointments.view_appointment', appointment_id=appointment_id))
+        except Exception as e:
+            conn.close()
+            current_app.logger.error(f'Error booking vaccine series for appointment {appointment_id}: {e}')
+            flash('Failed to book the vaccination series.', 'danger')
+            return redirect(url_for('appointments.view_appointment', appointment_id=appointment_id))
+        conn.close()
+
+        # One combined confirmation for the whole course
+        message = format_series_message(day0.get('patient_name'), vaccine_name, visits)
+        if day0.get('patient_phone'):
+            try:
+                from utils.sms import send_message
+                send_message(day0['patient_phone'], message, message_type='appointment_confirmation')
+            except Exception as e:
+                current_app.logger.error(f'Error sending series confirmation for appointment {appointment_id}: {e}')
+
+        shifted = sum(1 for v in visits if v['shifted'])
+        summary = ', '.join(f"Dose {v['dose_number']}: {v['appointment_date']} {v['appointment_time']}" for v in visits)
+        note = f' ({shifted} moved to the nearest open slot)' if shifted else ''
+        flash(f'Booked {len(visits)} follow-up visits{note}. {summary}', 'success')
+        return redirect(url_for('appointments.view_appointment', appointment_id=appointment_id))
+
     @appointments_bp.route('/appointments/send_sms/<int:appointment_id>', methods=['POST'])
     @admin_required
     def send_sms_notification(appointment_id):
@@ -278,22 +341,17 @@ def init_appointments_routes(app, get_db):
                     body = None
             else:
                 try:
-                    from utils.sms_templates import get_templates
-                    templates = get_templates()
-                    tpl = templates.get(template_key)
+                    from utils.template_store import get_json_template
+                    tpl = get_json_template(template_key)
                     if tpl:
-                        # render simple {{var}} placeholders from appointment and form
+                        # fill {{var}} placeholders from appointment and form
                         ctx = {
                             'appointment_date': appointment.get('appointment_date'),
                             'appointment_time': appointment.get('appointment_time'),
                             'new_date': request.form.get('new_date') or appointment.get('appointment_date'),
                             'new_time': request.form.get('new_time') or appointment.get('appointment_time')
                         }
-                        text = tpl.get('body', '')
-                        for k, v in ctx.items():
-                            text = text.replace('{{' + k + '}}', str(v))
-                            text = text.replace('{{ ' + k + ' }}', str(v))
-                        body = text
+                        body = tpl.render(ctx)
                 except Exception:
                     body = None
 
@@ -319,7 +377,7 @@ def init_appointments_routes(app, get_db):
             from utils.sms import send_message
             result = send_message(phone, body)
             if result.get('ok'):
-                flash('SMS sent successfully.', 'success')
+                flash('SMS queued for delivery.' if result.get('queued') else 'SMS sent successfully.', 'success')
             else:
                 flash(f"Failed to send SMS: {result.get('error')}", 'danger')
         except Exception as e:
@@ -391,7 +449,9 @@ def init_appointments_routes(app, get_db):
     @admin_required
     def manage_sms_templates():
         try:
-            from utils.sms_templates import get_templates, save_templates
+            from utils.sms_templates import (TEMPLATE_VARIABLES, get_templates, save_templates,
+                                             segment_summary, segment_warnings)
+            from utils.template_store import unknown_variables
         except Exception:
             flash('SMS templates backend not available.', 'danger')
             return redirect(url_for('appointments.list_appointments'))
@@ -412,9 +472,17 @@ def init_appointments_routes(app, get_db):
                 templates[new_key] = {'title': new_title or new_key, 'body': new_body}
             save_templates(templates)
             flash('SMS templates updated.', 'success')
+            for key, tpl in templates.items():
+                unknown = unknown_variables(tpl.get('body', ''), TEMPLATE_VARIABLES)
+                if unknown:
+                    flash(f"Template '{key}' uses {', '.join('{{' + v + '}}' for v in unknown)}, which "
+                          f"won't be filled in (available: {', '.join(TEMPLATE_VARIABLES)}).", 'warning')
             return redirect(url_for('appointments.manage_sms_templates'))
 
         templates = get_templates()
-        return render_template('admin/sms_templates.html', templates=templates)
+        segments = {key: {'summary': segment_summary(tpl.get('body', '')),
+                          'warnings': segment_warnings(tpl.get('body', ''))}
+                    for key, tpl in templates.items()}
+        return render_template('admin/sms_templates.html', templates=templates, segments=segments)
 
     app.register_blueprint(appointments_bp, url_prefix='/admin')
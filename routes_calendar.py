@@ -1,9 +1,80 @@
-from flask import Blueprint, render_template, jsonify, url_for
+import hashlib
+from datetime import date, datetime, timedelta
+from flask import Blueprint, render_template, jsonify, url_for, request, Response, current_app
 from functools import wraps
 from flask import session, redirect, url_for
+from utils.booking_slots import SLOT_CAPACITY, month_occupancy
 
 calendar_bp = Blueprint('calendar_bp', __name__)
 
+# Event colors per appointment status (shared with the calendar template)
+STATUS_COLORS = {
+    'pending': '#f39c12',
+    'confirmed': '#2ecc71',
+    'completed': '#3498db',
+    'cancelled': '#e74c3c'
+}
+DEFAULT_EVENT_COLOR = '#6c757d'
+
+# Maximum number of changed appointments returned per delta poll
+CHANGES_PAGE_SIZE = 500
+
+
+def _parse_window(start, end):
+    """Return (start, end) ISO dates for a FullCalendar range; end is exclusive.
+
+    FullCalendar sends values like '2025-09-28T00:00:00+08:00'; only the date part is used.
+    Without params, fall back to a window around today so the feed stays bounded.
+    """
+    def _to_date(value):
+        try:
+            return datetime.strptime(value[:10], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            return None
+
+    start_date = _to_date(start) or (date.today() - timedelta(days=31))
+    end_date = _to_date(end) or (start_date + timedelta(days=93))
+    if end_date <= start_date:
+        end_date = start_date + timedelta(days=1)
+    return start_date.isoformat(), end_date.isoformat()
+
+
+def _parse_timestamp(value):
+    """Parse the mixed updated_at spellings (isoformat and CURRENT_TIMESTAMP)."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    text = str(value).replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _event_payload(appt):
+    """Compact event: title, color and url are derived client-side from these fields."""
+    time = (appt.get('appointment_time') or '').strip()
+    date_str = str(appt.get('appointment_date'))
+    event = {
+        'id': appt.get('id'),
+        'start': f"{date_str}T{_pad_time(time)}" if time else date_str,
+        'status': (appt.get('status') or '').lower(),
+        'patient_name': appt.get('patient_name'),
+        'service': appt.get('service'),
+    }
+    if not time:
+        event['allDay'] = True
+    return event
+
+
+def _pad_time(value):
+    # '7:00' -> '07:00' so the start is a valid ISO8601 datetime
+    hour, _, rest = value.partition(':')
+    return f"{hour.zfill(2)}:{rest}" if rest else value
+
 def init_calendar_routes(app, get_db):
 
     def admin_required(f):
@@ -40,66 +111,146 @@ def init_calendar_routes(app, get_db):
             'recent_appointments': recent_appointments
         }
 
-        return render_template('calendar/view.html', dashboard_payload=dashboard_payload)
+        # Starting cursor for the delta feed polled by the calendar
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute('SELECT MAX(seq) FROM appointment_changes')
+            change_cursor = c.fetchone()[0] or 0
+        except Exception:
+            change_cursor = None
+        finally:
+            conn.close()
+
+        return render_template('calendar/view.html', dashboard_payload=dashboard_payload,
+                               status_colors=STATUS_COLORS, default_event_color=DEFAULT_EVENT_COLOR,
+                               change_cursor=change_cursor)
 
     @calendar_bp.route('/api/appointments')
     @admin_required
     def api_appointments():
-        """Provides appointment data as JSON for FullCalendar."""
+        """Provides appointment data as JSON for FullCalendar.
+
+        Only the visible window (FullCalendar's `start`/`end` params) is queried. Responses
+        carry an ETag/Last-Modified derived from the window so unchanged views get a 304.
+        """
+        window_start, window_end = _parse_window(request.args.get('start'), request.args.get('end'))
+
         conn = get_db()
         c = conn.cursor()
-        c.execute("""
-            SELECT id, patient_name, service, appointment_date, appointment_time, status
-            FROM appointments
-            WHERE status != 'cancelled'
-        """)
-        rows = c.fetchall()
-        # ensure mapping access - convert sqlite rows to dicts if necessary
         try:
-            appointments = [dict(r) for r in rows]
-        except Exception:
-            # fallback: assume rows are already dict-like
-            appointments = rows
-        conn.close()
-
-        events = []
-        for appt in appointments:
-            # Build ISO start; if time is missing, use all-day event
-            time = appt.get('appointment_time') or ''
-            date = appt.get('appointment_date')
-            if time and time.strip():
-                # ensure time is HH:MM or HH:MM:SS
-                start = f"{date}T{time}"
-                all_day = False
+            # Validator query: cancelled rows are included in MAX(updated_at) so a cancellation
+            # (which drops the event) still changes the ETag; COUNT(*) catches deletes/archives.
+            c.execute("""
+                SELECT COUNT(*) AS total,
+                       SUM(CASE WHEN status != 'cancelled' THEN 1 ELSE 0 END) AS active,
+                       MAX(updated_at) AS last_updated
+                FROM appointments
+                WHERE appointment_date >= ? AND appointment_date < ?
+            """, (window_start, window_end))
+            stats = c.fetchone()
+            total, active, last_updated = stats[0] or 0, stats[1] or 0, stats[2]
+            etag = hashlib.sha1(
+                f"{window_start}|{window_end}|{total}|{active}|{last_updated}".encode()
+            ).hexdigest()
+            last_modified = _parse_timestamp(last_updated)
+
+            # Only the ETag decides: a delete can lower MAX(updated_at), so If-Modified-Since
+            # alone could hide a change.
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
             else:
-                start = date
-                all_day = True
-
-            # color mapping per status
-            status = (appt.get('status') or '').lower()
-            color_map = {
-                'pending': '#f39c12',
-                'confirmed': '#2ecc71',
-                'completed': '#3498db',
-                'cancelled': '#e74c3c'
-            }
-            color = color_map.get(status, '#6c757d')
-
-            events.append({
-                'id': appt.get('id'),
-                'title': f"{appt.get('patient_name') or 'Appointment'} - {appt.get('service') or ''}",
-                'start': start,
-                'allDay': all_day,
-                'url': url_for('appointments.view_appointment', appointment_id=appt.get('id')) if appt.get('id') else None,
-                'color': color,
-                'extendedProps': {
-                    'status': status,
-                    'service': appt.get('service'),
-                    'patient_name': appt.get('patient_name'),
-                    'appointment_time': appt.get('appointment_time')
-                }
-            })
-        
-        return jsonify(events)
+                c.execute("""
+                    SELECT id, patient_name, service, appointment_date, appointment_time, status
+                    FROM appointments
+                    WHERE appointment_date >= ? AND appointment_date < ?
+                      AND status != 'cancelled'
+                    ORDER BY appointment_date, appointment_time
+                """, (window_start, window_end))
+                resp = jsonify([_event_payload(dict(r)) for r in c.fetchall()])
+        finally:
+            conn.close()
+
+        resp.set_etag(etag)
+        if last_modified:
+            resp.last_modified = last_modified
+        # Let the browser keep the payload but always revalidate with the ETag
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+
+    @calendar_bp.route('/api/appointments/changes')
+    @admin_required
+    def api_appointment_changes():
+        """Delta feed for the calendar: appointments changed since the `since` cursor.
+
+        Returns `{cursor, changes, more, reset}`. Each change is either an `upsert` carrying
+        the compact event payload or a `remove` (deleted, archived or cancelled). Several
+        changes to one appointment collapse into its current state. `reset` tells the client
+        its cursor is older than the retained history and it should refetch.
+        """
+        since = request.args.get('since', type=int)
+        limit = min(request.args.get('limit', CHANGES_PAGE_SIZE, type=int) or CHANGES_PAGE_SIZE, CHANGES_PAGE_SIZE)
+
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute('SELECT MIN(seq), MAX(seq) FROM appointment_changes')
+            bounds = c.fetchone()
+            min_seq, max_seq = bounds[0], bounds[1] or 0
+
+            if since is None or since > max_seq:
+                # First poll (or a cursor from a rebuilt database): just hand out the cursor
+                return jsonify({'cursor': max_seq, 'changes': [], 'more': False, 'reset': since is not None})
+            if min_seq is not None and since < min_seq - 1:
+                return jsonify({'cursor': max_seq, 'changes': [], 'more': False, 'reset': True})
+
+            c.execute("""
+                SELECT ch.appointment_id, MAX(ch.seq) AS seq,
+                       a.id AS present, a.patient_name, a.service,
+                       a.appointment_date, a.appointment_time, a.status
+                FROM appointment_changes ch
+                LEFT JOIN appointments a ON a.id = ch.appointment_id
+                WHERE ch.seq > ?
+                GROUP BY ch.appointment_id
+                ORDER BY seq
+                LIMIT ?
+            """, (since, limit + 1))
+            rows = [dict(r) for r in c.fetchall()]
+        finally:
+            conn.close()
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+        changes = []
+        for row in rows:
+            if row.get('present') and (row.get('status') or '').lower() != 'cancelled':
+                appt = dict(row, id=row['appointment_id'])
+                changes.append({'op': 'upsert', 'id': row['appointment_id'], 'event': _event_payload(appt)})
+            else:
+                changes.append({'op': 'remove', 'id': row['appointment_id']})
+        cursor = rows[-1]['seq'] if rows else since
+        return jsonify({'cursor': cursor, 'changes': changes, 'more': more, 'reset': False})
+
+    @calendar_bp.route('/api/calendar/occupancy')
+    @admin_required
+    def api_calendar_occupancy():
+        """Per-day occupancy for a month (`?month=YYYY-MM`) from the precomputed table."""
+        month = request.args.get('month') or date.today().strftime('%Y-%m')
+        try:
+            datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return jsonify({'error': 'invalid_month'}), 400
+
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            days = month_occupancy(c, month)
+        except Exception as e:
+            current_app.logger.error(f'Error loading calendar occupancy for {month}: {e}')
+            days = {}
+        finally:
+            conn.close()
+
+        return jsonify({'month': month, 'slot_capacity': SLOT_CAPACITY, 'days': days})
 
     app.register_blueprint(calendar_bp)
@@ -0,0 +1,146 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from functools import wraps
+
+from utils.keyset_pager import keyset_page
+from utils.sms_campaigns import (SEGMENTS, CampaignError, campaign_progress, campaigns_progress, cancel_campaign,
+                                 create_campaign, start_campaign)
+from utils.sms_log_store import expand_rows
+
+# Create blueprint
+campaigns_bp = Blueprint('campaigns', __name__)
+
+
+def init_campaign_routes(app, get_db):
+
+    def admin_required(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if 'admin_logged_in' not in session:
+                flash('Please log in as admin to access this page.', 'danger')
+                return redirect(url_for('login'))
+            return f(*args, **kwargs)
+        return decorated_function
+
+    # Campaign list and create form
+    @campaigns_bp.route('/sms/campaigns', methods=['GET', 'POST'])
+    @admin_required
+    def list_campaigns():
+        conn = get_db()
+        c = conn.cursor()
+        if request.method == 'POST':
+            name = request.form.get('name', '').strip()
+            if not name:
+                conn.close()
+                flash('Campaign name is required.', 'danger')
+                return redirect(url_for('campaigns.list_campaigns'))
+            try:
+                campaign_id = create_campaign(
+                    conn, name,
+                    body=request.form.get('body', '').strip() or None,
+                    template_name=request.form.get('template_name') or None,
+                    segment=request.form.get('segment', 'marketing'),
+                    service=request.form.get('service') or None,
+                    rate_per_minute=request.form.get('rate_per_minute', type=float),
+                    created_by='admin',
+                )
+                total = campaign_progress(c, campaign_id)['total']
+                flash(f'Campaign created with {total} recipients. Review it and press Start to send.', 'success')
+            except CampaignError as e:
+                flash(str(e), 'danger')
+            except Exception as e:
+                app.logger.error(f"Error creating campaign: {str(e)}")
+                flash(f'Error creating campaign: {str(e)}', 'danger')
+            finally:
+                conn.close()
+            return redirect(url_for('campaigns.list_campaigns'))
+
+        c.execute('SELECT * FROM sms_campaigns ORDER BY id DESC LIMIT 50')
+        campaigns = [dict(row) for row in c.fetchall()]
+        progress = campaigns_progress(c, [campaign['id'] for campaign in campaigns])
+        for campaign in campaigns:
+            campaign['progress'] = progress[campaign['id']]
+        c.execute("SELECT template_name, message_type FROM sms_templates WHERE is_active = 1 ORDER BY template_name")
+        templates = [dict(row) for row in c.fetchall()]
+        try:
+            c.execute('SELECT DISTINCT name FROM services ORDER BY name')
+            services = [row[0] for row in c.fetchall()]
+        except Exception:
+            services = []
+        conn.close()
+        return render_template('admin/sms_campaigns.html', campaigns=campaigns, templates=templates,
+                               services=services, segments=sorted(SEGMENTS))
+
+    @campaigns_bp.route('/sms/campaigns/<int:campaign_id>/start', methods=['POST'])
+    @admin_required
+    def start(campaign_id):
+        conn = get_db()
+        try:
+            if start_campaign(conn, campaign_id):
+                flash('Campaign started; messages are released by the campaign dispatcher.', 'success')
+            else:
+                flash('Only draft campaigns can be started.', 'warning')
+        finally:
+            conn.close()
+        return redirect(url_for('campaigns.list_campaigns'))
+
+    @campaigns_bp.route('/sms/campaigns/<int:campaign_id>/cancel', methods=['POST'])
+    @admin_required
+    def cancel(campaign_id):
+        conn = get_db()
+        try:
+            result = cancel_campaign(conn, campaign_id)
+        finally:
+            conn.close()
+        flash(f"Campaign cancelled ({result['cancelled']} pending, {result['withdrawn']} queued messages withdrawn).",
+              'info')
+        return redirect(url_for('campaigns.list_campaigns'))
+
+    # Live counts, polled by the list page while a campaign is running
+    @campaigns_bp.route('/sms/campaigns/<int:campaign_id>/progress')
+    @admin_required
+    def progress(campaign_id):
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT status FROM sms_campaigns WHERE id = ?', (campaign_id,))
+            row = c.fetchone()
+            if not row:
+                return jsonify({'error': 'not_found'}), 404
+            return jsonify({'status': row[0], 'counts': campaign_progress(c, campaign_id)})
+        finally:
+            conn.close()
+
+    # Sent message log; compact rows are rebuilt from their template (utils/sms_log_store.py)
+    @campaigns_bp.route('/sms/logs')
+    @admin_required
+    def sms_logs():
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            filters, params = [], []
+            if request.args.get('message_type'):
+                filters.append('message_type = ?')
+                params.append(request.args.get('message_type'))
+            if request.args.get('status'):
+                filters.append('status = ?')
+                params.append(request.args.get('status'))
+            if request.args.get('phone'):
+                filters.append('phone_number = ?')
+                params.append(request.args.get('phone').strip())
+            page = keyset_page(
+                c, '''SELECT id, user_id, phone_number, message_type, message_content, status,
+                             segments, encoding, template_id, template_vars, sent_at, created_at
+                      FROM sms_logs''',
+                ' AND '.join(filters), params,
+                order_keys=[('id', 'id')],
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+            )
+            expand_rows(c, page.items)
+            c.execute('SELECT DISTINCT message_type FROM sms_logs ORDER BY message_type')
+            message_types = [row[0] for row in c.fetchall()]
+        finally:
+            conn.close()
+        return render_template('admin/sms_logs.html', logs=page.items, page=page, message_types=message_types)
+
+    app.register_blueprint(campaigns_bp, url_prefix='/admin')
@@ -2,6 +2,8 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from datetime import datetime
 from functools import wraps
 
+from utils.keyset_pager import cached_count, keyset_page
+
 # Create blueprint
 inventory_bp = Blueprint('inventory', __name__)
 
@@ -274,47 +276,53 @@ def init_inventory_routes(app, get_db):
         end_date = request.args.get('end_date')
         
         # Build query
-        query = '''
+        select_sql = '''
             SELECT t.*, i.name as item_name, i.unit
             FROM inventory_transactions t
             JOIN inventory_items i ON t.item_id = i.id
-            WHERE 1=1
         '''
+        filters = []
         params = []
         
         if item_id:
-            query += ' AND t.item_id = ?'
+            filters.append('t.item_id = ?')
             params.append(item_id)
             
         if transaction_type:
-            query += ' AND t.transaction_type = ?'
+            filters.append('t.transaction_type = ?')
             params.append(transaction_type)
             
         if start_date:
-            query += ' AND t.created_at >= ?'
+            filters.append('t.created_at >= ?')
             params.append(f"{start_date} 00:00:00")
             
         if end_date:
-            query += ' AND t.created_at <= ?'
+            filters.append('t.created_at <= ?')
             params.append(f"{end_date} 23:59:59")
+        where_sql = ' AND '.join(filters)
+        
+        # Keyset pagination on (created_at, id)
+        page = keyset_page(
+            c, select_sql, where_sql, params,
+            order_keys=[('t.created_at', 'created_at'), ('t.id', 'id')],
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=20,
+        )
         
-        query += ' ORDER BY t.created_at DESC'
-        
-        # Add pagination
-        page = request.args.get('page', 1, type=int)
-        per_page = 20
-        
-        # Get total count for pagination
-        count_query = 'SELECT COUNT(*) FROM (' + query.replace('t.*, i.name as item_name, i.unit', '1') + ')'
-        c.execute(count_query, params)
-        total = c.fetchone()[0]
-        
-        # Add pagination to the main query
-        query += ' LIMIT ? OFFSET ?'
-        params.extend([per_page, (page - 1) * per_page])
-        
-        c.execute(query, params)
-        transactions = [dict(row) for row in c.fetchall()]
+        # Total for the current filters. Transactions are removed together with their
+        # item, so the count doesn't need the join; cached until a trigger bumps the
+        # table's write counter (without the triggers, e.g. on PostgreSQL, only the TTL applies).
+        try:
+            c.execute("SELECT version FROM table_versions WHERE table_name = 'inventory_transactions'")
+            row = c.fetchone()
+            version = row[0] if row else 0
+        except Exception:
+            version = None
+        count_sql = 'SELECT COUNT(*) FROM inventory_transactions t'
+        if where_sql:
+            count_sql += ' WHERE ' + where_sql
+        page.total = cached_count(c, count_sql, params, 'inventory_transactions', version=version)
         
         # Get items for filter dropdown
         c.execute('SELECT id, name FROM inventory_items ORDER BY name')
@@ -324,16 +332,14 @@ def init_inventory_routes(app, get_db):
         
         return render_template(
             'inventory/transactions/list.html',
-            transactions=transactions,
+            transactions=page.items,
             items=items,
             transaction_types=['in', 'out', 'adjustment', 'expired', 'initial', 'returned'],
             selected_item=item_id,
             selected_type=transaction_type,
             start_date=start_date,
             end_date=end_date,
-            page=page,
-            per_page=per_page,
-            total=total
+            page=page
         )
     
     # Record Inventory Transaction (e.g., stock in/out)
@@ -1,10 +1,33 @@
-from flask import Blueprint, request, jsonify, current_app
-from utils.sms import send_otp, verify_otp, normalize_phone
+import os
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Blueprint, request, jsonify, current_app, abort, session, flash, redirect, url_for
+from twilio.request_validator import RequestValidator
+
+from utils import redis_client
+from utils.local_semaphore import fallback_metrics
+from utils.phone import normalize_phone
+from utils.rate_limit import OTP_IP_LIMITS, client_ip, rate_limit
+from utils.sms import send_otp, verify_otp
+from utils.sms_providers import get_provider
+from utils.sms_status import get_status_buffer
 
 sms_bp = Blueprint('sms_bp', __name__)
 
 
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'admin_logged_in' not in session:
+            flash('Please log in as admin to access this page.', 'danger')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 @sms_bp.route('/send_sms_otp', methods=['POST'])
+@rate_limit((client_ip('otp'), OTP_IP_LIMITS))
 def send_sms_otp():
     data = request.get_json(force=True, silent=True) or {}
     phone = data.get('phone')
@@ -43,3 +66,81 @@ def verify_sms_otp():
         # Optionally: mark user phone_verified in DB here
         return jsonify({'ok': True})
     return jsonify({'ok': False, 'error': 'invalid_code'}), 400
+
+
+def _callback_url():
+    # behind a proxy request.url may not be the URL Twilio signed, so allow pinning it
+    return os.getenv('TWILIO_STATUS_CALLBACK_URL') or request.url
+
+
+@sms_bp.route('/sms/status', methods=['POST'])
+def sms_status_callback():
+    """Twilio delivery receipt; buffered and written to sms_logs in batches."""
+    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+    signature = request.headers.get('X-Twilio-Signature', '')
+    if not auth_token or not RequestValidator(auth_token).validate(
+            _callback_url(), request.form.to_dict(), signature):
+        abort(403)
+
+    sid = request.form.get('MessageSid') or request.form.get('SmsSid')
+    status = request.form.get('MessageStatus') or request.form.get('SmsStatus')
+    if not sid or not status:
+        return '', 400
+    get_status_buffer(current_app.get_db).add(sid, status, request.form.get('ErrorCode'))
+    # Twilio only needs a 2xx; an empty body keeps the response cheap
+    return '', 204
+
+
+@sms_bp.route('/admin/sms/fallbacks')
+@admin_required
+def sms_fallbacks():
+    """Redis breaker state, local semaphore fallback counters and SMS provider health of this process."""
+    return jsonify({
+        'pid': os.getpid(),
+        'redis': {'state': redis_client.breaker.state, 'trips': redis_client.breaker.trips},
+        'semaphores': fallback_metrics(),
+        # per-provider breaker state and latency when SMS_PROVIDER routes over several
+        'providers': getattr(get_provider(), 'snapshot', dict)(),
+    })
+
+
+@sms_bp.route('/admin/sms/segments')
+@admin_required
+def sms_segments():
+    """Messages and billable segments per message type and encoding over the last `days` days."""
+    days = request.args.get('days', default=7, type=int)
+    since = (datetime.utcnow() - timedelta(days=max(days, 1))).strftime('%Y-%m-%d %H:%M:%S')
+    conn = current_app.get_db()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            SELECT message_type, encoding, COUNT(*) AS messages, SUM(segments) AS segments
+            FROM sms_logs
+            WHERE created_at >= ? AND segments IS NOT NULL
+            GROUP BY message_type, encoding
+            ORDER BY segments DESC
+        ''', (since,))
+        rows = c.fetchall()
+        c.execute('''
+            SELECT COUNT(*) FROM sms_logs WHERE created_at >= ? AND status = 'merged'
+        ''', (since,))
+        merged = c.fetchone()[0]
+    finally:
+        conn.close()
+    breakdown = [dict(row) for row in rows]
+    messages = sum(row['messages'] for row in breakdown)
+    segments = sum(row['segments'] or 0 for row in breakdown)
+    return jsonify({
+        'since': since,
+        'messages': messages,
+        'segments': segments,
+        'segments_per_message': round(segments / messages, 2) if messages else None,
+        'ucs2_messages': sum(row['messages'] for row in breakdown if row['encoding'] == 'UCS-2'),
+        # notifications folded into another message's digest (utils/sms_outbox.py)
+        'merged_notifications': merged,
+        'by_type': breakdown,
+    })
+
+
+def init_sms_routes(app, get_db):
+    app.register_blueprint(sms_bp)
@@ -0,0 +1,147 @@
+"""
+Verify benchmark: Lua OTP store (utils.otp_store) vs the previous GET/GET/DEL|DECR sequence.
+
+--threads workers hammer --phones numbers with verify attempts (mostly wrong guesses,
+as a brute-force client would), re-issuing each code when it runs out. Reports verify
+latency p50/p99, throughput, Redis commands per verify, and how many guesses were
+answered beyond the codes' tries budgets (the old check-then-decrement race). Command
+counts include the re-issues.
+
+Usage:
+  REDIS_URL=redis://localhost:6379/0 python scripts/bench_otp.py --threads 32 --phones 8
+  python scripts/bench_otp.py --memory          # in-process store only, no Redis needed
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import otp_store, redis_client  # noqa: E402
+
+TRIES = 3
+
+
+class LegacyStore:
+    """The previous plain-text store, kept here only as the baseline."""
+
+    def __init__(self, client):
+        self.r = client
+
+    def issue(self, phone, code):
+        pipe = self.r.pipeline()
+        pipe.set(f"bench:otp:{phone}", code, ex=300)
+        pipe.set(f"bench:otp:{phone}:tries", TRIES, ex=300)
+        pipe.execute()
+
+    def verify(self, phone, code):
+        otp_key = f"bench:otp:{phone}"
+        tries_key = f"{otp_key}:tries"
+        stored = self.r.get(otp_key)
+        if not stored:
+            return otp_store.EXPIRED
+        tries = int(self.r.get(tries_key) or 0)
+        if tries <= 0:
+            self.r.delete(otp_key)
+            self.r.delete(tries_key)
+            return otp_store.LOCKED
+        if stored.decode() == code:
+            self.r.delete(otp_key)
+            self.r.delete(tries_key)
+            return otp_store.VERIFIED
+        self.r.decr(tries_key)
+        return otp_store.INVALID
+
+
+class LuaStore:
+    def issue(self, phone, code):
+        otp_store.issue(phone, code, tries=TRIES)
+
+    def verify(self, phone, code):
+        return otp_store.verify(phone, code)
+
+
+def _commands(client):
+    return int(client.info("stats")["total_commands_processed"]) if client else 0
+
+
+def run(label, store, client, args):
+    phones = [f"+63917{i:07d}" for i in range(args.phones)]
+    codes = {}
+    generation = {p: 0 for p in phones}
+    # every issued code can answer at most TRIES guesses with verified/invalid
+    issued = {p: 1 for p in phones}
+    checked = {p: 0 for p in phones}
+    lock = threading.Lock()
+    for p in phones:
+        codes[p] = f"{random.randrange(10 ** 6):06d}"
+        store.issue(p, codes[p])
+    latencies = []
+    stop_at = time.monotonic() + args.duration
+
+    def worker():
+        rnd = random.Random()
+        local = []
+        while time.monotonic() < stop_at:
+            phone = rnd.choice(phones)
+            with lock:
+                gen, code = generation[phone], codes[phone]
+            guess = code if rnd.random() < args.hit_rate else f"{rnd.randrange(10 ** 6):06d}"
+            started = time.perf_counter()
+            result = store.verify(phone, guess)
+            local.append(time.perf_counter() - started)
+            with lock:
+                if result in (otp_store.VERIFIED, otp_store.INVALID):
+                    checked[phone] += 1
+                if result in (otp_store.VERIFIED, otp_store.EXPIRED, otp_store.LOCKED) and generation[phone] == gen:
+                    generation[phone] += 1
+                    issued[phone] += 1
+                    codes[phone] = f"{rnd.randrange(10 ** 6):06d}"
+                    store.issue(phone, codes[phone])
+        with lock:
+            latencies.extend(local)
+
+    before = _commands(client)
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    commands = _commands(client) - before
+    latencies.sort()
+    over_budget = sum(max(0, checked[p] - TRIES * issued[p]) for p in phones)
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+    print(f"{label:7s} verifies={len(latencies):7d} ({len(latencies) / elapsed:8.1f}/s) "
+          f"p50={statistics.median(latencies) * 1000 if latencies else 0:6.2f}ms p99={p99 * 1000:6.2f}ms "
+          f"guesses_over_budget={over_budget}"
+          + (f" redis_commands/verify={commands / max(len(latencies), 1):.1f}" if client else ""))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--threads", type=int, default=32)
+    p.add_argument("--phones", type=int, default=8, help="numbers under concurrent attack")
+    p.add_argument("--duration", type=float, default=5.0, help="seconds per implementation")
+    p.add_argument("--hit-rate", type=float, default=0.05, help="share of attempts with the right code")
+    p.add_argument("--memory", action="store_true", help="benchmark the in-process store only")
+    args = p.parse_args()
+
+    if args.memory:
+        otp_store.OTP_STORE = "memory"
+        run("memory", LuaStore(), None, args)
+        return
+    if not redis_client.ping():
+        sys.exit("Redis is not reachable; set REDIS_URL or pass --memory")
+    client = redis_client.get_client()
+    run("legacy", LegacyStore(client), client, args)
+    run("lua", LuaStore(), client, args)
+
+
+if __name__ == "__main__":
+    main()
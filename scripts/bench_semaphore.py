@@ -0,0 +1,128 @@
+"""
+Contention benchmark: Lua/BRPOP semaphore (utils.redis_semaphore) vs the previous
+RPOP + sleep(0.05) polling version.
+
+N threads repeatedly acquire one of P permits, hold it for --hold seconds and release it.
+Reports completed acquisitions per second, acquire wait p50/p99, timeouts, and how many
+commands Redis processed (from INFO stats) for each implementation.
+
+Usage:
+  REDIS_URL=redis://localhost:6379/0 python scripts/bench_semaphore.py --threads 32 --permits 4
+  python scripts/bench_semaphore.py --threads 64 --permits 8 --hold 0.005 --duration 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import redis_client, redis_semaphore  # noqa: E402
+
+
+class PollingSemaphore:
+    """The previous algorithm, kept here only as the baseline."""
+
+    def __init__(self, client, name):
+        self.r = client
+        self.name = name
+
+    def init(self, permits):
+        self.r.delete(f"{self.name}:tokens")
+        self.r.lpush(f"{self.name}:tokens", *[f"t{i}" for i in range(permits)])
+
+    def acquire(self, timeout, lease_secs):
+        end = time.time() + timeout
+        while time.time() < end:
+            token = self.r.rpop(f"{self.name}:tokens")
+            if token:
+                token = token.decode()
+                self.r.set(f"{self.name}:owner:{token}", "1", ex=lease_secs)
+                return token
+            time.sleep(0.05)
+        return None
+
+    def release(self, token):
+        pipe = self.r.pipeline()
+        pipe.delete(f"{self.name}:owner:{token}")
+        pipe.lpush(f"{self.name}:tokens", token)
+        pipe.execute()
+
+
+class LuaSemaphore:
+    def __init__(self, name):
+        self.name = name
+
+    def init(self, permits):
+        redis_semaphore.init_semaphore(self.name, permits)
+
+    def acquire(self, timeout, lease_secs):
+        return redis_semaphore.acquire_token(self.name, timeout=timeout, lease_secs=lease_secs)
+
+    def release(self, token):
+        redis_semaphore.release_token(self.name, token)
+
+
+def _commands(client):
+    return int(client.info("stats")["total_commands_processed"])
+
+
+def run(label, sem, client, args):
+    sem.init(args.permits)
+    waits, timeouts = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+
+    def worker():
+        local_waits, local_timeouts = [], 0
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            token = sem.acquire(timeout=args.timeout, lease_secs=30)
+            if not token:
+                local_timeouts += 1
+                continue
+            local_waits.append(time.monotonic() - started)
+            time.sleep(args.hold)
+            sem.release(token)
+        with lock:
+            waits.extend(local_waits)
+            timeouts[0] += local_timeouts
+
+    before = _commands(client)
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    commands = _commands(client) - before - 1
+
+    waits.sort()
+    p99 = waits[int(len(waits) * 0.99) - 1] if waits else 0.0
+    print(f"{label:8s} acquisitions={len(waits):6d} ({len(waits) / elapsed:8.1f}/s) "
+          f"wait p50={statistics.median(waits) * 1000 if waits else 0:7.2f}ms p99={p99 * 1000:7.2f}ms "
+          f"timeouts={timeouts[0]} redis_commands={commands} ({commands / max(len(waits), 1):.1f}/acquisition)")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--threads", type=int, default=32)
+    p.add_argument("--permits", type=int, default=4)
+    p.add_argument("--hold", type=float, default=0.01, help="seconds each permit is held")
+    p.add_argument("--duration", type=float, default=5.0, help="seconds per implementation")
+    p.add_argument("--timeout", type=float, default=5.0, help="acquire timeout")
+    args = p.parse_args()
+
+    if not redis_client.ping():
+        sys.exit("Redis is not reachable; set REDIS_URL")
+    client = redis_client.get_client()
+
+    run("polling", PollingSemaphore(client, "bench:sem:polling"), client, args)
+    run("lua", LuaSemaphore("bench:sem:lua"), client, args)
+
+
+if __name__ == "__main__":
+    main()
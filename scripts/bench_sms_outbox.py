@@ -0,0 +1,146 @@
+"""
+Benchmark the SMS outbox against the fake provider, with no network or Twilio account.
+
+Queues --messages rows in a throwaway SQLite database, drains them with OutboxWorker
+and reports throughput, retries, dead letters and the peak number of sends in flight.
+By default the in-process FakeProvider is used; --server points the real Twilio SDK at
+scripts/fake_sms_server.py instead, so HTTP connection pooling is exercised too.
+
+Usage:
+  python scripts/bench_sms_outbox.py --messages 2000 --concurrency 16 --latency uniform:0.02,0.1
+  python scripts/bench_sms_outbox.py --error-rate 0.05 --max-rps 200 --backoff-base 0.2
+  python scripts/bench_sms_outbox.py --server http://127.0.0.1:8099
+  python scripts/bench_sms_outbox.py --semaphore          # also take the Redis semaphore (REDIS_URL)
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Only the tables the outbox touches; mirrors app.init_db
+_SCHEMA = '''
+    CREATE TABLE sms_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT NOT NULL,
+        message_type TEXT NOT NULL,
+        message_content TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        provider_response TEXT,
+        provider_message_id TEXT,
+        segments INTEGER,
+        encoding TEXT,
+        template_id INTEGER,
+        template_vars TEXT,
+        sent_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE sms_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT NOT NULL,
+        body TEXT NOT NULL,
+        message_type TEXT NOT NULL DEFAULT 'general',
+        channel TEXT NOT NULL DEFAULT 'sms',
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        next_attempt_at TIMESTAMP NOT NULL,
+        locked_by TEXT,
+        locked_until TIMESTAMP,
+        last_error TEXT,
+        provider_message_id TEXT,
+        sms_log_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_sms_outbox_due ON sms_outbox (status, next_attempt_at);
+'''
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--messages", type=int, default=1000)
+    p.add_argument("--concurrency", type=int, default=8, help="sender threads")
+    p.add_argument("--batch-size", type=int, default=50, help="rows claimed per poll")
+    p.add_argument("--latency", default="uniform:0.02,0.08", help="fake provider latency spec")
+    p.add_argument("--error-rate", type=float, default=0.0, help="share of transient 500s")
+    p.add_argument("--permanent-error-rate", type=float, default=0.0, help="share of permanent 400s")
+    p.add_argument("--max-rps", type=float, default=0.0, help="fake provider 429s above this rate")
+    p.add_argument("--backoff-base", type=float, default=0.5, help="retry backoff base seconds")
+    p.add_argument("--server", default=None, help="base URL of scripts/fake_sms_server.py")
+    p.add_argument("--semaphore", action="store_true", help="acquire the Redis semaphore per send")
+    args = p.parse_args()
+
+    # must be set before the outbox module reads them
+    os.environ["SMS_OUTBOX_BACKOFF_BASE"] = str(args.backoff_base)
+    os.environ["SMS_OUTBOX_BACKOFF_MAX"] = str(max(args.backoff_base * 8, 1.0))
+    if args.server:
+        os.environ.update(TWILIO_API_BASE_URL=args.server, SMS_PROVIDER="twilio")
+        os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACfake")
+        os.environ.setdefault("TWILIO_AUTH_TOKEN", "fake")
+        os.environ.setdefault("TWILIO_FROM", "+15550000000")
+
+    from utils.sms_outbox import OutboxWorker, enqueue_sms, outbox_stats
+    from utils.sms_providers import FakeProvider, get_provider, set_provider
+
+    provider = None
+    if not args.server:
+        provider = FakeProvider(latency=args.latency, error_rate=args.error_rate,
+                                permanent_error_rate=args.permanent_error_rate, max_rps=args.max_rps)
+        set_provider(provider)
+    else:
+        get_provider()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="sms-bench-"), "bench.db")
+
+    def get_db():
+        conn = sqlite3.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    conn = get_db()
+    conn.executescript(_SCHEMA)
+    for i in range(args.messages):
+        enqueue_sms(conn, f"+63917{i:07d}", f"Benchmark message {i}", commit=False)
+    conn.commit()
+    conn.close()
+
+    worker = OutboxWorker(get_db, concurrency=args.concurrency, batch_size=args.batch_size,
+                          poll_interval=0.05, use_semaphore=args.semaphore)
+    started = time.monotonic()
+    sent = 0
+    while True:
+        outcomes = worker.run_once()
+        sent += outcomes.get('sent', 0)
+        if not outcomes:
+            conn = get_db()
+            try:
+                stats = outbox_stats(conn)
+            finally:
+                conn.close()
+            if not stats.get('queued') and not stats.get('sending'):
+                break
+            time.sleep(0.05)  # only retries waiting out their backoff are left
+    elapsed = time.monotonic() - started
+    worker.stop()
+
+    conn = get_db()
+    try:
+        stats = outbox_stats(conn)
+        retried = conn.execute("SELECT COUNT(*) FROM sms_outbox WHERE attempts > 1").fetchone()[0]
+    finally:
+        conn.close()
+    print(f"messages={args.messages} concurrency={args.concurrency} elapsed={elapsed:.2f}s "
+          f"throughput={sent / elapsed if elapsed else 0:.1f}/s")
+    print(f"outbox={stats} retried={retried}")
+    if provider is not None:
+        print(f"provider={provider.counts} max_in_flight={provider.max_in_flight}")
+
+
+if __name__ == "__main__":
+    main()
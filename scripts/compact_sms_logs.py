@@ -0,0 +1,63 @@
+"""
+Compress existing sms_logs rows into template references (see utils/sms_log_store.py).
+
+Matches each full-text log row against every template body the app knows about (the
+sms_templates table, data/sms_templates.json, campaign bodies and the built-in reminder
+texts) and stores the template id plus values instead. A row changes only when its
+template renders back to exactly the stored text; everything else is left as it is.
+Works in batches, one commit per batch, so it can run while the app is serving.
+
+Usage:
+  python scripts/compact_sms_logs.py --dry-run        # count matches and bytes saved
+  python scripts/compact_sms_logs.py --batch-size 1000
+  python scripts/compact_sms_logs.py --vacuum         # SQLite: give the space back afterwards
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from utils.sms_log_store import compact_existing  # noqa: E402
+from utils.template_store import DEFAULT_REMINDER_TEMPLATE, OLD_DEFAULT_REMINDER_TEMPLATE, json_templates  # noqa: E402
+
+
+def known_templates(conn):
+    """Every template body a logged message may have been rendered from."""
+    c = conn.cursor()
+    sources = [DEFAULT_REMINDER_TEMPLATE, OLD_DEFAULT_REMINDER_TEMPLATE]
+    for query in ('SELECT body FROM sms_log_templates',
+                  'SELECT template_content FROM sms_templates',
+                  'SELECT body FROM sms_campaigns'):
+        try:
+            c.execute(query)
+            sources.extend(row[0] for row in c.fetchall())
+        except Exception as e:
+            print(f"Skipping templates from '{query}': {e}")
+    sources.extend(tpl.get('body', '') for tpl in json_templates().values())
+    return [s for s in sources if s]
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--batch-size", type=int, default=500, help="log rows scanned per transaction")
+    p.add_argument("--max-batches", type=int, default=None, help="stop after this many batches")
+    p.add_argument("--dry-run", action="store_true", help="only report what would be compacted")
+    p.add_argument("--vacuum", action="store_true", help="run VACUUM afterwards (SQLite)")
+    args = p.parse_args()
+
+    app = create_app()
+    conn = app.get_db()
+    try:
+        stats = compact_existing(conn, known_templates(conn), batch_size=args.batch_size,
+                                 max_batches=args.max_batches, dry_run=args.dry_run)
+        print(stats)
+        if args.vacuum and not args.dry_run:
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Local stand-in for the Twilio Messages and Verify APIs, for load tests without network.
+
+Serves Twilio's wire format so the real SDK can be pointed at it; latency, error and
+rate-limit injection come from utils.sms_providers.FakeProvider.
+
+  POST /2010-04-01/Accounts/<sid>/Messages.json   -> 201 {"sid": "SM...", "status": "queued"}
+  POST /v2/Services/<sid>/Verifications           -> 201 {"sid": "VE...", "status": "pending"}
+  POST /v2/Services/<sid>/VerificationCheck       -> 200 {"status": "approved" | "pending"}
+  GET  /stats                                     -> injected-fault counters
+
+Usage:
+  python scripts/fake_sms_server.py --port 8099 --latency lognormal:-2.5,0.6 --error-rate 0.02 --max-rps 100
+  TWILIO_API_BASE_URL=http://127.0.0.1:8099 TWILIO_ACCOUNT_SID=AC1 TWILIO_AUTH_TOKEN=x \
+      TWILIO_FROM=+15550000000 python scripts/sms_outbox_worker.py
+
+The FAKE_SMS_* environment variables (see utils/sms_providers.py) are the defaults for
+the matching options.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sms_providers import FakeProvider  # noqa: E402
+from utils.twilio_client import ProviderHTTPError  # noqa: E402
+
+_MESSAGES = re.compile(r'^/2010-04-01/Accounts/(?P<account>[^/]+)/Messages\.json$')
+_VERIFICATIONS = re.compile(r'^/v2/Services/(?P<service>[^/]+)/Verifications$')
+_VERIFICATION_CHECK = re.compile(r'^/v2/Services/(?P<service>[^/]+)/VerificationCheck$')
+
+# Twilio error codes the SDK and the outbox understand
+_ERROR_CODES = {400: 21211, 429: 20429, 500: 20500}
+
+
+def make_handler(provider: FakeProvider):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _reply(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _form(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length).decode('utf-8') if length else ''
+            return {k: v[0] for k, v in parse_qs(raw).items()}
+
+        def _error(self, exc: ProviderHTTPError):
+            headers = {'Retry-After': '1'} if exc.status == 429 else None
+            self._reply(exc.status, {'code': _ERROR_CODES.get(exc.status, 20001), 'message': str(exc),
+                                     'status': exc.status}, headers)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, dict(provider.counts, max_in_flight=provider.max_in_flight))
+            else:
+                self._reply(404, {'code': 20404, 'message': 'Not Found', 'status': 404})
+
+        def do_POST(self):
+            form = self._form()
+            try:
+                match = _MESSAGES.match(self.path)
+                if match:
+                    sid, status = provider.send(form.get('To', ''), form.get('Body', ''))
+                    self._reply(201, {'sid': sid, 'status': status, 'to': form.get('To'),
+                                      'from': form.get('From'), 'body': form.get('Body'),
+                                      'account_sid': match.group('account'), 'num_segments': '1'})
+                    return
+                match = _VERIFICATIONS.match(self.path)
+                if match:
+                    sid, status = provider.start_verification(form.get('To', ''))
+                    self._reply(201, {'sid': sid, 'status': status, 'to': form.get('To'),
+                                      'service_sid': match.group('service'), 'channel': 'sms'})
+                    return
+                match = _VERIFICATION_CHECK.match(self.path)
+                if match:
+                    approved = provider.check_verification(form.get('To', ''), form.get('Code', ''))
+                    self._reply(200, {'status': 'approved' if approved else 'pending',
+                                      'valid': approved, 'to': form.get('To'),
+                                      'service_sid': match.group('service')})
+                    return
+            except ProviderHTTPError as e:
+                self._error(e)
+                return
+            self._reply(404, {'code': 20404, 'message': 'Not Found', 'status': 404})
+
+    return Handler
+
+
+def make_server(provider: FakeProvider, host: str = '127.0.0.1', port: int = 8099) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(provider))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--latency", default=None, help="latency spec, e.g. uniform:0.02,0.2")
+    p.add_argument("--error-rate", type=float, default=None, help="share of transient 500s")
+    p.add_argument("--permanent-error-rate", type=float, default=None, help="share of permanent 400s")
+    p.add_argument("--max-rps", type=float, default=None, help="429 above this many requests/second")
+    args = p.parse_args()
+
+    provider = FakeProvider(latency=args.latency, error_rate=args.error_rate,
+                            permanent_error_rate=args.permanent_error_rate, max_rps=args.max_rps)
+    server = make_server(provider, args.host, args.port)
+    print(f"Fake SMS provider on http://{args.host}:{args.port} (latency={provider.latency_spec}, "
+          f"errors={provider.error_rate}, permanent={provider.permanent_error_rate}, max_rps={provider.max_rps})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping fake SMS provider")
+        print(dict(provider.counts, max_in_flight=provider.max_in_flight))
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
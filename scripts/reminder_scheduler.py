@@ -0,0 +1,64 @@
+"""
+Periodic appointment reminder scheduler (see utils/reminder_scheduler.py).
+
+Safe to run on more than one machine: each appointment is claimed once in
+`appointment_reminders_sent`, and the messages go out through the SMS outbox worker.
+
+Usage:
+  python scripts/reminder_scheduler.py                 # run every --interval seconds
+  python scripts/reminder_scheduler.py --once          # one pass (e.g. from cron)
+  python scripts/reminder_scheduler.py --once --dry-run
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from utils.reminder_scheduler import run_reminders  # noqa: E402
+
+
+def run_pass(app, dry_run=False):
+    conn = app.get_db()
+    try:
+        return run_reminders(conn, dry_run=dry_run)
+    finally:
+        conn.close()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--interval", type=float, default=300.0, help="seconds between passes")
+    p.add_argument("--once", action="store_true", help="run a single pass and exit")
+    p.add_argument("--dry-run", action="store_true", help="only count due reminders")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+
+    if args.once or args.dry_run:
+        print(run_pass(app, dry_run=args.dry_run))
+        return
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    print(f"Starting reminder scheduler (interval={args.interval}s)")
+    try:
+        while not stop.is_set():
+            try:
+                stats = run_pass(app)
+                if stats['due']:
+                    print(f"reminders: {stats}")
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Reminder pass failed: {e}")
+            stop.wait(args.interval)
+    except KeyboardInterrupt:
+        print("Stopping reminder scheduler")
+
+
+if __name__ == "__main__":
+    main()
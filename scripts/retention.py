@@ -0,0 +1,68 @@
+"""
+Periodic retention pass for sms_logs, user_activity, sms_outbox and appointment_changes
+(see utils/retention.py).
+
+Rolls raw rows older than their retention window up into sms_log_daily /
+user_activity_daily and deletes them in small batches; finished outbox rows and old
+change-feed rows are deleted without a rollup. Runs once a day by default
+(Procfile `retention`); use --once from cron instead if you prefer.
+
+Usage:
+  python scripts/retention.py                      # run every --interval seconds
+  python scripts/retention.py --once               # one pass
+  python scripts/retention.py --dry-run            # report what would be rolled up
+  python scripts/retention.py --once --vacuum      # reclaim the file space afterwards (SQLite)
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from utils.retention import run_retention  # noqa: E402
+
+
+def run_pass(app, dry_run=False, vacuum=False, batch_size=None):
+    conn = app.get_db()
+    try:
+        return run_retention(conn, dry_run=dry_run, vacuum=vacuum, batch_size=batch_size)
+    finally:
+        conn.close()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--interval", type=float, default=86400.0, help="seconds between passes")
+    p.add_argument("--once", action="store_true", help="run a single pass and exit")
+    p.add_argument("--dry-run", action="store_true", help="only report eligible rows per table")
+    p.add_argument("--vacuum", action="store_true", help="VACUUM after a pass that deleted rows")
+    p.add_argument("--batch-size", type=int, default=None, help="rows rolled up per transaction")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+
+    if args.once or args.dry_run:
+        print(run_pass(app, dry_run=args.dry_run, vacuum=args.vacuum, batch_size=args.batch_size))
+        return
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    print(f"Starting retention scheduler (interval={args.interval}s)")
+    try:
+        while not stop.is_set():
+            try:
+                print(f"retention: {run_pass(app, vacuum=args.vacuum, batch_size=args.batch_size)}")
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Retention pass failed: {e}")
+            stop.wait(args.interval)
+    except KeyboardInterrupt:
+        print("Stopping retention scheduler")
+
+
+if __name__ == "__main__":
+    main()
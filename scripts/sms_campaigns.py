@@ -0,0 +1,95 @@
+"""
+Bulk SMS campaign dispatcher and command-line admin (see utils/sms_campaigns.py).
+
+Without arguments it runs as a background process (Procfile `campaigns`), moving the
+recipients of every running campaign into the SMS outbox; the outbox worker does the
+sending. Several dispatchers may run: each campaign is leased to one at a time.
+
+Usage:
+  python scripts/sms_campaigns.py                                   # dispatch loop
+  python scripts/sms_campaigns.py --once                            # one pass
+  python scripts/sms_campaigns.py --create "Rabies week" --template welcome_message --segment marketing
+  python scripts/sms_campaigns.py --start 3
+  python scripts/sms_campaigns.py --status 3
+  python scripts/sms_campaigns.py --cancel 3
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from utils.sms_campaigns import (SEGMENTS, campaign_progress, cancel_campaign, create_campaign,  # noqa: E402
+                                 run_campaigns, start_campaign)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--interval", type=float, default=15.0, help="seconds between dispatch passes")
+    p.add_argument("--once", action="store_true", help="run a single dispatch pass and exit")
+    p.add_argument("--batch-size", type=int, default=None, help="recipients queued per transaction")
+    p.add_argument("--create", metavar="NAME", help="create a draft campaign")
+    p.add_argument("--template", help="sms_templates name for --create")
+    p.add_argument("--body", help="message text for --create ({{name}} is filled in)")
+    p.add_argument("--segment", default="marketing", choices=sorted(SEGMENTS), help="opt-in segment")
+    p.add_argument("--service", help="only users who booked this service")
+    p.add_argument("--rate", type=float, default=None, help="messages released per minute")
+    p.add_argument("--start", type=int, metavar="ID", help="start a draft campaign")
+    p.add_argument("--cancel", type=int, metavar="ID", help="cancel a campaign")
+    p.add_argument("--status", type=int, metavar="ID", help="print live counts for a campaign")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+
+    if args.create or args.start or args.cancel or args.status:
+        conn = app.get_db()
+        try:
+            if args.create:
+                campaign_id = create_campaign(conn, args.create, body=args.body, template_name=args.template,
+                                              segment=args.segment, service=args.service,
+                                              rate_per_minute=args.rate, created_by='cli')
+                print(f"created campaign {campaign_id}: {campaign_progress(conn.cursor(), campaign_id)}")
+            if args.start:
+                print("started" if start_campaign(conn, args.start) else "not a draft campaign")
+            if args.cancel:
+                print(cancel_campaign(conn, args.cancel))
+            if args.status:
+                print(campaign_progress(conn.cursor(), args.status))
+        finally:
+            conn.close()
+        return
+
+    def run_pass():
+        conn = app.get_db()
+        try:
+            return run_campaigns(conn, batch_size=args.batch_size)
+        finally:
+            conn.close()
+
+    if args.once:
+        print(run_pass())
+        return
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    print(f"Starting campaign dispatcher (interval={args.interval}s)")
+    try:
+        while not stop.is_set():
+            try:
+                results = run_pass()
+                if results:
+                    print(f"campaigns: {results}")
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Campaign pass failed: {e}")
+            stop.wait(args.interval)
+    except KeyboardInterrupt:
+        print("Stopping campaign dispatcher")
+
+
+if __name__ == "__main__":
+    main()
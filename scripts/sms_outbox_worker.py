@@ -0,0 +1,77 @@
+"""
+Worker process that drains the SMS outbox (see utils/sms_outbox.py).
+
+Run one or more of these next to the web process (Procfile `worker`, supervisor, systemd).
+Concurrency across all workers is bounded by the Redis semaphore; acquires seed it with
+SMS_OUTBOX_CONCURRENCY permits whenever it is missing from Redis (first start, a Redis
+restart without persistence, a flush).
+
+Usage:
+  python scripts/sms_outbox_worker.py                  # run until interrupted
+  python scripts/sms_outbox_worker.py --once           # drain one batch and exit
+  python scripts/sms_outbox_worker.py --stats          # print outbox counts per status
+  python scripts/sms_outbox_worker.py --requeue-dead   # retry dead-lettered messages
+
+Requires: Twilio env vars (see utils/sms.py); REDIS_URL for the shared semaphore.
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from utils.sms_outbox import CONCURRENCY, SEMAPHORE_NAME, OutboxWorker, outbox_stats, requeue_dead  # noqa: E402
+
+
+def _ensure_semaphore(permits: int) -> None:
+    # The Redis token list is seeded by the acquires themselves (OutboxWorker passes
+    # permits=), so a restarting worker doesn't wipe permits other workers hold and a
+    # Redis that was down at boot is picked up later. Only the local fallback needs it here.
+    from utils import local_semaphore
+    local_semaphore.configure(SEMAPHORE_NAME, permits)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--concurrency", type=int, default=CONCURRENCY, help="sends in flight per process")
+    p.add_argument("--batch-size", type=int, default=20, help="rows claimed per poll")
+    p.add_argument("--interval", type=float, default=2.0, help="poll interval seconds when idle")
+    p.add_argument("--once", action="store_true", help="process one batch and exit")
+    p.add_argument("--stats", action="store_true", help="print outbox counts and exit")
+    p.add_argument("--requeue-dead", action="store_true", help="requeue dead-lettered messages and exit")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+
+    if args.stats or args.requeue_dead:
+        conn = app.get_db()
+        try:
+            if args.requeue_dead:
+                print(f"requeued {requeue_dead(conn)} messages")
+            print(outbox_stats(conn))
+        finally:
+            conn.close()
+        return
+
+    _ensure_semaphore(CONCURRENCY)
+    worker = OutboxWorker(app.get_db, concurrency=args.concurrency,
+                          batch_size=args.batch_size, poll_interval=args.interval)
+    if args.once:
+        print(worker.run_once())
+        return
+
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    try:
+        print(f"Starting SMS outbox worker {worker.worker_id} (concurrency={worker.concurrency})")
+        worker.run_forever()
+    except KeyboardInterrupt:
+        print("Stopping SMS outbox worker")
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Shared fixtures: a throwaway SQLite database with the schema the app itself builds."""
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# init_db doesn't create appointments (db/users.db predates it); same columns as there,
+# created first so update_db_schema adds its indexes and triggers as it does in production
+APPOINTMENTS_DDL = '''
+    CREATE TABLE appointments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        service TEXT NOT NULL,
+        appointment_date TEXT NOT NULL,
+        appointment_time TEXT NOT NULL,
+        patient_name TEXT NOT NULL,
+        patient_address TEXT,
+        patient_age INTEGER,
+        patient_gender TEXT,
+        patient_phone TEXT,
+        branch TEXT,
+        patient_email TEXT,
+        status TEXT DEFAULT 'pending',
+        price REAL NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        animal_type TEXT, exposure_type TEXT, bite_location TEXT, category TEXT, animal_etc_text TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+'''
+
+
+def pytest_configure(config):
+    # tests that call create_app themselves (test_db, test_full_booking, ...) get a copy of
+    # db/users.db, so a test run never migrates or writes the tracked file
+    config._sqlite_dir = tempfile.mkdtemp(prefix='users-db-')
+    path = os.path.join(config._sqlite_dir, 'users.db')
+    shutil.copy(os.path.join(ROOT, 'db', 'users.db'), path)
+    os.environ['SQLITE_PATH'] = path
+    os.environ.pop('DATABASE_URL', None)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(getattr(config, '_sqlite_dir', ''), ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def schema_db(tmp_path_factory):
+    """Path of a database built by init_db and update_db_schema (copy it, don't write to it)."""
+    path = str(tmp_path_factory.mktemp('schema') / 'schema.db')
+    conn = sqlite3.connect(path)
+    conn.execute(APPOINTMENTS_DDL)
+    conn.close()
+    # in a child process: create_app registers module-level blueprints and can only run once
+    env = dict(os.environ, SQLITE_PATH=path)
+    env.pop('DATABASE_URL', None)
+    subprocess.run([sys.executable, '-c', 'from app import create_app; create_app()'],
+                   cwd=ROOT, env=env, check=True, capture_output=True)
+    return path
+
+
+@pytest.fixture
+def get_db(schema_db, tmp_path):
+    """Connection factory (sqlite3.Row rows) for a fresh copy of the app schema."""
+    path = str(tmp_path / 'app.db')
+    shutil.copy(schema_db, path)
+
+    def connect():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    return connect
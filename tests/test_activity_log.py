@@ -0,0 +1,86 @@
+"""Tests for utils.activity_log (buffered, batched user_activity writes)."""
+import sqlite3
+import time
+from datetime import datetime
+
+from utils.activity_log import ActivityLogger, insert_rows
+
+
+def _get_db(tmp_path):
+    path = str(tmp_path / 'activity.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE user_activity (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+                                    activity_type TEXT NOT NULL, activity_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                    ip_address TEXT, user_agent TEXT)
+    ''')
+    conn.commit()
+    conn.close()
+    return lambda: sqlite3.connect(path)
+
+
+def _rows(get_db):
+    conn = get_db()
+    rows = conn.execute('SELECT user_id, activity_type, activity_time, ip_address, user_agent '
+                        'FROM user_activity ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+
+def test_insert_rows_chunks_multi_row_statements(tmp_path):
+    get_db = _get_db(tmp_path)
+    conn = get_db()
+    rows = [(i, 'login', '2025-01-02 08:00:00', '10.0.0.1', 'ua') for i in range(400)]
+    assert insert_rows(conn, rows) == 400
+    conn.close()
+    assert len(_rows(get_db)) == 400
+
+
+def test_events_wait_in_the_buffer_until_flushed(tmp_path):
+    get_db = _get_db(tmp_path)
+    activity = ActivityLogger(get_db, flush_size=100, flush_interval=60)
+    activity.add(1, 'login', '10.0.0.1', 'x' * 500, at=datetime(2025, 1, 2, 8, 0, 0))
+    activity.add(1, 'booking')
+    assert activity.pending() == 2 and _rows(get_db) == []
+
+    assert activity.close() == 2
+    rows = _rows(get_db)
+    assert rows[0] == (1, 'login', '2025-01-02 08:00:00', '10.0.0.1', 'x' * 255)
+    assert rows[1][:2] == (1, 'booking')
+
+
+def test_background_thread_flushes_on_size_and_interval(tmp_path):
+    get_db = _get_db(tmp_path)
+    activity = ActivityLogger(get_db, flush_size=3, flush_interval=0.05)
+    for user_id in range(3):
+        activity.add(user_id, 'login')
+    deadline = time.monotonic() + 2
+    while activity.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert activity.pending() == 0 and len(_rows(get_db)) == 3
+
+    activity.add(9, 'logout')
+    deadline = time.monotonic() + 2
+    while len(_rows(get_db)) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(_rows(get_db)) == 4
+    activity.close()
+
+
+def test_failed_writes_stay_buffered_and_are_bounded(tmp_path):
+    calls = []
+
+    def broken_db():
+        calls.append(1)
+        raise sqlite3.OperationalError('database is locked')
+
+    activity = ActivityLogger(broken_db, flush_size=100, flush_interval=60, max_buffered=3)
+    for user_id in range(5):
+        activity.add(user_id, 'login')
+    assert activity.pending() == 3 and activity.dropped == 2
+    assert activity.flush() == 0 and activity.pending() == 3
+
+    get_db = _get_db(tmp_path)
+    activity.get_db = get_db
+    assert activity.close() == 3
+    assert [row[0] for row in _rows(get_db)] == [2, 3, 4]
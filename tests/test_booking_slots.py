@@ -0,0 +1,63 @@
+"""Tests for the precomputed calendar occupancy helpers in utils.booking_slots."""
+import sqlite3
+
+from utils import booking_slots
+from utils.booking_slots import fetch_slot_counts, has_capacity, month_occupancy, rebuild_occupancy
+
+
+def _conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        CREATE TABLE appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            appointment_date TEXT NOT NULL,
+            appointment_time TEXT NOT NULL,
+            status TEXT DEFAULT 'pending'
+        );
+        CREATE TABLE calendar_occupancy (
+            slot_date TEXT NOT NULL,
+            slot_time TEXT NOT NULL,
+            booked INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (slot_date, slot_time)
+        );
+    ''')
+    conn.executemany(
+        'INSERT INTO appointments (appointment_date, appointment_time, status) VALUES (?, ?, ?)',
+        [
+            ('2025-10-27', '9:00', 'pending'),
+            ('2025-10-27', '09:00', 'confirmed'),
+            ('2025-10-27', '10:00', 'cancelled'),
+            ('2025-10-25', '8:00', 'pending'),
+            ('2025-11-03', '9:00', 'pending'),
+        ],
+    )
+    conn.commit()
+    return conn
+
+
+def test_rebuild_merges_padded_times_and_skips_cancelled():
+    conn = _conn()
+    assert rebuild_occupancy(conn) == 3
+    counts = fetch_slot_counts(conn.cursor(), '2025-10-01', '2025-10-31')
+    assert counts == {('2025-10-27', '9:00'): 2, ('2025-10-25', '8:00'): 1}
+
+
+def test_month_occupancy_reports_capacity_per_day():
+    conn = _conn()
+    rebuild_occupancy(conn)
+    days = month_occupancy(conn.cursor(), '2025-10', capacity=5)
+    assert set(days) == {'2025-10-25', '2025-10-27'}
+    # weekdays have 9 hourly slots, Saturdays 7
+    assert days['2025-10-27'] == {'booked': 2, 'capacity': 45, 'slots': {'9:00': 2}}
+    assert days['2025-10-25']['capacity'] == 35
+
+
+def test_no_configured_capacity_means_no_limit(monkeypatch):
+    monkeypatch.setattr(booking_slots, 'SLOT_CAPACITY', None)
+    counts = {('2025-10-27', '9:00'): 40}
+    assert has_capacity(counts, '2025-10-27', '09:00')
+    assert not has_capacity(counts, '2025-10-27', '09:00', capacity=40)
+    conn = _conn()
+    rebuild_occupancy(conn)
+    assert month_occupancy(conn.cursor(), '2025-10')['2025-10-27']['capacity'] is None
@@ -0,0 +1,190 @@
+"""Tests for the calendar JSON feeds (routes_calendar) on the schema built by update_db_schema."""
+import importlib
+from datetime import date, timedelta
+
+import pytest
+from flask import Flask
+
+import routes_calendar
+
+
+@pytest.fixture(scope='module')
+def calendar_app():
+    # routes are added to the module-level blueprint inside init_calendar_routes, and
+    # create_app may already have registered it in this process: start from a fresh one
+    module = importlib.reload(routes_calendar)
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config['TESTING'] = True
+    app.db_factory = None
+    module.init_calendar_routes(app, lambda: app.db_factory())
+    return app
+
+
+@pytest.fixture
+def client(calendar_app, get_db):
+    calendar_app.db_factory = get_db
+    client = calendar_app.test_client()
+    with client.session_transaction() as sess:
+        sess['admin_logged_in'] = True
+    return client
+
+
+@pytest.fixture
+def conn(get_db):
+    conn = get_db()
+    conn.execute("INSERT INTO users (id, name, email, password_hash) VALUES (1, 'Ana', 'ana@example.com', 'x')")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _book(conn, day='2025-10-27', time='9:00', name='Ana', status='pending'):
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO appointments (user_id, service, appointment_date, appointment_time, patient_name, status, price)
+        VALUES (1, 'Anti-Rabies', ?, ?, ?, ?, 0)
+    ''', (day, time, name, status))
+    conn.commit()
+    return c.lastrowid
+
+
+def _window(client, start='2025-10-26T00:00:00+08:00', end='2025-11-02T00:00:00+08:00', etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    return client.get('/api/appointments', query_string={'start': start, 'end': end}, headers=headers)
+
+
+def _changes(client, since, **params):
+    return client.get('/api/appointments/changes', query_string=dict(params, since=since)).get_json()
+
+
+def test_triggers_record_every_write_in_seq_order(conn):
+    appt = _book(conn)
+    conn.execute("UPDATE appointments SET status = 'confirmed' WHERE id = ?", (appt,))
+    conn.execute('DELETE FROM appointments WHERE id = ?', (appt,))
+    conn.commit()
+    rows = [tuple(r) for r in conn.execute('SELECT seq, appointment_id, change_type FROM appointment_changes')]
+    assert rows == [(1, appt, 'insert'), (2, appt, 'update'), (3, appt, 'delete')]
+
+
+def test_first_poll_hands_out_the_cursor(client, conn):
+    _book(conn)
+    assert _changes(client, None) == {'cursor': 1, 'changes': [], 'more': False, 'reset': False}
+
+
+def test_changes_collapse_to_the_current_state(client, conn):
+    appt = _book(conn)
+    conn.execute("UPDATE appointments SET status = 'confirmed' WHERE id = ?", (appt,))
+    conn.execute("UPDATE appointments SET appointment_time = '10:30' WHERE id = ?", (appt,))
+    conn.commit()
+
+    body = _changes(client, 0)
+    assert body['cursor'] == 3 and body['more'] is False and body['reset'] is False
+    assert body['changes'] == [{'op': 'upsert', 'id': appt, 'event': {
+        'id': appt, 'start': '2025-10-27T10:30', 'status': 'confirmed',
+        'patient_name': 'Ana', 'service': 'Anti-Rabies'}}]
+    assert _changes(client, 3)['changes'] == []
+
+
+def test_cancel_archive_and_delete_become_removes(client, conn):
+    cancelled, archived, deleted, kept = (_book(conn, time=f'{9 + i}:00') for i in range(4))
+    start = _changes(client, None)['cursor']
+
+    conn.execute("UPDATE appointments SET status = 'cancelled' WHERE id = ?", (cancelled,))
+    # archiving (routes.admin_archive_appointment) copies the row, then deletes it
+    conn.execute('CREATE TABLE archived_appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                 'original_appointment_id INTEGER, data TEXT)')
+    conn.execute('INSERT INTO archived_appointments (original_appointment_id) VALUES (?)', (archived,))
+    conn.execute('DELETE FROM appointments WHERE id = ?', (archived,))
+    conn.execute('DELETE FROM appointments WHERE id = ?', (deleted,))
+    conn.execute("UPDATE appointments SET status = 'completed' WHERE id = ?", (kept,))
+    conn.commit()
+
+    changes = _changes(client, start)['changes']
+    assert [(ch['op'], ch['id']) for ch in changes] == [
+        ('remove', cancelled), ('remove', archived), ('remove', deleted), ('upsert', kept)]
+
+
+def test_pages_follow_the_cursor(client, conn):
+    ids = [_book(conn, time=f'{8 + i}:00') for i in range(5)]
+
+    first = _changes(client, 0, limit=2)
+    assert [ch['id'] for ch in first['changes']] == ids[:2] and first['more'] is True
+    second = _changes(client, first['cursor'], limit=2)
+    assert [ch['id'] for ch in second['changes']] == ids[2:4] and second['more'] is True
+    last = _changes(client, second['cursor'], limit=2)
+    assert [ch['id'] for ch in last['changes']] == ids[4:] and last['more'] is False
+    assert last['cursor'] == 5
+
+
+def test_stale_cursors_are_told_to_reset(client, conn):
+    for i in range(4):
+        _book(conn, time=f'{8 + i}:00')
+    # a cursor from a rebuilt (smaller) change table
+    assert _changes(client, 99) == {'cursor': 4, 'changes': [], 'more': False, 'reset': True}
+
+    # history before seq 3 pruned: cursor 1 has missed seq 2
+    conn.execute('DELETE FROM appointment_changes WHERE seq < 3')
+    conn.commit()
+    assert _changes(client, 1) == {'cursor': 4, 'changes': [], 'more': False, 'reset': True}
+    assert [ch['id'] for ch in _changes(client, 2)['changes']] == [3, 4]
+
+
+def test_window_parsing():
+    assert routes_calendar._parse_window('2025-09-28T00:00:00+08:00', '2025-11-09T00:00:00+08:00') == (
+        '2025-09-28', '2025-11-09')
+    assert routes_calendar._parse_window('2025-10-01', '2025-10-01') == ('2025-10-01', '2025-10-02')
+    assert routes_calendar._parse_window('2025-10-01', 'garbage') == ('2025-10-01', '2026-01-02')
+    today = date.today()
+    assert routes_calendar._parse_window(None, None) == (
+        (today - timedelta(days=31)).isoformat(), (today + timedelta(days=62)).isoformat())
+
+
+def test_only_the_visible_window_is_returned(client, conn):
+    inside = _book(conn, day='2025-10-27')
+    _book(conn, day='2025-10-28', status='cancelled')
+    _book(conn, day='2025-11-02')  # end is exclusive
+    _book(conn, day='2025-10-25')
+
+    resp = _window(client)
+    assert resp.status_code == 200
+    assert [event['id'] for event in resp.get_json()] == [inside]
+    assert resp.headers['ETag'] and resp.headers['Cache-Control'] == 'private, no-cache'
+
+
+def test_unchanged_window_revalidates_with_304(client, conn):
+    _book(conn, day='2025-10-27')
+    etag = _window(client).headers['ETag']
+
+    resp = _window(client, etag=etag)
+    assert resp.status_code == 304 and resp.headers['ETag'] == etag
+    # another window has its own ETag, and writes outside this window keep it valid
+    assert _window(client, start='2025-11-02', end='2025-11-09').headers['ETag'] != etag
+    _book(conn, day='2025-11-05')
+    assert _window(client, etag=etag).status_code == 304
+
+
+def test_status_change_or_delete_in_the_window_changes_the_etag(client, conn):
+    appt = _book(conn, day='2025-10-27')
+    other = _book(conn, day='2025-10-28')
+    etag = _window(client).headers['ETag']
+
+    # status updates stamp updated_at (routes_appointments.update_appointment_status)
+    conn.execute("UPDATE appointments SET status = 'confirmed', updated_at = '2099-01-01T00:00:00' WHERE id = ?",
+                 (appt,))
+    conn.commit()
+    resp = _window(client, etag=etag)
+    assert resp.status_code == 200 and resp.get_json()[0]['status'] == 'confirmed'
+    etag = resp.headers['ETag']
+
+    # the newest row going away can lower MAX(updated_at); COUNT(*) still changes the ETag
+    conn.execute('DELETE FROM appointments WHERE id = ?', (appt,))
+    conn.commit()
+    resp = _window(client, etag=etag)
+    assert resp.status_code == 200 and [event['id'] for event in resp.get_json()] == [other]
+    etag = resp.headers['ETag']
+
+    conn.execute("UPDATE appointments SET status = 'cancelled' WHERE id = ?", (other,))
+    conn.commit()
+    resp = _window(client, etag=etag)
+    assert resp.status_code == 200 and resp.get_json() == []
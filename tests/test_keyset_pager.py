@@ -0,0 +1,75 @@
+"""Tests for utils.keyset_pager (seek pagination and cached filter totals)."""
+import sqlite3
+
+import pytest
+
+from utils.keyset_pager import cached_count, clear_count_cache, keyset_page
+
+ORDER = [('appointment_date', 'appointment_date'), ('appointment_time', 'appointment_time'), ('id', 'id')]
+SELECT = 'SELECT id, appointment_date, appointment_time, status FROM appointments'
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE appointments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        appointment_date TEXT NOT NULL,
+        appointment_time TEXT NOT NULL,
+        status TEXT)''')
+    # several rows share a slot so the id tiebreaker matters
+    conn.executemany(
+        'INSERT INTO appointments (appointment_date, appointment_time, status) VALUES (?, ?, ?)',
+        [('2025-10-%02d' % (i // 3 + 1), '9:00', 'pending' if i % 2 else 'confirmed') for i in range(23)],
+    )
+    clear_count_cache()
+    yield conn.cursor()
+    conn.close()
+
+
+def test_pages_forward_and_back_without_gaps(cursor):
+    seen = []
+    page = keyset_page(cursor, SELECT, '', [], ORDER, per_page=5)
+    assert not page.has_prev
+    pages = [page]
+    while page.has_next:
+        page = keyset_page(cursor, SELECT, '', [], ORDER, after=page.next_cursor, per_page=5)
+        pages.append(page)
+    for p in pages:
+        seen.extend(row['id'] for row in p.items)
+    assert seen == list(range(23, 0, -1))
+
+    back = keyset_page(cursor, SELECT, '', [], ORDER, before=pages[-1].prev_cursor, per_page=5)
+    assert back.items == pages[-2].items
+    assert back.has_next and back.has_prev
+
+
+def test_filters_and_bad_cursor(cursor):
+    page = keyset_page(cursor, SELECT, 'status = ?', ['pending'], ORDER, after='not-a-cursor', per_page=50)
+    assert len(page.items) == 11 and not page.has_next and not page.has_prev
+
+
+def test_cached_count_reuses_until_version_changes(cursor):
+    sql = 'SELECT COUNT(*) FROM appointments WHERE status = ?'
+    assert cached_count(cursor, sql, ['pending'], 'appointments', version=1) == 11
+    cursor.execute("INSERT INTO appointments (appointment_date, appointment_time, status) VALUES ('2025-11-01', '9:00', 'pending')")
+    assert cached_count(cursor, sql, ['pending'], 'appointments', version=1) == 11
+    assert cached_count(cursor, sql, ['pending'], 'appointments', version=2) == 12
+
+
+def test_inventory_transaction_writes_bump_the_count_version(get_db):
+    conn = get_db()
+
+    def version():
+        row = conn.execute("SELECT version FROM table_versions WHERE table_name = 'inventory_transactions'").fetchone()
+        return row[0] if row else 0
+
+    conn.execute("INSERT INTO inventory_items (id, name, unit) VALUES (1, 'Vaccine', 'vial')")
+    conn.execute("INSERT INTO inventory_transactions (item_id, transaction_type, quantity) VALUES (1, 'in', 5)")
+    conn.execute("INSERT INTO inventory_transactions (item_id, transaction_type, quantity) VALUES (1, 'out', 1)")
+    assert version() == 2
+    # a delete leaves MAX(id) alone but must still invalidate the cached total
+    conn.execute('DELETE FROM inventory_transactions WHERE id = 1')
+    assert version() == 3
+    conn.close()
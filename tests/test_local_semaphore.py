@@ -0,0 +1,85 @@
+"""Tests for utils.local_semaphore (thread and cross-process permits) and the Redis fallback path."""
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from utils import local_semaphore, redis_client, redis_semaphore
+from utils.local_semaphore import LocalSemaphore
+
+
+def test_bounds_threads_and_ignores_double_release(tmp_path):
+    sem = LocalSemaphore('t:sem', permits=2, lock_dir=str(tmp_path))
+    a, b = sem.acquire(0.1), sem.acquire(0.1)
+    assert a and b and a != b
+    assert sem.acquire(0.05) is None
+    assert sem.release(a)
+    assert not sem.release(a)
+    assert sem.acquire(0.1)
+    m = sem.metrics
+    assert (m['acquired'], m['released'], m['timeouts'], m['in_use'], m['max_in_use']) == (3, 1, 1, 2, 2)
+
+
+def _hold(lock_dir, ready, done):
+    sem = LocalSemaphore('t:xproc', permits=1, lock_dir=lock_dir)
+    token = sem.acquire(1)
+    ready.set()
+    done.wait(5)
+    if token:
+        sem.release(token)
+
+
+@pytest.mark.skipif(local_semaphore.fcntl is None, reason="needs fcntl")
+def test_permits_are_shared_across_processes(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    ready, done = ctx.Event(), ctx.Event()
+    child = ctx.Process(target=_hold, args=(str(tmp_path), ready, done))
+    child.start()
+    try:
+        assert ready.wait(5)
+        sem = LocalSemaphore('t:xproc', permits=1, lock_dir=str(tmp_path))
+        assert sem.acquire(0.1) is None
+        done.set()
+        child.join(5)
+        assert sem.acquire(1)
+    finally:
+        done.set()
+        child.join(5)
+
+
+@pytest.mark.skipif(local_semaphore.fcntl is None, reason="needs fcntl")
+def test_crashed_holder_frees_its_permit(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    ready, never = ctx.Event(), ctx.Event()
+    child = ctx.Process(target=_hold, args=(str(tmp_path), ready, never))
+    child.start()
+    assert ready.wait(5)
+    child.kill()
+    child.join(5)
+    assert LocalSemaphore('t:xproc', permits=1, lock_dir=str(tmp_path)).acquire(1)
+
+
+def test_redis_semaphore_falls_back_to_bounded_local_permits(tmp_path, monkeypatch):
+    breaker = redis_client.CircuitBreaker(failure_threshold=1, reset_timeout=float('inf'))
+    breaker.record_failure()
+    monkeypatch.setattr(redis_client, 'breaker', breaker)
+    monkeypatch.setattr(local_semaphore, 'LOCAL_SEMAPHORE_DIR', str(tmp_path))
+    monkeypatch.setattr(local_semaphore, '_semaphores', {})
+
+    redis_semaphore.init_semaphore('t:fallback', permits=2)
+    tokens = [redis_semaphore.acquire_token('t:fallback', timeout=0.1) for _ in range(2)]
+    assert all(local_semaphore.is_local_token(t) for t in tokens)
+
+    got = {}
+    waiter = threading.Thread(target=lambda: got.update(t=redis_semaphore.acquire_token('t:fallback', timeout=2)))
+    started = time.monotonic()
+    waiter.start()
+    time.sleep(0.1)
+    assert 't' not in got
+    redis_semaphore.release_token('t:fallback', tokens[0])
+    waiter.join(3)
+    assert got['t'] and time.monotonic() - started < 2
+
+    metrics = redis_semaphore.fallback_metrics()['t:fallback']
+    assert metrics['acquired'] == 3 and metrics['in_use'] == 2 and metrics['permits'] == 2
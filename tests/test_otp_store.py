@@ -0,0 +1,131 @@
+"""Tests for utils.otp_store (hashed codes, atomic tries, in-memory store); no Redis needed."""
+import os
+import threading
+import uuid
+
+import pytest
+
+from utils import otp_store, redis_client
+from utils.otp_store import EXPIRED, INVALID, LOCKED, VERIFIED, MemoryOTPStore, OTPStoreUnavailable, hash_code
+
+
+@pytest.fixture(autouse=True)
+def _hmac_secret(monkeypatch):
+    monkeypatch.setattr(otp_store, '_secret', b'test-secret')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_memory_store_ttl_tries_and_single_use():
+    clock = Clock()
+    store = MemoryOTPStore(clock=clock)
+    phone = '+639171234567'
+    store.issue(phone, hash_code(phone, '123456'), ttl=300, tries=3)
+    assert store.verify(phone, hash_code(phone, '000000')) == INVALID
+    assert store.verify(phone, hash_code(phone, '123456')) == VERIFIED
+    assert store.verify(phone, hash_code(phone, '123456')) == EXPIRED  # used up
+
+    store.issue(phone, hash_code(phone, '123456'), ttl=300, tries=2)
+    assert store.verify(phone, hash_code(phone, '1')) == INVALID
+    assert store.verify(phone, hash_code(phone, '2')) == INVALID
+    assert store.verify(phone, hash_code(phone, '123456')) == EXPIRED  # out of tries, deleted
+
+    store.issue(phone, hash_code(phone, '123456'), ttl=300, tries=0)
+    assert store.verify(phone, hash_code(phone, '123456')) == LOCKED  # no tries budget, even for the right code
+    assert store.verify(phone, hash_code(phone, '123456')) == EXPIRED  # and the entry is gone
+
+    store.issue(phone, hash_code(phone, '123456'), ttl=300, tries=3)
+    clock.now = 301
+    assert store.verify(phone, hash_code(phone, '123456')) == EXPIRED
+
+
+def test_codes_are_hashed_per_number():
+    assert hash_code('+639171234567', '123456') != hash_code('+639170000000', '123456')
+    store = MemoryOTPStore()
+    store.issue('+639171234567', hash_code('+639171234567', '808080'), ttl=60, tries=3)
+    assert '808080' not in repr(store._codes)
+
+
+def test_concurrent_guesses_never_exceed_the_budget():
+    store = MemoryOTPStore()
+    phone = '+639171234567'
+    store.issue(phone, hash_code(phone, '999999'), ttl=60, tries=3)
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(store.verify(phone, hash_code(phone, str(i)))))
+               for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(INVALID) == 3 and results.count(EXPIRED) == 17
+
+
+def _open_breaker(monkeypatch):
+    breaker = redis_client.CircuitBreaker(failure_threshold=1, reset_timeout=float('inf'))
+    breaker.record_failure()
+    monkeypatch.setattr(redis_client, 'breaker', breaker)
+
+
+def test_memory_mode_uses_the_in_process_store(monkeypatch):
+    _open_breaker(monkeypatch)
+    monkeypatch.setattr(otp_store, 'OTP_STORE', 'memory')
+    monkeypatch.setattr(otp_store, '_memory', MemoryOTPStore())
+    otp_store.issue('+639171234567', '424242')
+    assert otp_store.verify('+639171234567', '000000') == INVALID
+    assert otp_store.verify('+639171234567', ' 424242 ') == VERIFIED
+
+
+def test_no_silent_memory_fallback_without_redis(monkeypatch):
+    _open_breaker(monkeypatch)
+    memory = MemoryOTPStore()
+    monkeypatch.setattr(otp_store, '_memory', memory)
+    with pytest.raises(OTPStoreUnavailable):
+        otp_store.issue('+639171234567', '424242')
+    with pytest.raises(OTPStoreUnavailable):
+        otp_store.verify('+639171234567', '424242')
+    assert not memory._codes
+
+
+def test_send_otp_reports_redis_unavailable(monkeypatch):
+    from utils import sms
+
+    class Provider:
+        supports_verify = False
+
+        def is_configured(self):
+            return True
+
+    _open_breaker(monkeypatch)
+    monkeypatch.setattr(sms, 'hit_key', lambda *a, **k: type('Hit', (), {'allowed': True})())
+    monkeypatch.setattr(sms, 'get_provider', lambda: Provider())
+    assert sms.send_otp('09171234567') == {'ok': False, 'error': 'redis_unavailable'}
+
+
+def test_missing_secret_fails_loudly_unless_memory(monkeypatch):
+    monkeypatch.setattr(otp_store, '_secret', b'')
+    with pytest.raises(RuntimeError):
+        hash_code('+639171234567', '123456')
+    monkeypatch.setattr(otp_store, 'OTP_STORE', 'memory')
+    assert hash_code('+639171234567', '123456') == hash_code('+639171234567', '123456')
+
+
+@pytest.mark.skipif(not os.getenv("REDIS_URL"), reason="REDIS_URL not set")
+def test_redis_scripts_lock_after_tries(monkeypatch):
+    monkeypatch.setattr(redis_client, 'REDIS_URL', os.environ['REDIS_URL'])
+    monkeypatch.setattr(redis_client, 'breaker', redis_client.CircuitBreaker())
+    redis_client.reset_client()
+    phone = f"+63917{uuid.uuid4().int % 10 ** 7:07d}"
+    otp_store.issue(phone, '808080', tries=2)
+    raw = redis_client.get_client().hgetall(otp_store.KEY_PREFIX + phone)
+    assert b'808080' not in b''.join(raw.values())
+    assert otp_store.verify(phone, '000000') == INVALID
+    assert otp_store.verify(phone, '808080') == VERIFIED
+    otp_store.issue(phone, '123456', tries=1)
+    assert otp_store.verify(phone, '000000') == INVALID
+    assert otp_store.verify(phone, '123456') == EXPIRED
@@ -0,0 +1,55 @@
+"""Tests for utils.phone (Philippine mobile fast path, cached phonenumbers fallback)."""
+import subprocess
+import sys
+
+import pytest
+
+from utils import phone
+from utils.phone import is_valid_phone, normalize_phone, try_normalize
+
+
+@pytest.mark.parametrize('raw', ['09171234567', '9171234567', '639171234567', '+639171234567',
+                                 '0917-123-4567', '+63 (917) 123 4567', ' 0917.123.4567 '])
+def test_ph_mobile_formats_take_the_fast_path(raw):
+    phone._parse_full.cache_clear()
+    assert normalize_phone(raw) == '+639171234567'
+    assert phone._parse_full.cache_info().misses == 0
+
+
+def test_other_numbers_use_the_cached_full_parser():
+    phone._parse_full.cache_clear()
+    assert try_normalize('+1 650-253-0000') == '+16502530000'
+    assert try_normalize('+1 650-253-0000') == '+16502530000'
+    assert try_normalize('not-a-phone') is None
+    assert try_normalize('not-a-phone') is None
+    info = phone._parse_full.cache_info()
+    assert (info.hits, info.misses) == (2, 2)
+
+    for bad in ('', None, '0817', '63917123456', '091712345678'):
+        assert not is_valid_phone(bad)
+    with pytest.raises(ValueError):
+        normalize_phone('12345')
+
+
+def test_fast_path_prefixes_match_phonenumbers():
+    import phonenumbers
+    for prefix in range(900, 1000):
+        number = f'+63{prefix}1234567'
+        expected = phonenumbers.is_valid_number(phonenumbers.parse(number))
+        assert (phone._PH_MOBILE.fullmatch(f'0{prefix}1234567') is not None) == expected, prefix
+        assert is_valid_phone(f'0{prefix}1234567') == expected, prefix
+
+
+def test_sms_service_uses_the_same_rules():
+    from utils.sms_service import SMSService
+    service = SMSService()
+    assert service.format_phone_number('0917 123 4567') == '+639171234567'
+    assert service.validate_phone_number('639171234567')
+    assert service.format_phone_number('63917123456') is None  # one digit short
+
+
+def test_importing_the_app_does_not_load_phonenumbers():
+    code = ("import sys, app, routes, routes_sms, routes_campaigns, utils.sms, utils.sms_campaigns; "
+            "print('phonenumbers' in sys.modules)")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip().splitlines()[-1] == 'False'
@@ -0,0 +1,109 @@
+"""Tests for utils.rate_limit (GCRA limits, all-or-nothing charging, in-process fallback, decorator)."""
+import os
+import uuid
+
+import pytest
+from flask import Flask
+
+from utils import rate_limit, redis_client
+from utils.rate_limit import Limit, LocalLimiter, client_ip, form_field
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_gcra_allows_burst_then_spaces_requests():
+    clock = Clock()
+    limiter = LocalLimiter(clock=clock)
+    per_minute = [('k', Limit('m', 6, 60, burst=3))]
+    assert all(limiter.hit(per_minute).allowed for _ in range(3))
+    refused = limiter.hit(per_minute)
+    assert not refused.allowed and refused.limit == 'm'
+    assert refused.retry_after == pytest.approx(10)
+    clock.now += 10
+    assert limiter.hit(per_minute).allowed
+    assert not limiter.hit(per_minute).allowed
+
+
+def test_refused_request_charges_no_limit():
+    clock = Clock()
+    limiter = LocalLimiter(clock=clock)
+    minute, daily = Limit('minute', 1, 60), Limit('daily', 2, 86400)
+    checks = [('minute:phone', minute), ('daily:phone', daily)]
+    assert limiter.hit(checks).allowed
+    clock.now += 60
+    assert limiter.hit(checks).allowed
+    clock.now += 60
+    refused = limiter.hit(checks)
+    assert refused.limit == 'daily'
+    # the minute limit was not charged by the refused attempt
+    assert limiter.hit([('minute:phone', minute)]).allowed
+
+
+def test_first_hit_is_never_refused_by_rounding():
+    clock = Clock()
+    clock.now = 92.29163881019353  # (now + 60) - 60 - now > 0 in floating point
+    limiter = LocalLimiter(clock=clock)
+    assert limiter.hit([('k', Limit('once', 1, 60))]).allowed
+
+
+def test_local_limiter_evicts_least_recent_keys():
+    limiter = LocalLimiter(max_keys=2, clock=Clock())
+    for key in ('a', 'b', 'c'):
+        limiter.hit([(key, Limit('x', 1, 60))])
+    assert limiter.hit([('a', Limit('x', 1, 60))]).allowed
+    assert not limiter.hit([('c', Limit('x', 1, 60))]).allowed
+
+
+def test_hit_falls_back_when_redis_is_down(monkeypatch):
+    monkeypatch.setattr(redis_client, 'REDIS_URL', 'redis://127.0.0.1:1/0')
+    monkeypatch.setattr(redis_client, 'breaker', redis_client.CircuitBreaker(failure_threshold=1))
+    redis_client.reset_client()
+    monkeypatch.setattr(rate_limit, '_local', LocalLimiter())
+    key = f"test:{uuid.uuid4()}"
+    assert rate_limit.hit_key(key, [Limit('once', 1, 60)]).allowed
+    assert not rate_limit.hit_key(key, [Limit('once', 1, 60)]).allowed
+    assert redis_client.breaker.state == 'open'
+    redis_client.reset_client()
+
+
+def test_decorator_returns_429_with_retry_after(monkeypatch):
+    breaker = redis_client.CircuitBreaker(failure_threshold=1, reset_timeout=float('inf'))
+    breaker.record_failure()
+    monkeypatch.setattr(redis_client, 'breaker', breaker)
+    monkeypatch.setattr(rate_limit, '_local', LocalLimiter())
+    app = Flask(__name__)
+
+    @app.route('/check', methods=['GET', 'POST'])
+    @rate_limit.rate_limit((client_ip('t'), [Limit('two', 2, 60)]),
+                           (form_field('t', 'user'), [Limit('user', 1, 60)]))
+    def check():
+        return 'ok'
+
+    client = app.test_client()
+    assert client.post('/check').status_code == 200
+    assert client.post('/check', data={'user': 'Ana'}).status_code == 200
+    # the IP allowance is used up; GETs are not counted
+    assert client.get('/check').status_code == 200
+    response = client.post('/check', data={'user': 'ben'})
+    assert response.status_code == 429
+    assert response.get_json()['error'] == 'rate_limited'
+    assert int(response.headers['Retry-After']) >= 1
+
+
+@pytest.mark.skipif(not os.getenv("REDIS_URL"), reason="REDIS_URL not set")
+def test_redis_script_matches_local_semantics(monkeypatch):
+    monkeypatch.setattr(redis_client, 'REDIS_URL', os.environ['REDIS_URL'])
+    monkeypatch.setattr(redis_client, 'breaker', redis_client.CircuitBreaker())
+    redis_client.reset_client()
+    key = f"test:{uuid.uuid4()}"
+    limits = [Limit('minute', 1, 60), Limit('daily', 5, 86400)]
+    assert rate_limit.hit_key(key, limits).allowed
+    refused = rate_limit.hit_key(key, limits)
+    assert (refused.allowed, refused.limit) == (False, 'minute')
+    assert 59 <= refused.retry_after <= 60
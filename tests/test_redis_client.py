@@ -0,0 +1,78 @@
+"""Tests for utils.redis_client (lazy pooled client and circuit breaker); no Redis server needed."""
+import socket
+import time
+
+import pytest
+
+from utils import redis_client
+from utils.redis_client import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def unreachable(monkeypatch):
+    # a port nothing listens on: connections are refused immediately
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    monkeypatch.setattr(redis_client, 'REDIS_URL', f'redis://127.0.0.1:{port}/0')
+    redis_client.reset_client()
+    yield
+    redis_client.reset_client()
+
+
+def test_breaker_opens_then_lets_one_probe_through():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    clock.now = 10
+    assert breaker.allow()          # the probe
+    assert not breaker.allow()      # everyone else waits for its outcome
+    breaker.record_failure()        # probe failed: open for another period
+    assert not breaker.allow()
+
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+    assert breaker.trips == 1
+
+
+def test_client_is_lazy_and_run_falls_back(unreachable, monkeypatch):
+    monkeypatch.setattr(redis_client, 'breaker', CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    client = redis_client.get_client()  # no connection attempt yet
+    assert client is redis_client.get_client()
+
+    calls = []
+    assert redis_client.run(lambda r: r.get('x'), fallback=lambda: calls.append(1) or 'local') == 'local'
+    assert redis_client.run(lambda r: r.get('x'), fallback=lambda: 'local') == 'local'
+    assert redis_client.breaker.state == 'open'
+
+    # while open, callers skip the network entirely
+    started = time.monotonic()
+    touched = []
+    assert redis_client.run(lambda r: touched.append(r), fallback=lambda: 'local') == 'local'
+    assert not touched and time.monotonic() - started < 0.05
+    assert not redis_client.ping()
+
+
+def test_non_availability_errors_propagate(monkeypatch):
+    monkeypatch.setattr(redis_client, 'breaker', CircuitBreaker(failure_threshold=1))
+
+    def bad(r):
+        raise ValueError('bug')
+
+    with pytest.raises(ValueError):
+        redis_client.run(bad, fallback=lambda: None)
+    assert redis_client.breaker.state == 'closed'
@@ -34,3 +34,67 @@ def test_token_lifecycle():
     release_token(name, tokens[0])
     t2 = acquire_token(name, timeout=1)
     assert t2 is not None
+
+
+def test_release_wakes_blocked_acquirer():
+    import threading
+
+    from utils.redis_semaphore import acquire_token, init_semaphore, release_token
+
+    name = "tests:sms:sem:wake"
+    init_semaphore(name, permits=1)
+    held = acquire_token(name, timeout=1, lease_secs=5)
+
+    got = {}
+
+    def waiter():
+        started = time.monotonic()
+        got['token'] = acquire_token(name, timeout=3, lease_secs=5)
+        got['waited'] = time.monotonic() - started
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    time.sleep(0.2)
+    release_token(name, held)
+    t.join()
+    assert got['token'] == held
+    # woken by the release, not by the next poll slice
+    assert got['waited'] < 0.5
+
+
+def test_expired_lease_is_reclaimed_once():
+    from utils.redis_semaphore import (acquire_token, extend_token, init_semaphore, list_tokens,
+                                       reclaim_expired, release_token)
+
+    name = "tests:sms:sem:lease"
+    init_semaphore(name, permits=2)
+    short = acquire_token(name, timeout=1, lease_secs=0.2)
+    longer = acquire_token(name, timeout=1, lease_secs=30)
+    time.sleep(0.3)
+
+    assert reclaim_expired(name) == 1
+    assert list_tokens(name) == [short]
+    assert not extend_token(name, short, 30)
+    assert extend_token(name, longer, 30)
+
+    # the late release of a reclaimed token must not duplicate it
+    release_token(name, short)
+    assert list_tokens(name) == [short]
+    release_token(name, longer)
+    assert sorted(list_tokens(name)) == sorted([short, longer])
+
+
+def test_acquire_reseeds_a_semaphore_redis_lost():
+    from utils import redis_client
+    from utils.redis_semaphore import acquire_token, init_semaphore, list_tokens, semaphore_exists
+
+    name = "tests:sms:sem:reseed"
+    init_semaphore(name, permits=2)
+    # Redis restarted without persistence (or was flushed)
+    redis_client.get_client().delete(*(f"{name}:{key}" for key in ('tokens', 'leases', 'owners', 'permits')))
+    assert acquire_token(name, timeout=0.1) is None
+
+    token = acquire_token(name, timeout=1, permits=2)
+    assert token and semaphore_exists(name) and len(list_tokens(name)) == 1
+    # seeded once: a second acquire doesn't add permits
+    assert acquire_token(name, timeout=1, permits=2) and acquire_token(name, timeout=0.1, permits=2) is None
@@ -0,0 +1,76 @@
+"""Tests for utils.reminder_scheduler (single-query selection, rendering and run-once dedup)."""
+from datetime import datetime
+
+import pytest
+
+from utils import sms_outbox
+from utils.reminder_scheduler import fetch_due_reminders, run_reminders
+
+NOW = datetime(2025, 10, 27, 10, 0)
+
+
+@pytest.fixture
+def conn(get_db):
+    conn = get_db()
+    conn.executescript('''
+        INSERT INTO users (id, name, email, password_hash) VALUES
+            (1, 'Maria', 'maria@example.com', 'x'), (2, 'Jose', 'jose@example.com', 'x'),
+            (3, 'Ana', 'ana@example.com', 'x');
+        INSERT INTO sms_settings (user_id, phone_number, appointment_reminders) VALUES
+            (2, '09181111111', 0), (3, '09182222222', 1);
+        UPDATE sms_templates SET template_content = 'Hi {{name}}, {{service}} on {{date}} at {{time}}'
+        WHERE template_name = 'appointment_reminder';
+    ''')
+    conn.executemany(
+        'INSERT INTO appointments (user_id, service, appointment_date, appointment_time, patient_name, '
+        'patient_phone, status, price) VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+        [
+            (1, 'Anti-Rabies', '2025-10-27', '13:00', 'Juan', '09171234567', 'pending'),    # due today
+            (1, 'Anti-Rabies', '2025-10-28', '09:00', 'Juan', '09171234567', 'confirmed'),  # due tomorrow
+            (1, 'Anti-Rabies', '2025-10-28', '11:00', 'Juan', '09171234567', 'pending'),    # beyond 24h
+            (1, 'Anti-Rabies', '2025-10-27', '9:00', 'Juan', '09171234567', 'pending'),     # already started
+            (1, 'Anti-Rabies', '2025-10-27', '14:00', 'Juan', '09171234567', 'cancelled'),
+            (2, 'Tetanus', '2025-10-27', '15:00', 'Jose', '09170000000', 'pending'),        # opted out
+            (3, 'Tetanus', '2025-10-27', '16:00', 'Ana', 'bad', 'pending'),                 # settings phone wins
+            (1, 'Tetanus', '2025-10-27', '15:00', 'Pedro', 'not-a-phone', 'pending'),       # no usable phone
+        ],
+    )
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_fetch_due_applies_window_status_and_opt_out(conn):
+    due = fetch_due_reminders(conn.cursor(), NOW)
+    assert [d['id'] for d in due] == [1, 8, 7, 2]
+    assert next(d for d in due if d['id'] == 7)['phone'] == '09182222222'
+
+
+def test_run_reminders_queues_each_appointment_once(conn, monkeypatch):
+    monkeypatch.setattr(sms_outbox, 'DIGEST_WINDOW', 0)
+    stats = run_reminders(conn, now=NOW, rate_per_minute=30)
+    assert stats == {'due': 4, 'queued': 3, 'skipped': 1, 'taken': 0}
+
+    rows = conn.execute('SELECT phone_number, body, next_attempt_at FROM sms_outbox ORDER BY id').fetchall()
+    assert rows[0]['body'] == 'Hi Juan, Anti-Rabies on 2025-10-27 at 13:00'
+    assert rows[0]['phone_number'] == '+639171234567'
+    # 30 per minute -> two seconds apart
+    assert rows[0]['next_attempt_at'] < rows[1]['next_attempt_at'] < rows[2]['next_attempt_at']
+
+    # a second run (or a second scheduler instance) finds nothing left to send
+    assert run_reminders(conn, now=NOW)['due'] == 0
+    assert conn.execute('SELECT COUNT(*) FROM sms_outbox').fetchone()[0] == 3
+
+
+def test_reminders_to_one_number_become_one_digest(conn):
+    stats = run_reminders(conn, now=NOW, rate_per_minute=30)
+    assert stats['queued'] == 3
+
+    rows = conn.execute('SELECT phone_number, body FROM sms_outbox ORDER BY id').fetchall()
+    assert len(rows) == 2
+    assert rows[0]['body'] == ('Hi Juan, Anti-Rabies on 2025-10-27 at 13:00\n'
+                               'Hi Juan, Anti-Rabies on 2025-10-28 at 09:00')
+    ids = conn.execute('SELECT outbox_id FROM appointment_reminders_sent WHERE appointment_id IN (1, 2)').fetchall()
+    assert {row[0] for row in ids} == {1}
+    merged = conn.execute("SELECT message_content FROM sms_logs WHERE status = 'merged'").fetchall()
+    assert [row[0] for row in merged] == ['Hi Juan, Anti-Rabies on 2025-10-28 at 09:00']
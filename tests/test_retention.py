@@ -0,0 +1,104 @@
+"""Tests for utils.retention (daily rollups and batched pruning of log tables)."""
+from datetime import datetime
+
+import pytest
+
+from utils.retention import RetentionPolicy, cutoff_for, default_policies, run_retention
+
+NOW = datetime(2025, 6, 30, 12, 0, 0)
+
+
+@pytest.fixture
+def conn(get_db):
+    conn = get_db()
+    yield conn
+    conn.close()
+
+
+def _policies(sms_days=30, activity_days=7):
+    sms, activity = default_policies()[:2]
+    return [sms._replace(keep_days=sms_days), activity._replace(keep_days=activity_days)]
+
+
+def test_cutoff_is_midnight_utc():
+    policy = RetentionPolicy('t', 'ts', 30, 't_daily', ('kind',), 'events')
+    assert cutoff_for(policy, NOW) == '2025-05-31 00:00:00'
+
+
+def test_old_rows_are_rolled_up_then_deleted(conn):
+    conn.executemany("INSERT INTO sms_logs (phone_number, message_content, message_type, status, segments, "
+                     "template_id, created_at) VALUES ('+639171234567', '', ?, ?, ?, ?, ?)", [
+                         ('appointment_reminder', 'sent', 1, 1, '2025-04-01 08:00:00'),
+                         ('appointment_reminder', 'sent', 2, None, '2025-04-01 09:00:00'),
+                         ('appointment_reminder', 'failed', 1, None, '2025-04-01 10:00:00'),
+                         ('marketing', 'pending', 1, None, '2025-04-02 08:00:00'),  # still in the outbox
+                         ('marketing', 'delivered', 3, None, '2025-04-02 09:00:00'),
+                         ('appointment_reminder', 'sent', 1, 2, '2025-06-29 08:00:00'),  # recent
+                     ])
+    conn.executemany('INSERT INTO sms_log_templates (id, body, created_at) VALUES (?, ?, ?)', [
+        (1, 'old {{x}}', '2025-04-01 00:00:00'), (2, 'new {{x}}', '2025-04-01 00:00:00'),
+        (3, 'just interned {{x}}', '2025-06-30 11:59:00'),  # its log row isn't committed yet
+    ])
+    conn.executemany('INSERT INTO user_activity (user_id, activity_type, activity_time) VALUES (?, ?, ?)', [
+        (1, 'login', '2025-06-01 08:00:00'),
+        (2, 'login', '2025-06-01 09:00:00'),
+        (1, 'logout', '2025-06-01 10:00:00'),
+        (1, 'login', '2025-06-29 08:00:00'),
+    ])
+    conn.commit()
+
+    report = run_retention(conn, _policies(), now=NOW, dry_run=True)
+    assert report['sms_logs']['eligible'] == 4 and report['sms_logs']['days'] == 2
+    assert report['user_activity']['eligible'] == 3
+    assert conn.execute('SELECT COUNT(*) FROM sms_logs').fetchone()[0] == 6
+
+    results = run_retention(conn, _policies(), now=NOW, batch_size=2, pause=0)
+    assert results['sms_logs']['deleted'] == 4 and results['sms_logs']['templates_deleted'] == 1
+    assert results['user_activity']['deleted'] == 3
+
+    daily = [tuple(r) for r in conn.execute('SELECT * FROM sms_log_daily ORDER BY day, message_type, status')]
+    assert daily == [
+        ('2025-04-01', 'appointment_reminder', 'failed', 1, 1),
+        ('2025-04-01', 'appointment_reminder', 'sent', 2, 3),
+        ('2025-04-02', 'marketing', 'delivered', 1, 3),
+    ]
+    assert [r[0] for r in conn.execute('SELECT status FROM sms_logs ORDER BY id')] == ['pending', 'sent']
+    assert [r[0] for r in conn.execute('SELECT id FROM sms_log_templates ORDER BY id')] == [2, 3]
+    activity = [tuple(r) for r in conn.execute('SELECT * FROM user_activity_daily ORDER BY activity_type')]
+    assert activity == [('2025-06-01', 'login', 2), ('2025-06-01', 'logout', 1)]
+
+    # a second pass finds nothing new and doesn't double count
+    again = run_retention(conn, _policies(), now=NOW, pause=0)
+    assert again['sms_logs']['deleted'] == 0
+    assert conn.execute('SELECT SUM(messages) FROM sms_log_daily').fetchone()[0] == 4
+
+
+def test_zero_days_keeps_everything(conn):
+    conn.execute("INSERT INTO user_activity (user_id, activity_type, activity_time) "
+                 "VALUES (1, 'login', '2020-01-01 00:00:00')")
+    conn.commit()
+    assert run_retention(conn, _policies(sms_days=0, activity_days=0), now=NOW) == {}
+    assert conn.execute('SELECT COUNT(*) FROM user_activity').fetchone()[0] == 1
+
+
+def test_finished_outbox_rows_and_old_feed_rows_are_dropped(conn):
+    conn.executemany("INSERT INTO sms_outbox (phone_number, body, status, next_attempt_at, created_at) "
+                     "VALUES ('+639171234567', 'hi', ?, ?, ?)", [
+                         ('sent', '2025-05-01 08:00:00', '2025-05-01 08:00:00'),
+                         ('dead', '2025-05-01 09:00:00', '2025-05-01 09:00:00'),
+                         ('queued', '2025-05-01 10:00:00', '2025-05-01 10:00:00'),  # still to send
+                         ('sent', '2025-06-29 08:00:00', '2025-06-29 08:00:00'),
+                     ])
+    conn.executemany('INSERT INTO appointment_changes (appointment_id, change_type, changed_at) VALUES (?, ?, ?)', [
+        (1, 'insert', '2025-06-01 08:00:00'),
+        (1, 'update', '2025-06-02 08:00:00'),
+        (2, 'insert', '2025-06-03 08:00:00'),  # the newest row always stays
+    ])
+    conn.commit()
+    outbox, changes = default_policies()[2:]
+
+    results = run_retention(conn, [outbox._replace(keep_days=14), changes._replace(keep_days=7)], now=NOW, pause=0)
+    assert results['sms_outbox']['deleted'] == 2 and results['sms_outbox']['rolled_up'] == 0
+    assert [r[0] for r in conn.execute('SELECT status FROM sms_outbox ORDER BY id')] == ['queued', 'sent']
+    assert results['appointment_changes']['deleted'] == 2
+    assert [tuple(r) for r in conn.execute('SELECT seq, appointment_id FROM appointment_changes')] == [(3, 2)]
@@ -0,0 +1,88 @@
+"""Tests for utils.sms_campaigns (set-based audience, resumable batched dispatch, live counts)."""
+import pytest
+
+from utils import sms_campaigns
+from utils.sms_campaigns import (CampaignError, campaign_progress, campaigns_progress, cancel_campaign,
+                                 create_campaign, dispatch_campaign, start_campaign)
+
+
+@pytest.fixture
+def conn(get_db):
+    conn = get_db()
+    conn.execute("UPDATE sms_templates SET template_content = 'Hi {{name}}, welcome!' "
+                 "WHERE template_name = 'welcome_message'")
+    users = [(1, 'Ana', '09170000001'), (2, 'Ben', '09170000002'), (3, 'Cai', '09170000003'),
+             (4, 'Dee', '09170000001'), (5, 'Eli', 'not-a-phone'), (6, 'Fay', '09170000006')]
+    conn.executemany("INSERT INTO users (id, name, contact_number, email, password_hash) VALUES (?, ?, ?, ?, 'x')",
+                     [(i, name, phone, f'{name.lower()}@example.com') for i, name, phone in users])
+    # 1, 4 (same phone as 1), 5 and 6 opted in to marketing; 2 opted out; 3 has no settings row
+    conn.executemany('INSERT INTO sms_settings (user_id, marketing_messages) VALUES (?, ?)',
+                     [(1, 1), (2, 0), (4, 1), (5, 1), (6, 1)])
+    conn.execute("INSERT INTO appointments (user_id, service, appointment_date, appointment_time, patient_name, price) "
+                 "VALUES (6, 'Anti-Rabies', '2025-10-27', '9:00', 'Fay', 0)")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_audience_respects_opt_ins_and_dedupes_phones(conn):
+    marketing = create_campaign(conn, 'Promo', template_name='welcome_message')
+    assert campaign_progress(conn.cursor(), marketing)['total'] == 3  # users 1 (not 4), 5, 6
+
+    # no settings row means opted in to general notifications
+    general = create_campaign(conn, 'Notice', body='Clinic closed', segment='general')
+    assert campaign_progress(conn.cursor(), general)['total'] == 5
+
+    targeted = create_campaign(conn, 'Booster', body='Dose due', service='Anti-Rabies')
+    assert campaign_progress(conn.cursor(), targeted)['total'] == 1
+
+    progress = campaigns_progress(conn.cursor(), [marketing, general, targeted, 999])
+    assert [progress[i]['total'] for i in (marketing, general, targeted, 999)] == [3, 5, 1, 0]
+    assert progress[general]['pending'] == 5
+
+    with pytest.raises(CampaignError):
+        create_campaign(conn, 'Empty', template_name='missing')
+
+
+def test_dispatch_resumes_without_double_sending(conn, monkeypatch):
+    campaign_id = create_campaign(conn, 'Promo', template_name='welcome_message', rate_per_minute=60)
+    assert dispatch_campaign(conn, campaign_id)['queued'] == 0  # drafts are not dispatched
+    assert start_campaign(conn, campaign_id)
+
+    # the second enqueue of the batch blows up: the first message must roll back with it
+    real_enqueue = sms_campaigns.enqueue_sms
+    calls = {'n': 0}
+
+    def flaky(*args, **kwargs):
+        calls['n'] += 1
+        if calls['n'] == 2:
+            raise RuntimeError('crash')
+        return real_enqueue(*args, **kwargs)
+
+    monkeypatch.setattr(sms_campaigns, 'enqueue_sms', flaky)
+    with pytest.raises(RuntimeError):
+        dispatch_campaign(conn, campaign_id, worker_id='w1', batch_size=3)
+    assert conn.execute('SELECT COUNT(*) FROM sms_outbox').fetchone()[0] == 0
+    monkeypatch.setattr(sms_campaigns, 'enqueue_sms', real_enqueue)
+
+    # a different dispatcher can't take the campaign while w1's lease is live
+    assert dispatch_campaign(conn, campaign_id, worker_id='w2')['queued'] == 0
+    stats = dispatch_campaign(conn, campaign_id, worker_id='w1', batch_size=2)
+    assert stats == {'queued': 2, 'skipped': 1, 'remaining': 0}
+    assert dispatch_campaign(conn, campaign_id, worker_id='w1')['queued'] == 0
+
+    rows = conn.execute('SELECT phone_number, body, next_attempt_at FROM sms_outbox ORDER BY id').fetchall()
+    assert [r[0] for r in rows] == ['+639170000001', '+639170000006']
+    assert rows[0][1] == 'Hi Ana, welcome!'
+    assert rows[1][2] > rows[0][2]  # spaced at the campaign rate
+
+    conn.execute("UPDATE sms_outbox SET status = 'sent' WHERE id = 1")
+    conn.execute("UPDATE sms_logs SET status = 'delivered' WHERE id = 1")
+    conn.commit()
+    counts = campaign_progress(conn.cursor(), campaign_id)
+    assert (counts['delivered'], counts['queued'], counts['skipped']) == (1, 1, 1)
+    assert conn.execute('SELECT status FROM sms_campaigns WHERE id = ?', (campaign_id,)).fetchone()[0] == 'dispatched'
+
+    assert cancel_campaign(conn, campaign_id) == {'cancelled': 0, 'withdrawn': 1}
+    counts = campaign_progress(conn.cursor(), campaign_id)
+    assert (counts['delivered'], counts['failed'], counts['queued']) == (1, 1, 0)
@@ -0,0 +1,65 @@
+"""Tests for utils.sms_encoding (GSM-7/UCS-2 segment counting and transliteration)."""
+import pytest
+
+from utils.sms_encoding import GSM7, UCS2, analyze, optimize, transliterate
+from utils.sms_outbox import enqueue_sms
+from utils.sms_templates import segment_warnings
+
+
+@pytest.mark.parametrize('text, encoding, units, segments', [
+    ('', GSM7, 0, 0),
+    ('a' * 160, GSM7, 160, 1),
+    ('a' * 161, GSM7, 161, 2),
+    ('a' * 306, GSM7, 306, 2),
+    ('a' * 307, GSM7, 307, 3),
+    ('€' * 80, GSM7, 160, 1),         # extension characters take two septets
+    ('a' + '{' * 80, GSM7, 161, 2),
+    ('₱' * 70, UCS2, 70, 1),
+    ('₱' * 71, UCS2, 71, 2),
+    ('😀' * 35, UCS2, 70, 1),          # outside the BMP: a surrogate pair each
+    ('😀' * 36, UCS2, 72, 2),
+])
+def test_analyze(text, encoding, units, segments):
+    info = analyze(text)
+    assert (info.encoding, info.units, info.segments) == (encoding, units, segments)
+
+
+def test_two_unit_characters_are_not_split_across_parts():
+    # 152 plain septets then an escape pair: the pair can't straddle the 153 boundary
+    assert analyze('a' * 152 + '€' + 'a' * 152).segments == 3
+    assert analyze('a' * 151 + '€' + 'a' * 153).segments == 2
+
+
+def test_one_non_gsm_character_switches_the_whole_message():
+    text = 'Your appointment fee is ₱425.00. ' + 'See you soon. ' * 4
+    info = analyze(text)
+    assert info.encoding == UCS2 and info.non_gsm == ('₱',)
+    assert info.segments == 2
+
+
+def test_transliterate_and_optimize():
+    assert transliterate('₱425 — “ok” it’s…') == 'PHP425 - "ok" it\'s...'
+    text, info = optimize('Total: ₱425.00 — salamat “po”')
+    assert text == 'Total: PHP425.00 - salamat "po"'
+    assert info.encoding == GSM7
+    # an emoji keeps it UCS-2 and transliterating wouldn't save a segment, so leave it alone
+    original = 'Salamat 😀 ₱425'
+    assert optimize(original) == (original, analyze(original))
+    assert optimize('Total: ₱425.00', enabled=False)[0] == 'Total: ₱425.00'
+
+
+def test_enqueue_records_segments(get_db):
+    conn = get_db()
+    enqueue_sms(conn, '+639171234567', 'Fee: ₱425 — ' + 'x' * 140)
+    enqueue_sms(conn, '+639171234567', 'Your code is 808080', channel='verify')
+    logs = [tuple(r) for r in conn.execute('SELECT message_content, segments, encoding FROM sms_logs ORDER BY id')]
+    assert logs[0] == ('Fee: PHP425 - ' + 'x' * 140, 1, GSM7)
+    assert logs[1] == ('Your code is 808080', None, None)
+    assert conn.execute('SELECT body FROM sms_outbox WHERE id = 1').fetchone()[0] == logs[0][0]
+
+
+def test_template_editor_warnings():
+    assert segment_warnings('Reminder: {{appointment_date}} at {{appointment_time}}.') == []
+    warnings = segment_warnings('Fee ₱425 on {{appointment_date}}. ' + 'Please come early. ' * 8)
+    assert 'replaced' in warnings[0]
+    assert 'billed as 2 SMS' in warnings[1]
@@ -0,0 +1,90 @@
+"""Tests for utils.sms_log_store (template-referenced sms_logs rows and the backfill)."""
+import json
+
+import pytest
+
+from utils.sms_log_store import compact_existing, compile_patterns, expand_rows, log_fields, match_template
+
+REMINDER = 'Hi {{name}}! Reminder: {{service}} on {{date}} at {{time}}. Please arrive 15 min early.'
+VARIABLES = {'name': 'Ana', 'service': 'Anti-rabies', 'date': '2025-01-02', 'time': '09:00', 'unused': 'x'}
+
+
+@pytest.fixture
+def conn(get_db):
+    conn = get_db()
+    yield conn
+    conn.close()
+
+
+def _insert_log(c, content, template_id=None, template_vars=None):
+    c.execute('''
+        INSERT INTO sms_logs (phone_number, message_type, message_content, template_id, template_vars)
+        VALUES ('+639171234567', 'appointment_reminder', ?, ?, ?)
+    ''', (content, template_id, template_vars))
+
+
+def _rendered(**overrides):
+    values = dict(VARIABLES, **overrides)
+    return (f"Hi {values['name']}! Reminder: {values['service']} on {values['date']} at {values['time']}. "
+            "Please arrive 15 min early.")
+
+
+def test_log_fields_stores_reference_only_when_it_rebuilds_exactly(conn):
+    c = conn.cursor()
+    body = _rendered()
+
+    assert log_fields(c, body, REMINDER, VARIABLES, compact=False) == (body, None, None)
+    assert log_fields(c, body, None, None, compact=True) == (body, None, None)
+    # transliterated or edited after rendering: kept in full
+    assert log_fields(c, body.replace('Ana', 'Anna'), REMINDER, VARIABLES, compact=True)[1] is None
+
+    content, template_id, template_vars = log_fields(c, body, REMINDER, VARIABLES, compact=True)
+    assert content == '' and template_id is not None
+    assert json.loads(template_vars) == {k: v for k, v in VARIABLES.items() if k != 'unused'}
+    # the same body is interned once
+    assert log_fields(c, _rendered(name='Ben'), REMINDER, dict(VARIABLES, name='Ben'), compact=True)[1] == template_id
+    assert c.execute('SELECT COUNT(*) FROM sms_log_templates').fetchone()[0] == 1
+
+
+def test_expand_rows_rebuilds_compact_rows(conn):
+    c = conn.cursor()
+    for name in ('Ana', 'Ben'):
+        content, template_id, template_vars = log_fields(c, _rendered(name=name), REMINDER,
+                                                         dict(VARIABLES, name=name), compact=True)
+        _insert_log(c, content, template_id, template_vars)
+    _insert_log(c, 'Your code is 123456')
+    c.execute('SELECT * FROM sms_logs ORDER BY id')
+    rows = expand_rows(c, [dict(row) for row in c.fetchall()])
+    assert [row['message_content'] for row in rows] == [_rendered(name='Ana'), _rendered(name='Ben'),
+                                                         'Your code is 123456']
+
+
+def test_match_template_requires_exact_rebuild_and_enough_fixed_text():
+    patterns = compile_patterns([REMINDER, '{{name}}', 'Hi {{name}}'])
+    assert [source for source, _ in patterns] == [REMINDER]
+    source, variables = match_template(_rendered(), patterns)
+    assert source == REMINDER and variables['service'] == 'Anti-rabies'
+    assert match_template('Reminder: something else entirely', patterns) is None
+
+
+def test_compact_existing_in_batches_and_dry_run(conn):
+    rows = [_rendered(name=f'Patient {i}') for i in range(5)] + ['Custom note from the clinic', 'Your code is 1']
+    c = conn.cursor()
+    for text in rows:
+        _insert_log(c, text)
+    conn.commit()
+
+    preview = compact_existing(conn, [REMINDER], batch_size=2, dry_run=True)
+    assert preview['scanned'] == 7 and preview['compacted'] == 5 and preview['bytes_saved'] > 0
+    assert conn.execute('SELECT COUNT(*) FROM sms_logs WHERE template_id IS NOT NULL').fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM sms_log_templates').fetchone()[0] == 0
+
+    first = compact_existing(conn, [REMINDER], batch_size=2, max_batches=1)
+    assert first['scanned'] == 2 and first['compacted'] == 2
+    rest = compact_existing(conn, [REMINDER], batch_size=2)
+    assert rest['compacted'] == 3
+
+    c.execute('SELECT * FROM sms_logs ORDER BY id')
+    stored = [dict(row) for row in c.fetchall()]
+    assert sum(1 for row in stored if row['message_content'] == '') == 5
+    assert [row['message_content'] for row in expand_rows(c, stored)] == rows
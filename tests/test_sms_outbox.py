@@ -0,0 +1,204 @@
+"""Tests for utils.sms_outbox (queueing, retries, dead-lettering and sms_logs status)."""
+from datetime import datetime, timedelta
+
+from utils import sms_outbox
+from utils.sms_outbox import OutboxWorker, PermanentSendError, claim_batch, enqueue_sms, outbox_stats, requeue_dead
+
+
+class ProviderError(Exception):
+    def __init__(self, status):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+
+
+def _log_status(get_db, outbox_id):
+    conn = get_db()
+    row = conn.execute('''
+        SELECT l.status, l.provider_response, l.provider_message_id
+        FROM sms_outbox o JOIN sms_logs l ON l.id = o.sms_log_id
+        WHERE o.id = ?
+    ''', (outbox_id,)).fetchone()
+    conn.close()
+    return tuple(row)
+
+
+def test_sent_messages_record_provider_id(get_db):
+    conn = get_db()
+    ids = [enqueue_sms(conn, '+639171234567', f'msg {i}') for i in range(3)]
+    conn.close()
+
+    worker = OutboxWorker(get_db, deliver=lambda row: (f"SM{row['id']}", 'queued'),
+                          concurrency=2, use_semaphore=False)
+    assert worker.run_once() == {'sent': 3}
+    assert _log_status(get_db, ids[0]) == ('sent', 'queued', f'SM{ids[0]}')
+    assert worker.run_once() == {}
+    # the text stays in sms_logs only
+    conn = get_db()
+    assert [r[0] for r in conn.execute('SELECT body FROM sms_outbox')] == ['', '', '']
+    conn.close()
+
+
+def test_transient_failures_back_off_then_dead_letter(get_db, monkeypatch):
+    monkeypatch.setattr(sms_outbox, 'backoff_delay', lambda attempts: 0)
+    conn = get_db()
+    outbox_id = enqueue_sms(conn, '+639171234567', 'hello', max_attempts=3)
+    conn.close()
+
+    def flaky(row):
+        raise ProviderError(503)
+
+    worker = OutboxWorker(get_db, deliver=flaky, use_semaphore=False)
+    assert worker.run_once() == {'queued': 1}
+    assert worker.run_once() == {'queued': 1}
+    assert worker.run_once() == {'dead': 1}
+    assert _log_status(get_db, outbox_id) == ('failed', 'HTTP 503', None)
+
+    conn = get_db()
+    assert requeue_dead(conn) == 1
+    assert outbox_stats(conn) == {'queued': 1}
+    conn.close()
+
+
+
+def test_verification_codes_are_not_kept_in_plain_text(get_db):
+    conn = get_db()
+    sent = enqueue_sms(conn, '+639171234567', 'Your verification code is 123456. It expires in 5 minutes.',
+                       message_type='verification')
+    dead = enqueue_sms(conn, '+639171234568', 'Your verification code is 654321.', message_type='verification')
+    logged = [r[0] for r in conn.execute('SELECT message_content FROM sms_logs ORDER BY id')]
+    conn.close()
+    assert logged == ['Your verification code is ******. It expires in 5 minutes.',
+                      'Your verification code is ******.']
+
+    def deliver(row):
+        assert '123456' in row['body'] or '654321' in row['body']
+        if row['id'] == dead:
+            raise ProviderError(400)
+        return 'SM1', 'queued'
+
+    worker = OutboxWorker(get_db, deliver=deliver, use_semaphore=False)
+    assert worker.run_once() == {'sent': 1, 'dead': 1}
+    conn = get_db()
+    assert [tuple(r) for r in conn.execute('SELECT id, body FROM sms_outbox ORDER BY id')] == [(sent, ''), (dead, '')]
+    # an expired code isn't worth resending
+    assert requeue_dead(conn) == 0
+    conn.close()
+
+def test_permanent_failures_skip_retries(get_db):
+    conn = get_db()
+    enqueue_sms(conn, '+639171234567', 'a')
+    enqueue_sms(conn, '+639171234568', 'b')
+    conn.close()
+
+    def reject(row):
+        if row['body'] == 'a':
+            raise ProviderError(400)
+        raise PermanentSendError('twilio_not_configured')
+
+    worker = OutboxWorker(get_db, deliver=reject, use_semaphore=False)
+    assert worker.run_once() == {'dead': 2}
+
+
+
+def test_rows_without_a_permit_back_off_without_an_attempt(get_db, monkeypatch):
+    conn = get_db()
+    outbox_id = enqueue_sms(conn, '+639171234567', 'hello')
+    conn.close()
+
+    worker = OutboxWorker(get_db, deliver=lambda row: ('SM1', 'queued'))
+    monkeypatch.setattr(worker, '_acquire', lambda: (None, lambda name, token: None))
+    assert worker.run_once() == {'released': 1}
+    # not due again straight away, so the worker doesn't spin on it
+    assert worker.run_once() == {}
+    conn = get_db()
+    row = conn.execute('SELECT status, attempts, next_attempt_at > ? FROM sms_outbox WHERE id = ?',
+                       (sms_outbox._ts(datetime.utcnow()), outbox_id)).fetchone()
+    conn.close()
+    assert tuple(row) == ('queued', 0, 1)
+
+def test_rows_are_claimed_once(get_db):
+    conn = get_db()
+    for i in range(5):
+        enqueue_sms(conn, '+639171234567', f'msg {i}')
+    first = claim_batch(conn, 'w1', 3)
+    second = claim_batch(conn, 'w2', 10)
+    conn.close()
+    assert len(first) == 3 and len(second) == 2
+    assert not {r['id'] for r in first} & {r['id'] for r in second}
+
+
+def test_notifications_to_one_number_coalesce(get_db, monkeypatch):
+    monkeypatch.setattr(sms_outbox, 'DIGEST_WINDOW', 30)
+    conn = get_db()
+    first = enqueue_sms(conn, '+639171234567', 'Confirmed: Ana, Mon 9:00', message_type='appointment_confirmation')
+    second = enqueue_sms(conn, '+639171234567', 'Confirmed: Ben, Mon 9:30', message_type='appointment_confirmation')
+    again = enqueue_sms(conn, '+639171234567', 'Confirmed: Ben, Mon 9:30', message_type='appointment_confirmation')
+    other = enqueue_sms(conn, '+639171234568', 'Confirmed: Cy, Tue 8:00', message_type='appointment_confirmation')
+    general = enqueue_sms(conn, '+639171234567', 'hello', message_type='general')
+    assert first == second == again
+    assert len({first, other, general}) == 3
+
+    row = conn.execute('SELECT body, next_attempt_at FROM sms_outbox WHERE id = ?', (first,)).fetchone()
+    assert row['body'] == 'Confirmed: Ana, Mon 9:00\nConfirmed: Ben, Mon 9:30'
+    # held for the window, so nothing but the general message is due yet
+    assert [r['id'] for r in claim_batch(conn, 'w1', 10)] == [general]
+
+    logs = conn.execute('SELECT status, message_content FROM sms_logs ORDER BY id').fetchall()
+    assert [tuple(r) for r in logs] == [
+        ('pending', 'Confirmed: Ana, Mon 9:00\nConfirmed: Ben, Mon 9:30'),
+        ('merged', 'Confirmed: Ben, Mon 9:30'),
+        ('merged', 'Confirmed: Ben, Mon 9:30'),
+        ('pending', 'Confirmed: Cy, Tue 8:00'),
+        ('pending', 'hello'),
+    ]
+    conn.close()
+
+
+def test_scheduled_messages_do_not_hold_back_new_notices(get_db, monkeypatch):
+    monkeypatch.setattr(sms_outbox, 'DIGEST_WINDOW', 30)
+    conn = get_db()
+    later = datetime.utcnow() + timedelta(hours=2)
+    reminder = enqueue_sms(conn, '+639171234567', 'Reminder: Ana, 11:00', message_type='appointment_reminder',
+                           send_after=later)
+    confirmation = enqueue_sms(conn, '+639171234567', 'Confirmed: Ben, Mon 9:30',
+                               message_type='appointment_confirmation')
+    another = enqueue_sms(conn, '+639171234567', 'Reminder: Cy, 11:30', message_type='appointment_reminder',
+                          send_after=later)
+    assert len({reminder, confirmation, another}) == 3
+    rows = conn.execute('SELECT id, body FROM sms_outbox ORDER BY id').fetchall()
+    assert [r['body'] for r in rows] == ['Reminder: Ana, 11:00', 'Confirmed: Ben, Mon 9:30', 'Reminder: Cy, 11:30']
+    conn.close()
+
+
+def test_digest_stays_within_the_segment_budget(get_db, monkeypatch):
+    monkeypatch.setattr(sms_outbox, 'DIGEST_WINDOW', 30)
+    monkeypatch.setattr(sms_outbox, 'DIGEST_MAX_SEGMENTS', 1)
+    conn = get_db()
+    ids = [enqueue_sms(conn, '+639171234567', f'{i}' * 70, message_type='appointment_reminder')
+           for i in range(3)]
+    conn.close()
+    # 70 + 1 + 70 fits one segment; a third notice would need a second one
+    assert ids[0] == ids[1] != ids[2]
+
+
+def test_compact_logs_keep_template_references(get_db, monkeypatch):
+    from utils import sms_log_store
+    monkeypatch.setattr(sms_log_store, 'SMS_LOG_COMPACT', True)
+    monkeypatch.setattr(sms_outbox, 'DIGEST_WINDOW', 30)
+    conn = get_db()
+    template = 'Confirmed: {{name}}, {{slot}}'
+    for name, slot in (('Ana', 'Mon 9:00'), ('Ben', 'Mon 9:30')):
+        enqueue_sms(conn, '+639171234567', f'Confirmed: {name}, {slot}', message_type='appointment_confirmation',
+                    template=template, variables={'name': name, 'slot': slot})
+    enqueue_sms(conn, '+639171234568', 'Custom note', template=None)
+
+    rows = [dict(r) for r in conn.execute('SELECT * FROM sms_logs ORDER BY id').fetchall()]
+    # the digest no longer matches its template, so it goes back to full text
+    assert [(r['status'], r['message_content'], r['template_id'] is not None) for r in rows] == [
+        ('pending', 'Confirmed: Ana, Mon 9:00\nConfirmed: Ben, Mon 9:30', False),
+        ('merged', '', True),
+        ('pending', 'Custom note', False),
+    ]
+    expanded = sms_log_store.expand_rows(conn.cursor(), rows)
+    assert expanded[1]['message_content'] == 'Confirmed: Ben, Mon 9:30'
+    conn.close()
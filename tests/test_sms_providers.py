@@ -0,0 +1,225 @@
+"""Tests for utils.sms_providers (fake provider fault injection, routing and the provider seam in utils.sms)."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+from utils import sms, sms_providers
+from utils.sms_outbox import PermanentSendError, is_permanent
+from utils.sms_providers import (FakeProvider, RoutingProvider, SemaphoreProvider, SMSProvider, get_provider,
+                                 parse_latency, parse_weights, set_provider)
+from utils.twilio_client import ProviderHTTPError
+
+
+@pytest.fixture
+def fake():
+    provider = FakeProvider(latency='fixed:0', seed=1)
+    set_provider(provider)
+    yield provider
+    set_provider(None)
+
+
+def test_parse_latency_specs():
+    assert parse_latency('fixed:0.25')() == 0.25
+    assert all(0.01 <= parse_latency('uniform:0.01,0.02')() <= 0.02 for _ in range(50))
+    assert parse_latency('lognormal:-3,0.5')() > 0
+    with pytest.raises(ValueError):
+        parse_latency('pareto:1')
+
+
+def test_fake_injects_rate_limits_and_errors():
+    limited = FakeProvider(max_rps=2)
+    limited.send('+639171234567', 'a')
+    limited.send('+639171234567', 'b')
+    with pytest.raises(ProviderHTTPError) as exc:
+        limited.send('+639171234567', 'c')
+    assert exc.value.status == 429 and not is_permanent(exc.value)
+
+    broken = FakeProvider(permanent_error_rate=1.0)
+    with pytest.raises(ProviderHTTPError) as exc:
+        broken.send('+639171234567', 'a')
+    assert is_permanent(exc.value)
+    assert broken.counts['permanent'] == 1 and broken.counts['sent'] == 0
+
+
+def test_sms_helpers_use_the_configured_provider(fake):
+    result = sms.send_otp('09171234567')
+    assert result['ok'] and result['method'] == 'verify' and result['queued'] is False
+    assert fake.counts['requests'] == 1
+    assert sms.verify_otp('09171234567', '123456')
+    assert not sms.verify_otp('09171234567', '000000')
+
+    sid, status = sms.deliver_sms('+639171234567', 'Hello')
+    assert sid.startswith('SM') and status == 'queued'
+    assert fake.sent[-1]['body'] == 'Hello'
+
+
+class TimingOutProvider(SMSProvider):
+    """Times out after sending: the message may or may not have gone out."""
+
+    name = 'flaky'
+
+    def __init__(self):
+        self.calls = 0
+
+    def is_configured(self):
+        return True
+
+    def send(self, phone, body):
+        self.calls += 1
+        raise requests.exceptions.ReadTimeout('read timed out')
+
+
+class UnavailableProvider(SMSProvider):
+    """Answers 503: the request was turned away, so another provider may send it."""
+
+    def __init__(self, name, status=503):
+        self.name = name
+        self.status = status
+        self.calls = 0
+
+    def is_configured(self):
+        return True
+
+    def send(self, phone, body):
+        self.calls += 1
+        raise ProviderHTTPError(self.status, 'unavailable')
+
+
+def test_routing_follows_weights():
+    a, b = FakeProvider(name='a'), FakeProvider(name='b')
+    router = RoutingProvider([a, b], weights={'a': 3, 'b': 1}, seed=7)
+    for route in router.routes:
+        route.latency = 0.05  # equal latency, so only the weights differ
+    for i in range(400):
+        router.send('+639171234567', f'm{i}')
+    assert a.counts['sent'] + b.counts['sent'] == 400
+    assert 250 < a.counts['sent'] < 350
+
+
+def test_routing_prefers_the_faster_provider():
+    fast, slow = FakeProvider(name='fast'), FakeProvider(name='slow')
+    router = RoutingProvider([fast, slow], seed=3)
+    router.routes[0].latency, router.routes[1].latency = 0.05, 0.5
+    picks = [router._order('+639171234567')[0].provider.name for _ in range(500)]
+    assert picks.count('fast') > 400
+
+
+def test_failover_on_rejection_and_breaker_trips():
+    broken = UnavailableProvider('broken')
+    healthy = FakeProvider(name='healthy')
+    router = RoutingProvider([broken, healthy], weights={'broken': 100, 'healthy': 1},
+                             failure_threshold=2, reset_timeout=60, seed=1)
+    for i in range(10):
+        sid, status = router.send('+639171234567', f'm{i}')
+        assert status == 'healthy:queued'
+    # each message went out exactly once; the broken provider stopped getting traffic once tripped
+    assert healthy.counts['sent'] == 10
+    assert broken.calls == 2
+    snapshot = router.snapshot()
+    assert snapshot['broken']['state'] == 'open' and snapshot['healthy']['failovers'] == 2
+    # failures don't count as latency samples, so failing fast doesn't rank a provider first
+    assert snapshot['broken']['latency_ms'] is None and snapshot['broken']['failed'] == 2
+
+
+def test_ambiguous_errors_and_permanent_errors_do_not_fail_over():
+    flaky, backup = TimingOutProvider(), FakeProvider(name='backup')
+    router = RoutingProvider([flaky, backup], weights={'flaky': 1, 'backup': 0})
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        router.send('+639171234567', 'hello')
+    assert backup.counts['requests'] == 0
+
+    # a 500 may come back after the provider accepted the message
+    erroring = UnavailableProvider('erroring', status=500)
+    router = RoutingProvider([erroring, backup], weights={'erroring': 1000, 'backup': 0.001}, seed=2)
+    with pytest.raises(ProviderHTTPError) as exc:
+        router.send('+639171234567', 'hello')
+    assert exc.value.status == 500 and backup.counts['requests'] == 0
+
+    invalid = FakeProvider(name='invalid', permanent_error_rate=1.0)
+    router = RoutingProvider([invalid, FakeProvider(name='other')], weights={'invalid': 1000, 'other': 0.001},
+                             seed=2)
+    with pytest.raises(ProviderHTTPError) as exc:
+        router.send('+639171234567', 'hello')
+    assert exc.value.status == 400
+    assert router.routes[0].breaker.state == 'closed'
+
+
+def test_routing_skips_providers_that_cannot_take_the_number():
+    router = RoutingProvider([SemaphoreProvider(api_key='k', base_url='http://127.0.0.1:9'), FakeProvider()])
+    assert [r.provider.name for r in router._order('+16502530000')] == ['fake']
+    with pytest.raises(ProviderHTTPError) as exc:
+        RoutingProvider([FakeProvider(name='only', error_rate=1.0)], failure_threshold=1).send('+1650', 'x')
+    assert exc.value.status == 500
+
+
+class _SemaphoreHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.requests.append(form)
+        if form['message'][0] == 'fail':
+            body, code = json.dumps({'number': ['The number format is invalid.']}), 200
+        elif form['message'][0] == 'busy':
+            body, code = 'Service Unavailable', 503
+        else:
+            body, code = json.dumps([{'message_id': 1234, 'status': 'Pending'}]), 200
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def semaphore_server():
+    server = HTTPServer(('127.0.0.1', 0), _SemaphoreHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_semaphore_adapter(semaphore_server):
+    provider = SemaphoreProvider(api_key='secret', sender_name='DRCARE',
+                                 base_url=f'http://127.0.0.1:{semaphore_server.server_port}')
+    assert provider.send('+639171234567', 'Hello') == ('1234', 'pending')
+    assert semaphore_server.requests[0] == {'apikey': ['secret'], 'number': ['639171234567'],
+                                            'message': ['Hello'], 'sendername': ['DRCARE']}
+    with pytest.raises(PermanentSendError):
+        provider.send('+639171234567', 'fail')
+    with pytest.raises(ProviderHTTPError) as exc:
+        provider.send('+639171234567', 'busy')
+    assert exc.value.status == 503 and not is_permanent(exc.value)
+    assert not SemaphoreProvider(api_key='').is_configured()
+
+
+def test_get_provider_routes_a_provider_list(monkeypatch):
+    monkeypatch.setenv('SMS_PROVIDER', 'fake, semaphore')
+    monkeypatch.setenv('SMS_PROVIDER_WEIGHTS', 'fake=2,semaphore=1')
+    set_provider(None)
+    try:
+        provider = get_provider()
+        assert isinstance(provider, RoutingProvider)
+        assert [(r.provider.name, r.weight) for r in provider.routes] == [('fake', 2.0), ('semaphore', 1.0)]
+        assert provider.supports_verify
+    finally:
+        set_provider(None)
+    assert parse_weights('a=1, b = 2.5,junk') == {'a': 1.0, 'b': 2.5}
+    assert sms_providers.rejected_before_send(ProviderHTTPError(429))
+    assert not sms_providers.rejected_before_send(ProviderHTTPError(502))
+
+
+def test_get_provider_rejects_unknown_names(monkeypatch):
+    monkeypatch.setenv('SMS_PROVIDER', 'twilio,semaphor')
+    set_provider(None)
+    try:
+        with pytest.raises(ValueError, match='semaphor'):
+            get_provider()
+    finally:
+        set_provider(None)
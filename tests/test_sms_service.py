@@ -0,0 +1,94 @@
+"""Tests for the SMSService send pipeline (single context query, log ids and batched status)."""
+import pytest
+
+from utils import sms_service as sms_module
+from utils.sms_service import SMSService
+
+
+class FakeApp:
+    def __init__(self, connect):
+        self.connect = connect
+        self.connections = 0
+
+    def get_db(self):
+        self.connections += 1
+        return self.connect()
+
+
+@pytest.fixture
+def service(get_db):
+    app = FakeApp(get_db)
+    conn = app.get_db()
+    conn.executescript('''
+        INSERT INTO users (id, name, email, password_hash) VALUES
+            (1, 'Maria', 'maria@example.com', 'x'), (2, 'Jose', 'jose@example.com', 'x');
+        INSERT INTO sms_settings (user_id, phone_number, appointment_confirmations) VALUES
+            (1, '09171234567', 1), (2, '09181234567', 0);
+        UPDATE sms_templates SET template_content = 'Hi {{name}}, {{service}} on {{date}} at {{time}} is confirmed.'
+        WHERE template_name = 'appointment_confirmation';
+        INSERT INTO appointments (id, user_id, service, appointment_date, appointment_time, patient_name,
+                                  patient_phone, price) VALUES
+            (10, 1, 'Anti-Rabies', '2025-10-27', '9:00', 'Maria', '09990000000', 0),
+            (11, 2, 'Tetanus', '2025-10-27', '10:00', 'Jose', '09990000001', 0);
+    ''')
+    conn.commit()
+    conn.close()
+
+    svc = SMSService()
+    svc.app = app
+    svc.sms_enabled = True
+    svc.provider_configured = True
+    app.connections = 0
+    return svc
+
+
+def test_template_send_uses_one_connection(service):
+    assert service.send_template_sms(1, 'appointment_confirmation',
+                                     {'service': 'Anti-Rabies', 'date': '2025-10-27', 'time': '9:00'})
+    assert service.app.connections == 1
+
+    conn = service.app.get_db()
+    row = conn.execute('SELECT phone_number, body, message_type FROM sms_outbox').fetchone()
+    assert tuple(row) == ('+639171234567', 'Hi Maria, Anti-Rabies on 2025-10-27 at 9:00 is confirmed.',
+                          'appointment_confirmation')
+    conn.close()
+
+
+def test_log_ids_and_batched_status_updates(service):
+    first = service.log_sms(1, '+639171234567', 'general', 'a')
+    second = service.log_sms(1, '+639171234567', 'general', 'b')
+    assert second == first + 1
+
+    assert service.update_sms_statuses([
+        (first, 'sent', 'queued', 'SM111'),
+        (second, 'failed', 'HTTP 400', None),
+    ])
+    conn = service.app.get_db()
+    rows = conn.execute('SELECT status, provider_response, provider_message_id, sent_at IS NOT NULL FROM sms_logs ORDER BY id').fetchall()
+    conn.close()
+    assert [tuple(r) for r in rows] == [('sent', 'queued', 'SM111', 1), ('failed', 'HTTP 400', None, 0)]
+
+
+def test_appointment_confirmation_respects_opt_out(service, monkeypatch):
+    monkeypatch.setattr(sms_module, 'sms_service', service)
+    assert sms_module.send_appointment_confirmation(10)
+    assert not sms_module.send_appointment_confirmation(11)
+    assert service.app.connections == 2
+
+
+def test_sends_inline_when_the_outbox_is_missing(service, monkeypatch):
+    # a PostgreSQL database migrated before the outbox existed
+    conn = service.app.get_db()
+    conn.execute('DROP TABLE sms_outbox')
+    conn.commit()
+    conn.close()
+    sent = []
+    monkeypatch.setattr(sms_module, 'send_inline', lambda phone, body: sent.append((phone, body)) or {
+        'ok': True, 'queued': False, 'message_id': 'SM1', 'status': 'queued'})
+
+    assert service.send_sms('09171234567', 'hello', 1, 'general')
+    assert sent == [('+639171234567', 'hello')]
+    conn = service.app.get_db()
+    rows = [tuple(r) for r in conn.execute('SELECT message_content, status, provider_message_id FROM sms_logs')]
+    conn.close()
+    assert rows == [('hello', 'sent', 'SM1')]
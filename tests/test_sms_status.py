@@ -0,0 +1,110 @@
+"""Tests for utils.sms_status and the /sms/status webhook (batched delivery receipts)."""
+import pytest
+from flask import Flask
+from twilio.request_validator import RequestValidator
+
+from utils.sms_status import StatusBuffer, apply_receipts
+
+
+@pytest.fixture
+def get_db(get_db):
+    connections = []
+
+    def connect():
+        conn = get_db()
+        connections.append(conn)
+        return conn
+
+    conn = get_db()
+    conn.executemany('''
+        INSERT INTO sms_logs (phone_number, message_type, message_content, status, provider_message_id)
+        VALUES ('+639171234567', 'general', 'hi', 'sent', ?)
+    ''', [(f'SM{i}',) for i in range(5)])
+    conn.commit()
+    conn.close()
+    connect.connections = connections
+    return connect
+
+
+def _statuses(get_db):
+    conn = get_db()
+    rows = conn.execute('SELECT provider_message_id, status, provider_response FROM sms_logs').fetchall()
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def test_out_of_order_receipts_never_regress(get_db):
+    conn = get_db()
+    apply_receipts(conn, [{'sid': 'SM0', 'status': 'delivered'},
+                          {'sid': 'SM0', 'status': 'sent'},
+                          {'sid': 'SM1', 'status': 'undelivered', 'error_code': '30003'},
+                          {'sid': 'SM2', 'status': 'bogus'}])
+    # a late 'sent' in a later batch must not undo 'delivered'
+    apply_receipts(conn, [{'sid': 'SM0', 'status': 'sent'}])
+
+    statuses = _statuses(get_db)
+    assert statuses['SM0'] == ('delivered', 'delivered')
+    assert statuses['SM1'] == ('failed', 'undelivered (30003)')
+    assert statuses['SM2'][0] == 'sent'
+
+
+def test_buffer_flushes_in_batches(get_db):
+    buffer = StatusBuffer(get_db, backend='memory', flush_size=3, flush_interval=60)
+    buffer.add('SM0', 'delivered')
+    buffer.add('SM1', 'delivered')
+    assert buffer.pending() == 2
+    assert _statuses(get_db)['SM0'][0] == 'sent'
+
+    opened = len(get_db.connections)
+    buffer.add('SM2', 'delivered')  # reaches flush_size
+    assert buffer.pending() == 0
+    assert len(get_db.connections) == opened + 1
+    assert {sid for sid, (status, _) in _statuses(get_db).items() if status == 'delivered'} == {'SM0', 'SM1', 'SM2'}
+
+
+
+def test_receipts_ahead_of_the_worker_are_retried(get_db):
+    conn = get_db()
+    unmatched = []
+    assert apply_receipts(conn, [{'sid': 'SM0', 'status': 'delivered'}, {'sid': 'SM9', 'status': 'delivered'}],
+                          unmatched) == 1
+    assert [r['sid'] for r in unmatched] == ['SM9']
+
+    # SM9's callback lands before the outbox worker has recorded its SID
+    buffer = StatusBuffer(get_db, backend='memory', flush_size=1, flush_interval=60)
+    buffer.add('SM9', 'delivered')
+    assert buffer.flush() == 0 and buffer.pending() == 0
+    conn.execute("INSERT INTO sms_logs (phone_number, message_type, message_content, status, provider_message_id) "
+                 "VALUES ('+639171234567', 'general', 'hi', 'sent', 'SM9')")
+    conn.commit()
+    conn.close()
+    assert buffer.flush() == 1
+    assert _statuses(get_db)['SM9'] == ('delivered', 'delivered')
+
+def test_webhook_checks_signature(get_db, monkeypatch):
+    from routes_sms import init_sms_routes
+
+    monkeypatch.setenv('TWILIO_AUTH_TOKEN', 'secret')
+    monkeypatch.delenv('TWILIO_STATUS_CALLBACK_URL', raising=False)
+    buffer = StatusBuffer(get_db, backend='memory', flush_size=1, flush_interval=60)
+    monkeypatch.setattr('routes_sms.get_status_buffer', lambda _get_db: buffer)
+
+    app = Flask(__name__)
+    app.get_db = get_db
+    init_sms_routes(app, get_db)
+    client = app.test_client()
+
+    form = {'MessageSid': 'SM3', 'MessageStatus': 'delivered'}
+    url = 'http://localhost/sms/status'
+    signature = RequestValidator('secret').compute_signature(url, form)
+
+    assert client.post('/sms/status', data=form, headers={'X-Twilio-Signature': 'nope'}).status_code == 403
+    assert _statuses(get_db)['SM3'][0] == 'sent'
+    assert client.post('/sms/status', data=form, headers={'X-Twilio-Signature': signature}).status_code == 204
+    assert _statuses(get_db)['SM3'][0] == 'delivered'
+
+
+def test_redis_backend_uses_the_shared_client_by_default():
+    from utils import redis_client
+    # building the client doesn't connect, so this runs without a Redis server
+    buffer = StatusBuffer(lambda: None, backend='redis')
+    assert buffer._redis is redis_client.get_client()
@@ -0,0 +1,119 @@
+"""Tests for utils.template_store (compiled templates, mtime and version caches)."""
+import json
+import os
+import sqlite3
+
+import pytest
+
+from utils import template_store
+from utils.template_store import MissingVariablesError, compile_template, render, unknown_variables
+
+
+@pytest.fixture(autouse=True)
+def _fresh_caches():
+    template_store.invalidate()
+    yield
+    template_store.invalidate()
+
+
+def test_compile_and_render():
+    tpl = compile_template('Hi {{name}}, see you {{ date }} at {{time}}. Bye {{name}}!')
+    assert tpl.variables == ('name', 'date', 'time')
+    assert tpl.render({'name': 'Ana', 'date': 'Jan 2', 'time': '9:00'}) == \
+        'Hi Ana, see you Jan 2 at 9:00. Bye Ana!'
+    assert compile_template(tpl.source) is tpl
+    assert render('plain text', {}) == 'plain text'
+
+
+def test_missing_variables_are_kept_or_raised():
+    tpl = compile_template('Hi {{name}}, {{date}}')
+    assert tpl.render({'name': 'Ana'}) == 'Hi Ana, {{date}}'
+    assert tpl.missing({'name': 'Ana'}) == {'date'}
+    with pytest.raises(MissingVariablesError) as exc:
+        tpl.render({}, strict=True)
+    assert exc.value.missing == ['date', 'name']
+    assert unknown_variables('{{name}} {{nmae}} {{ date }}', ('name', 'date')) == ['nmae']
+
+
+def test_render_many():
+    tpl = compile_template('Hello {{name}}')
+    assert tpl.render_many([{'name': 'A'}, {'name': 'B'}]) == ['Hello A', 'Hello B']
+
+
+def test_json_templates_reload_on_mtime_change(tmp_path, monkeypatch):
+    path = tmp_path / 'sms_templates.json'
+    monkeypatch.setattr(template_store, 'JSON_TEMPLATES_PATH', str(path))
+    assert template_store.json_templates() == {}
+
+    path.write_text(json.dumps({'cancel': {'title': 'Cancel', 'body': 'Cancelled {{appointment_date}}'}}))
+    assert template_store.get_json_template('cancel').render({'appointment_date': 'Jan 2'}) == 'Cancelled Jan 2'
+    first = template_store.json_templates()
+    assert template_store.json_templates() is first
+
+    path.write_text(json.dumps({'cancel': {'title': 'Cancel', 'body': 'Moved'}}))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert template_store.get_json_template('cancel').source == 'Moved'
+    copy = template_store.json_templates_copy()
+    copy['cancel']['body'] = 'edited'
+    assert template_store.get_json_template('cancel').source == 'Moved'
+
+
+def _templates_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''
+        CREATE TABLE sms_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_name TEXT UNIQUE NOT NULL,
+            template_content TEXT NOT NULL,
+            message_type TEXT,
+            is_active BOOLEAN DEFAULT 1,
+            updated_at TIMESTAMP
+        )
+    ''')
+    conn.execute("INSERT INTO sms_templates (template_name, template_content, message_type) "
+                 "VALUES ('reminder', 'See you {{date}}', 'reminder')")
+    conn.commit()
+    return conn
+
+
+def test_db_templates_reload_when_the_table_changes(monkeypatch):
+    conn = _templates_db()
+    monkeypatch.setattr(template_store, 'TEMPLATE_CACHE_TTL', 0)
+    assert template_store.get_db_template(conn, 'reminder').render({'date': 'Mon'}) == 'See you Mon'
+
+    conn.execute("UPDATE sms_templates SET template_content = 'Until {{date}}' WHERE template_name = 'reminder'")
+    assert template_store.get_db_template(conn, 'reminder').source == 'Until {{date}}'
+
+    conn.execute("UPDATE sms_templates SET is_active = 0")
+    assert template_store.get_db_template(conn, 'reminder') is None
+
+
+class _Uncloseable:
+    """Wraps the in-memory connection so the factory's close() keeps it usable."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def close(self):
+        pass
+
+
+def test_db_templates_ttl_skips_the_version_check(monkeypatch):
+    conn = _Uncloseable(_templates_db())
+    opened = []
+
+    def factory():
+        opened.append(1)
+        return conn
+
+    monkeypatch.setattr(template_store, 'TEMPLATE_CACHE_TTL', 60)
+    assert template_store.get_db_template(factory, 'reminder') is not None
+    assert template_store.get_db_template(factory, 'reminder') is not None
+    assert len(opened) == 1
+    template_store.invalidate()
+    assert template_store.get_db_template(factory, 'reminder') is not None
+    assert len(opened) == 2
@@ -0,0 +1,28 @@
+"""Tests for utils.twilio_client (per-process client cache)."""
+import pytest
+
+from utils import twilio_client
+
+
+@pytest.fixture(autouse=True)
+def credentials(monkeypatch):
+    monkeypatch.setenv('TWILIO_ACCOUNT_SID', 'AC123')
+    monkeypatch.setenv('TWILIO_AUTH_TOKEN', 'secret')
+    twilio_client.reset_twilio_client()
+    yield
+    twilio_client.reset_twilio_client()
+
+
+def test_client_is_shared_and_rebuilt_in_a_new_process(monkeypatch):
+    first = twilio_client.get_twilio_client()
+    assert first is twilio_client.get_twilio_client()
+
+    # a forked child sees a different pid and must not reuse the parent's sockets
+    monkeypatch.setattr(twilio_client.os, 'getpid', lambda: -1)
+    assert twilio_client.get_twilio_client() is not first
+
+    monkeypatch.delenv('TWILIO_AUTH_TOKEN')
+    twilio_client.reset_twilio_client()
+    assert twilio_client.get_twilio_client() is None
+    assert not twilio_client.is_configured()
+
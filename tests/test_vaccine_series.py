@@ -0,0 +1,154 @@
+"""Tests for utils.vaccine_series (series planning and single-transaction booking).
+
+Uses an in-memory SQLite database with the subset of the schema the series booking touches.
+"""
+import sqlite3
+
+import pytest
+
+from utils.booking_slots import fetch_slot_counts
+from utils.vaccine_series import SeriesBookingError, book_series, plan_series
+
+RABIES_SCHEDULE = [
+    {'id': 1, 'dose_number': 1, 'days_after_previous_dose': None},
+    {'id': 2, 'dose_number': 2, 'days_after_previous_dose': 3},
+    {'id': 3, 'dose_number': 3, 'days_after_previous_dose': 4},
+    {'id': 4, 'dose_number': 4, 'days_after_previous_dose': 7},
+    {'id': 5, 'dose_number': 5, 'days_after_previous_dose': 14},
+]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        CREATE TABLE appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            service TEXT NOT NULL,
+            appointment_date TEXT NOT NULL,
+            appointment_time TEXT NOT NULL,
+            patient_name TEXT NOT NULL,
+            patient_address TEXT,
+            patient_age INTEGER,
+            patient_gender TEXT,
+            patient_phone TEXT,
+            branch TEXT,
+            patient_email TEXT,
+            status TEXT DEFAULT 'pending',
+            price REAL NOT NULL,
+            category TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE vaccine_schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vaccine_name TEXT NOT NULL,
+            recommended_age TEXT NOT NULL,
+            dose_number INTEGER NOT NULL,
+            is_booster INTEGER DEFAULT 0,
+            days_after_previous_dose INTEGER
+        );
+        CREATE TABLE services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price REAL NOT NULL DEFAULT 0,
+            is_active INTEGER DEFAULT 1
+        );
+    ''')
+    for dose in RABIES_SCHEDULE:
+        conn.execute(
+            'INSERT INTO vaccine_schedules (vaccine_name, recommended_age, dose_number, days_after_previous_dose) VALUES (?, ?, ?, ?)',
+            ('Anti-Rabies Vaccine', 'Any', dose['dose_number'], dose['days_after_previous_dose']),
+        )
+    conn.execute("INSERT INTO services (name, price) VALUES ('Anti-Rabies Vaccine', 425.0)")
+    # Monday 2025-10-27 at 9:00
+    conn.execute('''
+        INSERT INTO appointments (user_id, service, appointment_date, appointment_time, patient_name, patient_phone, price)
+        VALUES (1, 'Anti-Rabies Vaccine', '2025-10-27', '9:00', 'Juan', '09171234567', 425.0)
+    ''')
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_plan_uses_cumulative_intervals():
+    visits = plan_series('2025-10-27', '9:00', RABIES_SCHEDULE, {})
+    # day 3 = Thu 10-30, day 7 = Mon 11-03, day 14 = Mon 11-10, day 28 = Mon 11-24
+    assert [v['appointment_date'] for v in visits] == ['2025-10-30', '2025-11-03', '2025-11-10', '2025-11-24']
+    assert all(v['appointment_time'] == '9:00' and not v['shifted'] for v in visits)
+
+
+def test_plan_moves_doses_off_closed_and_full_slots():
+    # day 0 on Thursday: day 3 lands on Sunday, which is closed
+    visits = plan_series('2025-10-23', '9:00', RABIES_SCHEDULE[:2], {})
+    assert visits[0]['appointment_date'] == '2025-10-27'
+    assert visits[0]['shifted']
+
+    full = {('2025-10-30', '9:00'): 2}
+    visits = plan_series('2025-10-27', '09:00', RABIES_SCHEDULE[:2], full, capacity=2)
+    assert visits[0]['appointment_date'] == '2025-10-30'
+    assert visits[0]['appointment_time'] == '8:00'
+
+
+def test_book_series_inserts_all_follow_ups_once(conn):
+    day0, visits = book_series(conn, 1, 'Anti-Rabies Vaccine')
+    assert day0['patient_name'] == 'Juan'
+    assert len(visits) == 4
+
+    rows = conn.execute('SELECT * FROM appointments WHERE series_parent_id = 1 ORDER BY appointment_date').fetchall()
+    assert [r['id'] for r in rows] == [v['appointment_id'] for v in visits]
+    assert all(r['price'] == 425.0 and r['patient_phone'] == '09171234567' for r in rows)
+
+    counts = fetch_slot_counts(conn.cursor(), '2025-10-27', '2025-11-30')
+    assert counts[('2025-10-30', '9:00')] == 1
+
+    with pytest.raises(SeriesBookingError):
+        book_series(conn, 1, 'Anti-Rabies Vaccine')
+
+
+class RacingConnection:
+    """Lets `compete()` (another request) book first, between this booking's plan and its insert."""
+
+    def __init__(self, conn, compete):
+        self._conn = conn
+        self._compete = compete
+
+    def cursor(self):
+        return RacingCursor(self._conn.cursor(), self._compete)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class RacingCursor:
+    def __init__(self, cursor, compete):
+        self._cursor = cursor
+        self._compete = compete
+
+    def executemany(self, sql, rows):
+        self._cursor.fetchall()  # finish the pending read so the other request can commit
+        self._compete()
+        return self._cursor.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def test_concurrent_series_bookings_insert_once(conn, tmp_path):
+    path = str(tmp_path / 'series.db')
+    disk = sqlite3.connect(path)
+    conn.backup(disk)
+    disk.close()
+
+    def connect():
+        db = sqlite3.connect(path)
+        db.row_factory = sqlite3.Row
+        return db
+
+    first, second = connect(), connect()
+    racing = RacingConnection(first, lambda: book_series(second, 1, 'Anti-Rabies Vaccine'))
+    with pytest.raises(SeriesBookingError):
+        book_series(racing, 1, 'Anti-Rabies Vaccine')
+    assert connect().execute('SELECT COUNT(*) FROM appointments WHERE series_parent_id = 1').fetchone()[0] == 4
@@ -0,0 +1,188 @@
+"""
+Buffered writer for `user_activity` (logins, logouts, bookings, cancellations, profile edits).
+
+Requests never touch the database to record activity: `log_activity` appends a row to
+an in-process buffer and returns. A daemon thread per process writes the buffer out
+with multi-row INSERTs in one transaction:
+ - every ACTIVITY_FLUSH_INTERVAL_MS milliseconds while anything is buffered;
+ - at once when ACTIVITY_FLUSH_SIZE events are waiting (the request only wakes the thread).
+Each event is stamped (UTC, like CURRENT_TIMESTAMP) when it happens, not when it is
+written. What is still buffered is flushed at interpreter exit (gunicorn workers exit
+normally on SIGTERM). If the database can't be written, the rows stay buffered for the
+next flush. At most ACTIVITY_BUFFER_MAX rows are kept; beyond that the oldest are dropped
+with a warning, so an outage can't grow the process without bound.
+
+Usage:
+  from utils.activity_log import log_activity
+  log_activity(get_db, 'login', user_id, request)
+
+Environment variables used:
+ - ACTIVITY_LOG (1 (default) to record activity, 0 to turn it off)
+ - ACTIVITY_FLUSH_SIZE (events per flush that trigger an immediate write, default 100)
+ - ACTIVITY_FLUSH_INTERVAL_MS (max milliseconds an event waits, default 500)
+ - ACTIVITY_BUFFER_MAX (events kept while the database is unavailable, default 10000)
+"""
+from __future__ import annotations
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from utils.request_ip import client_ip
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_LOG = os.getenv("ACTIVITY_LOG", "1").lower() not in ("0", "false", "no")
+ACTIVITY_FLUSH_SIZE = int(os.getenv("ACTIVITY_FLUSH_SIZE", "100"))
+ACTIVITY_FLUSH_INTERVAL_MS = int(os.getenv("ACTIVITY_FLUSH_INTERVAL_MS", "500"))
+ACTIVITY_BUFFER_MAX = int(os.getenv("ACTIVITY_BUFFER_MAX", "10000"))
+
+# 5 parameters per row keeps each statement under SQLite's default 999-variable limit
+_ROWS_PER_INSERT = 150
+_USER_AGENT_MAX = 255
+
+Row = Tuple[Optional[int], str, str, Optional[str], Optional[str]]
+
+
+def insert_rows(conn, rows: List[Row]) -> int:
+    """Write (user_id, activity_type, activity_time, ip_address, user_agent) rows in one transaction."""
+    c = conn.cursor()
+    try:
+        for start in range(0, len(rows), _ROWS_PER_INSERT):
+            chunk = rows[start:start + _ROWS_PER_INSERT]
+            c.execute(f'''
+                INSERT INTO user_activity (user_id, activity_type, activity_time, ip_address, user_agent)
+                VALUES {', '.join('(?, ?, ?, ?, ?)' for _ in chunk)}
+            ''', [value for row in chunk for value in row])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+class ActivityLogger:
+    """Collects activity rows and writes them from a background thread."""
+
+    def __init__(self, get_db: Callable, flush_size: Optional[int] = None,
+                 flush_interval: Optional[float] = None, max_buffered: Optional[int] = None):
+        self.get_db = get_db
+        self.flush_size = flush_size or ACTIVITY_FLUSH_SIZE
+        self.flush_interval = ACTIVITY_FLUSH_INTERVAL_MS / 1000.0 if flush_interval is None else flush_interval
+        self.max_buffered = max_buffered or ACTIVITY_BUFFER_MAX
+        self._items: List[Row] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self.dropped = 0
+
+    def add(self, user_id: Optional[int], activity_type: str, ip_address: Optional[str] = None,
+            user_agent: Optional[str] = None, at: Optional[datetime] = None) -> None:
+        stamp = (at or datetime.utcnow()).strftime('%Y-%m-%d %H:%M:%S')
+        row = (user_id, activity_type, stamp, ip_address, (user_agent or '')[:_USER_AGENT_MAX] or None)
+        with self._lock:
+            self._items.append(row)
+            self._trim()
+            pending = len(self._items)
+        self._ensure_flusher()
+        if pending >= self.flush_size:
+            self._wake.set()
+
+    def _trim(self) -> None:
+        # caller holds self._lock
+        excess = len(self._items) - self.max_buffered
+        if excess > 0:
+            del self._items[:excess]
+            self.dropped += excess
+            logger.warning(f"Activity buffer full; dropped {excess} oldest events")
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def flush(self) -> int:
+        """Write everything buffered so far; returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._items = self._items, []
+            if not batch:
+                return 0
+            conn = None
+            try:
+                conn = self.get_db()
+                return insert_rows(conn, batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} activity events: {e}")
+                with self._lock:
+                    self._items = batch + self._items
+                    self._trim()
+                return 0
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def close(self) -> int:
+        """Stop the flusher thread and write what is left."""
+        self._stopped = True
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=5)
+        return self.flush()
+
+    def _ensure_flusher(self) -> None:
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._stopped or (self._thread is not None and self._thread_pid == pid and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run, name='activity-log-flush', daemon=True)
+            self._thread_pid = pid
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stopped:
+                return
+            try:
+                if self.pending():
+                    self.flush()
+            except Exception as e:
+                logger.error(f"Activity flush failed: {e}")
+
+
+_logger: Optional[ActivityLogger] = None
+_logger_lock = threading.Lock()
+
+
+def get_activity_logger(get_db: Callable) -> ActivityLogger:
+    """The process-wide logger, flushed at exit."""
+    global _logger
+    if _logger is None:
+        with _logger_lock:
+            if _logger is None:
+                _logger = ActivityLogger(get_db)
+                atexit.register(_logger.close)
+    return _logger
+
+
+def log_activity(get_db: Callable, activity_type: str, user_id: Optional[int], req=None) -> None:
+    """Record one event for `user_id`, with IP and user agent taken from the Flask request `req`."""
+    if not ACTIVITY_LOG or not user_id:
+        return
+    ip_address = user_agent = None
+    if req is not None:
+        ip_address = client_ip(req)
+        user_agent = req.headers.get('User-Agent')
+    try:
+        get_activity_logger(get_db).add(user_id, activity_type, ip_address, user_agent)
+    except Exception as e:
+        logger.error(f"Could not record {activity_type} activity: {e}")
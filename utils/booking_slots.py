@@ -0,0 +1,154 @@
+"""
+Clinic booking slot helpers shared by the booking flows and the calendar.
+
+The slots mirror the hourly buttons rendered by `book_appointment_datetime.html`:
+ - Monday-Friday: 7:00 to 16:00
+ - Saturday: 8:00 to 15:00
+ - no 12:00 slot (lunch break), closed on Sunday
+
+Times are stored the way the booking form posts them ('7:00', '13:00'); the admin
+form posts zero-padded values ('07:00'), so comparisons go through `normalize_slot_time`.
+
+Booked counts per slot live in `calendar_occupancy`, which SQLite triggers keep in step
+with every appointment write (see `update_db_schema` in app.py).
+
+Environment variables used:
+ - SLOT_CAPACITY (appointments allowed per hourly slot; unset means no limit, as the
+   booking form enforces none)
+"""
+from __future__ import annotations
+import os
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+SLOT_CAPACITY: Optional[int] = int(os.environ["SLOT_CAPACITY"]) if os.getenv("SLOT_CAPACITY") else None
+
+_WEEKDAY_HOURS = (7, 17)
+_SATURDAY_HOURS = (8, 16)
+_LUNCH_HOUR = 12
+
+
+def parse_date(value) -> date:
+    """Accept a date, datetime or 'YYYY-MM-DD' string (extra time suffix is ignored)."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
+def normalize_slot_time(value) -> Optional[str]:
+    """Normalize '07:00', '7:00' or '07:00:00' to the booking form's 'H:MM' spelling."""
+    if not value:
+        return None
+    parts = str(value).strip().split(":")
+    try:
+        hour = int(parts[0])
+        minute = int(parts[1]) if len(parts) > 1 else 0
+    except ValueError:
+        return None
+    return f"{hour}:{minute:02d}"
+
+
+def slot_times_for(day) -> List[str]:
+    """Return the bookable slot times for `day` (empty list when the clinic is closed)."""
+    weekday = parse_date(day).weekday()  # Monday=0 .. Sunday=6
+    if weekday <= 4:
+        start, end = _WEEKDAY_HOURS
+    elif weekday == 5:
+        start, end = _SATURDAY_HOURS
+    else:
+        return []
+    return [f"{hour}:00" for hour in range(start, end) if hour != _LUNCH_HOUR]
+
+
+def fetch_slot_counts(c, start_date, end_date) -> Dict[Tuple[str, str], int]:
+    """Count non-cancelled appointments per (date, time) slot between two dates (inclusive).
+
+    Reads the trigger-maintained `calendar_occupancy` table (a primary-key range read).
+    Databases without it (e.g. PostgreSQL, where init_db doesn't run) fall back to a range
+    aggregate over `appointments` served by `idx_appointments_date`.
+    """
+    start = parse_date(start_date).isoformat()
+    end = parse_date(end_date).isoformat()
+    try:
+        c.execute('''
+            SELECT slot_date, slot_time, booked
+            FROM calendar_occupancy
+            WHERE slot_date >= ? AND slot_date <= ? AND booked > 0
+        ''', (start, end))
+    except Exception:
+        c.execute('''
+            SELECT appointment_date, appointment_time, COUNT(*) AS booked
+            FROM appointments
+            WHERE appointment_date >= ? AND appointment_date <= ?
+              AND status != 'cancelled'
+            GROUP BY appointment_date, appointment_time
+        ''', (start, end))
+    counts: Dict[Tuple[str, str], int] = {}
+    for row in c.fetchall():
+        key = (str(row[0])[:10], normalize_slot_time(row[1]))
+        counts[key] = counts.get(key, 0) + int(row[2] or 0)
+    return counts
+
+
+def has_capacity(counts: Dict[Tuple[str, str], int], day, time_value,
+                 capacity: Optional[int] = None) -> bool:
+    capacity = SLOT_CAPACITY if capacity is None else capacity
+    if capacity is None:
+        return True
+    key = (parse_date(day).isoformat(), normalize_slot_time(time_value))
+    return counts.get(key, 0) < capacity
+
+
+def rebuild_occupancy(conn) -> int:
+    """Recompute `calendar_occupancy` from scratch; returns the number of slot rows written.
+
+    The triggers in update_db_schema keep it current afterwards; this is for the initial
+    backfill or to repair drift.
+    """
+    c = conn.cursor()
+    try:
+        c.execute('DELETE FROM calendar_occupancy')
+        c.execute('''
+            INSERT INTO calendar_occupancy (slot_date, slot_time, booked)
+            SELECT appointment_date, ltrim(appointment_time, '0'), COUNT(*)
+            FROM appointments
+            WHERE status IS NULL OR status != 'cancelled'
+            GROUP BY appointment_date, ltrim(appointment_time, '0')
+        ''')
+        written = c.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return written
+
+
+def month_occupancy(c, month: str, capacity: Optional[int] = None) -> Dict[str, dict]:
+    """Per-day load for a 'YYYY-MM' month: booked count, capacity and booked per slot.
+
+    Only days with bookings are returned; capacity is derived from the slot layout, or
+    None when no SLOT_CAPACITY is configured.
+    """
+    capacity = SLOT_CAPACITY if capacity is None else capacity
+    first = datetime.strptime(month, "%Y-%m").date()
+    following = date(first.year + (first.month == 12), first.month % 12 + 1, 1)
+    c.execute('''
+        SELECT slot_date, slot_time, booked
+        FROM calendar_occupancy
+        WHERE slot_date >= ? AND slot_date < ? AND booked > 0
+    ''', (first.isoformat(), following.isoformat()))
+    days: Dict[str, dict] = {}
+    for row in c.fetchall():
+        day = str(row[0])[:10]
+        entry = days.get(day)
+        if entry is None:
+            entry = days[day] = {
+                'booked': 0,
+                'capacity': len(slot_times_for(day)) * capacity if capacity is not None else None,
+                'slots': {},
+            }
+        entry['booked'] += int(row[2])
+        entry['slots'][row[1]] = int(row[2])
+    return days
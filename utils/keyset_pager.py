@@ -0,0 +1,166 @@
+"""
+Keyset (seek) pagination shared by the admin list views.
+
+Instead of OFFSET, each page continues from the sort key of the last row shown, so
+page N costs the same as page 1 and rows inserted meanwhile don't shift the pages.
+Lists are sorted newest first on a tuple of NOT NULL columns ending in a unique id,
+e.g. `(appointment_date, appointment_time, id)`; the cursor carries that tuple as an
+opaque token in the `after` / `before` query parameters. The seek uses a row-value
+comparison, which SQLite (3.15+) and PostgreSQL both serve from a matching index.
+
+Totals are optional and cached per filter combination: the caller passes a cheap
+`version` value (e.g. MAX(seq) of a change table) so a cached count is reused until
+the underlying rows change, with COUNT_CACHE_TTL as an upper bound.
+
+Usage:
+  page = keyset_page(c, select_sql, where_sql, params,
+                     order_keys=[('a.appointment_date', 'appointment_date'), ...],
+                     after=request.args.get('after'), before=request.args.get('before'))
+  page.items, page.next_cursor, page.prev_cursor
+
+Environment variables used:
+ - LIST_PAGE_SIZE (rows per page, default 25)
+ - COUNT_CACHE_TTL (seconds a cached total may be reused, default 60)
+"""
+from __future__ import annotations
+import base64
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "25"))
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "60"))
+_COUNT_CACHE_MAX = 256
+
+_count_cache: Dict[tuple, Tuple[float, int]] = {}
+_count_lock = threading.Lock()
+
+
+class KeysetPage:
+    """One page of rows plus the cursors needed to move either way."""
+
+    def __init__(self, items: List[dict], next_cursor: Optional[str], prev_cursor: Optional[str],
+                 per_page: int, total: Optional[int] = None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self) -> bool:
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    raw = json.dumps(list(values), default=str, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: Optional[str], width: int) -> Optional[list]:
+    """Return the key tuple from a cursor token, or None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        return None
+    if not isinstance(values, list) or len(values) != width:
+        return None
+    return values
+
+
+def keyset_page(c, select_sql: str, where_sql: str, params: Sequence[Any],
+                order_keys: Sequence[Tuple[str, str]], after: Optional[str] = None,
+                before: Optional[str] = None, per_page: Optional[int] = None) -> KeysetPage:
+    """Fetch one page of `select_sql` ordered descending on `order_keys`.
+
+    `select_sql` is the SELECT ... FROM ... JOIN part, `where_sql` the filter conditions
+    (without WHERE, may be empty) and `order_keys` a list of (sql expression, row key)
+    pairs whose last entry must be unique. `after` continues towards older rows, `before`
+    goes back towards newer ones.
+    """
+    per_page = per_page or LIST_PAGE_SIZE
+    columns = ', '.join(expr for expr, _ in order_keys)
+    placeholders = ', '.join('?' for _ in order_keys)
+
+    backwards = False
+    seek = decode_cursor(after, len(order_keys))
+    if seek is None:
+        seek = decode_cursor(before, len(order_keys))
+        backwards = seek is not None
+
+    conditions = [where_sql] if where_sql else []
+    query_params = list(params)
+    if seek is not None:
+        conditions.append(f"({columns}) {'>' if backwards else '<'} ({placeholders})")
+        query_params.extend(seek)
+
+    direction = 'ASC' if backwards else 'DESC'
+    query = select_sql
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(f'({cond})' for cond in conditions)
+    query += ' ORDER BY ' + ', '.join(f'{expr} {direction}' for expr, _ in order_keys)
+    # one extra row tells us whether another page exists in the direction we're moving
+    query += ' LIMIT ?'
+    query_params.append(per_page + 1)
+
+    c.execute(query, query_params)
+    rows = [dict(row) for row in c.fetchall()]
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor([row[key] for _, key in order_keys])
+
+    if not rows:
+        return KeysetPage([], None, None, per_page)
+    if backwards:
+        has_newer, has_older = more, True
+    else:
+        has_newer, has_older = seek is not None, more
+    return KeysetPage(
+        rows,
+        next_cursor=cursor_for(rows[-1]) if has_older else None,
+        prev_cursor=cursor_for(rows[0]) if has_newer else None,
+        per_page=per_page,
+    )
+
+
+def cached_count(c, count_sql: str, params: Sequence[Any], cache_key: str,
+                 version: Any = None, ttl: Optional[float] = None) -> int:
+    """COUNT(*) for a filter combination, reused while `version` is unchanged."""
+    ttl = COUNT_CACHE_TTL if ttl is None else ttl
+    key = (cache_key, count_sql, tuple(params), version)
+    now = time.monotonic()
+    with _count_lock:
+        hit = _count_cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+
+    c.execute(count_sql, list(params))
+    total = int(c.fetchone()[0] or 0)
+
+    with _count_lock:
+        if len(_count_cache) >= _COUNT_CACHE_MAX:
+            # drop expired entries first, then the oldest if still full
+            for stale in [k for k, (exp, _) in _count_cache.items() if exp <= now]:
+                del _count_cache[stale]
+            if len(_count_cache) >= _COUNT_CACHE_MAX:
+                del _count_cache[min(_count_cache, key=lambda k: _count_cache[k][0])]
+        _count_cache[key] = (now + ttl, total)
+    return total
+
+
+def clear_count_cache() -> None:
+    with _count_lock:
+        _count_cache.clear()
@@ -0,0 +1,207 @@
+"""
+Local counting semaphore used when Redis is unreachable (see utils/redis_semaphore.py).
+
+Permits are bounded at two levels:
+ - in the process, a `threading.BoundedSemaphore` per name, so sender threads wait on a
+   condition instead of spinning;
+ - across processes on the same machine (gunicorn workers, outbox workers on one dyno),
+   one lock file per permit under LOCAL_SEMAPHORE_DIR. Holding a permit means holding an
+   exclusive `flock` on one of the slot files. The kernel drops the lock when the holder
+   exits or crashes, so a dead worker can't leak a permit and no lease reclaim is needed.
+
+Where `fcntl` is unavailable (Windows dev machines) only the in-process bound applies.
+
+Tokens look like `local:<name>:<slot>:<id>`; `utils.redis_semaphore.release_token` sends
+them back here even if Redis has recovered in the meantime.
+
+Usage counters per semaphore name are available from `fallback_metrics()`.
+
+Environment variables used:
+ - LOCAL_SEMAPHORE_DIR (default <tmp>/abcnaic-semaphores)
+ - LOCAL_SEMAPHORE_PERMITS (default 5; permits for names that init_semaphore never configured)
+"""
+from __future__ import annotations
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+LOCAL_SEMAPHORE_DIR = os.getenv("LOCAL_SEMAPHORE_DIR") or os.path.join(tempfile.gettempdir(),
+                                                                        "abcnaic-semaphores")
+LOCAL_SEMAPHORE_PERMITS = int(os.getenv("LOCAL_SEMAPHORE_PERMITS", "5"))
+TOKEN_PREFIX = "local:"
+# longest sleep between attempts while every cross-process slot is taken
+_MAX_BACKOFF_SECS = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+def is_local_token(token: Optional[str]) -> bool:
+    return bool(token) and token.startswith(TOKEN_PREFIX)
+
+
+class LocalSemaphore:
+    """`permits` slots shared by every thread and process on this machine using `name`."""
+
+    def __init__(self, name: str, permits: int, lock_dir: Optional[str] = None):
+        self.name = name
+        self.permits = permits
+        self.lock_dir = lock_dir or LOCAL_SEMAPHORE_DIR
+        self._threads = threading.BoundedSemaphore(permits)
+        self._held: Dict[str, Optional[int]] = {}
+        self._lock = threading.Lock()
+        self.metrics = {'acquired': 0, 'released': 0, 'timeouts': 0, 'in_use': 0,
+                        'max_in_use': 0, 'wait_seconds': 0.0}
+        self._file_stem = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        if fcntl is not None:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _slot_path(self, slot: int) -> str:
+        return os.path.join(self.lock_dir, f"{self._file_stem}.{slot}.lock")
+
+    def _lock_slot(self) -> Optional[tuple]:
+        """Try each slot file once (random start so processes don't all contend on slot 0)."""
+        start = random.randrange(self.permits)
+        for i in range(self.permits):
+            slot = (start + i) % self.permits
+            fd = os.open(self._slot_path(slot), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            return slot, fd
+        return None
+
+    def _record(self, key: str, delta=1) -> None:
+        with self._lock:
+            self.metrics[key] += delta
+
+    def acquire(self, timeout: float = 5.0) -> Optional[str]:
+        """A token within `timeout` seconds, or None."""
+        started = time.monotonic()
+        end = started + timeout
+        if not self._threads.acquire(timeout=max(0.0, timeout)):
+            self._record('timeouts')
+            return None
+        slot, fd = 0, None
+        if fcntl is not None:
+            delay = 0.005
+            while True:
+                try:
+                    locked = self._lock_slot()
+                except OSError as e:
+                    logger.warning(f"Local semaphore {self.name}: lock files unusable ({e}); "
+                                   f"bounding in-process only")
+                    break
+                if locked:
+                    slot, fd = locked
+                    break
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    self._threads.release()
+                    self._record('timeouts')
+                    return None
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, _MAX_BACKOFF_SECS)
+        token = f"{TOKEN_PREFIX}{self.name}:{slot}:{uuid.uuid4().hex}"
+        with self._lock:
+            self._held[token] = fd
+            m = self.metrics
+            m['acquired'] += 1
+            m['in_use'] += 1
+            m['max_in_use'] = max(m['max_in_use'], m['in_use'])
+            m['wait_seconds'] += time.monotonic() - started
+        return token
+
+    def release(self, token: str) -> bool:
+        """Give the permit back; unknown or already released tokens are ignored (False)."""
+        with self._lock:
+            if token not in self._held:
+                return False
+            fd = self._held.pop(token)
+            self.metrics['released'] += 1
+            self.metrics['in_use'] -= 1
+        if fd is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        self._threads.release()
+        return True
+
+    def held(self) -> int:
+        with self._lock:
+            return len(self._held)
+
+
+_semaphores: Dict[str, LocalSemaphore] = {}
+_permits: Dict[str, int] = {}
+_registry_lock = threading.Lock()
+
+
+def configure(name: str, permits: int) -> None:
+    """Set the local permit count for `name` (init_semaphore calls this).
+
+    Takes effect for a semaphore that hasn't been used yet in this process.
+    """
+    with _registry_lock:
+        _permits[name] = permits
+        current = _semaphores.get(name)
+        if current is not None and current.permits != permits and not current.held():
+            del _semaphores[name]
+
+
+def get_semaphore(name: str) -> LocalSemaphore:
+    sem = _semaphores.get(name)
+    if sem is None:
+        with _registry_lock:
+            sem = _semaphores.get(name)
+            if sem is None:
+                sem = _semaphores[name] = LocalSemaphore(name, _permits.get(name, LOCAL_SEMAPHORE_PERMITS))
+    return sem
+
+
+def acquire_token(name: str, timeout: float = 5.0) -> Optional[str]:
+    return get_semaphore(name).acquire(timeout)
+
+
+def release_token(name: str, token: str) -> bool:
+    # the name embedded in the token wins, in case a caller mixes names up
+    if is_local_token(token):
+        name = token[len(TOKEN_PREFIX):].rsplit(":", 2)[0]
+    sem = _semaphores.get(name)
+    return sem.release(token) if sem is not None else False
+
+
+def fallback_metrics() -> Dict[str, dict]:
+    """Per-name fallback counters for this process."""
+    with _registry_lock:
+        sems = list(_semaphores.values())
+    result = {}
+    for sem in sems:
+        with sem._lock:
+            result[sem.name] = dict(sem.metrics, permits=sem.permits,
+                                    cross_process=fcntl is not None)
+    return result
+
+
+def _reset_after_fork() -> None:
+    # permits held by the parent belong to the parent; the child starts empty
+    global _registry_lock
+    _registry_lock = threading.Lock()
+    _semaphores.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
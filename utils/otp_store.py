@@ -0,0 +1,187 @@
+"""
+One-time code storage for the programmable-SMS OTP path (Twilio Verify keeps its own).
+
+Codes are never stored in plain text: each is kept as HMAC-SHA256(secret, phone:code),
+so a dump of Redis (or of this process) doesn't reveal live codes, and a hash can't be
+replayed for another number.
+
+Issue and verify are one Lua script each, so each is a single round trip. Verify
+decrements the tries counter and compares the hash atomically. Concurrent guesses
+can't get more than OTP_MAX_TRIES attempts between a read and a write.
+
+With OTP_STORE=memory codes live in an in-process TTL store instead. That is only correct
+for a single-process deployment (with several workers a code may be issued by one and
+checked by another), so it is never used as a silent fallback: while Redis is unreachable
+(utils/redis_client.py breaker) issue and verify raise OTPStoreUnavailable.
+
+Usage:
+  from utils import otp_store
+  otp_store.issue(phone, code)
+  otp_store.verify(phone, code)  -> VERIFIED | INVALID | EXPIRED | LOCKED
+
+Environment variables used:
+ - OTP_HMAC_SECRET (falls back to FLASK_SECRET_KEY; one of them is required unless OTP_STORE=memory)
+ - OTP_STORE ('auto' (default): Redis, or 'memory' for a single process)
+ - OTP_TTL_SECS (default 300), OTP_MAX_TRIES (default 3)
+"""
+from __future__ import annotations
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from utils import redis_client
+
+OTP_STORE = os.getenv("OTP_STORE", "auto").lower()
+OTP_TTL_SECS = int(os.getenv("OTP_TTL_SECS", "300"))
+OTP_MAX_TRIES = int(os.getenv("OTP_MAX_TRIES", "3"))
+# not "sms:otp:", which held the old plain-text string keys
+KEY_PREFIX = "sms:otp-hash:"
+
+VERIFIED = 'verified'
+INVALID = 'invalid'
+EXPIRED = 'expired'  # no code (never sent, expired, or already used)
+LOCKED = 'locked'    # out of tries
+
+logger = logging.getLogger(__name__)
+
+_secret = (os.getenv("OTP_HMAC_SECRET") or os.getenv("FLASK_SECRET_KEY") or "").encode()
+# only for OTP_STORE=memory, where hashes never leave this process
+_process_secret = os.urandom(32)
+
+
+class OTPStoreUnavailable(Exception):
+    """Redis can't be reached, so codes can't be issued or checked."""
+
+
+# KEYS: otp hash key; ARGV: code hash, tries, ttl_ms
+_ISSUE_LUA = '''
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'h', ARGV[1], 'tries', ARGV[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return 1
+'''
+
+# KEYS: otp hash key; ARGV: code hash. Returns 1 verified, 0 invalid, -1 expired, -2 locked
+_VERIFY_LUA = '''
+local stored = redis.call('HGET', KEYS[1], 'h')
+if not stored then
+  return -1
+end
+local left = redis.call('HINCRBY', KEYS[1], 'tries', -1)
+if left < 0 then
+  redis.call('DEL', KEYS[1])
+  return -2
+end
+if stored == ARGV[1] then
+  redis.call('DEL', KEYS[1])
+  return 1
+end
+if left == 0 then
+  redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+_RESULTS = {1: VERIFIED, 0: INVALID, -1: EXPIRED, -2: LOCKED}
+
+
+def _hmac_key() -> bytes:
+    if _secret:
+        return _secret
+    if OTP_STORE == "memory":
+        return _process_secret
+    # a per-process key would make codes issued by one worker fail in every other
+    raise RuntimeError("OTP_HMAC_SECRET or FLASK_SECRET_KEY must be set to store OTPs in Redis")
+
+
+def hash_code(phone: str, code: str) -> str:
+    return hmac.new(_hmac_key(), f"{phone}:{code}".encode(), hashlib.sha256).hexdigest()
+
+
+class MemoryOTPStore:
+    """In-process TTL store with the same semantics as the Lua scripts."""
+
+    def __init__(self, max_entries: int = 100000, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self._clock = clock
+        # phone -> (code hash, tries left, expires at); insertion order = issue order
+        self._codes: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, phone: str, code_hash: str, ttl: float, tries: int) -> None:
+        with self._lock:
+            self._codes.pop(phone, None)
+            self._codes[phone] = (code_hash, tries, self._clock() + ttl)
+            if len(self._codes) > self.max_entries:
+                self._purge()
+
+    def _purge(self) -> None:
+        now = self._clock()
+        for phone in [p for p, (_, _, expires) in self._codes.items() if expires <= now]:
+            del self._codes[phone]
+        while len(self._codes) > self.max_entries:
+            self._codes.popitem(last=False)
+
+    def verify(self, phone: str, code_hash: str) -> str:
+        with self._lock:
+            entry = self._codes.get(phone)
+            if entry is None or entry[2] <= self._clock():
+                self._codes.pop(phone, None)
+                return EXPIRED
+            stored, tries, expires = entry
+            left = tries - 1
+            if left < 0:
+                del self._codes[phone]
+                return LOCKED
+            if hmac.compare_digest(stored, code_hash):
+                del self._codes[phone]
+                return VERIFIED
+            if left == 0:
+                del self._codes[phone]
+            else:
+                self._codes[phone] = (stored, left, expires)
+            return INVALID
+
+
+_memory = MemoryOTPStore()
+
+
+def _use_redis() -> bool:
+    return OTP_STORE != "memory"
+
+
+def _unavailable():
+    raise OTPStoreUnavailable("redis_unavailable")
+
+
+def issue(phone: str, code: str, ttl: Optional[int] = None, tries: Optional[int] = None) -> None:
+    """Store `code` for `phone` (replacing any previous one) with a TTL and a tries budget.
+
+    Raises OTPStoreUnavailable while Redis is unreachable (unless OTP_STORE=memory).
+    """
+    ttl = ttl or OTP_TTL_SECS
+    tries = tries or OTP_MAX_TRIES
+    code_hash = hash_code(phone, code)
+    if not _use_redis():
+        return _memory.issue(phone, code_hash, ttl, tries)
+    redis_client.run(lambda r: redis_client.register_script(_ISSUE_LUA)(
+        keys=[KEY_PREFIX + phone], args=[code_hash, tries, int(ttl * 1000)], client=r), fallback=_unavailable)
+
+
+def verify(phone: str, code: str) -> str:
+    """Check `code` for `phone`; one attempt is used up whatever the outcome.
+
+    Raises OTPStoreUnavailable while Redis is unreachable (unless OTP_STORE=memory).
+    """
+    code_hash = hash_code(phone, str(code).strip())
+    if not _use_redis():
+        return _memory.verify(phone, code_hash)
+    return redis_client.run(
+        lambda r: _RESULTS[int(redis_client.register_script(_VERIFY_LUA)(
+            keys=[KEY_PREFIX + phone], args=[code_hash], client=r))],
+        fallback=_unavailable)
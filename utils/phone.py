@@ -0,0 +1,67 @@
+"""
+Phone number normalization shared by OTPs, outbound SMS and campaigns.
+
+Almost every number this app sees is a Philippine mobile number typed as 09XXXXXXXXX,
+9XXXXXXXXX, 639XXXXXXXXX or +639XXXXXXXXX (with optional spaces, dashes, dots or
+brackets) with an allocated mobile prefix. Those are turned into E.164 by one
+precompiled regex. Anything else (including unallocated 09XX prefixes) goes through
+`phonenumbers`, which is imported on first use so its metadata isn't loaded at app
+startup, and whose results (valid or not) are kept in a bounded LRU cache.
+
+Usage:
+  from utils.phone import normalize_phone, try_normalize
+  normalize_phone('0917 123 4567')  -> '+639171234567'   (ValueError if invalid)
+  try_normalize('garbage')          -> None
+
+Environment variables used:
+ - PHONE_CACHE_SIZE (entries in the slow-path LRU cache, default 4096)
+"""
+from __future__ import annotations
+import os
+import re
+from functools import lru_cache
+from typing import Optional
+
+PHONE_CACHE_SIZE = int(os.getenv("PHONE_CACHE_SIZE", "4096"))
+
+_SEPARATORS = re.compile(r"[\s().\-]")
+# national 09XXXXXXXXX / 9XXXXXXXXX, or 63 / +63 followed by 9XXXXXXXXX, for the mobile
+# prefixes phonenumbers accepts (900-904, 913, 940, 941, 980, 982, 984, 990 aren't allocated;
+# tests/test_phone.py checks this list against the phonenumbers metadata)
+_PH_MOBILE = re.compile(r"(?:\+?63|0)?(9(?:0[5-9]|1[0-24-9]|[23]\d|4[2-9]|[5-7]\d|8[135-9]|9[1-9])\d{7})")
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _parse_full(raw: str, default_region: str) -> Optional[str]:
+    import phonenumbers  # lazy: the metadata is large and most numbers never need it
+    try:
+        pn = phonenumbers.parse(raw, default_region)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_possible_number(pn) or not phonenumbers.is_valid_number(pn):
+        return None
+    return phonenumbers.format_number(pn, phonenumbers.PhoneNumberFormat.E164)
+
+
+def try_normalize(raw: Optional[str], default_region: str = "PH") -> Optional[str]:
+    """E.164 form of `raw`, or None when it isn't a valid number."""
+    if not raw:
+        return None
+    raw = str(raw).strip()
+    if default_region == "PH":
+        match = _PH_MOBILE.fullmatch(_SEPARATORS.sub("", raw))
+        if match:
+            return "+63" + match.group(1)
+    return _parse_full(raw, default_region)
+
+
+def normalize_phone(raw: str, default_region: str = "PH") -> str:
+    """Parse and return E.164 formatted phone number or raise ValueError."""
+    phone = try_normalize(raw, default_region)
+    if phone is None:
+        raise ValueError("invalid phone")
+    return phone
+
+
+def is_valid_phone(raw: Optional[str], default_region: str = "PH") -> bool:
+    return try_normalize(raw, default_region) is not None
@@ -0,0 +1,222 @@
+"""
+Rate limiting with GCRA (generic cell rate algorithm) in one Redis round trip.
+
+Each limit is a rate (`count` requests per `period` seconds) plus a burst. GCRA stores a
+single "theoretical arrival time" per key instead of counters, so a limit costs one small
+string key and a check is one EVAL no matter how many limits apply: every limit for every
+key of a request is evaluated atomically, and nothing is charged unless all of them allow
+it (a request rejected by the daily limit does not use up the per-minute allowance).
+
+When Redis is unreachable (see the circuit breaker in utils/redis_client.py) the same
+algorithm runs in process (per worker, bounded LRU of keys), so limits loosen to
+per-process instead of switching off.
+
+Usage:
+  from utils.rate_limit import Limit, hit, rate_limit, client_ip
+
+  decision = hit([(f"otp:{phone}", OTP_LIMITS)])
+  if not decision.allowed: ...  # decision.retry_after seconds, decision.limit name
+
+  @app.route('/check-username', methods=['POST'])
+  @rate_limit((client_ip('check'), AVAILABILITY_LIMITS))
+  def check_username(): ...
+
+Environment variables used:
+ - REDIS_URL (through utils.redis_client)
+ - RATE_LIMIT_ENABLED (default 1; 0 disables every limit, e.g. for load tests)
+ - RATE_LIMIT_LOCAL_MAX_KEYS (default 10000; keys kept by the in-process fallback)
+"""
+from __future__ import annotations
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from utils import redis_client, request_ip
+
+KEY_PREFIX = "rl"
+
+
+class Limit(NamedTuple):
+    """`count` requests per `period` seconds; up to `burst` (default `count`) back to back."""
+    name: str
+    count: int
+    period: float
+    burst: Optional[int] = None
+
+    @property
+    def interval(self) -> float:
+        return self.period / self.count
+
+    @property
+    def tolerance(self) -> float:
+        return self.interval * (self.burst or self.count)
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    retry_after: float = 0.0
+    limit: Optional[str] = None
+
+
+ALLOWED = Decision(True)
+
+# Named limits used by the routes
+OTP_LIMITS = (Limit('otp_minute', 1, 60), Limit('otp_daily', 5, 86400))
+OTP_IP_LIMITS = (Limit('otp_ip_hourly', 20, 3600, burst=5),)
+AVAILABILITY_LIMITS = (Limit('check_burst', 10, 10), Limit('check_hourly', 300, 3600))
+LOGIN_IP_LIMITS = (Limit('login_ip', 30, 600, burst=10),)
+LOGIN_ID_LIMITS = (Limit('login_id', 10, 900, burst=5),)
+
+# KEYS: one per (key, limit); ARGV: interval_ms, tolerance_ms per KEY.
+# Returns {allowed, retry_after_ms, index of the limit that refused (1-based)}
+_GCRA_LUA = '''
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local tats = {}
+local retry, refused = 0, 0
+for i = 1, #KEYS do
+  local interval = tonumber(ARGV[2 * i - 1])
+  local tolerance = tonumber(ARGV[2 * i])
+  local tat = tonumber(redis.call('GET', KEYS[i]) or 0)
+  if tat < now then tat = now end
+  local new_tat = tat + interval
+  local wait = new_tat - tolerance - now
+  if wait > retry then
+    retry, refused = wait, i
+  end
+  tats[i] = new_tat
+end
+if refused > 0 then
+  return {0, retry, refused}
+end
+for i = 1, #KEYS do
+  redis.call('SET', KEYS[i], tats[i], 'PX', tats[i] - now)
+end
+return {1, 0, 0}
+'''
+
+
+def _enabled() -> bool:
+    return os.getenv("RATE_LIMIT_ENABLED", "1").lower() not in ("0", "false", "no")
+
+
+class LocalLimiter:
+    """In-process GCRA with the same semantics as the Redis script."""
+
+    def __init__(self, max_keys: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, entries: Sequence[Tuple[str, Limit]]) -> Decision:
+        with self._lock:
+            now = self._clock()
+            new_tats = []
+            retry, refused = 0.0, None
+            for key, limit in entries:
+                tat = max(self._tats.get(key, now), now)
+                new_tat = tat + limit.interval
+                # (tat - now) first: a fresh key must wait exactly 0, not a rounding error above it
+                wait = tat - now + limit.interval - limit.tolerance
+                if wait > retry:
+                    retry, refused = wait, limit.name
+                new_tats.append((key, new_tat))
+            if refused:
+                return Decision(False, retry, refused)
+            for key, new_tat in new_tats:
+                self._tats[key] = new_tat
+                self._tats.move_to_end(key)
+            while len(self._tats) > self.max_keys:
+                self._tats.popitem(last=False)
+            return ALLOWED
+
+    def reset(self) -> None:
+        with self._lock:
+            self._tats.clear()
+
+
+_local = LocalLimiter(int(os.getenv("RATE_LIMIT_LOCAL_MAX_KEYS", "10000")))
+
+
+def _entries(checks: Iterable[Tuple[str, Sequence[Limit]]]) -> List[Tuple[str, Limit]]:
+    return [(f"{KEY_PREFIX}:{limit.name}:{key}", limit)
+            for key, limits in checks if key for limit in limits]
+
+
+def hit(checks: Iterable[Tuple[str, Sequence[Limit]]]) -> Decision:
+    """Charge one request against every (key, limits) pair, all or nothing.
+
+    Keys that are None/empty are skipped. Returns the Decision; when refused,
+    `retry_after` is the seconds until the request would be allowed.
+    """
+    if not _enabled():
+        return ALLOWED
+    entries = _entries(checks)
+    if not entries:
+        return ALLOWED
+
+    def gcra(r):
+        args = []
+        for _, limit in entries:
+            args += [int(limit.interval * 1000), int(limit.tolerance * 1000)]
+        allowed, retry_ms, index = redis_client.register_script(_GCRA_LUA)(
+            keys=[k for k, _ in entries], args=args, client=r)
+        if allowed:
+            return ALLOWED
+        return Decision(False, int(retry_ms) / 1000.0, entries[int(index) - 1][1].name)
+
+    return redis_client.run(gcra, fallback=lambda: _local.hit(entries))
+
+
+def hit_key(key: str, limits: Sequence[Limit]) -> Decision:
+    return hit([(key, limits)])
+
+
+# Key functions for the decorator: each takes the Flask request and returns a key or None
+
+def client_ip(scope: str) -> Callable:
+    return lambda req: f"{scope}:ip:{request_ip.client_ip(req) or 'unknown'}"
+
+
+def form_field(scope: str, field: str) -> Callable:
+    def key(req):
+        value = (req.form.get(field) or '').strip().lower()
+        return f"{scope}:{field}:{value}" if value else None
+    return key
+
+
+def _limited_response(decision: Decision):
+    from flask import jsonify
+    response = jsonify({'ok': False, 'error': 'rate_limited',
+                        'retry_after': math.ceil(decision.retry_after)})
+    response.status_code = 429
+    return response
+
+
+def rate_limit(*rules: Tuple[Callable, Sequence[Limit]], methods: Sequence[str] = ('POST',),
+               on_limited: Optional[Callable[[Decision], object]] = None):
+    """Route decorator: `rules` are (key_func, limits) pairs checked in one round trip.
+
+    Only requests whose method is in `methods` are counted. Refused requests get
+    `on_limited(decision)` (default: a JSON 429) with a Retry-After header.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            from flask import make_response, request
+            if request.method not in methods:
+                return f(*args, **kwargs)
+            decision = hit([(key_func(request), limits) for key_func, limits in rules])
+            if decision.allowed:
+                return f(*args, **kwargs)
+            response = make_response((on_limited or _limited_response)(decision))
+            response.headers['Retry-After'] = str(max(1, math.ceil(decision.retry_after)))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,198 @@
+"""
+Shared Redis client: one lazily created connection pool per process behind a circuit breaker.
+
+Nothing here touches the network at import time. `get_client()` builds the client (and its
+connection pool) on first use and caches it per process id, so gunicorn workers forked
+from the master each get their own pool; redis-py only connects when the first command runs.
+
+Callers that have a local fallback go through `run()` (or `get_redis()`): after
+REDIS_BREAKER_FAILURES consecutive connection errors/timeouts the breaker opens and every
+caller goes straight to its fallback without waiting on sockets. After
+REDIS_BREAKER_RESET seconds one caller is let through as a probe; if it succeeds the
+breaker closes again, so a Redis that comes back is picked up within seconds instead of
+staying disabled for the life of the process.
+
+Usage:
+  from utils import redis_client
+  count = redis_client.run(lambda r: r.incr(key), fallback=lambda: local_count())
+
+  script = redis_client.register_script(LUA)   # Script bound to the current process' client
+
+Environment variables used:
+ - REDIS_URL
+ - REDIS_MAX_CONNECTIONS (pool size per process, default 20)
+ - REDIS_CONNECT_TIMEOUT (seconds, default 0.5)
+ - REDIS_SOCKET_TIMEOUT (seconds per command, default 5; must exceed blocking command waits)
+ - REDIS_BREAKER_FAILURES (consecutive failures that open the breaker, default 3)
+ - REDIS_BREAKER_RESET (seconds before a recovery probe, default 10)
+"""
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+import redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "3"))
+REDIS_BREAKER_RESET = float(os.getenv("REDIS_BREAKER_RESET", "10"))
+
+# Errors that mean "Redis is unreachable", as opposed to a bad command or script
+UNAVAILABLE_ERRORS = (redis.ConnectionError, redis.TimeoutError, OSError)
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_client: Optional[redis.Redis] = None
+_client_pid: Optional[int] = None
+_scripts: Dict[str, object] = {}
+
+
+class CircuitBreaker:
+    """closed -> (failures) -> open -> (reset timeout) -> half-open probe -> closed/open."""
+
+    def __init__(self, failure_threshold: int = REDIS_BREAKER_FAILURES,
+                 reset_timeout: float = REDIS_BREAKER_RESET, clock: Callable[[], float] = time.monotonic,
+                 name: str = 'Redis'):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if self._probing or self._clock() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        """Whether a call may go through now; while open only a single probe is let through."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or self._clock() - self.opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"{self.name} reachable again; closing circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self, exc: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    self.trips += 1
+                    logger.warning(f"{self.name} unavailable ({exc}); circuit open for {self.reset_timeout}s")
+                self.opened_at = self._clock()
+            self._probing = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+
+breaker = CircuitBreaker()
+
+
+def get_client() -> redis.Redis:
+    """The process-wide pooled client. Creating it does not connect."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            pool = redis.ConnectionPool.from_url(
+                REDIS_URL,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                health_check_interval=30,
+            )
+            _client = redis.Redis(connection_pool=pool)
+            _client_pid = pid
+            _scripts.clear()
+    return _client
+
+
+def reset_client() -> None:
+    """Drop the cached client (after fork, or when REDIS_URL changes)."""
+    global _client, _client_pid
+    _client = None
+    _client_pid = None
+    _scripts.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_client)
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """The client, or None while the breaker is open. Callers must report the outcome
+    with `breaker.record_success()` / `breaker.record_failure()`; `run()` does that."""
+    if not breaker.allow():
+        return None
+    return get_client()
+
+
+def is_available() -> bool:
+    """Cheap check: False while the breaker is open. Does not touch the network."""
+    return breaker.state != 'open'
+
+
+def run(fn: Callable[[redis.Redis], T], fallback: Callable[[], T]) -> T:
+    """Call `fn(client)`, or `fallback()` when the breaker is open or Redis is unreachable.
+
+    Only connection errors and timeouts count against the breaker; other Redis errors
+    (bad command, script error) propagate.
+    """
+    client = get_redis()
+    if client is None:
+        return fallback()
+    try:
+        result = fn(client)
+    except UNAVAILABLE_ERRORS as e:
+        breaker.record_failure(e)
+        return fallback()
+    except BaseException:
+        # not an availability problem; don't leave a half-open probe hanging
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+def ping() -> bool:
+    """Round trip through the breaker; True when Redis answered."""
+    return run(lambda r: bool(r.ping()), fallback=lambda: False)
+
+
+def register_script(source: str):
+    """A Script (EVALSHA with EVAL fallback) registered on this process' client."""
+    client = get_client()
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script
@@ -1,5 +1,5 @@
 """
-A Redis-backed token-list semaphore with a simple reclaim pattern.
+A Redis-backed counting semaphore with atomic Lua acquire/release and lease-ordered reclaim.
 
 Usage:
 1. Initialize the semaphore (one-time):
@@ -16,35 +16,127 @@ Usage:
    finally:
        release_token('sms:semaphore', token)
 
-3. Run the reclaimer periodically (there's a small runner script in scripts/)
-
-Notes:
-- This implementation stores a token registry in a Redis set and an owner key per-acquired token
-  with TTL (lease). If a worker dies without releasing, once the owner key expires the token
-  becomes reclaimable by the reclaimer.
-- The reclaimer is best run as a separate scheduled job/process.
+   Pass `permits=` to have the acquire seed the semaphore itself whenever its keys are
+   missing (never initialized, Redis restarted without persistence, or flushed):
+   token = acquire_token('sms:semaphore', timeout=3, permits=5)
+
+3. Run the reclaimer periodically (there's a small runner script in scripts/); acquirers
+   also reclaim a few expired leases on every attempt, so the runner is a safety net.
+
+Keys for a semaphore `name`:
+ - `{name}:tokens`  list of free tokens
+ - `{name}:leases`  sorted set token -> lease expiry (ms, Redis server clock)
+ - `{name}:owners`  set of every token (registry)
+ - `{name}:permits` permit count written by init_semaphore or a seeding acquire (marks a
+                    semaphore in this format)
+ - `{name}:wake`    short list that releases push to, so blocked acquirers wake up
+
+Popping a token and recording its lease happen in one Lua script, so a client that dies
+mid-acquire can't leak a permit: the token is either still free or has a lease that
+expires. Release only returns a token whose lease is still held (ZREM succeeded), so a
+late release after a reclaim can't duplicate it. Waiting is a BRPOP on the wake list
+rather than a sleep/poll loop, and reclaim is a ZRANGEBYSCORE over expired leases
+instead of a scan of the whole registry.
+
+Expiry uses the Redis server's TIME, so clients with skewed clocks agree on leases.
+Blocking waits use fractional BRPOP timeouts, which need Redis 6 or newer.
+
+Connections come from the shared pool in `utils.redis_client`; while its circuit
+breaker is open (Redis unreachable) acquires fall back to `utils.local_semaphore`, which
+still bounds concurrency to the configured permits across the processes of one machine.
+Local tokens are released locally even if Redis comes back while they are held.
+
+Environment variables used:
+ - REDIS_URL and the REDIS_* pool/breaker settings (see utils/redis_client.py)
 """
 from __future__ import annotations
-import os
 import time
 import uuid
 from typing import Optional, List
 
-import redis
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-
-# Initialize Redis client defensively. On developer machines Redis may not be
-# running; in that case set _redis = None and provide safe fallbacks so import
-# doesn't raise (prevents Error 10061 connection refused on import).
-_redis = None
-try:
-    _redis = redis.from_url(REDIS_URL)
-    try:
-        _redis.ping()
-    except Exception:
-        _redis = None
-except Exception:
-    _redis = None
+from utils import local_semaphore, redis_client
+from utils.local_semaphore import fallback_metrics, is_local_token  # noqa: F401  (re-exported)
+
+# Longest single BRPOP while waiting; waiters re-run the acquire script after each wake
+# or timeout, which also reclaims leases that expired meanwhile.
+WAIT_SLICE_SECS = 1.0
+RECLAIM_ON_ACQUIRE = 5
+_WAKE_TTL_SECS = 60
+
+_NOW_MS = '''
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+'''
+
+_RECLAIM = '''
+local function reclaim(tokens, leases, wake, now, limit, wake_ttl)
+  local expired = redis.call('ZRANGEBYSCORE', leases, '-inf', now, 'LIMIT', 0, limit)
+  for _, token in ipairs(expired) do
+    redis.call('ZREM', leases, token)
+    redis.call('LPUSH', tokens, token)
+  end
+  if #expired > 0 then
+    redis.call('LPUSH', wake, unpack(expired))
+    redis.call('LTRIM', wake, 0, 63)
+    redis.call('EXPIRE', wake, wake_ttl)
+  end
+  return #expired
+end
+'''
+
+# KEYS: tokens, leases, wake, permits, owners; ARGV: lease_ms, reclaim_limit, wake_ttl, seed_permits
+_ACQUIRE_LUA = _NOW_MS + _RECLAIM + '''
+local seed = tonumber(ARGV[4])
+if seed > 0 and redis.call('EXISTS', KEYS[4]) == 0 then
+  -- never initialized or lost with Redis' data: seed it, once, inside this script
+  redis.call('DEL', KEYS[1], KEYS[2], KEYS[5])
+  redis.call('SET', KEYS[4], seed)
+  for i = 1, seed do
+    local token = 'seed:' .. now .. ':' .. i
+    redis.call('LPUSH', KEYS[1], token)
+    redis.call('SADD', KEYS[5], token)
+  end
+end
+reclaim(KEYS[1], KEYS[2], KEYS[3], now, tonumber(ARGV[2]), ARGV[3])
+local token = redis.call('RPOP', KEYS[1])
+if not token then
+  return false
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), token)
+return token
+'''
+
+# KEYS: tokens, leases, wake; ARGV: token, wake_ttl
+_RELEASE_LUA = '''
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+  return 0
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LPUSH', KEYS[3], ARGV[1])
+redis.call('LTRIM', KEYS[3], 0, 63)
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+return 1
+'''
+
+# KEYS: leases; ARGV: token, lease_ms
+_EXTEND_LUA = _NOW_MS + '''
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[2]), ARGV[1])
+return 1
+'''
+
+# KEYS: tokens, leases, wake; ARGV: limit, wake_ttl
+_RECLAIM_LUA = _NOW_MS + _RECLAIM + '''
+return reclaim(KEYS[1], KEYS[2], KEYS[3], now, tonumber(ARGV[1]), ARGV[2])
+'''
+
+
+def _script(source: str):
+    # Script objects cache the SHA (EVALSHA) and are re-registered for each process' client
+    return redis_client.register_script(source)
 
 
 def _tokens_key(name: str) -> str:
@@ -55,118 +147,141 @@ def _owners_key(name: str) -> str:
     return f"{name}:owners"
 
 
+def _leases_key(name: str) -> str:
+    return f"{name}:leases"
+
+
+def _wake_key(name: str) -> str:
+    return f"{name}:wake"
+
+
+def _permits_key(name: str) -> str:
+    return f"{name}:permits"
+
+
+def _keys(name: str) -> List[str]:
+    return [_tokens_key(name), _leases_key(name), _wake_key(name)]
+
+
+def _acquire_keys(name: str) -> List[str]:
+    return _keys(name) + [_permits_key(name), _owners_key(name)]
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
 def init_semaphore(name: str, permits: int) -> int:
     """Create a fresh semaphore with `permits` tokens.
 
-    This will delete any existing tokens/owner information for the given name.
+    This will delete any existing tokens/lease information for the given name.
     Returns number of tokens pushed.
     """
-    # If Redis is unavailable, just return the requested permits and avoid
-    # performing any Redis operations. This keeps behavior safe in dev.
-    if not _redis:
+    def init(r):
+        tokens_key = _tokens_key(name)
+        owners_key = _owners_key(name)
+        pipe = r.pipeline()
+        pipe.delete(tokens_key, owners_key, _leases_key(name), _wake_key(name))
+        pipe.set(_permits_key(name), permits)
+        tokens = [str(uuid.uuid4()) for _ in range(permits)]
+        if tokens:
+            # store tokens as a list for fast pop/push
+            pipe.lpush(tokens_key, *tokens)
+            # and register tokens in a set so callers can tell the semaphore exists
+            pipe.sadd(owners_key, *tokens)
+        pipe.execute()
         return permits
 
-    tokens_key = _tokens_key(name)
-    owners_key = _owners_key(name)
-    pipe = _redis.pipeline()
-    pipe.delete(tokens_key)
-    pipe.delete(owners_key)
-    tokens = [str(uuid.uuid4()) for _ in range(permits)]
-    if tokens:
-        # store tokens as a list for fast pop/push
-        pipe.lpush(tokens_key, *tokens)
-        # and register tokens in a set to make scanning/reclaim easier
-        pipe.sadd(owners_key, *tokens)
-    pipe.execute()
-    return permits
-
-
-def acquire_token(name: str, timeout: float = 5.0, lease_secs: int = 30) -> Optional[str]:
-    """Try to acquire a token within `timeout` seconds. If successful, sets an owner key
-    with TTL `lease_secs` and returns the token string. Returns None on timeout.
+    # the local fallback uses the same permit count while Redis is unreachable
+    local_semaphore.configure(name, permits)
+    return redis_client.run(init, fallback=lambda: permits)
+
+
+def semaphore_exists(name: str) -> bool:
+    """Whether `init_semaphore` has set up `name` (semaphores from the older per-token
+    owner-key format report False, so they get re-initialized)."""
+    return redis_client.run(lambda r: bool(r.exists(_permits_key(name))), fallback=lambda: False)
+
+
+def _try_acquire(r, name: str, lease_secs: int, permits: Optional[int] = None) -> Optional[str]:
+    token = _script(_ACQUIRE_LUA)(keys=_acquire_keys(name),
+                                  args=[int(lease_secs * 1000), RECLAIM_ON_ACQUIRE, _WAKE_TTL_SECS, permits or 0],
+                                  client=r)
+    return _decode(token) if token else None
+
+
+def try_acquire(name: str, lease_secs: int = 30, permits: Optional[int] = None) -> Optional[str]:
+    """One atomic attempt: pop a free token and lease it, or None if none is free."""
+    return redis_client.run(lambda r: _try_acquire(r, name, lease_secs, permits),
+                            fallback=lambda: local_semaphore.acquire_token(name, timeout=0))
+
+
+def acquire_token(name: str, timeout: float = 5.0, lease_secs: int = 30,
+                  permits: Optional[int] = None) -> Optional[str]:
+    """Acquire a token within `timeout` seconds; returns the token string or None on timeout.
+
+    Blocks on the semaphore's wake list between attempts instead of polling. With
+    `permits`, a semaphore whose keys are missing is seeded with that many tokens first.
     """
-    # If Redis is unavailable, provide a local token immediately so callers
-    # can proceed (best-effort behavior for development environments).
-    if not _redis:
-        return f"local-token-{int(time.time())}"
-
-    tokens_key = _tokens_key(name)
-    end = time.time() + timeout
-    while time.time() < end:
-        token = _redis.rpop(tokens_key)
-        if token:
-            token = token.decode() if isinstance(token, bytes) else token
-            owner_key = f"{name}:owner:{token}"
-            # set an owner key with TTL; we don't store owner value (could store PID or hostname)
-            _redis.set(owner_key, "1", ex=lease_secs)
-            return token
-        # if no token, sleep briefly and try again
-        time.sleep(0.05)
-    return None
+    end = time.monotonic() + timeout
+
+    def wait(r):
+        while True:
+            token = _try_acquire(r, name, lease_secs, permits)
+            if token:
+                return token
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return None
+            # woken by a release/reclaim, or re-check after a slice for leases that expired
+            r.brpop([_wake_key(name)], timeout=max(0.01, min(remaining, WAIT_SLICE_SECS)))
+
+    # Redis unreachable (or lost mid-wait): wait out the rest of the timeout locally
+    return redis_client.run(wait, fallback=lambda: local_semaphore.acquire_token(
+        name, timeout=max(0.0, end - time.monotonic())))
 
 
 def release_token(name: str, token: str) -> None:
-    """Release a token back into the pool and remove its owner key."""
+    """Release a token back into the pool; a token whose lease was already reclaimed is ignored."""
     if not token:
         return
-    if not _redis:
+    if is_local_token(token):
+        local_semaphore.release_token(name, token)
         return
-    tokens_key = _tokens_key(name)
-    owner_key = f"{name}:owner:{token}"
-    pipe = _redis.pipeline()
-    pipe.delete(owner_key)
-    pipe.lpush(tokens_key, token)
-    pipe.execute()
+    redis_client.run(lambda r: _script(_RELEASE_LUA)(keys=_keys(name), args=[token, _WAKE_TTL_SECS], client=r),
+                     fallback=lambda: None)
+
+
+def extend_token(name: str, token: str, lease_secs: int = 30) -> bool:
+    """Push a held token's lease out to `lease_secs` from now; False if it was already lost."""
+    if is_local_token(token):
+        return True  # local permits have no lease; the kernel frees them if the holder dies
+    return bool(redis_client.run(
+        lambda r: _script(_EXTEND_LUA)(keys=[_leases_key(name)], args=[token, int(lease_secs * 1000)], client=r),
+        fallback=lambda: True))
 
 
 def list_tokens(name: str) -> List[str]:
-    if not _redis:
-        return []
-    tokens_key = _tokens_key(name)
-    raw = _redis.lrange(tokens_key, 0, -1)
-    return [t.decode() if isinstance(t, bytes) else t for t in raw]
+    raw = redis_client.run(lambda r: r.lrange(_tokens_key(name), 0, -1), fallback=list)
+    return [_decode(t) for t in raw]
 
 
 def reclaim_expired(name: str, scan_batch: int = 100) -> int:
-    """Find tokens whose owner keys have expired and return them into the token list.
-
-    Algorithm (best-effort):
-    - We keep a set of all known tokens at `{name}:owners`. We scan this set and for each token
-      check whether `{name}:owner:{token}` exists. If not, we LPUSH the token back into the list
-      (unless it already exists) and continue.
-    - Returns number of tokens reclaimed.
+    """Return tokens whose leases have expired to the free list.
 
-    Note: This is best-effort and intended for moderate token counts. For very large registries
-    a more sophisticated approach (pagination, Lua scripts) is recommended.
+    Pops expired leases in `scan_batch`-sized ranges off the lease sorted set, so the cost
+    is O(log n) per reclaimed token no matter how many tokens are registered.
+    Returns number of tokens reclaimed.
     """
-    if not _redis:
-        return 0
-
-    owners_key = _owners_key(name)
-    tokens_key = _tokens_key(name)
-    reclaimed = 0
-    cursor = 0
-    # Use SSCAN to iterate set members
-    while True:
-        cursor, members = _redis.sscan(owners_key, cursor=cursor, count=scan_batch)
-        for m in members:
-            token = m.decode() if isinstance(m, bytes) else m
-            owner_key = f"{name}:owner:{token}"
-            if not _redis.exists(owner_key):
-                # token owner expired; ensure token not already in list
-                # Use LPOS to check presence (LPOS requires redis-py and Redis >= 6.0)
-                try:
-                    pos = _redis.lpos(tokens_key, token)
-                except Exception:
-                    # older Redis might not support LPOS; fall back to scanning list
-                    pos = None
-                if pos is None:
-                    # push it back
-                    _redis.lpush(tokens_key, token)
-                    reclaimed += 1
-        if cursor == 0:
-            break
-    return reclaimed
+    def reclaim(r):
+        reclaimed = 0
+        while True:
+            count = int(_script(_RECLAIM_LUA)(keys=_keys(name), args=[scan_batch, _WAKE_TTL_SECS], client=r))
+            reclaimed += count
+            if count < scan_batch:
+                return reclaimed
+
+    return redis_client.run(reclaim, fallback=lambda: 0)
 
 
 class Reclaimer:
@@ -0,0 +1,163 @@
+"""
+Batch appointment reminders, run periodically by `scripts/reminder_scheduler.py`.
+
+Each run:
+ 1. selects every pending/confirmed appointment starting within REMINDER_LEAD_HOURS in one
+    query that joins the booking user, their `sms_settings` opt-in and the
+    `appointment_reminders_sent` markers (so already-reminded rows never come back);
+ 2. renders the 'appointment_reminder' template for all of them in memory;
+ 3. claims each appointment in `appointment_reminders_sent` and queues its SMS in the
+    outbox inside the same transaction. The claim's primary key makes a second scheduler
+    instance skip rows another instance already took, so each appointment is reminded
+    exactly once;
+ 4. spreads the queued messages at REMINDER_RATE_PER_MINUTE via the outbox's
+    `send_after`, and the outbox worker delivers them under its own concurrency limit.
+
+Users without an `sms_settings` row get reminders (the column defaults to opted in);
+the settings phone number wins over the phone on the appointment.
+
+Environment variables used:
+ - REMINDER_LEAD_HOURS (default 24)
+ - REMINDER_RATE_PER_MINUTE (messages released per minute, default 60)
+"""
+from __future__ import annotations
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from utils.booking_slots import normalize_slot_time
+from utils.phone import try_normalize
+from utils.sms_outbox import enqueue_sms
+from utils.template_store import DEFAULT_REMINDER_TEMPLATE, compile_template
+
+logger = logging.getLogger(__name__)
+
+REMINDER_LEAD_HOURS = float(os.getenv("REMINDER_LEAD_HOURS", "24"))
+REMINDER_RATE_PER_MINUTE = float(os.getenv("REMINDER_RATE_PER_MINUTE", "60"))
+REMINDER_TYPE = 'appointment_reminder'
+
+
+def _starts_at(row) -> Optional[datetime]:
+    time_value = normalize_slot_time(row['appointment_time'])
+    if not time_value:
+        return None
+    try:
+        return datetime.strptime(f"{str(row['appointment_date'])[:10]} {time_value}", '%Y-%m-%d %H:%M')
+    except ValueError:
+        return None
+
+
+def fetch_due_reminders(c, now: datetime, lead_hours: Optional[float] = None) -> List[dict]:
+    """Appointments starting in (now, now + lead] that still need a reminder, in one query."""
+    lead = timedelta(hours=REMINDER_LEAD_HOURS if lead_hours is None else lead_hours)
+    until = now + lead
+    c.execute('''
+        SELECT a.id, a.user_id, a.service, a.appointment_date, a.appointment_time,
+               COALESCE(NULLIF(a.patient_name, ''), u.name) AS name,
+               COALESCE(NULLIF(s.phone_number, ''), a.patient_phone) AS phone
+        FROM appointments a
+        JOIN users u ON u.id = a.user_id
+        LEFT JOIN sms_settings s ON s.user_id = a.user_id
+        LEFT JOIN appointment_reminders_sent r
+               ON r.appointment_id = a.id AND r.reminder_type = ?
+        WHERE a.appointment_date >= ? AND a.appointment_date <= ?
+          AND a.status IN ('pending', 'confirmed')
+          AND COALESCE(s.appointment_reminders, 1) = 1
+          AND r.appointment_id IS NULL
+        ORDER BY a.appointment_date, a.appointment_time, a.id
+    ''', (REMINDER_TYPE, now.date().isoformat(), until.date().isoformat()))
+
+    due, seen = [], set()
+    for row in c.fetchall():
+        # times are stored as 'H:MM' or 'HH:MM', so the exact window is checked here
+        starts = _starts_at(row)
+        if row['id'] in seen or starts is None or not (now < starts <= until):
+            continue
+        seen.add(row['id'])
+        item = dict(row)
+        item['starts_at'] = starts
+        due.append(item)
+    return due
+
+
+def render_reminders(template: str, appointments: List[dict]) -> List[dict]:
+    """Attach the rendered message, its variables and formatted phone to each appointment."""
+    contexts = [{
+        'name': appt.get('name') or '',
+        'service': appt.get('service') or '',
+        'date': str(appt['appointment_date'])[:10],
+        'time': appt['appointment_time'],
+    } for appt in appointments]
+    messages = compile_template(template).render_many(contexts)
+    for appt, context, message in zip(appointments, contexts, messages):
+        appt['message'] = message
+        appt['variables'] = context
+        appt['to'] = try_normalize(appt.get('phone'))
+    return appointments
+
+
+def _load_template(c) -> str:
+    try:
+        c.execute('''
+            SELECT template_content FROM sms_templates
+            WHERE template_name = ? AND is_active = 1
+        ''', (REMINDER_TYPE,))
+        row = c.fetchone()
+        if row and row[0]:
+            return row[0]
+    except Exception as e:
+        logger.error(f"Error loading reminder template: {e}")
+    return DEFAULT_REMINDER_TEMPLATE
+
+
+def run_reminders(conn, now: Optional[datetime] = None, rate_per_minute: Optional[float] = None,
+                  dry_run: bool = False) -> Dict[str, int]:
+    """Queue reminders for everything due; returns counts of queued/skipped/taken rows."""
+    now = now or datetime.now()
+    rate = REMINDER_RATE_PER_MINUTE if rate_per_minute is None else rate_per_minute
+    c = conn.cursor()
+    due = fetch_due_reminders(c, now)
+    stats = {'due': len(due), 'queued': 0, 'skipped': 0, 'taken': 0}
+    if not due or dry_run:
+        return stats
+
+    template = _load_template(c)
+    render_reminders(template, due)
+    spacing = 60.0 / rate if rate > 0 else 0.0
+    release_at = datetime.utcnow()
+    claimed_at = now.isoformat()
+    try:
+        for appt in due:
+            # the primary key is the cross-instance dedup: only one claim per appointment wins
+            c.execute('''
+                INSERT INTO appointment_reminders_sent (appointment_id, reminder_type, status, claimed_at)
+                VALUES (?, ?, 'claimed', ?)
+                ON CONFLICT (appointment_id, reminder_type) DO NOTHING
+            ''', (appt['id'], REMINDER_TYPE, claimed_at))
+            if c.rowcount != 1:
+                stats['taken'] += 1
+                continue
+            if not appt['to']:
+                c.execute('''
+                    UPDATE appointment_reminders_sent SET status = 'skipped'
+                    WHERE appointment_id = ? AND reminder_type = ?
+                ''', (appt['id'], REMINDER_TYPE))
+                stats['skipped'] += 1
+                continue
+            outbox_id = enqueue_sms(
+                conn, appt['to'], appt['message'], message_type=REMINDER_TYPE,
+                user_id=appt['user_id'],
+                send_after=release_at + timedelta(seconds=spacing * stats['queued']),
+                commit=False, template=template, variables=appt['variables'],
+            )
+            c.execute('''
+                UPDATE appointment_reminders_sent SET status = 'queued', outbox_id = ?
+                WHERE appointment_id = ? AND reminder_type = ?
+            ''', (outbox_id, appt['id'], REMINDER_TYPE))
+            stats['queued'] += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return stats
@@ -0,0 +1,17 @@
+"""
+Client address of a Flask request, shared by the rate limiter and the activity log.
+
+app.py wraps the WSGI app in ProxyFix (x_for=1), so behind the Heroku router
+`request.remote_addr` is already the client address taken from X-Forwarded-For.
+Nothing here parses forwarding headers again.
+
+Usage:
+  from utils.request_ip import client_ip
+  client_ip(request)  -> '203.0.113.7' (None without an address)
+"""
+from __future__ import annotations
+from typing import Optional
+
+
+def client_ip(req) -> Optional[str]:
+    return req.remote_addr or None
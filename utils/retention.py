@@ -0,0 +1,219 @@
+"""
+Retention for append-only log tables: roll old rows up into daily totals, then delete them.
+
+Each `RetentionPolicy` names a raw table, its timestamp column, how many days of raw rows
+to keep, and a daily aggregate table keyed by (day, group columns), or no aggregate for
+tables whose old rows are simply dropped. A pass walks the table in primary-key order
+(keys follow insertion time, so no extra index is needed) and, for each batch of rows
+older than the cutoff, in one short transaction:
+ 1. adds the batch's counts (and summed columns) to the daily table with an upsert;
+ 2. deletes the batch.
+The cutoff is midnight UTC, so a day is always rolled up whole, and rerunning a pass
+never counts a row twice. Batches are small and separated by a short pause, so bookings
+and the outbox worker keep getting the write lock. Afterwards the pruned tables are
+ANALYZEd, and VACUUMed when asked.
+
+Policies:
+ - sms_logs -> sms_log_daily (day, message_type, status: messages, segments). Pending
+   rows (still in the outbox) are never pruned. Campaign progress for campaigns older
+   than the window then shows 'sent' instead of 'delivered'. sms_log_templates rows no
+   longer referenced by any log are dropped too (utils/sms_log_store.py);
+ - user_activity -> user_activity_daily (day, activity_type: events);
+ - sms_outbox: sent and dead rows are deleted (their text and outcome are in sms_logs);
+   queued and sending rows are never touched;
+ - appointment_changes: old change-feed rows are deleted, always keeping the newest one so
+   the cursor sequence carries on. Calendar clients with an older cursor get `reset` and
+   refetch (routes_calendar.api_appointment_changes).
+
+Usage:
+  from utils.retention import run_retention
+  run_retention(conn)                 # {'sms_logs': {'cutoff': ..., 'rolled_up': n, 'deleted': n}, ...}
+  run_retention(conn, dry_run=True)   # only report what would go
+
+Environment variables used:
+ - SMS_LOG_RETENTION_DAYS (days of raw sms_logs rows to keep, default 180; 0 keeps all)
+ - USER_ACTIVITY_RETENTION_DAYS (days of raw user_activity rows to keep, default 90; 0 keeps all)
+ - SMS_OUTBOX_RETENTION_DAYS (days of sent/dead sms_outbox rows to keep, default 14; 0 keeps all)
+ - APPOINTMENT_CHANGES_RETENTION_DAYS (days of change-feed rows to keep, default 7; 0 keeps all)
+ - RETENTION_BATCH_SIZE (rows rolled up and deleted per transaction, default 500)
+ - RETENTION_PAUSE (seconds to sleep between batches, default 0.05)
+"""
+from __future__ import annotations
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+SMS_LOG_RETENTION_DAYS = int(os.getenv("SMS_LOG_RETENTION_DAYS", "180"))
+USER_ACTIVITY_RETENTION_DAYS = int(os.getenv("USER_ACTIVITY_RETENTION_DAYS", "90"))
+SMS_OUTBOX_RETENTION_DAYS = int(os.getenv("SMS_OUTBOX_RETENTION_DAYS", "14"))
+APPOINTMENT_CHANGES_RETENTION_DAYS = int(os.getenv("APPOINTMENT_CHANGES_RETENTION_DAYS", "7"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", "0.05"))
+# unreferenced sms_log_templates rows younger than this are kept (see prune_log_templates)
+TEMPLATE_GRACE = timedelta(days=1)
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(NamedTuple):
+    table: str
+    time_column: str
+    keep_days: int
+    rollup_table: Optional[str]      # None: old rows are deleted without a rollup
+    group_columns: Tuple[str, ...]   # rollup key besides `day`
+    count_column: str                # rows per (day, group)
+    sum_columns: Tuple[str, ...] = ()  # raw columns summed into rollup columns of the same name
+    keep_where: Optional[str] = None   # rows matching this are never pruned
+    key_column: str = 'id'
+
+
+def default_policies() -> List[RetentionPolicy]:
+    return [
+        RetentionPolicy('sms_logs', 'created_at', SMS_LOG_RETENTION_DAYS, 'sms_log_daily',
+                        ('message_type', 'status'), 'messages', ('segments',), "status = 'pending'"),
+        RetentionPolicy('user_activity', 'activity_time', USER_ACTIVITY_RETENTION_DAYS, 'user_activity_daily',
+                        ('activity_type',), 'events'),
+        RetentionPolicy('sms_outbox', 'created_at', SMS_OUTBOX_RETENTION_DAYS, None, (), '',
+                        keep_where="status NOT IN ('sent', 'dead')"),
+        RetentionPolicy('appointment_changes', 'changed_at', APPOINTMENT_CHANGES_RETENTION_DAYS, None, (), '',
+                        keep_where='seq = (SELECT MAX(seq) FROM appointment_changes)', key_column='seq'),
+    ]
+
+
+def cutoff_for(policy: RetentionPolicy, now: Optional[datetime] = None) -> str:
+    """Rows stamped before this (midnight UTC, `keep_days` ago) are rolled up."""
+    day = (now or datetime.utcnow()).date() - timedelta(days=policy.keep_days)
+    return f"{day.isoformat()} 00:00:00"
+
+
+def _rollup_sql(policy: RetentionPolicy, n: int) -> str:
+    groups = ', '.join(policy.group_columns)
+    sums = ''.join(f', {col}' for col in policy.sum_columns)
+    select_sums = ''.join(f', COALESCE(SUM({col}), 0)' for col in policy.sum_columns)
+    updates = ', '.join(f'{col} = {col} + excluded.{col}' for col in (policy.count_column,) + policy.sum_columns)
+    return f'''
+        INSERT INTO {policy.rollup_table} (day, {groups}, {policy.count_column}{sums})
+        SELECT date({policy.time_column}), {', '.join(f"COALESCE({col}, '')" for col in policy.group_columns)},
+               COUNT(*){select_sums}
+        FROM {policy.table}
+        WHERE {policy.key_column} IN ({', '.join('?' for _ in range(n))})
+        GROUP BY 1, {', '.join(str(i + 2) for i in range(len(policy.group_columns)))}
+        ON CONFLICT (day, {groups}) DO UPDATE SET {updates}
+    '''
+
+
+def _next_batch(c, policy: RetentionPolicy, cutoff: str, last_id: int, batch_size: int) -> Tuple[List[int], int, bool]:
+    """(ids to prune, last id scanned, whether the scan reached the cutoff)."""
+    keep = policy.keep_where or '0'
+    key = policy.key_column
+    c.execute(f'''
+        SELECT {key}, {policy.time_column}, ({keep}) FROM {policy.table}
+        WHERE {key} > ? ORDER BY {key} LIMIT ?
+    ''', (last_id, batch_size))
+    rows = [tuple(row) for row in c.fetchall()]
+    ids = []
+    for row_id, stamp, keep_row in rows:
+        if stamp is not None and str(stamp) >= cutoff:
+            return ids, row_id, True
+        last_id = row_id
+        if stamp is not None and not keep_row:
+            ids.append(row_id)
+    return ids, last_id, len(rows) < batch_size
+
+
+def prune_table(conn, policy: RetentionPolicy, now: Optional[datetime] = None,
+                batch_size: Optional[int] = None, pause: Optional[float] = None) -> Dict[str, object]:
+    """Roll up and delete `policy.table` rows older than its cutoff, a batch per transaction."""
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    pause = RETENTION_PAUSE if pause is None else pause
+    cutoff = cutoff_for(policy, now)
+    stats = {'cutoff': cutoff, 'rolled_up': 0, 'deleted': 0, 'batches': 0}
+    c = conn.cursor()
+    last_id, done = 0, False
+    while not done:
+        ids, last_id, done = _next_batch(c, policy, cutoff, last_id, batch_size)
+        if not ids:
+            continue
+        try:
+            if policy.rollup_table:
+                c.execute(_rollup_sql(policy, len(ids)), ids)
+            c.execute(f"DELETE FROM {policy.table} WHERE {policy.key_column} IN ({', '.join('?' for _ in ids)})",
+                      ids)
+            deleted = c.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if policy.rollup_table:
+            stats['rolled_up'] += len(ids)
+        stats['deleted'] += deleted
+        stats['batches'] += 1
+        if pause and not done:
+            time.sleep(pause)
+    return stats
+
+
+def prune_log_templates(conn, now: Optional[datetime] = None) -> int:
+    """Delete sms_log_templates rows no sms_logs row refers to any more.
+
+    Templates first seen within TEMPLATE_GRACE are left alone: a writer may have interned
+    one and not yet committed the log row that refers to it.
+    """
+    grace_cutoff = ((now or datetime.utcnow()) - TEMPLATE_GRACE).strftime('%Y-%m-%d %H:%M:%S')
+    c = conn.cursor()
+    try:
+        c.execute('''
+            DELETE FROM sms_log_templates
+            WHERE created_at < ?
+              AND NOT EXISTS (SELECT 1 FROM sms_logs l WHERE l.template_id = sms_log_templates.id)
+        ''', (grace_cutoff,))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error pruning sms_log_templates: {e}")
+        return 0
+    return c.rowcount
+
+
+def retention_report(conn, policies: Sequence[RetentionPolicy], now: Optional[datetime] = None) -> Dict[str, dict]:
+    """What a pass would roll up and delete, per table, without changing anything."""
+    c = conn.cursor()
+    report = {}
+    for policy in policies:
+        cutoff = cutoff_for(policy, now)
+        keep = f" AND NOT ({policy.keep_where})" if policy.keep_where else ''
+        c.execute(f'''
+            SELECT COUNT(*), MIN({policy.time_column}), COUNT(DISTINCT date({policy.time_column}))
+            FROM {policy.table} WHERE {policy.time_column} < ?{keep}
+        ''', (cutoff,))
+        rows, oldest, days = tuple(c.fetchone())
+        report[policy.table] = {'cutoff': cutoff, 'eligible': rows, 'oldest': oldest, 'days': days}
+    return report
+
+
+def run_retention(conn, policies: Optional[Sequence[RetentionPolicy]] = None, now: Optional[datetime] = None,
+                  dry_run: bool = False, vacuum: bool = False, batch_size: Optional[int] = None,
+                  pause: Optional[float] = None) -> Dict[str, dict]:
+    """Apply every policy with keep_days > 0; returns per-table stats (or the dry-run report)."""
+    policies = [p for p in (default_policies() if policies is None else policies) if p.keep_days > 0]
+    if dry_run:
+        return retention_report(conn, policies, now)
+    results = {}
+    for policy in policies:
+        try:
+            results[policy.table] = prune_table(conn, policy, now, batch_size, pause)
+        except Exception as e:
+            logger.error(f"Retention for {policy.table} failed: {e}")
+            results[policy.table] = {'error': str(e)}
+    pruned = [table for table, stats in results.items() if stats.get('deleted')]
+    if 'sms_logs' in pruned:
+        results['sms_logs']['templates_deleted'] = prune_log_templates(conn, now)
+    for table in pruned:
+        conn.execute(f'ANALYZE {table}')
+    conn.commit()
+    if vacuum and pruned:
+        # needs no open transaction and briefly locks the whole file; run it off-peak
+        conn.execute('VACUUM')
+    return results
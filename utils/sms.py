@@ -7,216 +7,184 @@ Environment variables used:
  - TWILIO_AUTH_TOKEN
  - TWILIO_FROM  (for Programmable SMS)
  - TWILIO_VERIFY_SERVICE_SID (optional; if set, Verify is used)
- - REDIS_URL (used by redis client and redis_semaphore)
+ - TWILIO_STATUS_CALLBACK_URL (optional; public URL of /sms/status for delivery receipts)
+ - REDIS_URL (used by utils.redis_client for OTP storage and the semaphore)
+ - OTP_HMAC_SECRET / OTP_STORE (see utils/otp_store.py)
+ - SMS_PROVIDER (optional; 'fake' swaps Twilio for the local fake, 'twilio,semaphore' routes
+   between providers, see utils/sms_providers.py)
 
 Usage:
   from utils.sms import send_otp, verify_otp
-  send_otp(phone) -> {'ok': True, 'method': 'verify'|'sms'}
+  send_otp(phone) -> {'ok': True, 'method': 'verify'|'sms', 'queued': True}
   verify_otp(phone, code) -> True/False
 
-The module stores OTPs in Redis when using Programmable SMS (short TTL).
+When using Programmable SMS the module stores HMAC-hashed OTPs with a short TTL
+(utils.otp_store, in Redis); while Redis is unreachable `send_otp` returns the
+error 'redis_unavailable'.
+
+Inside a request, `send_otp` and `send_message` only queue the message in the SMS outbox
+(`utils.sms_outbox`); `scripts/sms_outbox_worker.py` performs the Twilio call through
+`deliver_sms`. Without an app context (e.g. one-off scripts), or when the outbox can't be
+written, they send inline.
 """
 from __future__ import annotations
-import os
-import random
-import time
+import logging
+import secrets
 from typing import Optional
 
-import phonenumbers
-from twilio.rest import Client
-import redis
-
-# Defer importing the semaphore helpers; they may depend on Redis being available.
-try:
-    from utils.redis_semaphore import acquire_token, release_token
-except Exception:
-    # Provide safe fallbacks so SMS sending can proceed without Redis/semaphore.
-    def acquire_token(semaphore_name: str, timeout: str = 3, lease_secs: int = 30):
-        return f"local-token-{int(time.time())}"
-
-    def release_token(semaphore_name: str, token: str):
-        return None
-
-# Configuration from env
-TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_FROM = os.getenv("TWILIO_FROM")
-TWILIO_VERIFY_SERVICE_SID = os.getenv("TWILIO_VERIFY_SERVICE_SID")
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-
-# Initialize Redis client if available. Some dev machines don't have Redis running;
-# in that case set _redis to None and proceed without rate-limiting/semaphore behavior.
-_redis = None
-try:
-    _redis = redis.from_url(REDIS_URL)
-    try:
-        _redis.ping()
-    except Exception:
-        _redis = None
-except Exception:
-    _redis = None
+from utils import otp_store
+from utils.phone import normalize_phone
+from utils.rate_limit import OTP_LIMITS, hit_key
+# the semaphore falls back to a local, per-machine one when Redis is unreachable
+from utils.redis_semaphore import acquire_token, release_token
+from utils.sms_outbox import CONCURRENCY, enqueue_sms
+from utils.sms_providers import get_provider
 
-_client = None
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    _client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+logger = logging.getLogger(__name__)
 
+# Twilio settings are read by utils.sms_providers; Redis connections come from the shared
+# lazy pool in utils.redis_client (nothing connects at import time). While Redis is
+# unreachable OTP storage is unavailable; rate limits and the semaphore fall back to
+# in-process/local stores.
 
-def normalize_phone(raw: str, default_region: str = "PH") -> str:
-    """Parse and return E.164 formatted phone number or raise ValueError."""
-    pn = phonenumbers.parse(raw, default_region)
-    if not phonenumbers.is_possible_number(pn) or not phonenumbers.is_valid_number(pn):
-        raise ValueError("invalid phone")
-    return phonenumbers.format_number(pn, phonenumbers.PhoneNumberFormat.E164)
+# Provider calls go through utils.sms_providers (Twilio by default, SMS_PROVIDER=fake for
+# load tests); the Twilio client is shared per process and created lazily after fork.
 
 
 def _generate_otp(n: int = 6) -> str:
-    return ''.join(str(random.randint(0, 9)) for _ in range(n))
-
-
-def _rate_limit_ok(phone: str, per_seconds: int = 60, daily_limit: int = 5) -> bool:
-    """Simple rate limiter using Redis: 1-per-`per_seconds`,  per-day `daily_limit`.
-    Returns True if allowed, False if rate-limited.
-    """
-    # If Redis is unavailable, skip rate limiting and allow sending.
-    if not _redis:
-        return True
-
-    short_key = f"sms:rate:short:{phone}"
-    day_key = f"sms:rate:day:{phone}:{time.strftime('%Y-%m-%d')}"
-    # short window
-    if _redis.exists(short_key):
-        return False
-    pipe = _redis.pipeline()
-    pipe.set(short_key, 1, ex=per_seconds)
-    pipe.incr(day_key)
-    pipe.expire(day_key, 60 * 60 * 24)
-    pipe.execute()
-    # check day count
-    count = int(_redis.get(day_key) or 0)
-    return count <= daily_limit
+    return ''.join(secrets.choice('0123456789') for _ in range(n))
 
 
 def send_otp(raw_phone: str, semaphore_name: str = "sms:semaphore") -> dict:
     """Send an OTP to `raw_phone`. Uses Twilio Verify if configured, otherwise sends a
-    programmable SMS and stores an OTP in Redis with a short TTL.
+    programmable SMS and stores a hashed OTP with a short TTL.
 
-    This function acquires a token from the Redis semaphore before sending and releases it
-    after the attempt.
-    Returns a dict with keys: ok, method, error (optional).
+    The Twilio call itself is queued in the SMS outbox (see module docstring).
+    Returns a dict with keys: ok, method, queued, error (optional).
     """
     try:
         phone = normalize_phone(raw_phone)
     except ValueError:
         return {"ok": False, "error": "invalid_phone"}
 
-    if not _rate_limit_ok(phone):
+    # 1 per minute and 5 per day per number, charged together in one round trip
+    if not hit_key(f"otp:{phone}", OTP_LIMITS).allowed:
         return {"ok": False, "error": "rate_limited"}
 
-    token = acquire_token(semaphore_name, timeout=3, lease_secs=30)
-    if not token:
-        return {"ok": False, "error": "server_busy"}
+    provider = get_provider()
+    if provider.supports_verify:
+        # use Verify; Twilio generates and checks the code
+        return _dispatch(phone, "[Twilio Verify code]", "verification", channel="verify", method="verify",
+                         semaphore_name=semaphore_name)
+
+    # fallback: programmable SMS with a stored OTP
+    if not provider.is_configured():
+        return {"ok": False, "error": "twilio_not_configured"}
 
+    otp = _generate_otp(6)
     try:
-        if TWILIO_VERIFY_SERVICE_SID and _client:
-            # use Verify
-            _client.verify.services(TWILIO_VERIFY_SERVICE_SID).verifications.create(
-                to=phone, channel="sms"
-            )
-            return {"ok": True, "method": "verify"}
-
-        # fallback: programmable SMS with Redis-stored OTP
-        if not _client or not TWILIO_FROM:
-            return {"ok": False, "error": "twilio_not_configured"}
-
-        # Programmable SMS path requires Redis to store OTP state; if Redis is
-        # unavailable, return an explicit error to avoid silent failures.
-        if not _redis:
-            return {"ok": False, "error": "redis_unavailable"}
-
-        otp = _generate_otp(6)
-        otp_key = f"sms:otp:{phone}"
-        # store OTP with TTL 5 minutes and allow 3 attempts
-        pipe = _redis.pipeline()
-        pipe.set(otp_key, otp, ex=300)
-        pipe.set(f"{otp_key}:tries", 3, ex=300)
-        pipe.execute()
-
-        body = f"Your verification code is {otp}. It expires in 5 minutes."
-        _client.messages.create(body=body, from_=TWILIO_FROM, to=phone)
-        return {"ok": True, "method": "sms"}
+        # stored as an HMAC with a TTL and a tries budget
+        otp_store.issue(phone, otp)
+    except otp_store.OTPStoreUnavailable:
+        return {"ok": False, "error": "redis_unavailable"}
     except Exception as e:
         return {"ok": False, "error": str(e)}
-    finally:
-        try:
-            release_token(semaphore_name, token)
-        except Exception:
-            # don't break on release failure
-            pass
+
+    body = f"Your verification code is {otp}. It expires in {otp_store.OTP_TTL_SECS // 60} minutes."
+    return _dispatch(phone, body, "verification", method="sms", semaphore_name=semaphore_name)
 
 
 def verify_otp(raw_phone: str, code: str) -> bool:
     """Verify an OTP previously sent.
-    If Verify is configured, check with Twilio Verify. Otherwise check Redis-stored OTP.
-    On successful verification the Redis stored OTP is deleted.
+    If Verify is configured, check with Twilio Verify. Otherwise check the stored OTP
+    (utils.otp_store); on successful verification it is deleted.
     """
     phone = normalize_phone(raw_phone)
-    if TWILIO_VERIFY_SERVICE_SID and _client:
+    provider = get_provider()
+    if provider.supports_verify:
         try:
-            chk = _client.verify.services(TWILIO_VERIFY_SERVICE_SID).verification_checks.create(
-                to=phone, code=code
-            )
-            return getattr(chk, "status", None) == "approved"
+            return provider.check_verification(phone, code)
         except Exception:
             return False
 
-    # If Verify service is not configured we require Redis to check stored OTPs.
-    if not TWILIO_VERIFY_SERVICE_SID and not _redis:
+    # one atomic round trip: uses up a try and compares the hashed code
+    try:
+        return otp_store.verify(phone, code) == otp_store.VERIFIED
+    except Exception:
         return False
 
-    otp_key = f"sms:otp:{phone}"
-    stored = _redis.get(otp_key)
-    if not stored:
-        return False
-    stored = stored.decode() if isinstance(stored, bytes) else stored
-    tries_key = f"{otp_key}:tries"
-    tries = int(_redis.get(tries_key) or 0)
-    if tries <= 0:
-        # expired or locked
-        _redis.delete(otp_key)
-        _redis.delete(tries_key)
-        return False
-    if stored == code:
-        _redis.delete(otp_key)
-        _redis.delete(tries_key)
-        return True
-    else:
-        _redis.decr(tries_key)
-        return False
 
+def deliver_sms(phone: str, body: str, channel: str = "sms"):
+    """Perform one provider call for an outbox row; returns (message_id, status).
 
-def send_message(raw_phone: str, body: str, semaphore_name: str = "sms:semaphore") -> dict:
-    """Send an arbitrary SMS message to `raw_phone` using the semaphore to limit concurrency.
-    Returns dict {ok: bool, error: str?} similar to send_otp.
+    Raises PermanentSendError when retrying can't help and lets provider/network errors
+    propagate so the outbox can decide whether to retry.
     """
+    provider = get_provider()
+    if channel == "verify":
+        return provider.start_verification(phone)
+    return provider.send(phone, body)
+
+
+def _dispatch(phone: str, body: str, message_type: str, channel: str = "sms",
+              method: Optional[str] = None, semaphore_name: str = "sms:semaphore") -> dict:
+    """Queue the message in the outbox, or send inline when there's no app context
+    or the outbox can't be written."""
+    result = {"ok": True}
+    if method:
+        result["method"] = method
     try:
-        phone = normalize_phone(raw_phone)
-    except ValueError:
-        return {"ok": False, "error": "invalid_phone"}
+        from flask import current_app
+        conn = current_app.get_db()
+    except (RuntimeError, AttributeError):
+        conn = None
 
-    token = acquire_token(semaphore_name, timeout=3, lease_secs=30)
+    if conn is not None:
+        try:
+            result["id"] = enqueue_sms(conn, phone, body, message_type=message_type, channel=channel)
+            result["queued"] = True
+            return result
+        except Exception as e:
+            # e.g. a PostgreSQL database without the outbox tables: send it now instead
+            logger.error(f"Could not queue {message_type} SMS, sending inline: {e}")
+        finally:
+            conn.close()
+
+    return send_inline(phone, body, channel=channel, semaphore_name=semaphore_name, result=result)
+
+
+def send_inline(phone: str, body: str, channel: str = "sms", semaphore_name: str = "sms:semaphore",
+                result: Optional[dict] = None) -> dict:
+    """Send one message right away under the semaphore, bypassing the outbox."""
+    result = dict(result or {"ok": True})
+    token = acquire_token(semaphore_name, timeout=3, lease_secs=30, permits=CONCURRENCY)
     if not token:
         return {"ok": False, "error": "server_busy"}
-
     try:
-        if not _client or not TWILIO_FROM:
-            return {"ok": False, "error": "twilio_not_configured"}
-
-        _client.messages.create(body=body, from_=TWILIO_FROM, to=phone)
-        return {"ok": True}
+        result["message_id"], result["status"] = deliver_sms(phone, body, channel=channel)
+        result["queued"] = False
+        return result
     except Exception as e:
         return {"ok": False, "error": str(e)}
     finally:
         try:
             release_token(semaphore_name, token)
         except Exception:
+            # don't break on release failure
             pass
+
+
+def send_message(raw_phone: str, body: str, semaphore_name: str = "sms:semaphore",
+                 message_type: str = "general") -> dict:
+    """Queue an arbitrary SMS message to `raw_phone` for the outbox worker.
+    Returns dict {ok: bool, queued: bool, error: str?} similar to send_otp.
+    """
+    try:
+        phone = normalize_phone(raw_phone)
+    except ValueError:
+        return {"ok": False, "error": "invalid_phone"}
+
+    if not get_provider().is_configured():
+        return {"ok": False, "error": "twilio_not_configured"}
+
+    return _dispatch(phone, body, message_type, semaphore_name=semaphore_name)
@@ -0,0 +1,337 @@
+"""
+Segmented bulk SMS campaigns, dispatched through the SMS outbox.
+
+A campaign is created in three steps:
+ 1. `create_campaign` snapshots the message body (from an `sms_templates` row or free
+    text) and materializes the audience with one INSERT ... SELECT over users and their
+    `sms_settings` opt-in (`marketing_messages` or `general_notifications`), optionally
+    narrowed to users who booked a given service. Duplicate phone numbers collapse on
+    the (campaign_id, phone_number) unique key.
+ 2. `start_campaign` marks it running.
+ 3. `dispatch_campaign` (run by `scripts/sms_campaigns.py`) moves pending recipients into
+    the outbox in batches. Each batch enqueues its messages and marks the recipients
+    'queued' in one transaction, so a crash rolls back the whole batch and a rerun
+    continues with exactly the recipients that were not queued yet: nobody is messaged
+    twice. Messages are spaced at the campaign's rate via the outbox `send_after`, and
+    the outbox worker sends them under its semaphore, retrying 429s and 5xx.
+
+A lease on the campaign row keeps two dispatchers from working the same campaign.
+`campaign_progress` reports live pending/queued/sent/delivered/failed counts from the
+recipients joined to their outbox rows and `sms_logs`, in one query; `campaigns_progress`
+does the same for a page of campaigns with one grouped query.
+
+Environment variables used:
+ - CAMPAIGN_RATE_PER_MINUTE (default release rate, default 60)
+ - CAMPAIGN_BATCH_SIZE (recipients queued per transaction, default 200)
+"""
+from __future__ import annotations
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from utils.phone import try_normalize
+from utils.sms_outbox import enqueue_sms
+from utils.template_store import compile_template, unknown_variables
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_RATE_PER_MINUTE = float(os.getenv("CAMPAIGN_RATE_PER_MINUTE", "60"))
+CAMPAIGN_BATCH_SIZE = int(os.getenv("CAMPAIGN_BATCH_SIZE", "200"))
+
+# segment -> (sms_settings opt-in column, value assumed when the user has no settings row)
+SEGMENTS = {
+    'marketing': ('marketing_messages', 0),
+    'general': ('general_notifications', 1),
+}
+
+# placeholders filled in per recipient
+CAMPAIGN_VARIABLES = ('name',)
+
+_TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class CampaignError(Exception):
+    """Raised for campaigns that can't be created or changed as asked."""
+
+
+def _ts(value: datetime) -> str:
+    return value.strftime(_TS_FORMAT)
+
+
+def _load_template_body(c, template_name: str) -> Optional[str]:
+    c.execute('''
+        SELECT template_content FROM sms_templates
+        WHERE template_name = ? AND is_active = 1
+    ''', (template_name,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def build_audience(c, campaign_id: int, segment: str, service: Optional[str] = None) -> int:
+    """Insert the segment's recipients for a campaign in one statement; returns the count."""
+    if segment not in SEGMENTS:
+        raise CampaignError(f"unknown segment: {segment}")
+    column, default = SEGMENTS[segment]
+    phone = "COALESCE(NULLIF(s.phone_number, ''), u.contact_number)"
+    conditions = [f"COALESCE(s.{column}, {int(default)}) = 1",
+                  f"{phone} IS NOT NULL", f"{phone} <> ''"]
+    params: List = [campaign_id]
+    if service:
+        conditions.append('EXISTS (SELECT 1 FROM appointments a WHERE a.user_id = u.id AND a.service = ?)')
+        params.append(service)
+    c.execute(f'''
+        INSERT INTO sms_campaign_recipients (campaign_id, user_id, name, phone_number)
+        SELECT ?, u.id, u.name, {phone}
+        FROM users u
+        LEFT JOIN sms_settings s ON s.user_id = u.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY u.id
+        ON CONFLICT (campaign_id, phone_number) DO NOTHING
+    ''', params)
+    c.execute('SELECT COUNT(*) FROM sms_campaign_recipients WHERE campaign_id = ?', (campaign_id,))
+    return int(c.fetchone()[0])
+
+
+def create_campaign(conn, name: str, body: Optional[str] = None, template_name: Optional[str] = None,
+                    segment: str = 'marketing', service: Optional[str] = None,
+                    rate_per_minute: Optional[float] = None, created_by: Optional[str] = None) -> int:
+    """Create a draft campaign with its audience; returns the campaign id."""
+    c = conn.cursor()
+    if not body and template_name:
+        body = _load_template_body(c, template_name)
+    if not body:
+        raise CampaignError('campaign needs a message body or an active template')
+    if segment not in SEGMENTS:
+        raise CampaignError(f"unknown segment: {segment}")
+    unknown = unknown_variables(body, CAMPAIGN_VARIABLES)
+    if unknown:
+        raise CampaignError(f"campaign messages can only use {{{{name}}}}, not: {', '.join(unknown)}")
+    try:
+        c.execute('''
+            INSERT INTO sms_campaigns (name, template_name, body, segment, service_filter,
+                                       rate_per_minute, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        ''', (name, template_name, body, segment, service or None, rate_per_minute, created_by))
+        campaign_id = c.fetchone()[0]
+        total = build_audience(c, campaign_id, segment, service)
+        c.execute('UPDATE sms_campaigns SET total_recipients = ? WHERE id = ?', (total, campaign_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return campaign_id
+
+
+def start_campaign(conn, campaign_id: int) -> bool:
+    c = conn.cursor()
+    c.execute('''
+        UPDATE sms_campaigns SET status = 'running', started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+        WHERE id = ? AND status = 'draft'
+    ''', (campaign_id,))
+    conn.commit()
+    return c.rowcount == 1
+
+
+def cancel_campaign(conn, campaign_id: int) -> Dict[str, int]:
+    """Stop a campaign: drop pending recipients and pull messages still waiting in the outbox."""
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE sms_campaigns SET status = 'cancelled', locked_by = NULL, locked_until = NULL
+            WHERE id = ? AND status IN ('draft', 'running', 'dispatched')
+        ''', (campaign_id,))
+        if c.rowcount != 1:
+            conn.rollback()
+            return {'cancelled': 0, 'withdrawn': 0}
+        c.execute('''
+            UPDATE sms_campaign_recipients SET status = 'cancelled'
+            WHERE campaign_id = ? AND status = 'pending'
+        ''', (campaign_id,))
+        cancelled = c.rowcount
+        withdrawn_ids = '''
+            SELECT o.id FROM sms_campaign_recipients r JOIN sms_outbox o ON o.id = r.outbox_id
+            WHERE r.campaign_id = ? AND o.status = 'queued'
+        '''
+        c.execute(f'''
+            UPDATE sms_logs SET status = 'failed', provider_response = 'campaign_cancelled'
+            WHERE id IN (SELECT o.sms_log_id FROM sms_outbox o WHERE o.id IN ({withdrawn_ids}))
+        ''', (campaign_id,))
+        c.execute(f'''
+            UPDATE sms_outbox SET status = 'dead', last_error = 'campaign_cancelled'
+            WHERE id IN ({withdrawn_ids})
+        ''', (campaign_id,))
+        withdrawn = c.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {'cancelled': cancelled, 'withdrawn': withdrawn}
+
+
+def _claim(c, campaign_id: int, worker_id: str, lease_secs: int) -> bool:
+    now = datetime.utcnow()
+    c.execute('''
+        UPDATE sms_campaigns SET locked_by = ?, locked_until = ?
+        WHERE id = ? AND status = 'running'
+          AND (locked_until IS NULL OR locked_until < ? OR locked_by = ?)
+    ''', (worker_id, _ts(now + timedelta(seconds=lease_secs)), campaign_id, _ts(now), worker_id))
+    return c.rowcount == 1
+
+
+def _next_release(c, campaign_id: int, spacing: float) -> datetime:
+    """When the next message may go out: after the last one already queued, never in the past."""
+    now = datetime.utcnow()
+    c.execute('''
+        SELECT MAX(o.next_attempt_at) FROM sms_campaign_recipients r
+        JOIN sms_outbox o ON o.id = r.outbox_id
+        WHERE r.campaign_id = ?
+    ''', (campaign_id,))
+    row = c.fetchone()
+    if row and row[0]:
+        try:
+            last = datetime.strptime(str(row[0])[:19], _TS_FORMAT)
+            return max(now, last + timedelta(seconds=spacing))
+        except ValueError:
+            pass
+    return now
+
+
+def dispatch_campaign(conn, campaign_id: int, worker_id: Optional[str] = None,
+                      batch_size: Optional[int] = None, lease_secs: int = 120,
+                      max_batches: Optional[int] = None) -> Dict[str, int]:
+    """Queue the campaign's pending recipients in the outbox, one transaction per batch.
+
+    Returns counts of queued/skipped recipients and how many are still pending.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+    batch_size = batch_size or CAMPAIGN_BATCH_SIZE
+    c = conn.cursor()
+    stats = {'queued': 0, 'skipped': 0, 'remaining': 0}
+
+    if not _claim(c, campaign_id, worker_id, lease_secs):
+        conn.commit()
+        return stats
+    conn.commit()
+    c.execute('SELECT body, segment, rate_per_minute FROM sms_campaigns WHERE id = ?', (campaign_id,))
+    campaign = dict(c.fetchone())
+    rate = campaign['rate_per_minute'] or CAMPAIGN_RATE_PER_MINUTE
+    spacing = 60.0 / rate if rate > 0 else 0.0
+    message_type = 'marketing' if campaign['segment'] == 'marketing' else 'general'
+    release_at = _next_release(c, campaign_id, spacing)
+    template = compile_template(campaign['body'])
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        c.execute('''
+            SELECT id, user_id, name, phone_number FROM sms_campaign_recipients
+            WHERE campaign_id = ? AND status = 'pending'
+            ORDER BY id LIMIT ?
+        ''', (campaign_id, batch_size))
+        recipients = [dict(row) for row in c.fetchall()]
+        if not recipients:
+            break
+        queued, skipped = [], []
+        try:
+            for recipient in recipients:
+                to = try_normalize(recipient['phone_number'])
+                if not to:
+                    skipped.append((recipient['id'],))
+                    continue
+                variables = {'name': recipient.get('name') or ''}
+                outbox_id = enqueue_sms(conn, to, template.render(variables), message_type=message_type,
+                                        user_id=recipient['user_id'], send_after=release_at, commit=False,
+                                        template=template.source, variables=variables)
+                release_at += timedelta(seconds=spacing)
+                queued.append((outbox_id, recipient['id']))
+            c.executemany('''
+                UPDATE sms_campaign_recipients SET status = 'queued', outbox_id = ?
+                WHERE id = ? AND status = 'pending'
+            ''', queued)
+            c.executemany('''
+                UPDATE sms_campaign_recipients SET status = 'skipped'
+                WHERE id = ? AND status = 'pending'
+            ''', skipped)
+            # still ours? otherwise another dispatcher took over and this batch must not land
+            if not _claim(c, campaign_id, worker_id, lease_secs):
+                conn.rollback()
+                logger.warning(f"Campaign {campaign_id}: lease lost, stopping dispatch")
+                return stats
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        stats['queued'] += len(queued)
+        stats['skipped'] += len(skipped)
+        batches += 1
+
+    c.execute('''
+        SELECT COUNT(*) FROM sms_campaign_recipients WHERE campaign_id = ? AND status = 'pending'
+    ''', (campaign_id,))
+    stats['remaining'] = int(c.fetchone()[0])
+    if stats['remaining'] == 0:
+        c.execute('''
+            UPDATE sms_campaigns SET status = 'dispatched', dispatched_at = CURRENT_TIMESTAMP,
+                   locked_by = NULL, locked_until = NULL
+            WHERE id = ? AND status = 'running'
+        ''', (campaign_id,))
+    else:
+        c.execute('''
+            UPDATE sms_campaigns SET locked_by = NULL, locked_until = NULL
+            WHERE id = ? AND locked_by = ?
+        ''', (campaign_id, worker_id))
+    conn.commit()
+    return stats
+
+
+def run_campaigns(conn, batch_size: Optional[int] = None) -> Dict[int, Dict[str, int]]:
+    """Dispatch every running campaign; returns stats per campaign id."""
+    c = conn.cursor()
+    c.execute("SELECT id FROM sms_campaigns WHERE status = 'running' ORDER BY id")
+    results = {}
+    for (campaign_id,) in [tuple(row) for row in c.fetchall()]:
+        try:
+            results[campaign_id] = dispatch_campaign(conn, campaign_id, batch_size=batch_size)
+        except Exception as e:
+            logger.error(f"Campaign {campaign_id} dispatch failed: {e}")
+    return results
+
+
+def campaigns_progress(c, campaign_ids: List[int]) -> Dict[int, Dict[str, int]]:
+    """`campaign_progress` for several campaigns at once, in one grouped query."""
+    progress = {}
+    for campaign_id in campaign_ids:
+        progress[campaign_id] = {key: 0 for key in
+                                 ('pending', 'queued', 'sent', 'delivered', 'failed', 'skipped', 'cancelled')}
+        progress[campaign_id]['total'] = 0
+    if not progress:
+        return progress
+    c.execute(f'''
+        SELECT r.campaign_id, r.status, o.status, l.status, COUNT(*)
+        FROM sms_campaign_recipients r
+        LEFT JOIN sms_outbox o ON o.id = r.outbox_id
+        LEFT JOIN sms_logs l ON l.id = o.sms_log_id
+        WHERE r.campaign_id IN ({', '.join('?' for _ in progress)})
+        GROUP BY r.campaign_id, r.status, o.status, l.status
+    ''', list(progress))
+    for campaign_id, recipient_status, outbox_status, log_status, count in [tuple(row) for row in c.fetchall()]:
+        counts = progress[campaign_id]
+        counts['total'] += count
+        if recipient_status != 'queued':
+            key = recipient_status
+        elif outbox_status == 'sent':
+            key = 'delivered' if log_status == 'delivered' else ('failed' if log_status == 'failed' else 'sent')
+        elif outbox_status == 'dead':
+            key = 'failed'
+        else:
+            key = 'queued'
+        counts[key] = counts.get(key, 0) + count
+    return progress
+
+
+def campaign_progress(c, campaign_id: int) -> Dict[str, int]:
+    """Live recipient counts: pending, queued, sent, delivered, failed, skipped, cancelled."""
+    return campaigns_progress(c, [campaign_id])[campaign_id]
@@ -0,0 +1,137 @@
+"""
+SMS encoding and segment counting (GSM 03.38 / UCS-2).
+
+A message made only of GSM-7 characters fits 160 characters in one SMS, or 153 per part
+once it has to be split. A single character outside that alphabet, such as '₱', a curly
+quote or an em-dash, switches the whole message to UCS-2. UCS-2 allows 70 characters
+(67 per part), so the message can cost two or three times as much.
+
+`analyze(text)` returns the encoding, the length in encoding units and the number of
+billable segments:
+ - characters from the GSM extension table (^ { } \\ [ ] ~ | €) take two septets;
+ - characters outside the Basic Multilingual Plane (emoji) take two UTF-16 units;
+ - neither pair is ever split across parts.
+
+`transliterate(text)` replaces the usual offenders with GSM equivalents ('₱' -> 'PHP',
+smart quotes -> ASCII quotes, dashes -> '-', '…' -> '...').
+
+`optimize(text)` is what the send pipeline (`utils.sms_outbox.enqueue_sms`) calls. It
+returns the transliterated text when that needs fewer segments, or the same number
+in GSM-7. Otherwise the text is left as written (e.g. a message that stays UCS-2
+because of an emoji).
+
+Usage:
+  from utils.sms_encoding import analyze, optimize
+  analyze('Bayad: ₱425.00')   -> SegmentInfo(encoding='UCS-2', units=14, segments=1, ...)
+  text, info = optimize(body)
+
+Environment variables used:
+ - SMS_TRANSLITERATE (1 (default) to transliterate before queueing, 0 to send text as written)
+"""
+from __future__ import annotations
+import os
+from typing import List, NamedTuple, Tuple
+
+SMS_TRANSLITERATE = os.getenv("SMS_TRANSLITERATE", "1").lower() not in ("0", "false", "no")
+
+GSM7 = 'GSM-7'
+UCS2 = 'UCS-2'
+
+# GSM 03.38 default alphabet (the escape character 0x1B itself is left out)
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+# extension table: sent as ESC + char, so two septets each
+GSM7_EXTENSION = frozenset("\f^{}\\[~]|€")
+
+# (single-part limit, per-part limit once split) in encoding units
+_LIMITS = {GSM7: (160, 153), UCS2: (70, 67)}
+
+TRANSLITERATIONS = {
+    '₱': 'PHP',
+    '‘': "'", '’': "'", '‚': "'", '‛': "'", '′': "'", '`': "'",
+    '“': '"', '”': '"', '„': '"', '‟': '"', '″': '"', '«': '"', '»': '"',
+    '–': '-', '—': '-', '―': '-', '‐': '-', '‑': '-', '−': '-',
+    '…': '...', '•': '-', '·': '-',
+    '\u00a0': ' ', '\u2007': ' ', '\u2009': ' ', '\u202f': ' ',  # non-breaking / thin spaces
+    '\u200b': '', '\ufeff': '',  # zero-width space, BOM
+    '\t': ' ',
+    'á': 'a', 'â': 'a', 'ã': 'a', 'í': 'i', 'î': 'i', 'ó': 'o', 'ô': 'o', 'õ': 'o',
+    'ú': 'u', 'û': 'u', 'ê': 'e', 'ç': 'c', 'ï': 'i', 'ë': 'e',
+    'Á': 'A', 'Í': 'I', 'Ó': 'O', 'Ú': 'U', 'À': 'A', 'È': 'E', 'Ì': 'I', 'Ò': 'O', 'Ù': 'U',
+}
+_TRANSLATE_TABLE = str.maketrans(TRANSLITERATIONS)
+
+
+class SegmentInfo(NamedTuple):
+    encoding: str        # GSM7 or UCS2
+    units: int           # septets (GSM-7) or UTF-16 code units (UCS-2)
+    segments: int        # billable parts (0 for an empty message)
+    per_segment: int     # capacity of each part at this length
+    non_gsm: Tuple[str, ...]  # distinct characters that forced UCS-2, in order of appearance
+
+
+def non_gsm_chars(text: str) -> Tuple[str, ...]:
+    return tuple(dict.fromkeys(ch for ch in text or '' if ch not in GSM7_BASIC and ch not in GSM7_EXTENSION))
+
+
+def _char_widths(text: str, encoding: str) -> List[int]:
+    if encoding == GSM7:
+        return [2 if ch in GSM7_EXTENSION else 1 for ch in text]
+    return [2 if ord(ch) > 0xFFFF else 1 for ch in text]
+
+
+def _count_segments(widths: List[int], single: int, multi: int) -> int:
+    total = sum(widths)
+    if total == 0:
+        return 0
+    if total <= single:
+        return 1
+    # greedy packing: a two-unit character that doesn't fit starts the next part
+    segments, used = 1, 0
+    for width in widths:
+        if used + width > multi:
+            segments += 1
+            used = 0
+        used += width
+    return segments
+
+
+def analyze(text: str) -> SegmentInfo:
+    """Encoding, length and billable segment count of `text`."""
+    text = text or ''
+    non_gsm = non_gsm_chars(text)
+    encoding = UCS2 if non_gsm else GSM7
+    widths = _char_widths(text, encoding)
+    single, multi = _LIMITS[encoding]
+    segments = _count_segments(widths, single, multi)
+    return SegmentInfo(encoding, sum(widths), segments, single if segments <= 1 else multi, non_gsm)
+
+
+def transliterate(text: str) -> str:
+    """`text` with common non-GSM punctuation and symbols replaced by GSM equivalents."""
+    return (text or '').translate(_TRANSLATE_TABLE)
+
+
+def optimize(text: str, enabled: bool = None) -> Tuple[str, SegmentInfo]:
+    """(text to send, its SegmentInfo); transliterated when that saves segments or reaches GSM-7."""
+    info = analyze(text)
+    if enabled is None:
+        enabled = SMS_TRANSLITERATE
+    if not enabled or info.encoding == GSM7:
+        return text, info
+    converted = transliterate(text)
+    converted_info = analyze(converted)
+    if converted_info.segments < info.segments or (
+            converted_info.encoding == GSM7 and converted_info.segments == info.segments):
+        return converted, converted_info
+    return text, info
+
+
+def describe(info: SegmentInfo) -> str:
+    """Short human-readable summary for admin pages, e.g. 'UCS-2, 2 segments (94/134)'."""
+    parts = 'segment' if info.segments == 1 else 'segments'
+    summary = f"{info.encoding}, {info.segments} {parts} ({info.units}/{info.per_segment * max(info.segments, 1)})"
+    if info.non_gsm:
+        summary += f"; non-GSM: {' '.join(info.non_gsm)}"
+    return summary
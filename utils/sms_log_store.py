@@ -0,0 +1,189 @@
+"""
+Compact storage for `sms_logs.message_content`.
+
+Most logged messages are a template plus a few values: reminders, confirmations and
+campaign texts. In compact mode a log row keeps only:
+ - `template_id`: a row in `sms_log_templates`, which stores each distinct template body
+   once and never changes. Editing a template adds a new body, so old logs still rebuild
+   to the text that was sent;
+ - `template_vars`: the values as compact JSON, e.g. {"name":"Ana","date":"2025-01-02"}.
+
+`message_content` is left empty on those rows.
+
+A row is stored compactly only when rendering the template with the values gives back
+exactly the text that was queued. Custom messages, digests and transliterated texts that
+no longer match their template are kept in full. Verification messages (SECRET_TYPES) are
+never stored as sent: their log rows keep the text with the one-time code masked, in
+either mode. `expand_rows` rebuilds the
+text for the admin views, using one template query per page of rows.
+
+`compact_existing` compresses rows written before compact mode was turned on, in batches
+(see scripts/compact_sms_logs.py). It matches each full text against the known template
+bodies, and keeps a match only if the template renders back to exactly the stored text.
+
+Usage:
+  content, template_id, template_vars = log_fields(c, body, template, variables)
+  rows = expand_rows(c, [dict(r) for r in c.fetchall()])
+
+Environment variables used:
+ - SMS_LOG_COMPACT (1 to store template references instead of full text; default 0)
+"""
+from __future__ import annotations
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from utils.template_store import compile_template
+
+SMS_LOG_COMPACT = os.getenv("SMS_LOG_COMPACT", "0").lower() in ("1", "true", "yes")
+# message types whose text carries a one-time code
+SECRET_TYPES = frozenset({'verification'})
+_CODE = re.compile(r'\d{4,8}')
+# templates need this much fixed text before the backfill trusts a match
+_MIN_LITERAL_CHARS = 12
+
+
+def intern_template(c, body: str) -> int:
+    """Id of `body` in sms_log_templates, inserting it the first time it's seen.
+
+    Always an upsert (a write), so the row is locked in the caller's transaction until the
+    log row referencing it is committed, and `utils.retention.prune_log_templates` can't
+    delete it in between.
+    """
+    c.execute('''
+        INSERT INTO sms_log_templates (body) VALUES (?)
+        ON CONFLICT (body) DO UPDATE SET body = excluded.body
+        RETURNING id
+    ''', (body,))
+    return c.fetchone()[0]
+
+
+def pack_variables(template: str, variables: Mapping) -> str:
+    """The values `template` uses, as compact JSON."""
+    used = compile_template(template).variables
+    return json.dumps({name: str(variables[name]) for name in used if variables.get(name) is not None},
+                      separators=(',', ':'), ensure_ascii=False)
+
+
+def redact(body: str, message_type: Optional[str]) -> str:
+    """`body` as it may be logged: one-time codes masked for SECRET_TYPES."""
+    if message_type not in SECRET_TYPES:
+        return body
+    return _CODE.sub(lambda m: '*' * len(m.group()), body)
+
+
+def log_fields(c, body: str, template: Optional[str] = None, variables: Optional[Mapping] = None,
+               compact: Optional[bool] = None,
+               message_type: Optional[str] = None) -> Tuple[str, Optional[int], Optional[str]]:
+    """(message_content, template_id, template_vars) to store for `body`."""
+    if message_type in SECRET_TYPES:
+        # the code would otherwise sit in message_content or template_vars
+        return redact(body, message_type), None, None
+    if compact is None:
+        compact = SMS_LOG_COMPACT
+    if not compact or not template or variables is None:
+        return body, None, None
+    packed = pack_variables(template, variables)
+    if compile_template(template).render(json.loads(packed)) != body:
+        return body, None, None
+    return '', intern_template(c, template), packed
+
+
+def render_stored(body: str, template_vars: Optional[str]) -> str:
+    try:
+        values = json.loads(template_vars) if template_vars else {}
+    except ValueError:
+        values = {}
+    return compile_template(body).render(values)
+
+
+def expand_rows(c, rows: List[dict]) -> List[dict]:
+    """Fill in `message_content` for compact rows (dicts, modified in place)."""
+    ids = sorted({row['template_id'] for row in rows if row.get('template_id') and not row.get('message_content')})
+    if not ids:
+        return rows
+    c.execute(f"SELECT id, body FROM sms_log_templates WHERE id IN ({', '.join('?' for _ in ids)})", ids)
+    bodies = {row[0]: row[1] for row in c.fetchall()}
+    for row in rows:
+        template_id = row.get('template_id')
+        if template_id and not row.get('message_content') and template_id in bodies:
+            row['message_content'] = render_stored(bodies[template_id], row.get('template_vars'))
+    return rows
+
+
+def template_pattern(source: str) -> Optional[re.Pattern]:
+    """A regex that matches texts rendered from `source` and captures each variable."""
+    compiled = compile_template(source)
+    segments = compiled.segments
+    if sum(len(lit) for lit in segments[0::2]) < _MIN_LITERAL_CHARS:
+        return None
+    parts, seen = [], set()
+    for i, segment in enumerate(segments):
+        if i % 2 == 0:
+            parts.append(re.escape(segment))
+        elif segment in seen:
+            parts.append(f'(?P={segment})')
+        else:
+            seen.add(segment)
+            parts.append(f'(?P<{segment}>.*?)')
+    return re.compile(''.join(parts), re.DOTALL)
+
+
+def match_template(text: str, patterns: Sequence[Tuple[str, re.Pattern]]) -> Optional[Tuple[str, dict]]:
+    """(template source, variables) of the first pattern that rebuilds `text` exactly."""
+    for source, pattern in patterns:
+        match = pattern.fullmatch(text)
+        if match and compile_template(source).render(match.groupdict()) == text:
+            return source, match.groupdict()
+    return None
+
+
+def compile_patterns(sources: Iterable[str]) -> List[Tuple[str, re.Pattern]]:
+    """Patterns for the distinct `sources`, most fixed text first so specific ones win."""
+    unique = [s for s in dict.fromkeys(s for s in sources if s)]
+    unique.sort(key=lambda s: -sum(len(lit) for lit in compile_template(s).segments[0::2]))
+    return [(s, p) for s in unique for p in [template_pattern(s)] if p is not None]
+
+
+def compact_existing(conn, sources: Iterable[str], batch_size: int = 500,
+                     max_batches: Optional[int] = None, dry_run: bool = False) -> Dict[str, int]:
+    """Compress full-text log rows that match one of the template `sources`, a batch per commit.
+
+    Returns counts: scanned, compacted, bytes_saved (message text removed, minus values kept).
+    """
+    patterns = compile_patterns(sources)
+    stats = {'scanned': 0, 'compacted': 0, 'bytes_saved': 0}
+    if not patterns:
+        return stats
+    c = conn.cursor()
+    last_id, batches = 0, 0
+    while max_batches is None or batches < max_batches:
+        c.execute('''
+            SELECT id, message_content FROM sms_logs
+            WHERE id > ? AND template_id IS NULL AND message_content != ''
+            ORDER BY id LIMIT ?
+        ''', (last_id, batch_size))
+        rows = [tuple(row) for row in c.fetchall()]
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for log_id, text in rows:
+            matched = match_template(text, patterns)
+            if matched is None:
+                continue
+            source, variables = matched
+            packed = pack_variables(source, variables)
+            updates.append((intern_template(c, source) if not dry_run else 0, packed, log_id))
+            stats['bytes_saved'] += len(text.encode('utf-8')) - len(packed.encode('utf-8'))
+        stats['scanned'] += len(rows)
+        stats['compacted'] += len(updates)
+        if updates and not dry_run:
+            c.executemany('''
+                UPDATE sms_logs SET message_content = '', template_id = ?, template_vars = ?
+                WHERE id = ? AND template_id IS NULL
+            ''', updates)
+            conn.commit()
+        batches += 1
+    return stats
@@ -0,0 +1,499 @@
+"""
+Durable SMS outbox drained by a separate worker process.
+
+Web requests never talk to Twilio directly: `enqueue_sms` inserts a row into `sms_outbox`
+(created by init_db) plus a 'pending' row in `sms_logs`, and returns at once. The body
+goes through `utils.sms_encoding.optimize` first, and the log row records its encoding
+and billable segment count.
+`OutboxWorker`, started by `scripts/sms_outbox_worker.py`, claims due rows in batches,
+sends them from a thread pool and writes the batch's results back in one transaction.
+Cluster-wide concurrency is bounded by the Redis semaphore (`utils.redis_semaphore`),
+so several worker processes share the same provider budget.
+
+Failures are retried with exponential backoff and jitter. Permanent failures (invalid
+number, unsubscribed recipient, bad credentials) and messages that run out of attempts
+are dead-lettered (status 'dead'). Either way the final status lands in `sms_logs`:
+'sent' with the provider message id (`provider_message_id`), or 'failed' with the last error.
+
+Notifications (SMS_DIGEST_TYPES) are held for SMS_DIGEST_WINDOW seconds before they
+become due. Another notification to the same number within that time is appended to the
+held row instead of becoming a second SMS. This happens, for example, when a parent books
+for several family members with one phone number. A digest grows only while it stays
+within SMS_DIGEST_MAX_SEGMENTS billable segments. The appended notification keeps its own
+`sms_logs` row with status 'merged', and the digest's log row holds the combined text.
+
+Row lifecycle: queued -> sending -> sent | queued (retry) | dead
+
+A sent row's body is cleared: the text (or its compact template reference) is kept in
+`sms_logs` only. Dead rows keep theirs so `requeue_dead` can send them again, until
+retention deletes them (utils/retention.py). Verification messages carry a live
+one-time code: their `sms_logs` row keeps the text with the code masked
+(`utils.sms_log_store.redact`), and their body is cleared when they go dead as well.
+
+Every message sent from a request goes through the outbox, OTPs included, so the `worker`
+process (Procfile) must be running and connected to the same database as `web` (the
+same DATABASE_URL, or the same SQLite file on one machine). Without it messages stay
+'queued' and nobody receives their verification code. Where the outbox can't be written
+at all (e.g. a PostgreSQL database migrated before `sms_outbox` existed), `utils.sms`
+and `SMSService` send inline instead, as they did before the outbox.
+
+Environment variables used:
+ - SMS_OUTBOX_MAX_ATTEMPTS (default 5)
+ - SMS_OUTBOX_BACKOFF_BASE (seconds before the first retry, default 30)
+ - SMS_OUTBOX_BACKOFF_MAX (cap on the retry delay in seconds, default 3600)
+ - SMS_OUTBOX_CONCURRENCY (sends in flight across all workers, default 4)
+ - SMS_OUTBOX_RELEASE_DELAY (seconds before retrying a row that got no semaphore permit, default 5)
+ - SMS_DIGEST_WINDOW (seconds a notification waits for others to the same number, default 20; 0 disables)
+ - SMS_DIGEST_MAX_SEGMENTS (largest digest in billable segments, default 3)
+ - SMS_DIGEST_TYPES (comma-separated message types that coalesce, default the appointment notices)
+"""
+from __future__ import annotations
+import logging
+import os
+import random
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.sms_encoding import optimize
+from utils.sms_log_store import SECRET_TYPES, log_fields
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv("SMS_OUTBOX_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE = float(os.getenv("SMS_OUTBOX_BACKOFF_BASE", "30"))
+BACKOFF_MAX = float(os.getenv("SMS_OUTBOX_BACKOFF_MAX", "3600"))
+CONCURRENCY = int(os.getenv("SMS_OUTBOX_CONCURRENCY", "4"))
+SEMAPHORE_NAME = "sms:semaphore"
+# seconds a row waits after no semaphore permit came free for it (with jitter)
+RELEASE_DELAY = float(os.getenv("SMS_OUTBOX_RELEASE_DELAY", "5"))
+DIGEST_WINDOW = float(os.getenv("SMS_DIGEST_WINDOW", "20"))
+DIGEST_MAX_SEGMENTS = int(os.getenv("SMS_DIGEST_MAX_SEGMENTS", "3"))
+DIGEST_TYPES = frozenset(t.strip() for t in os.getenv(
+    "SMS_DIGEST_TYPES",
+    "appointment_reminder,appointment_confirmation,appointment_cancellation,vaccine_reminder",
+).split(",") if t.strip())
+
+# HTTP statuses from the provider that mean "try again later" rather than "never"
+_TRANSIENT_STATUSES = {408, 409, 425, 429}
+
+
+class PermanentSendError(Exception):
+    """A send failure that retrying can't fix; the message is dead-lettered."""
+
+
+def _now() -> datetime:
+    return datetime.utcnow()
+
+
+def _ts(value: datetime) -> str:
+    # Same text format as SQLite's CURRENT_TIMESTAMP so comparisons stay lexical
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _insert_message(c, phone_number, body, message_type, user_id, channel, max_attempts, due, now,
+                    template=None, variables=None) -> int:
+    segments = encoding = None
+    if channel == 'sms':
+        # Verify sends its own text; everything else is billed per segment of this body
+        body, info = optimize(body)
+        segments, encoding = info.segments, info.encoding
+    content, template_id, template_vars = log_fields(c, body, template, variables,
+                                                     message_type=message_type)
+    # RETURNING rather than lastrowid, which psycopg2 cursors don't fill in
+    c.execute('''
+        INSERT INTO sms_logs (user_id, phone_number, message_type, message_content, status,
+                              segments, encoding, template_id, template_vars)
+        VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?)
+        RETURNING id
+    ''', (user_id, phone_number, message_type, content, segments, encoding, template_id, template_vars))
+    log_id = c.fetchone()[0]
+    c.execute('''
+        INSERT INTO sms_outbox (user_id, phone_number, body, message_type, channel,
+                                max_attempts, next_attempt_at, sms_log_id, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        RETURNING id
+    ''', (user_id, phone_number, body, message_type, channel,
+          max_attempts or MAX_ATTEMPTS, due, log_id, now, now))
+    return c.fetchone()[0]
+
+
+def _merge_into_digest(c, phone_number, body, message_type, user_id, now, window_end,
+                       template=None, variables=None) -> Optional[int]:
+    """Append `body` to a held notification for the same number; its outbox id, or None.
+
+    Only rows due by `window_end` qualify: a reminder scheduled hours ahead (send_after)
+    must not hold back a confirmation that should go out now.
+    """
+    types = sorted(DIGEST_TYPES)
+    c.execute(f'''
+        SELECT id, body, sms_log_id FROM sms_outbox
+        WHERE phone_number = ? AND status = 'queued' AND attempts = 0 AND channel = 'sms'
+          AND next_attempt_at > ? AND next_attempt_at <= ?
+          AND message_type IN ({', '.join('?' for _ in types)})
+        ORDER BY id DESC
+        LIMIT 1
+    ''', (phone_number, now, window_end, *types))
+    row = c.fetchone()
+    if row is None:
+        return None
+    outbox_id, held_body, log_id = row[0], row[1], row[2]
+    if body in held_body.split('\n'):
+        combined, info = held_body, None  # the same notice twice; send it once
+    else:
+        combined, info = optimize(held_body + '\n' + body)
+        if info.segments > DIGEST_MAX_SEGMENTS:
+            return None
+        # matching the old body too keeps a concurrent merge from being overwritten
+        c.execute('''
+            UPDATE sms_outbox SET body = ?, updated_at = ?
+            WHERE id = ? AND status = 'queued' AND body = ?
+        ''', (combined, now, outbox_id, held_body))
+        if c.rowcount != 1:
+            return None
+        if log_id:
+            c.execute('''
+                UPDATE sms_logs SET message_content = ?, segments = ?, encoding = ?,
+                                    template_id = NULL, template_vars = NULL
+                WHERE id = ?
+            ''', (combined, info.segments, info.encoding, log_id))
+    content, template_id, template_vars = log_fields(c, body, template, variables,
+                                                     message_type=message_type)
+    c.execute('''
+        INSERT INTO sms_logs (user_id, phone_number, message_type, message_content, status,
+                              provider_response, template_id, template_vars)
+        VALUES (?, ?, ?, ?, 'merged', ?, ?, ?)
+    ''', (user_id, phone_number, message_type, content, f"digest:outbox:{outbox_id}",
+          template_id, template_vars))
+    return outbox_id
+
+
+def _queue_message(c, phone_number, body, message_type, user_id, channel, max_attempts,
+                   send_after, coalesce, template, variables) -> int:
+    now_dt = _now()
+    now = _ts(now_dt)
+    due = send_after or now_dt
+    if coalesce is None:
+        coalesce = DIGEST_WINDOW > 0 and channel == 'sms' and message_type in DIGEST_TYPES
+    if message_type in SECRET_TYPES:
+        # a code must go out at once, and a digest's log row would keep it in plain text
+        coalesce = False
+    window_end = now_dt + timedelta(seconds=DIGEST_WINDOW)
+    # a message scheduled past the window goes out on its own slot, not with today's digest
+    if coalesce and due <= window_end:
+        merged = _merge_into_digest(c, phone_number, body, message_type, user_id, now, _ts(window_end),
+                                    template, variables)
+        if merged is not None:
+            return merged
+        # hold it for the window so the next notice to this number can join it
+        due = window_end
+    return _insert_message(c, phone_number, body, message_type, user_id, channel, max_attempts,
+                           _ts(due), now, template, variables)
+
+
+def enqueue_sms(conn, phone_number: str, body: str, message_type: str = 'general',
+                user_id: Optional[int] = None, channel: str = 'sms',
+                max_attempts: Optional[int] = None, send_after: Optional[datetime] = None,
+                commit: bool = True, coalesce: Optional[bool] = None,
+                template: Optional[str] = None, variables: Optional[dict] = None) -> int:
+    """Queue one message for the worker and return its outbox id.
+
+    `phone_number` should already be normalized (E.164). `send_after` (UTC) holds the
+    message back, e.g. to spread a bulk run. With `commit=False` the rows join the
+    caller's transaction and the caller commits or rolls back.
+
+    `coalesce` (default: whether `message_type` is in DIGEST_TYPES) lets the message merge
+    with other notifications to the same number. A merged message returns the outbox id
+    of the digest it joined.
+
+    `template` and `variables` (what `body` was rendered from) let the log row be stored
+    compactly when SMS_LOG_COMPACT is on (see utils/sms_log_store.py).
+    """
+    c = conn.cursor()
+    args = (phone_number, body, message_type, user_id, channel, max_attempts, send_after, coalesce,
+            template, variables)
+    if not commit:
+        return _queue_message(c, *args)
+    try:
+        outbox_id = _queue_message(c, *args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return outbox_id
+
+
+def backoff_delay(attempts: int, base: Optional[float] = None, cap: Optional[float] = None) -> float:
+    """Seconds to wait after the `attempts`-th failure: base * 2^(n-1), capped, with jitter."""
+    base = BACKOFF_BASE if base is None else base
+    cap = BACKOFF_MAX if cap is None else cap
+    delay = min(cap, base * (2 ** max(attempts - 1, 0)))
+    # full jitter on the upper half keeps retries from a burst from lining up again
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_permanent(exc: Exception) -> bool:
+    if isinstance(exc, PermanentSendError):
+        return True
+    status = getattr(exc, 'status', None)
+    if isinstance(status, int) and 400 <= status < 500 and status not in _TRANSIENT_STATUSES:
+        return True
+    return False
+
+
+def claim_batch(conn, worker_id: str, limit: int, lease_secs: int = 60) -> List[dict]:
+    """Atomically mark up to `limit` due rows as 'sending' for this worker and return them.
+
+    Rows left in 'sending' by a crashed worker become claimable again once their
+    lease runs out.
+    """
+    now = _now()
+    claim = f"{worker_id}:{uuid.uuid4().hex[:8]}"
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE sms_outbox
+            SET status = 'sending', locked_by = ?, locked_until = ?, updated_at = ?
+            WHERE id IN (
+                SELECT id FROM sms_outbox
+                WHERE (status = 'queued' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND locked_until < ?)
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+            )
+            -- checked again on the row itself: under PostgreSQL another worker may have
+            -- claimed an id after this statement's snapshot picked it
+              AND ((status = 'queued' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND locked_until < ?))
+        ''', (claim, _ts(now + timedelta(seconds=lease_secs)), _ts(now), _ts(now), _ts(now), limit,
+              _ts(now), _ts(now)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    c.execute('SELECT * FROM sms_outbox WHERE locked_by = ? ORDER BY id', (claim,))
+    return [dict(row) for row in c.fetchall()]
+
+
+def update_log_statuses(conn, updates: List[tuple]) -> None:
+    """Batch-update `sms_logs` rows with one executemany (no commit).
+
+    `updates` holds (log_id, status, provider_response, provider_message_id) tuples;
+    None leaves the stored response / message id unchanged.
+    """
+    if not updates:
+        return
+    conn.cursor().executemany('''
+        UPDATE sms_logs
+        SET status = ?,
+            provider_response = COALESCE(?, provider_response),
+            provider_message_id = COALESCE(?, provider_message_id),
+            sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP ELSE sent_at END
+        WHERE id = ?
+    ''', [(status, response, message_id, status, log_id)
+          for log_id, status, response, message_id in updates])
+
+
+def _failure_outcome(row: dict, error: Exception, now: datetime) -> Tuple[str, int, str, Optional[str]]:
+    """(new status, attempts, error text, retry time) for a failed send."""
+    attempts = int(row.get('attempts') or 0) + 1
+    message = str(error)[:500] or error.__class__.__name__
+    if is_permanent(error) or attempts >= int(row.get('max_attempts') or MAX_ATTEMPTS):
+        return 'dead', attempts, message, None
+    return 'queued', attempts, message, _ts(now + timedelta(seconds=backoff_delay(attempts)))
+
+
+def record_results(conn, results: List[tuple]) -> Dict[str, int]:
+    """Apply a batch of send results in one transaction; returns counts per new status.
+
+    `results` holds (outcome, row, payload) from the worker: ('sent', row, (message_id,
+    provider_status)), ('failed', row, exception) or ('released', row, None) when no
+    semaphore permit was free. Released rows go back to the queue after RELEASE_DELAY
+    without using up an attempt, and are counted as 'released'.
+    """
+    now = _now()
+    stamp = _ts(now)
+    sent_rows, retry_rows, dead_rows, released, log_updates = [], [], [], [], []
+    scrubbed = []
+    counts: Dict[str, int] = {}
+    for outcome, row, payload in results:
+        if outcome == 'sent':
+            message_id, provider_status = payload
+            sent_rows.append((message_id, stamp, row['id']))
+            log_updates.append((row.get('sms_log_id'), 'sent', provider_status, message_id))
+            status = 'sent'
+        elif outcome == 'failed':
+            status, attempts, error, retry_at = _failure_outcome(row, payload, now)
+            if status == 'dead':
+                dead_rows.append((attempts, error, stamp, row['id']))
+                log_updates.append((row.get('sms_log_id'), 'failed', error, None))
+            else:
+                retry_rows.append((attempts, error, retry_at, stamp, row['id']))
+        else:
+            released.append((_ts(now + timedelta(seconds=backoff_delay(1, base=RELEASE_DELAY))),
+                             row['id']))
+            status = 'released'
+        if status == 'dead' and row.get('message_type') in SECRET_TYPES:
+            # the one-time code is no use once the message is given up; don't keep it
+            scrubbed.append((row['id'],))
+        counts[status] = counts.get(status, 0) + 1
+
+    c = conn.cursor()
+    try:
+        if sent_rows:
+            c.executemany('''
+                UPDATE sms_outbox
+                SET status = 'sent', attempts = attempts + 1, provider_message_id = ?, body = '',
+                    locked_by = NULL, locked_until = NULL, last_error = NULL, updated_at = ?
+                WHERE id = ?
+            ''', sent_rows)
+        if retry_rows:
+            c.executemany('''
+                UPDATE sms_outbox
+                SET status = 'queued', attempts = ?, last_error = ?, next_attempt_at = ?,
+                    locked_by = NULL, locked_until = NULL, updated_at = ?
+                WHERE id = ?
+            ''', retry_rows)
+        if dead_rows:
+            c.executemany('''
+                UPDATE sms_outbox
+                SET status = 'dead', attempts = ?, last_error = ?,
+                    locked_by = NULL, locked_until = NULL, updated_at = ?
+                WHERE id = ?
+            ''', dead_rows)
+        if released:
+            c.executemany('''
+                UPDATE sms_outbox SET status = 'queued', next_attempt_at = ?, locked_by = NULL, locked_until = NULL
+                WHERE id = ? AND status = 'sending'
+            ''', released)
+        if scrubbed:
+            c.executemany("UPDATE sms_outbox SET body = '' WHERE id = ?", scrubbed)
+        update_log_statuses(conn, [u for u in log_updates if u[0]])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return counts
+
+
+def requeue_dead(conn, ids: Optional[List[int]] = None) -> int:
+    """Move dead-lettered rows back to the queue with a fresh attempt budget.
+
+    Rows whose body was cleared (verification codes) stay dead.
+    """
+    now = _ts(_now())
+    c = conn.cursor()
+    if ids:
+        marks = ', '.join('?' for _ in ids)
+        c.execute(f'''
+            UPDATE sms_outbox SET status = 'queued', attempts = 0, next_attempt_at = ?, updated_at = ?
+            WHERE status = 'dead' AND body != '' AND id IN ({marks})
+        ''', [now, now, *ids])
+    else:
+        c.execute('''
+            UPDATE sms_outbox SET status = 'queued', attempts = 0, next_attempt_at = ?, updated_at = ?
+            WHERE status = 'dead' AND body != ''
+        ''', (now, now))
+    count = c.rowcount
+    conn.commit()
+    return count
+
+
+def outbox_stats(conn) -> dict:
+    c = conn.cursor()
+    c.execute('SELECT status, COUNT(*) FROM sms_outbox GROUP BY status')
+    return {row[0]: row[1] for row in c.fetchall()}
+
+
+def _default_deliver(row: dict):
+    from utils.sms import deliver_sms
+    return deliver_sms(row['phone_number'], row['body'], channel=row.get('channel') or 'sms')
+
+
+class OutboxWorker:
+    """Claims due outbox rows and sends them from a bounded thread pool.
+
+    `get_db` returns a new DB connection; only the polling thread touches the database.
+    `deliver(row)` sends one message and returns `(provider_message_id, provider_status)`,
+    raising on failure.
+    """
+
+    def __init__(self, get_db: Callable, deliver: Optional[Callable] = None,
+                 concurrency: Optional[int] = None, batch_size: int = 20,
+                 poll_interval: float = 2.0, lease_secs: int = 60,
+                 semaphore_name: str = SEMAPHORE_NAME, use_semaphore: bool = True):
+        self.get_db = get_db
+        self.deliver = deliver or _default_deliver
+        self.concurrency = concurrency or CONCURRENCY
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_secs = lease_secs
+        self.semaphore_name = semaphore_name
+        self.use_semaphore = use_semaphore
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='sms-outbox')
+
+    def _acquire(self):
+        if not self.use_semaphore:
+            return None, None
+        try:
+            from utils.redis_semaphore import acquire_token, release_token
+        except Exception:
+            return None, None
+        # a permit should free up within one send; if not, the row goes back to the queue.
+        # permits= re-seeds the semaphore if Redis lost it (restart, flush) or never had it
+        return acquire_token(self.semaphore_name, timeout=5, lease_secs=self.lease_secs,
+                             permits=CONCURRENCY), release_token
+
+    def _send_one(self, row: dict) -> tuple:
+        token, release = self._acquire()
+        try:
+            if self.use_semaphore and release is not None and not token:
+                return 'released', row, None
+            try:
+                return 'sent', row, self.deliver(row)
+            except Exception as exc:
+                logger.warning(f"SMS outbox {row['id']} to {row['phone_number']} failed: {exc}")
+                return 'failed', row, exc
+        finally:
+            if token and release:
+                try:
+                    release(self.semaphore_name, token)
+                except Exception:
+                    pass
+
+    def run_once(self) -> dict:
+        """Claim one batch, send it, and record every result in a single transaction.
+
+        Returns counts per new outbox status.
+        """
+        conn = self.get_db()
+        try:
+            rows = claim_batch(conn, self.worker_id, self.batch_size, self.lease_secs)
+            if not rows:
+                return {}
+            results = list(self._pool.map(self._send_one, rows))
+            return record_results(conn, results)
+        finally:
+            conn.close()
+
+    def run_forever(self) -> None:
+        while not self._stop.is_set():
+            try:
+                outcomes = self.run_once()
+            except Exception as exc:
+                logger.error(f"SMS outbox worker error: {exc}")
+                outcomes = {}
+            if outcomes:
+                logger.info(f"SMS outbox batch: {outcomes}")
+            else:
+                # nothing due; don't spin on an empty queue
+                self._stop.wait(self.poll_interval)
+        self._pool.shutdown(wait=True)
+
+    def stop(self) -> None:
+        self._stop.set()
@@ -0,0 +1,464 @@
+"""
+Pluggable SMS providers behind one small interface.
+
+`utils.sms` and the outbox worker talk to `get_provider()` instead of the Twilio SDK:
+
+  provider.is_configured() -> bool
+  provider.accepts(phone) -> bool                                    # e.g. PH-only gateways
+  provider.send(phone, body) -> (message_id, status)
+  provider.start_verification(phone) -> (verification_id, status)   # Verify-style OTP
+  provider.check_verification(phone, code) -> bool
+
+`TwilioProvider` is the production implementation (shared client from
+`utils.twilio_client`). `SemaphoreProvider` sends through Semaphore's HTTP API
+(semaphore.co, Philippine numbers only). `FakeProvider` runs in-process with no network: it sleeps for a
+configurable latency distribution and injects transient errors (HTTP 500), permanent
+errors (HTTP 400) and rate limiting (HTTP 429 once more than FAKE_SMS_MAX_RPS requests
+arrive per second), raising `ProviderHTTPError` just like a real provider failure, so
+throughput, semaphore and retry behaviour can be measured on a laptop.
+`scripts/fake_sms_server.py` serves the same fake over HTTP in Twilio's wire format for
+end-to-end runs through the real SDK (see TWILIO_API_BASE_URL in utils.twilio_client).
+
+With several names in SMS_PROVIDER (e.g. 'twilio,semaphore'), `RoutingProvider` picks a
+provider per message. The choice is a weighted random draw: each provider's configured
+weight divided by its latency EWMA. Each provider has its own circuit breaker, so one
+that keeps failing is skipped until its probe succeeds. A send fails over to the next
+provider only when the first one certainly didn't accept the message: a connection that
+was never made, or HTTP 429/503. On a timeout, another 5xx or any other ambiguous
+outcome the message may already be on its way, so the error goes back to the outbox
+instead of being sent again elsewhere. Only successful sends update the latency EWMA, so
+a provider that fails fast doesn't look like the fastest one. Permanent errors (e.g. an invalid number) are not retried anywhere.
+
+Latency specs: 'fixed:0.05', 'uniform:0.02,0.2', 'normal:0.1,0.03' or
+'lognormal:-2.5,0.6' (mu, sigma of the underlying normal); values are seconds.
+
+Environment variables used:
+ - SMS_PROVIDER ('twilio' (default), 'semaphore', 'fake', or a comma-separated list to route)
+ - SMS_PROVIDER_WEIGHTS (e.g. 'twilio=3,semaphore=1'; default 1 each)
+ - SMS_PROVIDER_BREAKER_FAILURES (consecutive failures that open a provider's breaker, default 5)
+ - SMS_PROVIDER_BREAKER_RESET (seconds before a tripped provider is probed again, default 30)
+ - SMS_PROVIDER_EWMA_ALPHA (weight of the newest latency sample, default 0.2)
+ - FAKE_SMS_LATENCY (latency spec, default 'fixed:0')
+ - FAKE_SMS_ERROR_RATE (share of transient 500s, default 0)
+ - FAKE_SMS_PERMANENT_ERROR_RATE (share of permanent 400s, default 0)
+ - FAKE_SMS_MAX_RPS (requests per second before 429s, default 0 = unlimited)
+ - FAKE_SMS_VERIFY_CODE (code the fake Verify API approves, default '123456')
+ - TWILIO_FROM / TWILIO_VERIFY_SERVICE_SID / TWILIO_STATUS_CALLBACK_URL (Twilio)
+ - SEMAPHORE_API_KEY / SEMAPHORE_SENDER_NAME (Semaphore)
+ - SEMAPHORE_API_URL (default https://api.semaphore.co/api/v4), SEMAPHORE_HTTP_TIMEOUT (default 10)
+"""
+from __future__ import annotations
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import requests
+import urllib3
+
+from utils.redis_client import CircuitBreaker
+from utils.sms_outbox import PermanentSendError, is_permanent
+from utils.twilio_client import ProviderHTTPError, get_twilio_client, is_configured
+
+SMS_PROVIDER_BREAKER_FAILURES = int(os.getenv("SMS_PROVIDER_BREAKER_FAILURES", "5"))
+SMS_PROVIDER_BREAKER_RESET = float(os.getenv("SMS_PROVIDER_BREAKER_RESET", "30"))
+SMS_PROVIDER_EWMA_ALPHA = float(os.getenv("SMS_PROVIDER_EWMA_ALPHA", "0.2"))
+SEMAPHORE_API_URL = os.getenv("SEMAPHORE_API_URL", "https://api.semaphore.co/api/v4").rstrip("/")
+SEMAPHORE_HTTP_TIMEOUT = float(os.getenv("SEMAPHORE_HTTP_TIMEOUT", "10"))
+
+# latencies below this count as equal, so routing follows the weights between fast providers
+_LATENCY_FLOOR = 0.05
+# answers that mean the provider turned the request away before taking the message; a
+# 500/502 can come back after the message was accepted, so those don't fail over
+_REJECTED_STATUSES = {429, 503}
+
+
+class SMSProvider:
+    """Interface shared by every provider."""
+
+    name = 'base'
+
+    @property
+    def supports_verify(self) -> bool:
+        return False
+
+    def is_configured(self) -> bool:
+        raise NotImplementedError
+
+    def accepts(self, phone: str) -> bool:
+        return True
+
+    def send(self, phone: str, body: str) -> Tuple[Optional[str], Optional[str]]:
+        raise NotImplementedError
+
+    def start_verification(self, phone: str) -> Tuple[Optional[str], Optional[str]]:
+        raise NotImplementedError
+
+    def check_verification(self, phone: str, code: str) -> bool:
+        raise NotImplementedError
+
+
+class TwilioProvider(SMSProvider):
+    name = 'twilio'
+
+    def __init__(self, from_number: Optional[str] = None, verify_service_sid: Optional[str] = None,
+                 status_callback: Optional[str] = None):
+        self.from_number = from_number or os.getenv("TWILIO_FROM")
+        self.verify_service_sid = verify_service_sid or os.getenv("TWILIO_VERIFY_SERVICE_SID")
+        self.status_callback = status_callback or os.getenv("TWILIO_STATUS_CALLBACK_URL")
+
+    @property
+    def supports_verify(self) -> bool:
+        return bool(self.verify_service_sid) and is_configured()
+
+    def is_configured(self) -> bool:
+        return is_configured() and bool(self.from_number)
+
+    def send(self, phone, body):
+        client = get_twilio_client()
+        if not client or not self.from_number:
+            raise PermanentSendError("twilio_not_configured")
+        extra = {"status_callback": self.status_callback} if self.status_callback else {}
+        message = client.messages.create(body=body, from_=self.from_number, to=phone, **extra)
+        return getattr(message, "sid", None), getattr(message, "status", None)
+
+    def start_verification(self, phone):
+        client = get_twilio_client()
+        if not client or not self.verify_service_sid:
+            raise PermanentSendError("verify_not_configured")
+        verification = client.verify.services(self.verify_service_sid).verifications.create(
+            to=phone, channel="sms"
+        )
+        return getattr(verification, "sid", None), getattr(verification, "status", None)
+
+    def check_verification(self, phone, code):
+        client = get_twilio_client()
+        if not client or not self.verify_service_sid:
+            return False
+        check = client.verify.services(self.verify_service_sid).verification_checks.create(
+            to=phone, code=code
+        )
+        return getattr(check, "status", None) == "approved"
+
+
+class SemaphoreProvider(SMSProvider):
+    """Semaphore (semaphore.co) HTTP API; Philippine numbers only, no Verify."""
+
+    name = 'semaphore'
+
+    def __init__(self, api_key: Optional[str] = None, sender_name: Optional[str] = None,
+                 base_url: Optional[str] = None, timeout: Optional[float] = None):
+        self.api_key = api_key or os.getenv("SEMAPHORE_API_KEY")
+        self.sender_name = sender_name or os.getenv("SEMAPHORE_SENDER_NAME")
+        self.base_url = (base_url or SEMAPHORE_API_URL).rstrip("/")
+        self.timeout = SEMAPHORE_HTTP_TIMEOUT if timeout is None else timeout
+        # pooled keep-alive connections, shared by the worker's sender threads
+        self._session = requests.Session()
+
+    def is_configured(self) -> bool:
+        return bool(self.api_key)
+
+    def accepts(self, phone: str) -> bool:
+        return bool(phone) and phone.startswith("+63")
+
+    def send(self, phone, body):
+        if not self.api_key:
+            raise PermanentSendError("semaphore_not_configured")
+        data = {"apikey": self.api_key, "number": phone.lstrip("+"), "message": body}
+        if self.sender_name:
+            data["sendername"] = self.sender_name
+        response = self._session.post(f"{self.base_url}/messages", data=data, timeout=self.timeout)
+        if response.status_code >= 300:
+            raise ProviderHTTPError(response.status_code, response.text[:200])
+        try:
+            payload = response.json()
+        except ValueError:
+            raise ProviderHTTPError(502, f"unexpected Semaphore response: {response.text[:200]}")
+        # success is a list with one entry per recipient; validation errors come back as a dict
+        if not isinstance(payload, list) or not payload or "message_id" not in payload[0]:
+            raise PermanentSendError(f"semaphore_rejected: {str(payload)[:200]}")
+        message = payload[0]
+        return str(message["message_id"]), str(message.get("status") or "").lower() or None
+
+
+def parse_latency(spec: Optional[str]) -> Callable[[], float]:
+    """Turn a latency spec ('uniform:0.02,0.2', ...) into a sampler returning seconds."""
+    kind, _, args = (spec or 'fixed:0').partition(':')
+    values = [float(v) for v in args.split(',') if v.strip()] or [0.0]
+    kind = kind.strip().lower()
+    if kind == 'uniform':
+        low, high = values[0], values[1] if len(values) > 1 else values[0]
+        return lambda: random.uniform(low, high)
+    if kind == 'normal':
+        mean, dev = values[0], values[1] if len(values) > 1 else 0.0
+        return lambda: max(0.0, random.gauss(mean, dev))
+    if kind == 'lognormal':
+        mu, sigma = values[0], values[1] if len(values) > 1 else 0.0
+        return lambda: random.lognormvariate(mu, sigma)
+    if kind == 'fixed':
+        return lambda: values[0]
+    raise ValueError(f"unknown latency spec: {spec}")
+
+
+class FakeProvider(SMSProvider):
+    """In-process stand-in with latency, error and rate-limit injection."""
+
+    name = 'fake'
+
+    def __init__(self, latency: Optional[str] = None, error_rate: Optional[float] = None,
+                 permanent_error_rate: Optional[float] = None, max_rps: Optional[float] = None,
+                 verify_code: Optional[str] = None, seed: Optional[int] = None, keep: int = 1000,
+                 name: Optional[str] = None):
+        if name:
+            self.name = name
+        self.latency_spec = latency or os.getenv("FAKE_SMS_LATENCY", "fixed:0")
+        self._latency = parse_latency(self.latency_spec)
+        self.error_rate = float(os.getenv("FAKE_SMS_ERROR_RATE", "0") if error_rate is None else error_rate)
+        self.permanent_error_rate = float(os.getenv("FAKE_SMS_PERMANENT_ERROR_RATE", "0")
+                                          if permanent_error_rate is None else permanent_error_rate)
+        self.max_rps = float(os.getenv("FAKE_SMS_MAX_RPS", "0") if max_rps is None else max_rps)
+        self.verify_code = verify_code or os.getenv("FAKE_SMS_VERIFY_CODE", "123456")
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window: Deque[float] = deque()
+        self.sent: Deque[dict] = deque(maxlen=keep)
+        self.counts: Dict[str, int] = {'requests': 0, 'sent': 0, 'rate_limited': 0,
+                                       'transient': 0, 'permanent': 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def supports_verify(self) -> bool:
+        return True
+
+    def is_configured(self) -> bool:
+        return True
+
+    def _admit(self) -> None:
+        """Apply latency and the injected failures for one request."""
+        now = time.monotonic()
+        with self._lock:
+            self.counts['requests'] += 1
+            if self.max_rps > 0:
+                while self._window and self._window[0] <= now - 1.0:
+                    self._window.popleft()
+                if len(self._window) >= self.max_rps:
+                    self.counts['rate_limited'] += 1
+                    raise ProviderHTTPError(429, 'Too Many Requests')
+                self._window.append(now)
+            roll = self._random.random()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self._latency())
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        if roll < self.permanent_error_rate:
+            with self._lock:
+                self.counts['permanent'] += 1
+            raise ProviderHTTPError(400, 'The To phone number is not valid')
+        if roll < self.permanent_error_rate + self.error_rate:
+            with self._lock:
+                self.counts['transient'] += 1
+            raise ProviderHTTPError(500, 'Internal Server Error')
+
+    def send(self, phone, body):
+        self._admit()
+        sid = 'SM' + uuid.uuid4().hex
+        with self._lock:
+            self.counts['sent'] += 1
+            self.sent.append({'sid': sid, 'to': phone, 'body': body, 'at': time.time()})
+        return sid, 'queued'
+
+    def start_verification(self, phone):
+        self._admit()
+        return 'VE' + uuid.uuid4().hex, 'pending'
+
+    def check_verification(self, phone, code):
+        return code == self.verify_code
+
+
+def rejected_before_send(exc: Exception) -> bool:
+    """Whether `exc` proves the provider never took the message, so another may send it."""
+    if isinstance(exc, (requests.exceptions.ConnectTimeout, requests.exceptions.SSLError,
+                        ConnectionRefusedError)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and not isinstance(exc, requests.exceptions.Timeout):
+        # refused or unresolvable (wrapped in MaxRetryError); "connection aborted" after the
+        # request went out is ambiguous
+        reason = exc.args[0] if exc.args else None
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    if isinstance(exc, (requests.exceptions.RequestException, OSError)):
+        return False  # e.g. a read timeout: the request may have been processed
+    return getattr(exc, 'status', None) in _REJECTED_STATUSES
+
+
+class _Route:
+    """One provider in a RoutingProvider with its breaker, latency EWMA and counters."""
+
+    def __init__(self, provider: SMSProvider, weight: float, breaker: CircuitBreaker):
+        self.provider = provider
+        self.weight = weight
+        self.breaker = breaker
+        self.latency: Optional[float] = None
+        self.counts = {'sent': 0, 'failed': 0, 'failovers': 0}
+
+
+class RoutingProvider(SMSProvider):
+    """Spreads sends over several providers by weight and latency, with per-provider breakers."""
+
+    name = 'routing'
+
+    def __init__(self, providers: Sequence[SMSProvider], weights: Optional[Dict[str, float]] = None,
+                 failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None,
+                 alpha: Optional[float] = None, seed: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        weights = weights or {}
+        self.alpha = SMS_PROVIDER_EWMA_ALPHA if alpha is None else alpha
+        self._clock = clock
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.routes = [
+            _Route(p, float(weights.get(p.name, 1.0)),
+                   CircuitBreaker(failure_threshold or SMS_PROVIDER_BREAKER_FAILURES,
+                                  SMS_PROVIDER_BREAKER_RESET if reset_timeout is None else reset_timeout,
+                                  clock=clock, name=f"SMS provider {p.name}"))
+            for p in providers
+        ]
+
+    @property
+    def supports_verify(self) -> bool:
+        return self._verify_route() is not None
+
+    def is_configured(self) -> bool:
+        return any(r.provider.is_configured() for r in self.routes)
+
+    def accepts(self, phone: str) -> bool:
+        return any(r.provider.accepts(phone) for r in self.routes)
+
+    def _order(self, phone: str) -> List[_Route]:
+        """Candidate routes for `phone`, best first: weighted draw without replacement."""
+        routes = [r for r in self.routes
+                  if r.weight > 0 and r.breaker.state != 'open'
+                  and r.provider.is_configured() and r.provider.accepts(phone)]
+        with self._lock:
+            known = [r.latency for r in routes if r.latency is not None]
+            prior = sum(known) / len(known) if known else 1.0
+            scores = [r.weight / max(r.latency if r.latency is not None else prior, _LATENCY_FLOOR)
+                      for r in routes]
+            ordered = []
+            while routes:
+                pick = self._random.uniform(0, sum(scores))
+                for i, score in enumerate(scores):
+                    pick -= score
+                    if pick <= 0 or i == len(scores) - 1:
+                        ordered.append(routes.pop(i))
+                        scores.pop(i)
+                        break
+        return ordered
+
+    def _observe(self, route: _Route, elapsed: Optional[float], outcome: str) -> None:
+        with self._lock:
+            if elapsed is not None:
+                route.latency = elapsed if route.latency is None else \
+                    self.alpha * elapsed + (1 - self.alpha) * route.latency
+            route.counts[outcome] += 1
+
+    def send(self, phone, body):
+        last_error: Optional[Exception] = None
+        for route in self._order(phone):
+            if not route.breaker.allow():
+                continue
+            if last_error is not None:
+                with self._lock:
+                    route.counts['failovers'] += 1
+            started = self._clock()
+            try:
+                message_id, status = route.provider.send(phone, body)
+            except Exception as exc:
+                self._observe(route, None, 'failed')
+                if is_permanent(exc):
+                    # the provider is fine; the message itself is bad everywhere
+                    route.breaker.record_success()
+                    raise
+                route.breaker.record_failure(exc)
+                if not rejected_before_send(exc):
+                    raise
+                last_error = exc
+                continue
+            self._observe(route, self._clock() - started, 'sent')
+            route.breaker.record_success()
+            return message_id, f"{route.provider.name}:{status}" if status else route.provider.name
+        if last_error is not None:
+            raise last_error
+        raise ProviderHTTPError(503, 'no SMS provider available')
+
+    def _verify_route(self) -> Optional[_Route]:
+        for route in self.routes:
+            if route.provider.supports_verify:
+                return route
+        return None
+
+    def start_verification(self, phone):
+        route = self._verify_route()
+        if route is None:
+            raise PermanentSendError("verify_not_configured")
+        return route.provider.start_verification(phone)
+
+    def check_verification(self, phone, code):
+        route = self._verify_route()
+        return route.provider.check_verification(phone, code) if route else False
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Per-provider state for the admin fallbacks page."""
+        with self._lock:
+            return {r.provider.name: dict(r.counts, weight=r.weight, state=r.breaker.state,
+                                          latency_ms=round(r.latency * 1000, 1) if r.latency is not None else None,
+                                          configured=r.provider.is_configured())
+                    for r in self.routes}
+
+
+def parse_weights(spec: Optional[str]) -> Dict[str, float]:
+    """'twilio=3,semaphore=1' -> {'twilio': 3.0, 'semaphore': 1.0}."""
+    weights = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        if name.strip() and value.strip():
+            weights[name.strip().lower()] = float(value)
+    return weights
+
+
+_PROVIDERS = {'twilio': TwilioProvider, 'semaphore': SemaphoreProvider, 'fake': FakeProvider}
+_provider: Optional[SMSProvider] = None
+_provider_lock = threading.Lock()
+
+
+def get_provider() -> SMSProvider:
+    """The process-wide provider selected by SMS_PROVIDER."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                names = [n.strip() for n in os.getenv("SMS_PROVIDER", "twilio").lower().split(",") if n.strip()]
+                unknown = [n for n in names if n not in _PROVIDERS]
+                if unknown:
+                    raise ValueError(f"unknown SMS_PROVIDER {', '.join(unknown)}; "
+                                     f"expected one of {', '.join(sorted(_PROVIDERS))}")
+                if len(names) > 1:
+                    _provider = RoutingProvider([_PROVIDERS[n]() for n in names],
+                                                weights=parse_weights(os.getenv("SMS_PROVIDER_WEIGHTS")))
+                else:
+                    _provider = _PROVIDERS[names[0] if names else 'twilio']()
+    return _provider
+
+
+def set_provider(provider: Optional[SMSProvider]) -> None:
+    """Swap the process-wide provider (benchmarks, tests); None re-reads SMS_PROVIDER."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
@@ -9,13 +9,20 @@ This module handles SMS functionality including:
 """
 
 import os
-import re
 import logging
 from datetime import datetime, timedelta
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioException
 from flask import current_app
 
+from utils.booking_slots import normalize_slot_time
+from utils.phone import is_valid_phone, try_normalize
+from utils.sms import send_inline
+from utils.sms_encoding import analyze
+from utils.sms_log_store import redact
+from utils.sms_outbox import enqueue_sms, update_log_statuses
+from utils.sms_providers import get_provider
+from utils.template_store import get_db_template, render as render_template_text
+from utils.twilio_client import get_twilio_client
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,96 +38,49 @@ class SMSService:
     def init_app(self, app):
         """Initialize SMS service with app configuration"""
         self.app = app
-        self.twilio_client = None
 
         # SMS Configuration from environment variables
         self.twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
         self.twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
         self.twilio_phone_number = os.getenv('TWILIO_PHONE_NUMBER', '+1234567890')
 
-        # Initialize Twilio client if credentials are available
-        if self.twilio_account_sid and self.twilio_auth_token:
-            self.twilio_client = Client(self.twilio_account_sid, self.twilio_auth_token)
+        # Messages are delivered by the outbox worker through utils.sms_providers; the Twilio
+        # client is shared per process and built on first use (utils.twilio_client)
+        self.provider_configured = get_provider().is_configured()
 
         # SMS Settings
         self.sms_enabled = os.getenv('SMS_ENABLED', 'true').lower() == 'true'
         self.sms_provider = os.getenv('SMS_PROVIDER', 'twilio')  # twilio, semaphore, etc.
 
+    @property
+    def twilio_client(self):
+        """The process-wide Twilio client, or None when credentials aren't set"""
+        return get_twilio_client()
+
     def is_enabled(self):
         """Check if SMS service is enabled"""
-        return self.sms_enabled and self.twilio_client is not None
+        return getattr(self, 'sms_enabled', False) and getattr(self, 'provider_configured', False)
 
     def validate_phone_number(self, phone_number):
-        """Validate Philippine phone number format"""
-        if not phone_number:
-            return False
-
-        # Remove all non-digit characters
-        digits_only = re.sub(r'\D', '', phone_number)
-
-        # Philippine phone numbers should be 10 digits starting with 9
-        # Or 11 digits starting with 63 (country code)
-        # Or 11 digits starting with 09 (mobile format)
-        if len(digits_only) == 10 and digits_only.startswith('9'):
-            return True
-        elif len(digits_only) == 11 and digits_only.startswith('639'):
-            return True
-        elif len(digits_only) == 11 and digits_only.startswith('09'):
-            return True
-        elif len(digits_only) == 12 and digits_only.startswith('639'):
-            return True
-
-        return False
+        """Validate phone number format (Philippine mobile numbers take the fast path)"""
+        return is_valid_phone(phone_number)
 
     def format_phone_number(self, phone_number):
-        """Format phone number for sending"""
-        if not phone_number:
-            return None
-
-        digits_only = re.sub(r'\D', '', phone_number)
-
-        # Add country code if not present
-        if len(digits_only) == 10 and digits_only.startswith('9'):
-            return f"+63{digits_only}"
-        elif len(digits_only) == 11 and digits_only.startswith('639'):
-            return f"+{digits_only}"
-        elif len(digits_only) == 11 and digits_only.startswith('09'):
-            # Convert 09XXXXXXXXX to +639XXXXXXXXX
-            return f"+63{digits_only[1:]}"
-        elif len(digits_only) == 12 and digits_only.startswith('639'):
-            return f"+{digits_only}"
-
-        return None
+        """Format phone number for sending (E.164), or None if it isn't valid"""
+        return try_normalize(phone_number)
 
     def get_sms_template(self, template_name):
-        """Get SMS template from database"""
+        """Get SMS template from database (cached, see utils.template_store)"""
         if not self.app:
             return None
 
-        try:
-            conn = self.app.get_db()
-            c = conn.cursor()
-            c.execute('''
-                SELECT template_content, is_active
-                FROM sms_templates
-                WHERE template_name = ? AND is_active = 1
-            ''', (template_name,))
-            template = c.fetchone()
-            conn.close()
-
-            if template:
-                return template['template_content']
-        except Exception as e:
-            logger.error(f"Error getting SMS template '{template_name}': {str(e)}")
-
-        return None
+        template = get_db_template(self.app.get_db, template_name)
+        return template.source if template else None
 
     def render_template(self, template_content, variables):
         """Render template with variables"""
         try:
-            for key, value in variables.items():
-                template_content = template_content.replace(f"{{{{{key}}}}}", str(value))
-            return template_content
+            return render_template_text(template_content, variables)
         except Exception as e:
             logger.error(f"Error rendering SMS template: {str(e)}")
             return template_content
@@ -202,139 +162,177 @@ class SMSService:
             logger.error(f"Error updating SMS settings for user {user_id}: {str(e)}")
             return False
 
-    def log_sms(self, user_id, phone_number, message_type, message_content, status='pending'):
-        """Log SMS activity"""
-        if not self.app:
-            return False
+    def _get_db(self):
+        return (self.app or current_app).get_db()
+
+    def get_send_context(self, user_id=None, template_name=None, appointment_id=None, conn=None):
+        """Everything one templated send needs, fetched in a single query.
 
+        Returns the user's name, SMS settings (phone and opt-in flags) and the active
+        template content; with `appointment_id` the appointment row is included too
+        (and its user is used). Returns None if the user/appointment doesn't exist.
+        """
+        own_conn = conn is None
+        conn = conn or self._get_db()
         try:
-            conn = self.app.get_db()
             c = conn.cursor()
+            columns = '''
+                u.id AS user_id, u.name AS user_name,
+                s.phone_number AS settings_phone, s.appointment_reminders,
+                s.appointment_confirmations, s.vaccine_reminders,
+                s.general_notifications, s.marketing_messages,
+                (SELECT template_content FROM sms_templates
+                 WHERE template_name = ? AND is_active = 1) AS template_content
+            '''
+            if appointment_id is not None:
+                c.execute(f'''
+                    SELECT a.*, {columns}
+                    FROM appointments a
+                    JOIN users u ON a.user_id = u.id
+                    LEFT JOIN sms_settings s ON s.user_id = u.id
+                    WHERE a.id = ?
+                ''', (template_name, appointment_id))
+            else:
+                c.execute(f'''
+                    SELECT {columns}
+                    FROM users u
+                    LEFT JOIN sms_settings s ON s.user_id = u.id
+                    WHERE u.id = ?
+                ''', (template_name, user_id))
+            row = c.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Error loading SMS context (user {user_id}, appointment {appointment_id}): {str(e)}")
+            return None
+        finally:
+            if own_conn:
+                conn.close()
+
+    def log_sms(self, user_id, phone_number, message_type, message_content, status='pending', conn=None):
+        """Log SMS activity; returns the new sms_logs row id (None on error)"""
+        own_conn = conn is None
+        try:
+            conn = conn or self._get_db()
+            c = conn.cursor()
+            info = analyze(message_content)
+            message_content = redact(message_content, message_type)
             c.execute('''
-                INSERT INTO sms_logs (user_id, phone_number, message_type, message_content, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, phone_number, message_type, message_content, status))
+                INSERT INTO sms_logs (user_id, phone_number, message_type, message_content, status,
+                                      segments, encoding)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+            ''', (user_id, phone_number, message_type, message_content, status,
+                  info.segments, info.encoding))
+            log_id = c.fetchone()[0]
             conn.commit()
-            conn.close()
-            return True
+            return log_id
         except Exception as e:
             logger.error(f"Error logging SMS: {str(e)}")
-            return False
+            return None
+        finally:
+            if own_conn and conn is not None:
+                conn.close()
 
-    def update_sms_status(self, log_id, status, provider_response=None):
-        """Update SMS log status"""
-        if not self.app:
+    def update_sms_status(self, log_id, status, provider_response=None, provider_message_id=None):
+        """Update one SMS log row by id"""
+        if not log_id:
             return False
+        return self.update_sms_statuses([(log_id, status, provider_response, provider_message_id)])
 
+    def update_sms_statuses(self, updates, conn=None):
+        """Batch-update SMS log rows: (log_id, status, provider_response, provider_message_id)"""
+        own_conn = conn is None
         try:
-            conn = self.app.get_db()
-            c = conn.cursor()
-
-            update_data = [status]
-            if provider_response:
-                update_data.append(provider_response)
-                update_data.append(log_id)
-                c.execute('''
-                    UPDATE sms_logs
-                    SET status = ?, provider_response = ?, sent_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', update_data)
-            else:
-                update_data.append(log_id)
-                c.execute('''
-                    UPDATE sms_logs
-                    SET status = ?, sent_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', update_data)
-
+            conn = conn or self._get_db()
+            update_log_statuses(conn, updates)
             conn.commit()
-            conn.close()
             return True
         except Exception as e:
             logger.error(f"Error updating SMS status: {str(e)}")
             return False
+        finally:
+            if own_conn and conn is not None:
+                conn.close()
+
+    def send_sms(self, to_phone, message, user_id=None, message_type='general', conn=None,
+                 template=None, variables=None):
+        """Queue an SMS message for delivery by the outbox worker
 
-    def send_sms(self, to_phone, message, user_id=None, message_type='general'):
-        """Send SMS message"""
+        `template`/`variables` are what `message` was rendered from, for compact logging.
+        """
         if not self.is_enabled():
             logger.warning("SMS service is not enabled or configured")
             return False
 
-        # Validate phone number
-        if not self.validate_phone_number(to_phone):
-            logger.error(f"Invalid phone number: {to_phone}")
-            self.log_sms(user_id, to_phone, message_type, message, 'failed')
-            return False
-
         formatted_phone = self.format_phone_number(to_phone)
         if not formatted_phone:
-            logger.error(f"Could not format phone number: {to_phone}")
-            self.log_sms(user_id, to_phone, message_type, message, 'failed')
+            logger.error(f"Invalid phone number: {to_phone}")
+            self.log_sms(user_id, to_phone or '', message_type, message, 'failed', conn=conn)
             return False
 
-        # Log the SMS attempt
-        self.log_sms(user_id, formatted_phone, message_type, message, 'pending')
-
+        # Queue for the outbox worker; it records the final status and provider SID in sms_logs
+        own_conn = conn is None
         try:
-            # Send via Twilio
-            twilio_message = self.twilio_client.messages.create(
-                body=message,
-                from_=self.twilio_phone_number,
-                to=formatted_phone
-            )
-
-            # Update log with success
-            self.update_sms_status(twilio_message.sid, 'sent', str(twilio_message.status))
-
-            logger.info(f"SMS sent successfully to {formatted_phone}")
+            conn = conn or self._get_db()
+            enqueue_sms(conn, formatted_phone, message, message_type=message_type, user_id=user_id,
+                        template=template, variables=variables)
+            logger.info(f"SMS to {formatted_phone} queued")
             return True
-
-        except TwilioException as e:
-            logger.error(f"Twilio error sending SMS to {formatted_phone}: {str(e)}")
-            self.update_sms_status(None, 'failed', str(e))
-            return False
         except Exception as e:
-            logger.error(f"Unexpected error sending SMS to {formatted_phone}: {str(e)}")
-            self.update_sms_status(None, 'failed', str(e))
-            return False
-
-    def send_template_sms(self, user_id, template_name, variables, message_type=None):
-        """Send SMS using template"""
-        template = self.get_sms_template(template_name)
-        if not template:
-            logger.error(f"Template '{template_name}' not found")
-            return False
-
-        # Add user name to variables if not present
-        if 'name' not in variables:
-            try:
-                conn = self.app.get_db()
-                c = conn.cursor()
-                c.execute('SELECT name FROM users WHERE id = ?', (user_id,))
-                user = c.fetchone()
+            # e.g. a PostgreSQL database without the outbox tables
+            logger.error(f"Error queueing SMS to {formatted_phone}, sending inline: {str(e)}")
+        finally:
+            if own_conn and conn is not None:
+                conn.close()
+        return self._send_inline(formatted_phone, message, user_id, message_type)
+
+    def _send_inline(self, phone, message, user_id, message_type):
+        """Send right away when the outbox can't be written, logging it as the worker would"""
+        log_id = self.log_sms(user_id, phone, message_type, message)
+        result = send_inline(phone, message)
+        if result['ok']:
+            self.update_sms_status(log_id, 'sent', result.get('status'), result.get('message_id'))
+            logger.info(f"SMS sent inline to {phone}")
+        else:
+            self.update_sms_status(log_id, 'failed', result.get('error'))
+            logger.error(f"Error sending SMS to {phone}: {result.get('error')}")
+        return result['ok']
+
+    def send_template_sms(self, user_id, template_name, variables, message_type=None, context=None, conn=None):
+        """Send SMS using template.
+
+        One context query (template, user name, settings) plus one insert into the outbox,
+        all on a single connection. Pass `context` from get_send_context to skip the query.
+        """
+        own_conn = conn is None
+        conn = conn or self._get_db()
+        try:
+            if context is None:
+                context = self.get_send_context(user_id, template_name, conn=conn)
+            if not context or not context.get('template_content'):
+                logger.error(f"Template '{template_name}' not found")
+                return False
+
+            # Add user name to variables if not present
+            if 'name' not in variables and context.get('user_name'):
+                variables['name'] = context['user_name']
+
+            message = self.render_template(context['template_content'], variables)
+
+            if not message_type:
+                message_type = template_name
+
+            # SMS settings phone first; appointment contexts fall back to the booking phone
+            phone = context.get('settings_phone') or context.get('patient_phone')
+            if not phone:
+                logger.error(f"No phone number configured for user {user_id}")
+                return False
+
+            return self.send_sms(phone, message, context.get('user_id') or user_id, message_type, conn=conn,
+                                 template=context['template_content'], variables=variables)
+        finally:
+            if own_conn:
                 conn.close()
-                if user:
-                    variables['name'] = user['name']
-            except Exception as e:
-                logger.error(f"Error getting user name for SMS template: {str(e)}")
-
-        message = self.render_template(template, variables)
-
-        if not message_type:
-            message_type = template_name
-
-        # Get user's phone number from SMS settings
-        settings = self.get_user_sms_settings(user_id)
-        if not settings or not settings.get('phone_number'):
-            logger.error(f"No phone number configured for user {user_id}")
-            return False
-
-        return self.send_sms(
-            settings['phone_number'],
-            message,
-            user_id,
-            message_type
-        )
 
     def can_send_sms(self, user_id, message_type):
         """Check if user allows SMS for specific message type"""
@@ -357,105 +355,64 @@ class SMSService:
 # Global SMS service instance
 sms_service = SMSService()
 
-def send_appointment_reminder(appointment_id):
-    """Send appointment reminder SMS"""
+def _send_appointment_template(appointment_id, template_name, opt_in_field, due_within=None):
+    """Queue a templated SMS about one appointment on a single connection."""
     if not sms_service.is_enabled():
         return False
 
+    conn = sms_service._get_db()
     try:
-        conn = current_app.get_db()
-        c = conn.cursor()
-
-        # Get appointment details with user info
-        c.execute('''
-            SELECT a.*, u.name, u.id as user_id
-            FROM appointments a
-            JOIN users u ON a.user_id = u.id
-            WHERE a.id = ?
-        ''', (appointment_id,))
-
-        appointment = c.fetchone()
-        conn.close()
-
-        if not appointment:
+        # Appointment, user, settings and template in one query
+        context = sms_service.get_send_context(template_name=template_name,
+                                               appointment_id=appointment_id, conn=conn)
+        if not context:
             logger.error(f"Appointment {appointment_id} not found")
             return False
 
-        appointment = dict(appointment)
-
-        # Check if reminder should be sent (24 hours before appointment)
-        appointment_datetime = datetime.strptime(
-            f"{appointment['appointment_date']} {appointment['appointment_time']}",
-            '%Y-%m-%d %H:%M'
-        )
-
-        if appointment_datetime - datetime.now() > timedelta(hours=24):
-            logger.info(f"Appointment reminder for {appointment_id} not yet due")
+        if context.get(opt_in_field) == 0:
+            logger.info(f"User {context['user_id']} opted out of {template_name} messages")
             return False
 
-        # Send reminder SMS
+        if due_within is not None:
+            appointment_datetime = datetime.strptime(
+                f"{context['appointment_date']} {normalize_slot_time(context['appointment_time'])}",
+                '%Y-%m-%d %H:%M'
+            )
+            if appointment_datetime - datetime.now() > due_within:
+                logger.info(f"Appointment reminder for {appointment_id} not yet due")
+                return False
+
         variables = {
-            'name': appointment['name'],
-            'service': appointment['service'],
-            'date': appointment['appointment_date'],
-            'time': appointment['appointment_time']
+            'name': context['user_name'],
+            'service': context['service'],
+            'date': context['appointment_date'],
+            'time': context['appointment_time']
         }
 
         return sms_service.send_template_sms(
-            appointment['user_id'],
-            'appointment_reminder',
+            context['user_id'],
+            template_name,
             variables,
-            'appointment_reminder'
+            template_name,
+            context=context,
+            conn=conn
         )
 
     except Exception as e:
-        logger.error(f"Error sending appointment reminder: {str(e)}")
+        logger.error(f"Error sending {template_name} for appointment {appointment_id}: {str(e)}")
         return False
-
-def send_appointment_confirmation(appointment_id):
-    """Send appointment confirmation SMS"""
-    if not sms_service.is_enabled():
-        return False
-
-    try:
-        conn = current_app.get_db()
-        c = conn.cursor()
-
-        # Get appointment details with user info
-        c.execute('''
-            SELECT a.*, u.name, u.id as user_id
-            FROM appointments a
-            JOIN users u ON a.user_id = u.id
-            WHERE a.id = ?
-        ''', (appointment_id,))
-
-        appointment = c.fetchone()
+    finally:
         conn.close()
 
-        if not appointment:
-            logger.error(f"Appointment {appointment_id} not found")
-            return False
-
-        appointment = dict(appointment)
-
-        # Send confirmation SMS
-        variables = {
-            'name': appointment['name'],
-            'service': appointment['service'],
-            'date': appointment['appointment_date'],
-            'time': appointment['appointment_time']
-        }
-
-        return sms_service.send_template_sms(
-            appointment['user_id'],
-            'appointment_confirmation',
-            variables,
-            'appointment_confirmation'
-        )
+def send_appointment_reminder(appointment_id):
+    """Send appointment reminder SMS (only within 24 hours of the appointment)"""
+    return _send_appointment_template(appointment_id, 'appointment_reminder',
+                                      'appointment_reminders', due_within=timedelta(hours=24))
 
-    except Exception as e:
-        logger.error(f"Error sending appointment confirmation: {str(e)}")
-        return False
+def send_appointment_confirmation(appointment_id):
+    """Send appointment confirmation SMS"""
+    return _send_appointment_template(appointment_id, 'appointment_confirmation',
+                                      'appointment_confirmations')
 
 def send_verification_code(phone_number, code, user_id=None):
     """Send verification code via SMS"""
@@ -0,0 +1,272 @@
+"""
+Buffered delivery receipts from Twilio status callbacks.
+
+Twilio calls `/sms/status` once per status change of every message, so a reminder
+batch of a few thousand messages produces several thousand callbacks within minutes.
+Instead of one UPDATE + commit per callback, receipts go into a buffer and are written
+to `sms_logs` in batches: one executemany over `provider_message_id` (indexed) inside a
+single transaction per flush.
+
+A flush happens when the buffer reaches STATUS_FLUSH_SIZE receipts, or at the latest
+STATUS_FLUSH_INTERVAL seconds after the first buffered receipt (a daemon thread per
+process handles the quiet case). Within a batch only the furthest status per SID is
+kept, and the UPDATE never moves a row back from a final state, so late or
+out-of-order callbacks ('sent' arriving after 'delivered') are harmless.
+
+With SMS_STATUS_BUFFER=redis the receipts are pushed to a Redis list instead of
+process memory, so they survive a worker restart and any web worker can drain them;
+the drain (LRANGE + LTRIM) runs in one MULTI so two workers never apply the same
+receipt twice.
+
+The outbox worker records a message's SID only when its whole batch is written back, so
+a fast 'sent' or 'delivered' callback can arrive before any sms_logs row carries the SID.
+Such receipts are kept in process and retried with every flush for STATUS_RETRY_SECS
+before they are given up.
+
+Environment variables used:
+ - SMS_STATUS_BUFFER ('memory' (default) or 'redis')
+ - STATUS_FLUSH_SIZE (receipts per batch, default 200)
+ - STATUS_FLUSH_INTERVAL (max seconds a receipt waits, default 2)
+ - STATUS_RETRY_SECS (how long a receipt for a SID not yet in sms_logs is retried, default 120)
+ - REDIS_URL (when SMS_STATUS_BUFFER=redis; via utils.redis_client)
+"""
+from __future__ import annotations
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+SMS_STATUS_BUFFER = os.getenv("SMS_STATUS_BUFFER", "memory").lower()
+STATUS_FLUSH_SIZE = int(os.getenv("STATUS_FLUSH_SIZE", "200"))
+STATUS_FLUSH_INTERVAL = float(os.getenv("STATUS_FLUSH_INTERVAL", "2"))
+STATUS_RETRY_SECS = float(os.getenv("STATUS_RETRY_SECS", "120"))
+REDIS_KEY = "sms:status_updates"
+
+# Twilio MessageStatus -> sms_logs.status, with how far along the lifecycle it is
+_STATUS_MAP = {
+    'accepted': ('sent', 1), 'scheduled': ('sent', 1), 'queued': ('sent', 1),
+    'sending': ('sent', 2), 'sent': ('sent', 3),
+    'delivered': ('delivered', 4), 'read': ('delivered', 4),
+    'undelivered': ('failed', 5), 'failed': ('failed', 5), 'canceled': ('failed', 5),
+}
+FINAL_STATUSES = ('delivered', 'failed')
+
+
+def map_status(provider_status: Optional[str]) -> Optional[Tuple[str, int]]:
+    """(sms_logs status, rank) for a Twilio MessageStatus, or None if unknown."""
+    return _STATUS_MAP.get((provider_status or '').lower())
+
+
+def coalesce_receipts(receipts: List[dict]) -> Dict[str, dict]:
+    """Keep the most advanced receipt per SID (later arrival wins on ties)."""
+    latest: Dict[str, dict] = {}
+    for receipt in receipts:
+        mapped = map_status(receipt.get('status'))
+        sid = receipt.get('sid')
+        if not sid or mapped is None:
+            continue
+        current = latest.get(sid)
+        if current is None or mapped[1] >= current['rank']:
+            latest[sid] = {'sid': sid, 'status': mapped[0], 'rank': mapped[1],
+                           'provider_status': receipt.get('status'),
+                           'error_code': receipt.get('error_code'),
+                           'retry_until': receipt.get('retry_until')}
+    return latest
+
+
+def _known_sids(c, sids: List[str]) -> set:
+    known = set()
+    for start in range(0, len(sids), 500):
+        chunk = sids[start:start + 500]
+        c.execute(f'''
+            SELECT provider_message_id FROM sms_logs
+            WHERE provider_message_id IN ({', '.join('?' for _ in chunk)})
+        ''', chunk)
+        known.update(row[0] for row in c.fetchall())
+    return known
+
+
+def apply_receipts(conn, receipts: List[dict], unmatched: Optional[List[dict]] = None) -> int:
+    """Write a batch of receipts to sms_logs in one transaction; returns rows updated.
+
+    Receipts whose SID is in no sms_logs row yet are appended to `unmatched`, if given.
+    """
+    latest = coalesce_receipts(receipts)
+    if not latest:
+        return 0
+    params = []
+    for r in latest.values():
+        response = r['provider_status'] if not r['error_code'] else f"{r['provider_status']} ({r['error_code']})"
+        params.append((r['status'], response, r['status'], r['sid'], r['status']))
+    c = conn.cursor()
+    try:
+        # a final state is only replaced by another final state, never by 'sent'
+        c.executemany('''
+            UPDATE sms_logs
+            SET status = ?,
+                provider_response = ?,
+                sent_at = CASE WHEN sent_at IS NULL AND ? <> 'failed' THEN CURRENT_TIMESTAMP ELSE sent_at END
+            WHERE provider_message_id = ?
+              AND (status NOT IN ('delivered', 'failed') OR ? IN ('delivered', 'failed'))
+        ''', params)
+        updated = c.rowcount
+        if unmatched is not None:
+            known = _known_sids(c, list(latest))
+            unmatched.extend({'sid': r['sid'], 'status': r['provider_status'], 'error_code': r['error_code'],
+                              'retry_until': r['retry_until']}
+                             for r in latest.values() if r['sid'] not in known)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return updated
+
+
+class StatusBuffer:
+    """Collects receipts and flushes them to the database in batches."""
+
+    def __init__(self, get_db: Callable, backend: Optional[str] = None,
+                 flush_size: Optional[int] = None, flush_interval: Optional[float] = None,
+                 client=None):
+        self.get_db = get_db
+        self.backend = (backend or SMS_STATUS_BUFFER)
+        self.flush_size = flush_size or STATUS_FLUSH_SIZE
+        self.flush_interval = STATUS_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._redis = client
+        self._items: List[dict] = []
+        # receipts whose SID wasn't in sms_logs yet, retried with every flush
+        self._deferred: List[dict] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._oldest: Optional[float] = None
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        if self.backend == 'redis' and self._redis is None:
+            # the shared lazy pool; nothing connects until the first receipt arrives
+            self._redis = redis_client.get_client()
+
+    def add(self, sid: str, status: str, error_code: Optional[str] = None) -> None:
+        receipt = {'sid': sid, 'status': status, 'error_code': error_code or None}
+        if self.backend == 'redis':
+            pending = self._redis.rpush(REDIS_KEY, json.dumps(receipt))
+        else:
+            with self._lock:
+                self._items.append(receipt)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                pending = len(self._items)
+        if pending >= self.flush_size:
+            self.flush()
+        else:
+            self._ensure_flusher()
+            self._wake.set()
+
+    def _drain(self) -> List[dict]:
+        if self.backend == 'redis':
+            pipe = self._redis.pipeline(transaction=True)
+            pipe.lrange(REDIS_KEY, 0, self.flush_size - 1)
+            pipe.ltrim(REDIS_KEY, self.flush_size, -1)
+            raw, _ = pipe.execute()
+            return [json.loads(item) for item in raw]
+        with self._lock:
+            items, self._items = self._items, []
+            self._oldest = None
+        return items
+
+    def _defer(self, receipts: List[dict]) -> None:
+        now = time.time()
+        keep = []
+        for receipt in receipts:
+            until = receipt.get('retry_until') or now + STATUS_RETRY_SECS
+            if until > now:
+                keep.append(dict(receipt, retry_until=until))
+            else:
+                logger.warning(f"Dropping SMS status receipt for unknown SID {receipt['sid']}")
+        if keep:
+            with self._lock:
+                self._deferred.extend(keep)
+            self._ensure_flusher()
+            self._wake.set()
+
+    def _take_deferred(self) -> List[dict]:
+        with self._lock:
+            deferred, self._deferred = self._deferred, []
+        return deferred
+
+    def pending(self) -> int:
+        if self.backend == 'redis':
+            return int(self._redis.llen(REDIS_KEY))
+        with self._lock:
+            return len(self._items)
+
+    def flush(self) -> int:
+        """Apply everything buffered so far (and retry deferred receipts); returns rows updated."""
+        written = 0
+        with self._flush_lock:
+            retry = self._take_deferred()
+            while True:
+                fresh = self._drain()
+                batch, retry = retry + fresh, []
+                if not batch:
+                    return written
+                unmatched: List[dict] = []
+                conn = self.get_db()
+                try:
+                    written += apply_receipts(conn, batch, unmatched)
+                    self._defer(unmatched)
+                except Exception as e:
+                    logger.error(f"Failed to apply {len(batch)} SMS status receipts: {e}")
+                    if self.backend != 'redis':
+                        # keep them for the next flush rather than dropping receipts
+                        with self._lock:
+                            self._items = batch + self._items
+                            self._oldest = self._oldest or time.monotonic()
+                    else:
+                        self._redis.lpush(REDIS_KEY, *[json.dumps(r) for r in reversed(batch)])
+                    return written
+                finally:
+                    conn.close()
+                if self.backend != 'redis' or len(fresh) < self.flush_size:
+                    return written
+
+    def _ensure_flusher(self) -> None:
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='sms-status-flush', daemon=True)
+            self._thread_pid = pid
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            # deferred receipts get retried every interval even when nothing new arrives
+            self._wake.wait(self.flush_interval if self._deferred else None)
+            time.sleep(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"SMS status flush failed: {e}")
+
+
+_buffer: Optional[StatusBuffer] = None
+
+
+def get_status_buffer(get_db: Callable) -> StatusBuffer:
+    """The process-wide buffer used by the webhook."""
+    global _buffer
+    if _buffer is None:
+        _buffer = StatusBuffer(get_db)
+        atexit.register(_buffer.flush)
+    return _buffer
@@ -1,20 +1,22 @@
 import json
 import os
-from typing import Dict
+from typing import Dict, List
 
-TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'sms_templates.json')
+from utils import template_store
+from utils.sms_encoding import UCS2, analyze, describe, optimize
 
+TEMPLATES_PATH = template_store.JSON_TEMPLATES_PATH
 
-def _load_raw() -> Dict:
-    try:
-        with open(TEMPLATES_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+# Placeholders the appointment notification sender fills in (routes_appointments)
+TEMPLATE_VARIABLES = ('appointment_date', 'appointment_time', 'new_date', 'new_time')
+# Typical values, used to estimate the length of a rendered message
+SAMPLE_CONTEXT = {'appointment_date': '2025-12-31', 'appointment_time': '10:30 AM',
+                  'new_date': '2025-12-31', 'new_time': '10:30 AM'}
 
 
 def get_templates() -> Dict[str, Dict[str, str]]:
-    return _load_raw()
+    # cached by file mtime in utils.template_store; a copy, so callers may edit it
+    return template_store.json_templates_copy()
 
 
 def save_templates(templates: Dict[str, Dict[str, str]]) -> None:
@@ -23,3 +25,27 @@ def save_templates(templates: Dict[str, Dict[str, str]]) -> None:
     with open(tmp, 'w', encoding='utf-8') as f:
         json.dump(templates, f, indent=2, ensure_ascii=False)
     os.replace(tmp, TEMPLATES_PATH)
+    template_store.invalidate()
+
+
+def segment_summary(body: str) -> str:
+    """Encoding and segment estimate of `body` rendered with SAMPLE_CONTEXT."""
+    return describe(analyze(template_store.render(body, SAMPLE_CONTEXT)))
+
+
+def segment_warnings(body: str) -> List[str]:
+    """What the editor should point out about the cost of `body` once rendered."""
+    rendered = template_store.render(body, SAMPLE_CONTEXT)
+    info = analyze(rendered)
+    _, sent = optimize(rendered)
+    warnings = []
+    if info.encoding == UCS2:
+        chars = ' '.join(info.non_gsm)
+        if sent.encoding == UCS2:
+            warnings.append(f"{chars} can't be sent in GSM-7, so every segment holds only "
+                            f"{sent.per_segment} characters.")
+        else:
+            warnings.append(f"{chars} will be replaced when sending to keep the message in GSM-7.")
+    if sent.segments > 1:
+        warnings.append(f"About {sent.units} characters once filled in: billed as {sent.segments} SMS.")
+    return warnings
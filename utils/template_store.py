@@ -0,0 +1,217 @@
+"""
+One cached, precompiled store for SMS templates.
+
+Templates come from two places: the `sms_templates` table (reminders, confirmations,
+campaigns, verification codes) and data/sms_templates.json (the appointment notices
+edited at /admin/sms_templates). Both are cached in process:
+ - the JSON file is re-read only when its mtime changes (one os.stat per lookup);
+ - the table is re-read when its version (a one-row aggregate fingerprint) changes,
+   checked at most every TEMPLATE_CACHE_TTL seconds. Writers in this process call
+   `invalidate()` so their own edits show up at once.
+
+Every template body is compiled once into a list of literal and variable segments.
+`{{name}}` and `{{ name }}` are the same placeholder. Rendering is then a single join.
+`missing()` reports the variables a context doesn't supply. With strict=True, `render`
+raises MissingVariablesError; otherwise unknown placeholders are left as written, as
+the old str.replace loop did. `render_many` renders one template for a batch of contexts.
+
+Usage:
+  from utils import template_store
+  tpl = template_store.get_db_template(get_db, 'appointment_reminder')
+  tpl.render({'name': 'Ana', 'date': '2025-01-02', 'time': '9:00'})
+  template_store.compile_template(body).render_many(rows)
+
+Environment variables used:
+ - TEMPLATE_CACHE_TTL (seconds between sms_templates version checks, default 30)
+"""
+from __future__ import annotations
+import copy
+import json
+import logging
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+TEMPLATE_CACHE_TTL = float(os.getenv("TEMPLATE_CACHE_TTL", "30"))
+JSON_TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'sms_templates.json')
+
+# Default reminder text; stays one GSM-7 SMS with typical names and service names filled in
+DEFAULT_REMINDER_TEMPLATE = ('Hi {{name}}! Reminder: {{service}} on {{date}} at {{time}}. '
+                             'Please arrive 15 min early. To reschedule, call 0953 7207 342.')
+OLD_DEFAULT_REMINDER_TEMPLATE = ('Hi {{name}}! Reminder: You have an appointment scheduled for {{service}} on '
+                                 '{{date}} at {{time}}. Please arrive 15 minutes early. Contact us at '
+                                 '0953 7207 342 if you need to reschedule.')
+
+_PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+logger = logging.getLogger(__name__)
+
+
+class MissingVariablesError(KeyError):
+    """A strict render found placeholders the context doesn't supply."""
+
+    def __init__(self, missing: Iterable[str]):
+        self.missing = sorted(missing)
+        super().__init__(f"missing template variables: {', '.join(self.missing)}")
+
+
+class CompiledTemplate:
+    """A template body split once into literal text and variable names.
+
+    `segments` alternates literal, variable, literal, ... (always odd length).
+    """
+    __slots__ = ('source', 'segments', 'variables')
+
+    def __init__(self, source: str):
+        self.source = source or ''
+        parts = _PLACEHOLDER.split(self.source)
+        self.segments: Tuple[str, ...] = tuple(parts)
+        self.variables: Tuple[str, ...] = tuple(dict.fromkeys(parts[1::2]))
+
+    def missing(self, context: Mapping) -> Set[str]:
+        return {name for name in self.variables if context.get(name) is None}
+
+    def render(self, context: Mapping, strict: bool = False) -> str:
+        segments = self.segments
+        if len(segments) == 1:
+            return segments[0]
+        if strict:
+            missing = self.missing(context)
+            if missing:
+                raise MissingVariablesError(missing)
+        out = list(segments)
+        for i in range(1, len(out), 2):
+            value = context.get(out[i])
+            out[i] = '{{' + out[i] + '}}' if value is None else str(value)
+        return ''.join(out)
+
+    def render_many(self, contexts: Iterable[Mapping], strict: bool = False) -> List[str]:
+        return [self.render(context, strict) for context in contexts]
+
+    def __repr__(self):
+        return f"CompiledTemplate({self.source[:40]!r})"
+
+
+@lru_cache(maxsize=512)
+def compile_template(source: str) -> CompiledTemplate:
+    """Compiled form of `source`; identical bodies share one compiled template."""
+    return CompiledTemplate(source)
+
+
+def render(source: str, context: Mapping, strict: bool = False) -> str:
+    return compile_template(source or '').render(context, strict)
+
+
+def unknown_variables(source: str, allowed: Iterable[str]) -> List[str]:
+    """Placeholders in `source` that aren't in `allowed` (for editor validation)."""
+    allowed = set(allowed)
+    return [name for name in compile_template(source or '').variables if name not in allowed]
+
+
+# JSON templates (data/sms_templates.json)
+
+_json_lock = threading.Lock()
+_json_cache: Tuple[Optional[float], Dict[str, Dict[str, str]]] = (None, {})
+
+
+def _json_mtime() -> Optional[float]:
+    try:
+        return os.stat(JSON_TEMPLATES_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def json_templates() -> Dict[str, Dict[str, str]]:
+    """The parsed JSON templates, shared and read-only; reloaded when the file changes."""
+    global _json_cache
+    mtime = _json_mtime()
+    cached_mtime, templates = _json_cache
+    if mtime == cached_mtime:
+        return templates
+    with _json_lock:
+        if _json_cache[0] != mtime:
+            try:
+                with open(JSON_TEMPLATES_PATH, 'r', encoding='utf-8') as f:
+                    templates = json.load(f)
+            except FileNotFoundError:
+                templates = {}
+            _json_cache = (mtime, templates)
+        return _json_cache[1]
+
+
+def json_templates_copy() -> Dict[str, Dict[str, str]]:
+    """A private copy callers may modify (e.g. before save_templates)."""
+    return copy.deepcopy(json_templates())
+
+
+def get_json_template(key: str) -> Optional[CompiledTemplate]:
+    tpl = json_templates().get(key)
+    return compile_template(tpl.get('body', '')) if tpl else None
+
+
+# DB templates (sms_templates table)
+
+_db_lock = threading.Lock()
+_db_templates: Dict[str, Tuple[CompiledTemplate, Optional[str]]] = {}
+_db_version: Optional[tuple] = None
+_db_checked_at = 0.0
+
+
+def invalidate() -> None:
+    """Drop both caches; the next lookup reloads."""
+    global _json_cache, _db_version, _db_checked_at
+    with _json_lock:
+        _json_cache = (None, {})
+    with _db_lock:
+        _db_version = None
+        _db_checked_at = 0.0
+
+
+def _load_db(conn) -> None:
+    global _db_templates, _db_version, _db_checked_at
+    c = conn.cursor()
+    # cheap fingerprint of a table of a few rows; edits rarely touch updated_at, hence the sums
+    c.execute('''
+        SELECT COUNT(*), MAX(id), MAX(updated_at), SUM(is_active), SUM(LENGTH(template_content))
+        FROM sms_templates
+    ''')
+    version = tuple(c.fetchone())
+    if version != _db_version:
+        c.execute('SELECT template_name, template_content, message_type FROM sms_templates WHERE is_active = 1')
+        _db_templates = {row[0]: (compile_template(row[1] or ''), row[2]) for row in c.fetchall()}
+        _db_version = version
+    _db_checked_at = time.monotonic()
+
+
+def db_templates(db: Callable | object) -> Dict[str, Tuple[CompiledTemplate, Optional[str]]]:
+    """Active DB templates as {name: (compiled, message_type)}.
+
+    `db` is either an open connection or a zero-argument factory (app.get_db); the
+    factory is only called when the version check is due.
+    """
+    if _db_version is not None and time.monotonic() - _db_checked_at < TEMPLATE_CACHE_TTL:
+        return _db_templates
+    with _db_lock:
+        if _db_version is None or time.monotonic() - _db_checked_at >= TEMPLATE_CACHE_TTL:
+            # sqlite3 connections are callable too, so tell them apart by .cursor
+            if hasattr(db, 'cursor'):
+                _load_db(db)
+            else:
+                conn = db()
+                try:
+                    _load_db(conn)
+                finally:
+                    conn.close()
+        return _db_templates
+
+
+def get_db_template(db, name: str) -> Optional[CompiledTemplate]:
+    try:
+        entry = db_templates(db).get(name)
+    except Exception as e:
+        logger.error(f"Error loading SMS templates: {e}")
+        return None
+    return entry[0] if entry else None
@@ -0,0 +1,101 @@
+"""
+Shared Twilio transport: one pooled client per process.
+
+`get_twilio_client()` builds the Twilio `Client` lazily on first use and caches it per
+process id. Gunicorn forks workers after importing the app, so a client (and its
+keep-alive sockets) created in the master is never reused in a child: the cache is
+dropped after fork and rebuilt on the child's first send. The client's `requests`
+session is pooled, so consecutive sends reuse the TLS connection.
+
+Environment variables used:
+ - TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN
+ - TWILIO_HTTP_TIMEOUT (seconds per provider request, default 10)
+ - TWILIO_POOL_SIZE (pooled connections per process for the sync client, default 10)
+ - TWILIO_API_BASE_URL (optional; send every Twilio API call to this base URL instead,
+   e.g. http://127.0.0.1:8099 for scripts/fake_sms_server.py)
+"""
+from __future__ import annotations
+import os
+import threading
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+TWILIO_HTTP_TIMEOUT = float(os.getenv("TWILIO_HTTP_TIMEOUT", "10"))
+TWILIO_POOL_SIZE = int(os.getenv("TWILIO_POOL_SIZE", "10"))
+TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL", "").rstrip("/")
+
+_lock = threading.Lock()
+_client: Optional[Client] = None
+_client_pid: Optional[int] = None
+
+
+class ProviderHTTPError(Exception):
+    """Non-2xx answer from the provider; `status` lets the outbox classify it."""
+
+    def __init__(self, status: int, message: str = ''):
+        super().__init__(message or f'HTTP {status}')
+        self.status = status
+
+
+class _RedirectingHttpClient(TwilioHttpClient):
+    """Sends requests for *.twilio.com hosts to TWILIO_API_BASE_URL (local fakes)."""
+
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname and parts.hostname.endswith("twilio.com"):
+            url = self.base_url + parts.path + (f"?{parts.query}" if parts.query else "")
+        return super().request(method, url, *args, **kwargs)
+
+
+def _credentials() -> Tuple[Optional[str], Optional[str]]:
+    return os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN")
+
+
+def is_configured() -> bool:
+    sid, token = _credentials()
+    return bool(sid and token)
+
+
+def get_twilio_client() -> Optional[Client]:
+    """The process-wide Twilio client, or None when credentials aren't set."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            sid, token = _credentials()
+            if not (sid and token):
+                return None
+            if TWILIO_API_BASE_URL:
+                http_client = _RedirectingHttpClient(TWILIO_API_BASE_URL, pool_connections=True,
+                                                     timeout=TWILIO_HTTP_TIMEOUT)
+            else:
+                http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_HTTP_TIMEOUT)
+            # size the keep-alive pool for the outbox worker's sender threads
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TWILIO_POOL_SIZE)
+            http_client.session.mount("https://", adapter)
+            http_client.session.mount("http://", adapter)
+            _client = Client(sid, token, http_client=http_client)
+            _client_pid = pid
+    return _client
+
+
+def reset_twilio_client() -> None:
+    """Drop the cached client (after fork, or when credentials change)."""
+    global _client, _client_pid
+    _client = None
+    _client_pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_twilio_client)
+
@@ -0,0 +1,254 @@
+"""
+Series booking for multi-visit vaccination courses (e.g. rabies PEP day 0/3/7/14/28).
+
+Given an existing day-0 appointment and the `vaccine_schedules` rows for a vaccine,
+`plan_series` computes every follow-up visit from `days_after_previous_dose` and checks
+slot availability against one pre-fetched count map. `book_series` then inserts all
+follow-ups in a single transaction so a course either books completely or not at all,
+and a unique index on (series_parent_id, appointment_date) keeps two concurrent requests
+from booking the same course twice.
+
+Usage:
+  from utils.vaccine_series import book_series, SeriesBookingError
+  day0, visits = book_series(conn, appointment_id, 'Anti-Rabies Vaccine')
+"""
+from __future__ import annotations
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from utils.booking_slots import (
+    SLOT_CAPACITY,
+    fetch_slot_counts,
+    has_capacity,
+    normalize_slot_time,
+    parse_date,
+    slot_times_for,
+)
+
+logger = logging.getLogger(__name__)
+
+# How many days a dose may be pushed back when its target day is closed or full.
+MAX_SHIFT_DAYS = 2
+
+SERIES_INDEX = 'idx_appointments_series_visit'
+
+
+class SeriesBookingError(Exception):
+    """Raised when a vaccination series can't be planned or booked."""
+
+
+def load_series_schedule(c, vaccine_name: str) -> List[dict]:
+    """Return the schedule rows for `vaccine_name` ordered by dose number."""
+    c.execute('''
+        SELECT id, vaccine_name, dose_number, days_after_previous_dose
+        FROM vaccine_schedules
+        WHERE vaccine_name = ? AND is_booster = 0
+        ORDER BY dose_number
+    ''', (vaccine_name,))
+    return [dict(row) for row in c.fetchall()]
+
+
+def list_series_vaccines(c) -> List[str]:
+    """Vaccines that have more than one scheduled dose (candidates for series booking)."""
+    c.execute('''
+        SELECT vaccine_name
+        FROM vaccine_schedules
+        WHERE is_booster = 0
+        GROUP BY vaccine_name
+        HAVING COUNT(*) > 1
+        ORDER BY vaccine_name
+    ''')
+    return [row[0] for row in c.fetchall()]
+
+
+def _follow_up_doses(schedule: List[dict]) -> List[dict]:
+    # The first dose is the day-0 appointment itself; later doses need an interval.
+    return [s for s in schedule[1:] if s.get('days_after_previous_dose') not in (None, '')]
+
+
+def series_window(day0_date, schedule: List[dict]) -> Tuple[str, str]:
+    """Date range that covers every follow-up target plus the allowed shift."""
+    first = parse_date(day0_date)
+    total = sum(int(s['days_after_previous_dose']) for s in _follow_up_doses(schedule))
+    last = first + timedelta(days=total + MAX_SHIFT_DAYS * len(schedule))
+    return first.isoformat(), last.isoformat()
+
+
+def _minutes_apart(slot_time: str, preferred_time: Optional[str]) -> int:
+    if not preferred_time:
+        return 0
+    sh, sm = (int(p) for p in slot_time.split(':'))
+    ph, pm = (int(p) for p in preferred_time.split(':'))
+    return abs((sh * 60 + sm) - (ph * 60 + pm))
+
+
+def plan_series(day0_date, day0_time, schedule: List[dict],
+                slot_counts: Dict[Tuple[str, str], int],
+                capacity: Optional[int] = None) -> List[dict]:
+    """Compute follow-up visits for a series starting at `day0_date`/`day0_time`.
+
+    Each dose is placed `days_after_previous_dose` days after the previous planned visit,
+    keeping the day-0 time when possible. If that slot is closed or full the closest open
+    slot on the same day is used, then the following days up to `MAX_SHIFT_DAYS`.
+    `slot_counts` is updated in place so doses in the same series never overbook a slot.
+    Raises SeriesBookingError when a dose can't be placed.
+    """
+    doses = _follow_up_doses(schedule)
+    if not doses:
+        raise SeriesBookingError('No follow-up doses are scheduled for this vaccine.')
+
+    capacity = SLOT_CAPACITY if capacity is None else capacity
+    preferred_time = normalize_slot_time(day0_time)
+    previous = parse_date(day0_date)
+    visits = []
+    for dose in doses:
+        target = previous + timedelta(days=int(dose['days_after_previous_dose']))
+        placed = None
+        for shift in range(MAX_SHIFT_DAYS + 1):
+            day = target + timedelta(days=shift)
+            # try the patient's usual time first, then the slots closest to it
+            times = sorted(slot_times_for(day), key=lambda t: _minutes_apart(t, preferred_time))
+            for slot_time in times:
+                if has_capacity(slot_counts, day, slot_time, capacity):
+                    placed = (day, slot_time, shift)
+                    break
+            if placed:
+                break
+        if not placed:
+            raise SeriesBookingError(
+                f"No open slot for dose {dose['dose_number']} within {MAX_SHIFT_DAYS} days of {target.isoformat()}."
+            )
+
+        day, slot_time, shift = placed
+        key = (day.isoformat(), slot_time)
+        slot_counts[key] = slot_counts.get(key, 0) + 1
+        visits.append({
+            'schedule_id': dose['id'],
+            'dose_number': dose['dose_number'],
+            'target_date': target.isoformat(),
+            'appointment_date': day.isoformat(),
+            'appointment_time': slot_time,
+            'shifted': shift > 0 or slot_time != preferred_time,
+        })
+        previous = day
+    return visits
+
+
+def _ensure_series_column(conn, c) -> None:
+    # Follow-up visits point back at their day-0 appointment (backfill safe, like animal_etc_text).
+    try:
+        c.execute("PRAGMA table_info(appointments)")
+        cols = [r[1] for r in c.fetchall()]
+        c.execute("PRAGMA index_list(appointments)")
+        indexes = [r[1] for r in c.fetchall()]
+    except Exception:
+        cols, indexes = [], []
+    if cols and 'series_parent_id' not in cols:
+        c.execute("ALTER TABLE appointments ADD COLUMN series_parent_id INTEGER")
+        conn.commit()
+    if cols and SERIES_INDEX not in indexes:
+        # One visit per series per day: a second, concurrent booking of the same series
+        # plans the same dates and fails on insert instead of duplicating the course.
+        try:
+            c.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {SERIES_INDEX} "
+                      "ON appointments (series_parent_id, appointment_date)")
+            conn.commit()
+        except Exception as e:
+            # existing duplicate follow-ups; bookings still work, just without the guarantee
+            conn.rollback()
+            logger.error(f"Could not create {SERIES_INDEX}: {e}")
+
+
+def book_series(conn, appointment_id: int, vaccine_name: str) -> Tuple[dict, List[dict]]:
+    """Plan and insert every follow-up visit for `appointment_id` in one transaction.
+
+    Returns `(day0_appointment, visits)` where each visit carries its new appointment id.
+    Nothing is written if any dose can't be placed. The duplicate check below is only a
+    fast path; the unique (series_parent_id, appointment_date) index makes it atomic.
+    """
+    c = conn.cursor()
+    _ensure_series_column(conn, c)
+
+    c.execute('SELECT * FROM appointments WHERE id = ?', (appointment_id,))
+    row = c.fetchone()
+    if not row:
+        raise SeriesBookingError('Appointment not found.')
+    day0 = dict(row)
+    if day0.get('status') == 'cancelled':
+        raise SeriesBookingError('Cannot book a series from a cancelled appointment.')
+
+    c.execute('SELECT COUNT(*) FROM appointments WHERE series_parent_id = ?', (appointment_id,))
+    if (c.fetchone()[0] or 0) > 0:
+        raise SeriesBookingError('Follow-up visits have already been booked for this appointment.')
+
+    schedule = load_series_schedule(c, vaccine_name)
+    if not schedule:
+        raise SeriesBookingError(f"No schedule found for '{vaccine_name}'.")
+
+    start, end = series_window(day0['appointment_date'], schedule)
+    slot_counts = fetch_slot_counts(c, start, end)
+    visits = plan_series(day0['appointment_date'], day0['appointment_time'], schedule, slot_counts)
+
+    c.execute('SELECT price FROM services WHERE name = ? AND is_active = 1', (vaccine_name,))
+    price_row = c.fetchone()
+    price = float(price_row[0]) if price_row else 0.0
+
+    now = datetime.now().isoformat()
+    rows = [(
+        day0['user_id'],
+        f"{vaccine_name} (Dose {v['dose_number']})",
+        v['appointment_date'],
+        v['appointment_time'],
+        day0.get('patient_name'),
+        day0.get('patient_address'),
+        day0.get('patient_age'),
+        day0.get('patient_gender'),
+        day0.get('patient_phone'),
+        day0.get('branch'),
+        day0.get('patient_email'),
+        price,
+        day0.get('category'),
+        appointment_id,
+        now,
+        now,
+    ) for v in visits]
+
+    try:
+        c.executemany('''
+            INSERT INTO appointments (
+                user_id, service, appointment_date, appointment_time,
+                patient_name, patient_address, patient_age, patient_gender,
+                patient_phone, branch, patient_email, price, category,
+                series_parent_id, status, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+        ''', rows)
+        c.execute('''
+            SELECT id, appointment_date, appointment_time
+            FROM appointments
+            WHERE series_parent_id = ?
+            ORDER BY appointment_date, id
+        ''', (appointment_id,))
+        ids = [r[0] for r in c.fetchall()]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # lost the race to another request booking this series (unique series index)
+        c.execute('SELECT COUNT(*) FROM appointments WHERE series_parent_id = ?', (appointment_id,))
+        if (c.fetchone()[0] or 0) > 0:
+            raise SeriesBookingError('Follow-up visits have already been booked for this appointment.')
+        raise
+
+    for visit, new_id in zip(visits, ids):
+        visit['appointment_id'] = new_id
+    return day0, visits
+
+
+def format_series_message(patient_name: Optional[str], vaccine_name: str, visits: List[dict]) -> str:
+    """Single combined confirmation listing every follow-up visit."""
+    lines = ', '.join(
+        f"Dose {v['dose_number']}: {v['appointment_date']} {v['appointment_time']}" for v in visits
+    )
+    greeting = f"Hi {patient_name}! " if patient_name else ''
+    return (f"{greeting}Your {vaccine_name} follow-up visits are booked. {lines}. "
+            f"Contact: 0953 7207 342")